@@ -1,70 +1,117 @@
 import numpy as np
-import warnings
-    
-def mean_time(t, min_threshold=0, max_threshold=1253):
+
+
+def _switched(t, min_threshold, max_threshold):
+    """Return a boolean mask of the switching events."""
+    t = np.asarray(t)
+    return np.logical_and(t > min_threshold, t < max_threshold)
+
+def _masked_mean_std(x, mask):
+    """
+    Compute the mean and the standard deviation of the elements of x
+    selected by mask along the last axis. NaNs are returned where
+    nothing is selected.
+    """
+    n = np.sum(mask, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.sum(np.where(mask, x, 0), axis=-1) / n
+        x_var = np.sum(np.where(mask, x - x_mean[..., np.newaxis], 0)**2,
+                axis=-1) / n
+    x_mean = np.where(n > 0, x_mean, np.nan)
+    x_std = np.where(n > 0, np.sqrt(x_var), np.nan)
+    if x_mean.ndim == 0:
+        return float(x_mean), float(x_std)
+    return x_mean, x_std
+
+def mean_time(t, min_threshold=0, max_threshold=1253, axis=None):
     """
     Take a switch probability result array from the PreAmp timer, and 
     compute mean switching time using the specified thresholds. Timing
-    data is assumed to be a numpy array.
-    """
-    t = t[np.logical_and(t > min_threshold, t < max_threshold)]
-    if np.size(t) > 0:
-        t_mean = np.mean(t)
-        t_std = np.std(t)
-    else:
-        t_mean = np.nan
-        t_std = np.nan
-
-    return t_mean, t_std
+    data is assumed to be a numpy array. By default the statistics are
+    computed over the whole array and floats are returned. With axis=-1
+    they are computed along the last axis, i.e. for an array of shape
+    (runs, channels, stats) arrays of shape (runs, channels) are
+    returned.
+    """
+    t = np.asarray(t, dtype=float)
+    mask = _switched(t, min_threshold, max_threshold)
+    if axis is None:
+        t, mask = t.ravel(), mask.ravel()
+    elif axis not in (-1, t.ndim - 1):
+        t = np.rollaxis(t, axis, t.ndim)
+        mask = np.rollaxis(mask, axis, t.ndim)
+    return _masked_mean_std(t, mask)
 
 def mean_time_diff(t, min_threshold=0, max_threshold=1253):
     """
     Take a switch probability result array from the PreAmp timers, and
-    compute mean switching time using the specified thresholds.
-    """
-    dt = t[0][:] - t[1][:]
-    t0_mask = np.logical_and(t[0,:] > min_threshold, t[0,:] < max_threshold)
-    t1_mask = np.logical_and(t[1,:] > min_threshold, t[1,:] < max_threshold)
-    dt = dt[np.logical_and(t0_mask, t1_mask)]
-    if np.size(dt) > 0:
-        dt_mean = np.mean(dt)
-        dt_std = np.std(dt)
-    else:
-        dt_mean = np.nan
-        dt_std = np.nan
-
-    return dt_mean, dt_std
+    compute mean switching time using the specified thresholds. The
+    channels are along the second to last axis and the stats are along
+    the last one.
+    """
+    t = np.asarray(t, dtype=float)
+    dt = t[..., 0, :] - t[..., 1, :]
+    mask = _switched(t, min_threshold, max_threshold)
+    return _masked_mean_std(dt, np.logical_and(mask[..., 0, :],
+                                               mask[..., 1, :]))
 
-def prob(t, min_threshold=0, max_threshold=1253):
+def prob(t, min_threshold=0, max_threshold=1253, axis=None):
     """
     Take a switch probability result array from the PreAmp timer, and
     compute switching probability using the specified thresholds.
+    By default the probability is computed over the whole array,
+    otherwise along the given axis.
     """
-    return float(np.size(t[np.logical_and(t > min_threshold, t < max_threshold)])) / float(np.size(t))
+    p = np.mean(_switched(t, min_threshold, max_threshold), axis=axis)
+    if p.ndim == 0:
+        return float(p)
+    return p
     
 def outcomes(t, min_threshold=0, max_threshold=1253):
     """
     Take a switch probability result array from the PreAmp timer, and
     convert to a numpy array of 0 or 1 based on the thresholds.
     """
-    def _threshold(x):
-        if x > min_threshold and x < max_threshold:
-            return 1
-        else:
-            return 0
-    
-    threshold_vectorized = np.vectorize(_threshold)
-
-    return threshold_vectorized(t)
+    return _switched(t, min_threshold, max_threshold).astype(int)
     
 def corr_coef_from_outcomes(outcomes):
     """
     Compute correrlation coefficient from an array of switching
-    outcomes.
+    outcomes. The channels are along the second to last axis and
+    the stats are along the last one. NaN is returned if any of the
+    outcomes is constant.
+    """
+    outcomes = np.asarray(outcomes, dtype=float)
+    x = outcomes[..., 0, :]
+    y = outcomes[..., 1, :]
+    dx = x - np.mean(x, axis=-1)[..., np.newaxis]
+    dy = y - np.mean(y, axis=-1)[..., np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (np.sum(dx * dy, axis=-1) /
+             np.sqrt(np.sum(dx**2, axis=-1) * np.sum(dy**2, axis=-1)))
+    if r.ndim == 0:
+        return float(r)
+    return r
+
+def joint_outcome_histogram(outcomes):
+    """
+    Count the joint outcomes of several channels. The channels are
+    along the second to last axis and the stats are along the last one.
+    The outcome of the channel k is bit k of the joint outcome index,
+    e.g. for two channels the counts are ordered as 00, 01 (only
+    channel 0 switched), 10, 11. For an array of shape (runs,
+    channels, stats) an array of shape (runs, 2**channels) is returned.
     """
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        return np.corrcoef(outcomes[0,:], outcomes[1,:])[0,1]
+    outcomes = np.asarray(outcomes, dtype=np.intp)
+    channels = outcomes.shape[-2]
+    weights = (1 << np.arange(channels, dtype=np.intp))[:, np.newaxis]
+    index = np.sum(outcomes * weights, axis=-2)
+    runs_shape = index.shape[:-1]
+    runs = int(np.prod(runs_shape))
+    offsets = (np.arange(runs, dtype=np.intp) << channels)[:, np.newaxis]
+    counts = np.bincount((index.reshape(runs, -1) + offsets).ravel(),
+                         minlength=runs << channels)
+    return counts.reshape(runs_shape + (1 << channels,))
 
 def software_demod(t, freq, Is, Qs):
     """
@@ -12,8 +12,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+import time
+import threading
+import collections
+import Queue
+import signal
 import multiprocessing as mp
 
+import numpy as np
+
 import labrad.units as units
 
 
@@ -52,4 +60,283 @@ def timeout(timeout, func, *args, **kwargs):
         raise TimeoutError('Execution of ' + str(func) + 
                 ' timed-out after ' + str(timeout) + ' sec.')
     else:
-        return q.get()
\ No newline at end of file
+        return q.get()
+
+
+def _seconds(timeout):
+    """Convert a timeout to seconds."""
+    if isinstance(timeout, units.Value):
+        return timeout['s']
+    return timeout
+
+
+class LatencyStats(object):
+    """
+    Latency statistics of timed-out calls. Only the last history
+    latencies are kept to bound the memory usage.
+    """
+    def __init__(self, history=1000):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=history)
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def add(self, latency, timed_out=False, error=False):
+        with self._lock:
+            self._latencies.append(latency)
+            self.calls += 1
+            if timed_out:
+                self.timeouts += 1
+            if error:
+                self.errors += 1
+
+    def summary(self):
+        """
+        Return a dictionary with the call, timeout and error counts
+        and the mean, median, 99th percentile and maximum latencies
+        (in seconds) of the recent calls.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies)
+            stats = {'calls': self.calls, 'timeouts': self.timeouts,
+                     'errors': self.errors}
+        if latencies.size:
+            stats.update({'mean': np.mean(latencies),
+                          'p50': np.percentile(latencies, 50),
+                          'p99': np.percentile(latencies, 99),
+                          'max': np.max(latencies)})
+        else:
+            stats.update({'mean': np.nan, 'p50': np.nan, 'p99': np.nan,
+                          'max': np.nan})
+        return stats
+
+
+class _Call(object):
+    """A function call submitted to a worker pool."""
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.abandoned = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+_current = threading.local()
+
+def cancelled():
+    """
+    Return True if the caller of the function that is currently
+    running in this worker thread has given up waiting for it. Long
+    running functions executed with ThreadTimeoutPool.call or
+    thread_timeout should poll this and return early.
+    """
+    call = getattr(_current, 'call', None)
+    return call is not None and call.abandoned.is_set()
+
+
+class ThreadTimeoutPool(object):
+    """
+    Timed-out execution of functions in a pool of reusable worker
+    threads. A call that times out cannot be killed: the worker keeps
+    running it until the function returns (see cancelled()), and
+    a new worker is started if all of the workers are busy (up to
+    max_workers).
+    """
+    def __init__(self, workers=2, max_workers=32, history=1000):
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+        self.max_workers = max_workers
+        self.stats = LatencyStats(history)
+        for k in range(workers):
+            self._spawn()
+
+    def _spawn(self):
+        self._workers += 1
+        self._idle += 1
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            if not call.abandoned.is_set():
+                _current.call = call
+                try:
+                    call.result = call.func(*call.args, **call.kwargs)
+                except Exception:
+                    call.exc_info = sys.exc_info()
+                _current.call = None
+                call.done.set()
+            with self._lock:
+                self._idle += 1
+
+    def call(self, timeout, func, *args, **kwargs):
+        """
+        Timed-out execution of a function in a worker thread.
+        
+        Inputs:
+            timeout: time in seconds.
+            func: specific function to run.
+            *args and **kwargs: input argumens of the function.
+        Output:
+            result: result of the function call, otherwise, an
+            exception is raisen.
+        """
+        timeout = _seconds(timeout)
+        call = _Call(func, args, kwargs)
+        with self._lock:
+            if self._idle <= self._queue.qsize() and \
+                    self._workers < self.max_workers:
+                self._spawn()
+        start = time.time()
+        self._queue.put(call)
+        finished = call.done.wait(timeout)
+        latency = time.time() - start
+        if not finished:
+            call.abandoned.set()
+            self.stats.add(latency, timed_out=True)
+            raise TimeoutError('Execution of ' + str(func) + 
+                    ' timed-out after ' + str(timeout) + ' sec.')
+        if call.exc_info is not None:
+            self.stats.add(latency, error=True)
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        self.stats.add(latency)
+        return call.result
+
+
+def _process_worker(conn):
+    """Execute function calls received through the pipe."""
+    # The worker is forked with the parent's signal handlers, e.g. those
+    # of a twisted reactor, which would keep terminate() from killing it.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        func, args, kwargs = msg
+        try:
+            conn.send((True, func(*args, **kwargs)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class ProcessTimeoutPool(object):
+    """
+    Timed-out execution of functions in a pool of long-lived worker
+    processes. Unlike ThreadTimeoutPool, a hung call is killed by
+    terminating its worker, which is then replaced. The function, its
+    arguments and its result should be picklable.
+    """
+    def __init__(self, workers=1, history=1000):
+        self._idle = Queue.Queue()
+        self.stats = LatencyStats(history)
+        for k in range(workers):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        conn, child_conn = mp.Pipe()
+        p = mp.Process(target=_process_worker, args=(child_conn,))
+        p.daemon = True
+        p.start()
+        return p, conn
+
+    def _respawn(self, p):
+        """Kill a worker that can no longer be trusted and replace it."""
+        p.terminate()
+        p.join()
+        self._idle.put(self._spawn())
+
+    def call(self, timeout, func, *args, **kwargs):
+        """
+        Timed-out execution of a function in a worker process. See
+        ThreadTimeoutPool.call for the description of the arguments.
+        """
+        timeout = _seconds(timeout)
+        start = time.time()
+        # The wait for an idle worker counts against the timeout.
+        try:
+            p, conn = self._idle.get(timeout=timeout)
+        except Queue.Empty:
+            self.stats.add(time.time() - start, timed_out=True)
+            raise TimeoutError('No worker available for ' + str(func) +
+                    ' within ' + str(timeout) + ' sec.')
+        remaining = None
+        if timeout is not None:
+            remaining = max(0, timeout - (time.time() - start))
+        try:
+            conn.send((func, args, kwargs))
+            finished = conn.poll(remaining)
+        except Exception:
+            self._respawn(p)
+            raise
+        latency = time.time() - start
+        if not finished:
+            self._respawn(p)
+            self.stats.add(latency, timed_out=True)
+            raise TimeoutError('Execution of ' + str(func) + 
+                    ' timed-out after ' + str(timeout) + ' sec.')
+        try:
+            ok, result = conn.recv()
+        except Exception:
+            # The worker died or sent something that cannot be
+            # unpickled; it must not be reused.
+            self._respawn(p)
+            self.stats.add(latency, error=True)
+            raise
+        self._idle.put((p, conn))
+        self.stats.add(latency, error=not ok)
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        """Stop all worker processes."""
+        while not self._idle.empty():
+            p, conn = self._idle.get()
+            conn.send(None)
+            p.join()
+
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+def thread_timeout(timeout, func, *args, **kwargs):
+    """
+    Timed-out execution of a function in a shared pool of worker
+    threads. This is much cheaper than timeout() and the result does
+    not need to be picklable, but a hung function is not killed. Use
+    ProcessTimeoutPool when that is required.
+    """
+    global _thread_pool
+    if _thread_pool is None:
+        with _thread_pool_lock:
+            if _thread_pool is None:
+                _thread_pool = ThreadTimeoutPool()
+    return _thread_pool.call(timeout, func, *args, **kwargs)
+
+
+def _noop():
+    return None
+
+
+if __name__ == '__main__':
+    # Per-call overhead benchmark.
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    pools = [('timeout', timeout),
+             ('thread_timeout', thread_timeout),
+             ('ProcessTimeoutPool', ProcessTimeoutPool().call)]
+    for name, func in pools:
+        start = time.time()
+        for k in range(n):
+            func(10, _noop)
+        elapsed = time.time() - start
+        print('%s: %d calls, %.1f us per call.'
+                %(name, n, 1e6 * elapsed / n))
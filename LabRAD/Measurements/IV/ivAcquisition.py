@@ -0,0 +1,284 @@
+"""
+Headless acquisition engine for the IV measurements.
+
+The engine owns a producer thread that reads continuous, hardware-timed
+DAQ buffers (one AC period at a time) into a preallocated ring and
+keeps a running sum of the acquired periods for averaging. The GUI
+never touches the DAQ; it only asks the engine for decimated snapshots.
+
+The DAQ is accessed through a backend object with the following
+interface:
+    start(wave, sampRate, inPort, outPort): start the AC output and
+        the triggered analog input;
+    readInto(data): fill a float64 array with the next len(data)
+        samples and return the number of samples read;
+    stop(): stop and clear the tasks;
+    overruns: number of samples lost by the backend.
+NIDAQBackend talks to the NI PCI-6221 card, FakeSampleSource generates
+samples in software and can be used without any hardware.
+"""
+
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+def genWave(amp, freq, sampRate):
+    """
+    Creates an output wave vector with one period of a cosine wave.
+    Returns wave in np.float64 array.
+    """
+    # Setting freq to 0 is just a DC output.
+    # Number of samples doesn't really matter in
+    #   that case, so just set to the sample rate.
+    if freq != 0:
+        samps = int(float(sampRate) / freq)
+    else:
+        samps = int(sampRate)
+    # Use cos such that the case of freq=0 will return DC amp.
+    return amp * np.cos(2 * np.pi * np.arange(samps) / samps)
+
+
+class NIDAQBackend(object):
+    """NI PCI-6221 backend: AC output triggered by a buffered input."""
+    def __init__(self, device='Dev1', bufferPeriods=16):
+        # Import here so that the engine can be used without PyDAQmx.
+        import niPCI6221 as ni
+        self.ni = ni
+        self.device = device
+        self.bufferPeriods = bufferPeriods
+        self.overruns = 0
+        self.waveInput = None
+        self.waveOutput = None
+
+    def start(self, wave, sampRate, inPort, outPort):
+        self.waveInput = self.ni.bufferedInputTask()
+        self.waveInput.configureBufferedInputTask(
+                self.device + "/ai" + str(outPort), sampRate,
+                self.bufferPeriods * len(wave))
+        triggerName = self.waveInput.getTrigName()
+
+        self.waveOutput = self.ni.acAnalogOutputTask()
+        self.waveOutput.configureAcAnalogOutputTask(
+                self.device + "/ao" + str(inPort), sampRate, wave,
+                trigName=triggerName)
+
+        self.waveOutput.StartTask()
+        self.waveInput.StartTask()
+
+    def readInto(self, data):
+        return self.waveInput.readInto(data)
+
+    def stop(self):
+        for task in [self.waveOutput, self.waveInput]:
+            if task is not None:
+                task.StopTask()
+                task.ClearTask()
+        self.waveOutput = None
+        self.waveInput = None
+
+
+class FakeSampleSource(object):
+    """
+    Software sample source that mimics a continuous, hardware-timed
+    acquisition. The samples are the output wave scaled by gain plus
+    Gaussian noise, paced in real time at the sampling rate. If the
+    reader falls behind by more than bufferSize samples, the excess is
+    discarded and counted as overruns, just like a DAQ buffer overflow.
+    """
+    def __init__(self, gain=1., noise=0., bufferSize=None, clock=time.time,
+                 sleep=time.sleep):
+        self.gain = gain
+        self.noise = noise
+        self.bufferSize = bufferSize
+        self.clock = clock
+        self.sleep = sleep
+        self.overruns = 0
+        self.wave = None
+
+    def start(self, wave, sampRate, inPort, outPort):
+        self.wave = np.asarray(wave, dtype=np.float64)
+        self.sampRate = float(sampRate)
+        if self.bufferSize is None:
+            self.bufferSize = 16 * len(self.wave)
+        self.position = 0   # Index of the next sample to be read.
+        self.overruns = 0
+        self.t0 = self.clock()
+
+    def readInto(self, data):
+        n = len(data)
+        available = int((self.clock() - self.t0) * self.sampRate)
+        if available - self.position > self.bufferSize:
+            lost = available - self.position - self.bufferSize
+            self.overruns += lost
+            self.position += lost
+        while available < self.position + n:
+            self.sleep(float(self.position + n - available) / self.sampRate)
+            available = int((self.clock() - self.t0) * self.sampRate)
+        idx = np.arange(self.position, self.position + n) % len(self.wave)
+        data[:] = self.gain * self.wave[idx]
+        if self.noise:
+            data += np.random.normal(0., self.noise, n)
+        self.position += n
+        return n
+
+    def stop(self):
+        self.wave = None
+
+
+class IVAcquisition(object):
+    """
+    Acquisition engine. The producer thread reads one AC period per
+    ring slot and adds it to the running sum when averaging is on.
+    All public methods are thread-safe.
+
+    If the backend raises, e.g. because of a DAQ error, the acquisition
+    stops and the error is raised again by snapshot and waitAverages
+    until the engine is configured again.
+    """
+    def __init__(self, backend, ringPeriods=32):
+        self.backend = backend
+        self.ringPeriods = ringPeriods
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self._thread = None
+        self._running = False
+        self._error = None
+        self.wave = np.zeros(0)
+        self.ring = np.zeros((ringPeriods, 0))
+        self._reset()
+
+    def _reset(self):
+        self.latest = -1                # Ring slot of the latest period.
+        self.periodsAcquired = 0
+        self.samplesAcquired = 0
+        self.shortReads = 0
+        self.averaging = False
+        self.totalAverages = 0
+        self.averages = 0
+        self.avgSum = np.zeros(len(self.wave))
+
+    def configure(self, wave, sampRate, inPort, outPort):
+        """(Re)start the acquisition with a new output wave."""
+        self.stop()
+        self.wave = np.asarray(wave, dtype=np.float64)
+        self.sampRate = sampRate
+        self.ring = np.zeros((self.ringPeriods, len(self.wave)))
+        self._reset()
+        self._error = None
+        self.backend.start(self.wave, sampRate, inPort, outPort)
+        self._running = True
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.backend.stop()
+
+    def _produce(self):
+        try:
+            self._acquire()
+        except Exception:
+            with self.lock:
+                self._error = sys.exc_info()
+                self._running = False
+                self.changed.notify_all()
+            try:
+                self.backend.stop()
+            except Exception:
+                pass
+
+    def _acquire(self):
+        slot = 0
+        while self._running:
+            block = self.ring[slot]
+            n = self.backend.readInto(block)
+            with self.lock:
+                self.samplesAcquired += n
+                if n < len(block):
+                    self.shortReads += len(block) - n
+                    continue
+                self.latest = slot
+                self.periodsAcquired += 1
+                if self.averaging and self.averages < self.totalAverages:
+                    self.avgSum += block
+                    self.averages += 1
+                    self.changed.notify_all()
+            slot = (slot + 1) % self.ringPeriods
+
+    def _raiseError(self):
+        """Raise the error that stopped the producer, if any.
+        Must be called with the lock held."""
+        if self._error is not None:
+            excType, exc, tb = self._error
+            raise excType, exc, tb
+
+    def startAveraging(self, totalAverages):
+        with self.lock:
+            self.avgSum[:] = 0
+            self.averages = 0
+            self.totalAverages = totalAverages
+            self.averaging = True
+
+    def cancelAveraging(self):
+        with self.lock:
+            self.averaging = False
+            self.averages = 0
+            self.changed.notify_all()
+
+    def waitAverages(self, timeout=None):
+        """
+        Wait until the requested number of periods has been averaged.
+        Returns False if the timeout (in seconds) expires first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while not (self.averaging and self.averages >= self.totalAverages):
+                self._raiseError()
+                if not self.averaging:
+                    raise Exception('Averaging was cancelled.')
+                if deadline is None:
+                    # Wait in steps so that the wait can be interrupted.
+                    self.changed.wait(1.)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.changed.wait(remaining)
+            return True
+
+    @property
+    def samplesDropped(self):
+        return self.backend.overruns + self.shortReads
+
+    def snapshot(self, maxPoints=None):
+        """
+        Return a dictionary with the output wave and the voltages
+        (the running average when averaging, the latest period
+        otherwise), decimated to at most maxPoints points, together
+        with the averaging progress. Returns None if no data have been
+        acquired yet. Raises the error that stopped the acquisition.
+        """
+        with self.lock:
+            self._raiseError()
+            if self.latest < 0:
+                return None
+            if self.averaging and self.averages > 0:
+                voltages = self.avgSum / self.averages
+            else:
+                voltages = self.ring[self.latest].copy()
+            averages = self.averages
+            done = self.averaging and self.averages >= self.totalAverages
+        step = 1
+        if maxPoints is not None and len(voltages) > maxPoints:
+            step = int(np.ceil(len(voltages) / float(maxPoints)))
+        return {'wave': self.wave[::step],
+                'voltages': voltages[::step],
+                'averages': averages,
+                'done': done}
@@ -7,7 +7,7 @@ import tkFileDialog
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
 import os, sys
 import niPCI6221 as ni
-import threading
+from ivAcquisition import IVAcquisition, NIDAQBackend, genWave
 
 # Check out:
 # https://pythonhosted.org/PyDAQmx/callback.html
@@ -17,18 +17,24 @@ import threading
 # change extension to .pyw to prevent window from opening
 # record all parameters used in notes
 
+PLOT_REFRESH_MS = 100   # Plot refresh interval.
+PLOT_MAX_POINTS = 2000  # Maximum number of points in the plot.
+
 class MeasureIV(tk.Tk):   
 
-    def __init__(self,parent):
+    def __init__(self,parent,backend=None):
         tk.Tk.__init__(self,parent)
         self.parent = parent
         self.running = True
+        self.acquisitionError = None
+        if backend is None:
+            backend = NIDAQBackend()
+        self.engine = IVAcquisition(backend)
         self.initParams()
         self.initializeWindow()
         self.initializeACWaves()
         self.initializeDCWave()
-        self.lock = threading.Lock()
-        self.cond = threading.Condition(threading.Lock())
+        self.after(PLOT_REFRESH_MS, self.refreshPlot)
     
     def initParams(self):
         self.RACIn = tk.DoubleVar()
@@ -198,44 +204,13 @@ class MeasureIV(tk.Tk):
         Creates an output wave vector.
         Returns wave in np.float64 array.
         """
-        # Setting freq to 0 is just a DC output.
-        # Number of samples doesn't really matter in
-        #   that case, so just set to the sample rate.
-        if freq is not 0:
-            samps = int(float(self.sampRate.get()) / freq)
-        else:
-            samps = int(self.sampRate.get())
-        
-        # Generate empty wave of correct size
-        wave = np.zeros((samps,),dtype=np.float64)
-        
-        # Sample the wave at sampRate. Use cos such
-        #   that the case of freq=0 will return DC amp.
-        for n in range(samps):
-            wave[n] = amp * np.cos(2*np.pi*n/samps)
-        
-        # Return the wave to the caller
-        return wave
+        return genWave(amp, freq, self.sampRate.get())
     
     def initializeACWaves(self):
         try:
             writeBuf = self.genWave(self.ACAmp.get(), self.ACFreq.get())
-            
-            self.waveInput = ni.CallbackTask()
-            self.waveInput.configureCallbackTask("Dev1/ai"+str(self.portOut.get()),
-                                                self.sampRate.get(),
-                                                len(writeBuf))
-            self.waveInput.setCallback(self.updateData)
-            triggerName = self.waveInput.getTrigName()
-            
-            self.waveOutput = ni.acAnalogOutputTask()
-            self.waveOutput.configureAcAnalogOutputTask("Dev1/ao"+str(self.portACIn.get()), 
-                                                        self.sampRate.get(),
-                                                        writeBuf,
-                                                        trigName=triggerName)
-            
-            self.waveOutput.StartTask()
-            self.waveInput.StartTask()
+            self.engine.configure(writeBuf, self.sampRate.get(),
+                                  self.portACIn.get(), self.portOut.get())
             print "started AC waves"
         except ValueError:
             pass #invalid value often happens before typing has fully finished
@@ -253,25 +228,10 @@ class MeasureIV(tk.Tk):
         except Exception as e:
             print 'Error initializing DC output:\n' + str(e)
         
-    def updateData(self, data):
-        try: self.ACAmp.get(), self.ACFreq.get()
-        except ValueError: return
-        
-        self.cond.acquire()
-        
-        try: newdata = data
-        except Exception as e:
-            print 'failed to aquire data'
-            newdata = []
-        #this is dummy data. Uncomment the line above
-        #newdata = [10 * np.random.random_sample(10),10* np.random.random_sample(10)]
-        
-        currents = np.array(self.genWave(self.ACAmp.get(),self.ACFreq.get()))
-        voltages = np.array(newdata)
-        
-        #print 'tab id',self.measurementTabs.select(), self.measurementTabs.index(self.measurementTabs.select())
-        #tabid = self.measurementTabs.select()
-        currentTab = self.currentTab#measurementTabs.index(tabid)
+    def convertData(self, currents, voltages):
+        """Convert the output wave and the measured voltages to the
+        plotted quantities depending on the measurement type."""
+        currentTab = self.currentTab
         self.ax.set_xlabel('Voltage [V]')
         self.ax.set_ylabel('Current [A]')
         if currentTab == 0: # 2 wire
@@ -300,35 +260,50 @@ class MeasureIV(tk.Tk):
                 self.ax.set_xlabel('$\Phi/L$ [A]')
                 self.ax.set_ylabel('Voltage [V]')
             except ValueError: pass
-        
-        # average data if selected
-        if self.averaging is True and self.averages.get() < self.totalAverages.get():
-            self.VAverages = (self.VAverages*self.averages.get() + voltages)/(self.averages.get()+1.)
-            self.IAverages = (self.IAverages*self.averages.get() + currents)/(self.averages.get()+1.)
-            self.averages.set(self.averages.get()+1)
-            if self.averages.get() == self.totalAverages.get(): # save and re-initialize
+        return currents, voltages
+    
+    def refreshPlot(self):
+        """Plot a decimated snapshot of the acquisition engine data.
+        This is periodically called on the Tk thread."""
+        if not self.running:
+            return
+        try:
+            snap = self.engine.snapshot(PLOT_MAX_POINTS)
+        except Exception as e:
+            # The acquisition has stopped. Report it once; restarting
+            # the AC waves starts a new acquisition.
+            if e is not self.acquisitionError:
+                self.acquisitionError = e
+                print 'Acquisition stopped:\n' + str(e)
+                if self.averaging:
+                    self.cancelAveraging()
+            snap = None
+        if snap is not None:
+            if self.averaging:
+                self.averages.set(snap['averages'])
+            if snap['done']: # save and re-initialize
+                # Save the full resolution average rather than the snapshot.
+                full = self.engine.snapshot()
+                self.IAverages, self.VAverages = self.convertData(
+                        full['wave'], full['voltages'])
                 self.saveAveragedData()
                 self.cancelAveraging()
-        else:
-            self.VAverages = voltages
-            self.IAverages = currents
-            
-        self.plotPoints.set_xdata(self.VAverages)
-        self.plotPoints.set_ydata(self.IAverages)     
-        
-        self.cond.notify()
-        self.cond.release()
-        
-        self.ax.relim()
-        self.ax.autoscale_view()
-        self.fig.canvas.draw()
+            currents, voltages = self.convertData(snap['wave'], snap['voltages'])
+            self.plotPoints.set_xdata(voltages)
+            self.plotPoints.set_ydata(currents)
+            self.ax.relim()
+            self.ax.autoscale_view()
+            self.fig.canvas.draw()
+        self.after(PLOT_REFRESH_MS, self.refreshPlot)
     
     def averageAndSave(self):
         self.averaging = True
+        self.engine.startAveraging(self.totalAverages.get())
         self.avgButton.config(text="Cancel Averaging",command=self.cancelAveraging)
     
     def cancelAveraging(self):
         self.averaging = False
+        self.engine.cancelAveraging()
         self.averages.set( 0 )
         if self.savePath.get() != '.': btntext = 'Average and Save'
         else: btntext = 'Average'
@@ -386,11 +361,7 @@ class MeasureIV(tk.Tk):
     
     def changeACWaves(self,*args):
         """This should be called (by a listener) every time any of the BNC output port variables change."""
-        try:
-            self.waveOutput.StopTask()
-            self.waveOutput.ClearTask()
-            self.waveInput.StopTask()
-            self.waveInput.ClearTask()
+        try: self.engine.stop()
         except: print 'failed to end wave'
         # if port is changed, we should automatically switch AC and DC ports
         if self.portACIn.get() == self.portDCIn.get():
@@ -423,10 +394,7 @@ class MeasureIV(tk.Tk):
         self.quit()     # stops mainloop
         self.destroy()  # this is necessary on Windows to prevent
                                # Fatal Python Error: PyEval_RestoreThread: NULL tstate
-        self.waveOutput.StopTask()
-        self.waveOutput.ClearTask()
-        self.waveInput.StopTask()
-        self.waveInput.ClearTask()
+        self.engine.stop()
         self.DCOutput.StopTask()
         self.DCOutput.ClearTask()
         #os._exit(1)
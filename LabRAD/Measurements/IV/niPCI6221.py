@@ -66,6 +66,23 @@ class CallbackTask(Task):
     def getTrigName(self):
         return self.trigName
 
+class bufferedInputTask(CallbackTask):
+    """Continuous, hardware-timed analog input that is read in blocks
+    by the caller (e.g. a dedicated acquisition thread) instead of
+    through the every N samples callback."""
+    def configureBufferedInputTask(self, analogInputNameStr, sampRate, bufferSize):
+        self.buffLen = bufferSize
+        self.CreateAIVoltageChan(analogInputNameStr,"",DAQmx_Val_Diff,-10.0,10.0,DAQmx_Val_Volts,None)
+        self.CfgSampClkTiming("",float(sampRate),DAQmx_Val_Rising,DAQmx_Val_ContSamps,bufferSize)
+        self.trigName = self.GetTerminalNameWithDevPrefix("ai/StartTrigger")
+
+    def readInto(self, data, timeout=10.0):
+        """Fill a contiguous float64 array with the next len(data)
+        samples. Returns the number of samples actually read."""
+        numReadBack = int32()
+        self.ReadAnalogF64(len(data),timeout,DAQmx_Val_GroupByChannel,data,len(data),byref(numReadBack),None)
+        return numReadBack.value
+
 class analogInputTask(Task):
     def __init__(self , analogInputNameStr, sampRate, numSamples):
         Task.__init__(self)
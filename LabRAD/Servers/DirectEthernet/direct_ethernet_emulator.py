@@ -0,0 +1,675 @@
+# Copyright (C) 2016  McDermott Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+### BEGIN NODE INFO
+[info]
+name = Direct Ethernet Emulator
+version = 1.0.0
+description = Stand-in for the Direct Ethernet server with emulated GHz DAC and ADC boards.
+instancename = %LABRADNODE% Direct Ethernet Emulator
+
+[startup]
+cmdline = %PYTHON% %FILE%
+timeout = 20
+
+[shutdown]
+message = 987654321
+timeout = 20
+### END NODE INFO
+"""
+
+# +DOCUMENTATION
+#
+# This server implements the Direct Ethernet settings used by the GHz FPGA
+# server, but instead of talking to a network adapter it passes packets to
+# software models of the GHz DAC and ADC boards. The FPGA server can be
+# pointed at it by naming this server in the boardGroups registry key, so
+# that detection, bringup helpers and the Run Sequence pipeline can be
+# exercised and benchmarked without any hardware.
+#
+# Each adapter (port) holds a set of boards, keyed by MAC address. Packets
+# written to a board's MAC are decoded like the FPGA would:
+#   DAC: register packets (REG_PACKET_LEN bytes), pktWriteMem (769 bytes)
+#        and pktWriteSram (1026 bytes). regRun streams TIMING_PACKET_LEN
+#        timer results per packet, computed from the memory page that was
+#        run. Packets with readback requested get a READBACK_LEN response.
+#   ADC: register packets (REG_PACKET_LEN bytes) and pktWriteSram. regAdcRun
+#        in average mode sends AVERAGE_PACKETS zero traces, in demod mode one
+#        demod packet per repetition. The I and Q values of each demod channel
+#        echo its dPhi and phi0 registers, so that results can be traced back
+#        to the settings that produced them.
+# Boards run one sequence at a time and their results arrive when the
+# sequence has finished, i.e. after reps times the sequence length (scaled
+# by the time scale) plus the latency.
+#
+# ++EMULATION PARAMETERS
+# The following parameters apply to all boards and can be changed at any time:
+#   latency - delay between a board finishing and the host receiving its packets
+#   loss - probability for each packet sent by a board to be lost
+#   stall - probability for a run to hang, so that no data comes back and
+#           collect times out. The execution counter of a stalled board
+#           stops somewhere before the requested number of reps.
+#   timeScale - factor applied to all sequence durations. 0 runs sequences
+#               instantly, 1 in real time.
+#
+# ++REGISTRY KEYS
+# Boards are loaded at startup from the registry directory
+# ['', 'Servers', 'Direct Ethernet Emulator']:
+#   boards: *(wsww), [(port, 'DAC' or 'ADC', boardNumber, build),...]
+# The shape of ADC data packets is taken from the adcBuildN keys in
+# ['', 'Servers', 'GHz FPGAs'], just like the FPGA server does, and falls
+# back to ADC_BUILD_DEFAULTS when a build is not in the registry.
+
+import time
+from collections import deque
+
+import numpy as np
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.reactor import callLater
+
+from labrad.errors import Error
+from labrad.server import LabradServer, setting
+import labrad.units as units
+
+import LabRAD.Servers.Instruments.GHzBoards.dac as dac
+import LabRAD.Servers.Instruments.GHzBoards.adc as adc
+
+NUM_ADAPTERS = 4
+HOST_MAC = '00:00:00:00:00:00'
+DEFAULT_TIMEOUT = 1.0 # seconds
+MEM_CLOCK = 25e6 # memory sequences run at 25 MHz
+SRAM_WORDS_PER_CYCLE = 40 # SRAM runs at 1 GHz
+ADC_REP_TIME = 26e-6 # 16us acquisition + 10us packet transmission
+
+ADC_BUILD_DEFAULTS = [
+    ('DEMOD_CHANNELS', 4),
+    ('DEMOD_CHANNELS_PER_PACKET', 11),
+    ('AVERAGE_PACKETS', 32),
+    ('AVERAGE_PACKET_LEN', 1024),
+]
+
+
+class NoAdapterError(Error):
+    """Please connect to an adapter first."""
+    code = 1
+
+class NoDestinationError(Error):
+    """Please set a destination MAC first."""
+    code = 2
+
+class TimeoutError(Error):
+    """Operation timed out."""
+    code = 3
+
+class UnknownBoardError(Error):
+    """No board with this MAC address."""
+    code = 4
+
+
+class PacketBuffer(object):
+    """Packets received in one context, with the filters of that context.
+
+    At most one wait can be pending at a time, since requests in a
+    context are handled in order.
+    """
+    def __init__(self):
+        self.packets = deque()
+        self.length = None
+        self.sourceMac = None
+        self.waiter = None
+
+    def accept(self, src, packets):
+        """Add those packets that pass our filters."""
+        if self.sourceMac is not None and src != self.sourceMac:
+            return
+        if self.length is not None:
+            packets = [p for p in packets if p[2] == self.length]
+        self.packets.extend(packets)
+        if self.waiter is not None:
+            n, d, call = self.waiter
+            if len(self.packets) >= n:
+                self.waiter = None
+                call.cancel()
+                d.callback(None)
+
+    def wait(self, n, timeout):
+        """Wait until at least n packets are in the buffer."""
+        if len(self.packets) >= n:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        call = callLater(timeout, self._timeout)
+        self.waiter = (n, d, call)
+        return d
+
+    def _timeout(self):
+        n, d, call = self.waiter
+        self.waiter = None
+        d.errback(TimeoutError())
+
+    def take(self, n):
+        return [self.packets.popleft() for _ in xrange(n)]
+
+    def clear(self):
+        self.packets.clear()
+
+    def cancel(self):
+        """Stop waiting, e.g. because the context expired."""
+        if self.waiter is not None:
+            n, d, call = self.waiter
+            self.waiter = None
+            call.cancel()
+
+
+class Adapter(object):
+    """An emulated network adapter and the boards connected to it."""
+    def __init__(self, port):
+        self.port = port
+        self.name = 'Emulated Adapter %d' % port
+        self.boards = {}
+        self.listeners = {}
+
+    def send(self, dest, data):
+        """Pass a packet from the host to a board, if there is one at dest."""
+        board = self.boards.get(dest)
+        if board is not None:
+            board.receive(data)
+
+    def deliver(self, src, packets):
+        """Pass packets from a board to all listening contexts."""
+        packets = [(src, HOST_MAC, len(data), data) for data in packets]
+        for buf in self.listeners.values():
+            buf.accept(src, packets)
+
+
+class BoardModel(object):
+    """Behaviour common to the emulated DAC and ADC boards."""
+    kind = None
+
+    def __init__(self, server, adapter, number, build):
+        self.server = server
+        self.adapter = adapter
+        self.number = number
+        self.build = build
+        self.mac = self.macFor(number)
+        self.sram = {}
+        self.executionCount = 0
+        self.busyUntil = 0.0
+
+    def macFor(self, number):
+        raise NotImplementedError
+
+    def receive(self, data):
+        """Handle a packet written to this board."""
+        raise NotImplementedError
+
+    def respond(self, packets, delay=0.0):
+        """Send packets to the host after delay plus the latency."""
+        packets = self.server.transmit(packets)
+        callLater(delay + self.server.config['latency'],
+                  self.adapter.deliver, self.mac, packets)
+
+    def execute(self, reps, repTime, makePackets):
+        """Run a sequence of reps repetitions and send back its data.
+
+        makePackets is called when the sequence is done, so that no work
+        is wasted on the data of a stalled run.
+        """
+        now = time.time()
+        start = max(now, self.busyUntil)
+        duration = reps * repTime * self.server.config['timeScale']
+        self.busyUntil = start + duration
+        self.executionCount = 0
+        self.server.stats['runs'] += 1
+        if self.server.random.random_sample() < self.server.config['stall']:
+            self.server.stats['stalls'] += 1
+            count = self.server.random.randint(0, max(reps, 1))
+            callLater(self.busyUntil - now, self._finish, count, None)
+        else:
+            callLater(self.busyUntil - now, self._finish, reps, makePackets)
+
+    def _finish(self, count, makePackets):
+        self.executionCount = count
+        if makePackets is not None:
+            self.respond(makePackets())
+
+    def writeSram(self, data):
+        derp = ord(data[0]) + (ord(data[1]) << 8)
+        self.sram[derp] = data[2:]
+
+
+class DacBoard(BoardModel):
+    """Emulated GHz DAC board."""
+    kind = 'DAC'
+
+    def __init__(self, server, adapter, number, build):
+        BoardModel.__init__(self, server, adapter, number, build)
+        self.memory = {}
+
+    def macFor(self, number):
+        return dac.macFor(number)
+
+    def receive(self, data):
+        if len(data) == dac.REG_PACKET_LEN:
+            self.registers(np.fromstring(data, dtype='<u1'))
+        elif len(data) == 769:
+            self.writeMemory(data)
+        elif len(data) == 1026:
+            self.writeSram(data)
+
+    def writeMemory(self, data):
+        a = np.fromstring(data[1:], dtype='<u1').astype('u4')
+        words = a[0::3] + (a[1::3] << 8) + (a[2::3] << 16)
+        self.memory[ord(data[0])] = analyzeMemory(words)
+
+    def registers(self, regs):
+        start, readback = regs[0], regs[1]
+        if start & 0x7F == 1 and regs[43] != 3:
+            # run memory in the page given by the high bit
+            page = start >> 7
+            reps = int(regs[13]) + (int(regs[14]) << 8)
+            cycles, timers = self.memory.get(page, (1, []))
+            def makePackets():
+                return timingPackets(timers, reps)
+            self.execute(reps, cycles / MEM_CLOCK, makePackets)
+        if readback in [1, 2]:
+            resp = np.zeros(dac.READBACK_LEN, dtype='<u1')
+            resp[51] = self.build
+            resp[52] = self.executionCount & 0xFF
+            resp[53] = (self.executionCount >> 8) & 0xFF
+            resp[56] = regs[48] # echo serial data
+            self.respond([resp.tostring()], 2e-6)
+
+
+class AdcBoard(BoardModel):
+    """Emulated GHz ADC board."""
+    kind = 'ADC'
+
+    def __init__(self, server, adapter, number, build, buildParams):
+        BoardModel.__init__(self, server, adapter, number, build)
+        self.buildParams = dict(buildParams)
+
+    def macFor(self, number):
+        return adc.macFor(number)
+
+    def receive(self, data):
+        if len(data) == adc.REG_PACKET_LEN:
+            self.registers(np.fromstring(data, dtype='<u1'))
+        elif len(data) == 1026:
+            self.writeSram(data)
+
+    def registers(self, regs):
+        mode = regs[0]
+        reps = int(regs[7]) + (int(regs[8]) << 8)
+        if mode == 1:
+            resp = np.zeros(adc.READBACK_LEN, dtype='<u1')
+            resp[0] = self.build
+            resp[2] = self.executionCount & 0xFF
+            resp[3] = (self.executionCount >> 8) & 0xFF
+            self.respond([resp.tostring()])
+        elif mode in [adc.RUN_MODE_AVERAGE_AUTO, adc.RUN_MODE_AVERAGE_DAISY]:
+            n = self.buildParams['AVERAGE_PACKETS']
+            length = self.buildParams['AVERAGE_PACKET_LEN']
+            def makePackets():
+                return ['\x00' * length] * n
+            self.execute(reps, ADC_REP_TIME, makePackets)
+        elif mode in [adc.RUN_MODE_DEMOD_AUTO, adc.RUN_MODE_DEMOD_DAISY]:
+            channels = self.buildParams['DEMOD_CHANNELS']
+            perPacket = self.buildParams['DEMOD_CHANNELS_PER_PACKET']
+            def makePackets():
+                return demodPackets(regs, channels, perPacket, reps)
+            self.execute(reps, ADC_REP_TIME, makePackets)
+
+
+def analyzeMemory(words):
+    """Get the length in memory cycles and the timer results of a memory page.
+
+    Execution stops at the first branch command, which ends one repetition.
+    Each timer result is the number of cycles between timer start and stop.
+    """
+    cycles = 0
+    timers = []
+    timerStart = sramStart = sramEnd = 0
+    for cmd in words:
+        cmd = int(cmd)
+        opcode, addr = (cmd >> 20) & 0xF, cmd & 0xFFFFF
+        if opcode == 0xF:
+            cycles += 2
+            break
+        elif opcode == 0x3:
+            cycles += addr + 1
+        elif opcode == 0xC:
+            cycles += max(sramEnd - sramStart + 1, 0) // SRAM_WORDS_PER_CYCLE + 1
+        else:
+            cycles += 1
+            if opcode == 0x8:
+                sramStart = addr
+            elif opcode == 0xA:
+                sramEnd = addr
+            elif cmd == 0x400000:
+                timerStart = cycles
+            elif cmd == 0x400001:
+                timers.append(cycles - timerStart)
+    return cycles, timers
+
+def timingPackets(timers, reps):
+    """Build the timing packets of a DAC run.
+
+    Timer results are streamed TIMING_PACKET_LEN at a time, as '<u2' in
+    bytes 3 to 63 of each READBACK_LEN packet. An incomplete last packet
+    is never sent.
+    """
+    n = reps * len(timers) // dac.TIMING_PACKET_LEN
+    if n == 0:
+        return []
+    values = np.resize(np.asarray(timers, dtype='<u2'), n * dac.TIMING_PACKET_LEN)
+    pkts = np.zeros((n, dac.READBACK_LEN), dtype='<u1')
+    pkts[:, 3:63] = values.view('<u1').reshape(n, -1)
+    data = pkts.tostring()
+    return [data[i:i+dac.READBACK_LEN] for i in xrange(0, len(data), dac.READBACK_LEN)]
+
+def demodPackets(regs, channels, perPacket, reps):
+    """Build the demod packets of an ADC run, one per repetition.
+
+    Each packet has (I, Q) as '<i2' for perPacket channels followed by
+    the ranges in bytes 46 and 47 (zero here).
+    """
+    iq = np.zeros((perPacket, 2), dtype='<i2')
+    for i in range(min(channels, perPacket)):
+        addr = 15 + 4*i
+        iq[i] = regs[addr:addr+4].view('<i2')
+    pkt = np.zeros(48, dtype='<u1')
+    pkt[:4*perPacket] = iq.view('<u1').ravel()
+    return [pkt.tostring()] * reps
+
+
+class DirectEthernetEmulator(LabradServer):
+    """Emulates the Direct Ethernet server and GHz DAC and ADC boards."""
+    name = '%LABRADNODE% Direct Ethernet Emulator'
+
+    @inlineCallbacks
+    def initServer(self):
+        self.adapters = dict((port, Adapter(port)) for port in range(NUM_ADAPTERS))
+        self.config = {'latency': 100e-6, 'loss': 0.0, 'stall': 0.0, 'timeScale': 1.0}
+        self.stats = dict.fromkeys(['written', 'sent', 'lost', 'runs', 'stalls', 'timeouts'], 0)
+        self.random = np.random.RandomState()
+        self.triggers = {}
+        self.triggerWaiters = {}
+        yield self.loadBoards()
+
+    @inlineCallbacks
+    def loadBoards(self):
+        """Add the boards listed in the registry."""
+        p = self.client.registry.packet()
+        p.cd(['', 'Servers', 'Direct Ethernet Emulator'], True)
+        p.get('boards', False, [], key='boards')
+        ans = yield p.send()
+        for port, kind, number, build in ans['boards']:
+            yield self.addBoard(port, kind, number, build)
+        print '%d emulated boards loaded from registry.' % len(ans['boards'])
+
+    @inlineCallbacks
+    def addBoard(self, port, kind, number, build):
+        adapter = self.getAdapter(port)
+        if kind == 'DAC':
+            board = DacBoard(self, adapter, number, build)
+        elif kind == 'ADC':
+            p = self.client.registry.packet()
+            p.cd(['', 'Servers', 'GHz FPGAs'])
+            p.get('adcBuild%d' % build, False, ADC_BUILD_DEFAULTS, key='params')
+            ans = yield p.send()
+            buildParams = dict(ADC_BUILD_DEFAULTS)
+            buildParams.update(dict(ans['params']))
+            board = AdcBoard(self, adapter, number, build, buildParams)
+        else:
+            raise Exception("Unknown board type '%s'. Use 'DAC' or 'ADC'." % kind)
+        adapter.boards[board.mac] = board
+        returnValue(board.mac)
+
+    def getAdapter(self, port):
+        try:
+            return self.adapters[port]
+        except KeyError:
+            raise Exception('Adapter %d does not exist.' % port)
+
+    def transmit(self, packets):
+        """Count packets sent by a board and drop those that get lost."""
+        loss = self.config['loss']
+        if loss > 0 and len(packets):
+            keep = self.random.random_sample(len(packets)) >= loss
+            lost = len(packets) - int(keep.sum())
+            if lost:
+                packets = [pkt for pkt, k in zip(packets, keep) if k]
+                self.stats['lost'] += lost
+        self.stats['sent'] += len(packets)
+        return packets
+
+    def initContext(self, c):
+        c['adapter'] = None
+        c['buffer'] = PacketBuffer()
+        c['timeout'] = DEFAULT_TIMEOUT
+        c['src'] = None
+        c['dest'] = None
+
+    def expireContext(self, c):
+        c['buffer'].cancel()
+        if c['adapter'] is not None:
+            c['adapter'].listeners.pop(c.ID, None)
+        self.triggers.pop(c.ID, None)
+        self.triggerWaiters.pop(c.ID, None)
+
+    def getContextAdapter(self, c):
+        if c['adapter'] is None:
+            raise NoAdapterError()
+        return c['adapter']
+
+    @inlineCallbacks
+    def waitFor(self, c, n):
+        try:
+            yield c['buffer'].wait(n, c['timeout'])
+        except TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+
+
+    # Direct Ethernet settings
+
+    @setting(1, 'Adapters', returns='*(ws)')
+    def adapters_list(self, c):
+        """Retrieves a list of network adapters."""
+        return [(port, a.name) for port, a in sorted(self.adapters.items())]
+
+    @setting(10, 'Connect', port='w', returns='s')
+    def connect(self, c, port):
+        """Connects to a network adapter."""
+        adapter = self.getAdapter(port)
+        if c['adapter'] is not None:
+            c['adapter'].listeners.pop(c.ID, None)
+        c['adapter'] = adapter
+        c['buffer'].clear()
+        return adapter.name
+
+    @setting(20, 'Listen', returns='')
+    def listen(self, c):
+        """Starts listening for packets that pass the filters of this context."""
+        adapter = self.getContextAdapter(c)
+        adapter.listeners[c.ID] = c['buffer']
+
+    @setting(30, 'Timeout', time='v[s]', returns='')
+    def timeout(self, c, time):
+        """Sets the timeout for read, collect and discard operations."""
+        c['timeout'] = seconds(time)
+
+    @setting(40, 'Source MAC', mac='s', returns='s')
+    def source_mac(self, c, mac=None):
+        """Sets the source MAC address of written packets."""
+        if mac is not None:
+            c['src'] = mac
+        return c['src'] or HOST_MAC
+
+    @setting(41, 'Destination MAC', mac='s', returns='s')
+    def destination_mac(self, c, mac=None):
+        """Sets the destination MAC address of written packets."""
+        if mac is not None:
+            c['dest'] = mac.upper()
+        return c['dest'] or ''
+
+    @setting(50, 'Require Length', length='w', returns='')
+    def require_length(self, c, length):
+        """Only accept packets of the given length."""
+        c['buffer'].length = length
+
+    @setting(51, 'Require Source MAC', mac='s', returns='')
+    def require_source_mac(self, c, mac):
+        """Only accept packets from the given MAC address."""
+        c['buffer'].sourceMac = mac.upper()
+
+    @setting(60, 'Write', data='s', returns='')
+    def write(self, c, data):
+        """Sends a packet to the destination MAC address."""
+        adapter = self.getContextAdapter(c)
+        if c['dest'] is None:
+            raise NoDestinationError()
+        self.stats['written'] += 1
+        adapter.send(c['dest'], data)
+
+    @setting(70, 'Read', count='w', returns=['(ssws)', '*(ssws)'])
+    def read(self, c, count=None):
+        """Reads packets as (source, destination, length, data).
+
+        Without a count, one packet is returned by itself.
+        """
+        n = 1 if count is None else count
+        yield self.waitFor(c, n)
+        pkts = c['buffer'].take(n)
+        returnValue(pkts[0] if count is None else pkts)
+
+    @setting(71, 'Collect', count='w', returns='')
+    def collect(self, c, count=1):
+        """Waits until count packets are in the buffer, without reading them."""
+        yield self.waitFor(c, count)
+
+    @setting(72, 'Discard', count='w', returns='')
+    def discard(self, c, count=1):
+        """Waits for count packets and removes them from the buffer."""
+        yield self.waitFor(c, count)
+        c['buffer'].take(count)
+
+    @setting(80, 'Clear', returns='')
+    def clear(self, c):
+        """Removes all packets from the buffer."""
+        c['buffer'].clear()
+
+    @setting(90, 'Send Trigger', context='(ww)', returns='')
+    def send_trigger(self, c, context):
+        """Sends a trigger to the given context."""
+        if context[0] == 0:
+            context = (c.source, context[1])
+        self.triggers[context] = self.triggers.get(context, 0) + 1
+        waiter = self.triggerWaiters.get(context)
+        if waiter is not None and self.triggers[context] >= waiter[0]:
+            del self.triggerWaiters[context]
+            waiter[1].callback(None)
+
+    @setting(91, 'Wait For Trigger', count='w', returns='v[s]')
+    def wait_for_trigger(self, c, count):
+        """Waits until count triggers have been received in this context.
+
+        Returns the time spent waiting.
+        """
+        start = time.time()
+        if self.triggers.get(c.ID, 0) < count:
+            d = defer.Deferred()
+            self.triggerWaiters[c.ID] = (count, d)
+            yield d
+        self.triggers[c.ID] = self.triggers.get(c.ID, 0) - count
+        returnValue(units.Value(time.time() - start, 's'))
+
+
+    # Emulator settings
+
+    @setting(100, 'Add Board', port='w', kind='s', number='w', build='w', returns='s')
+    def add_board(self, c, port, kind, number, build):
+        """Adds an emulated 'DAC' or 'ADC' board and returns its MAC address."""
+        return self.addBoard(port, kind, number, build)
+
+    @setting(101, 'Remove Board', port='w', mac='s', returns='')
+    def remove_board(self, c, port, mac):
+        """Removes an emulated board."""
+        boards = self.getAdapter(port).boards
+        if mac.upper() not in boards:
+            raise UnknownBoardError()
+        del boards[mac.upper()]
+
+    @setting(102, 'Boards', returns='*(wswws)')
+    def boards(self, c):
+        """Lists emulated boards as (port, type, number, build, MAC)."""
+        return [(port, b.kind, b.number, b.build, b.mac)
+                for port, a in sorted(self.adapters.items())
+                for mac, b in sorted(a.boards.items())]
+
+    @setting(110, 'Latency', latency='v[s]', returns='v[s]')
+    def latency(self, c, latency=None):
+        """Gets or sets the delay before the host receives a board's packets."""
+        if latency is not None:
+            self.config['latency'] = seconds(latency)
+        return units.Value(self.config['latency'], 's')
+
+    @setting(111, 'Packet Loss', loss='v', returns='v')
+    def packet_loss(self, c, loss=None):
+        """Gets or sets the probability for a packet from a board to be lost."""
+        if loss is not None:
+            self.config['loss'] = float(loss)
+        return self.config['loss']
+
+    @setting(112, 'Stall Probability', stall='v', returns='v')
+    def stall_probability(self, c, stall=None):
+        """Gets or sets the probability for a run to hang without sending data."""
+        if stall is not None:
+            self.config['stall'] = float(stall)
+        return self.config['stall']
+
+    @setting(113, 'Time Scale', scale='v', returns='v')
+    def time_scale(self, c, scale=None):
+        """Gets or sets the factor applied to sequence durations."""
+        if scale is not None:
+            self.config['timeScale'] = float(scale)
+        return self.config['timeScale']
+
+    @setting(120, 'Statistics', returns='*(sw)')
+    def statistics(self, c):
+        """Counts of packets written, sent, lost, runs, stalls and timeouts."""
+        return sorted(self.stats.items())
+
+    @setting(121, 'Reset Statistics', returns='')
+    def reset_statistics(self, c):
+        for key in self.stats:
+            self.stats[key] = 0
+
+
+def seconds(t):
+    """Convert a time that may or may not have units to seconds."""
+    if isinstance(t, units.Value):
+        return t['s']
+    return float(t)
+
+
+__server__ = DirectEthernetEmulator()
+
+if __name__ == '__main__':
+    from labrad import util
+    util.runServer(__server__)
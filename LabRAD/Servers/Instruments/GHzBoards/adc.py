@@ -1,3 +1,6 @@
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -45,6 +48,8 @@ from util import littleEndian, TimedLock
 #   FILTER_LEN - length of filter function
 #   SRAM_WRITE_DERPS - Total number of writable derps in SRAM, ie filter and trig tables
 #   SRAM_WRITE_PKT_LEN - Number of words written per SRAM write packet, ie. words per derp.
+#   DEMOD_PACKET_COUNTER - Optional. If True, bytes 44 and 45 of each demod packet count
+#                          the packets, and demod results are checked for lost packets.
 
 
 
@@ -58,6 +63,8 @@ RUN_MODE_DEMOD_AUTO = 4
 RUN_MODE_DEMOD_DAISY = 5
 RUN_MODE_CALIBRATE = 7
 
+SETUP_CACHE_SIZE = 8 # setup packets kept by each board, see AdcDevice.setup
+
 def macFor(board):
     """Get the MAC address of an ADC board as a string."""
     return '00:01:CA:AA:01:' + ('0'+hex(int(board))[2:])[-2:].upper()
@@ -153,6 +160,7 @@ class AdcDevice(DeviceWrapper):
         self.devName = name
         self.serverName = de._labrad_name
         self.timeout = T.Value(1, 's')
+        self.setupCache = OrderedDict() # setup digest: setup packet, least recently used first
 
         # set up our context with the ethernet server
         p = self.makePacket()
@@ -226,7 +234,7 @@ class AdcDevice(DeviceWrapper):
     def collect(self, nPackets, timeout, triggerCtx):
         """Create a packet to collect data on the FPGA."""
         p = self.makePacket()
-        p.timeout(T.Value(timeout, 's'))
+        p.timeout(T.Value(timeout, 's'), key='timeout')
         p.collect(nPackets)
         # note that if a timeout error occurs the remainder of the packet
         # is discarded, so that the trigger command will not be sent
@@ -246,10 +254,15 @@ class AdcDevice(DeviceWrapper):
         return self.makePacket().discard(nPackets)
 
     def setup(self, filter, demods):
+        """Create a packet to upload the filter function and trig lookup tables.
+        
+        Returns the packet and the setup state it leaves the board in.  The
+        state is the board name and a digest of the filter function and the
+        trig amplitudes, from which the lookup tables are computed.  Packets
+        are cached by digest, so setting up the same contents again reuses
+        the packet made the first time.
+        """
         filterFunc, filterStretchLen, filterStretchAt = filter
-        p = self.makePacket()
-        self.makeFilter(filterFunc, p)
-        self.makeTrigLookups(demods, p)
         amps = ''
         for ch in xrange(self.buildParams['DEMOD_CHANNELS']):
             if ch in demods:
@@ -258,7 +271,17 @@ class AdcDevice(DeviceWrapper):
             else:
                 cosineAmp = sineAmp = 0
             amps += '%s,%s;' % (cosineAmp, sineAmp) 
-        setupState = '%s: filter=%s, trigAmps=%s' % (self.devName, filterFunc.tostring(), amps)
+        filterBytes = filterFunc.tostring()
+        digest = hashlib.md5('%d:%s%s' % (len(filterBytes), filterBytes, amps)).hexdigest()
+        p = self.setupCache.pop(digest, None)
+        if p is None:
+            p = self.makePacket()
+            self.makeFilter(filterFunc, p)
+            self.makeTrigLookups(demods, p)
+        self.setupCache[digest] = p
+        while len(self.setupCache) > SETUP_CACHE_SIZE:
+            self.setupCache.popitem(last=False)
+        setupState = '%s: filter, trigAmps=%s' % (self.devName, digest)
         return p, setupState
 
     def clear(self, triggerCtx=None):
@@ -317,17 +340,34 @@ class AdcDevice(DeviceWrapper):
     # chatty functions that require locking the device
     
     def recalibrate(self):
-        @inlineCallbacks
-        def func():
-            regs = regAdcRecalibrate()
-            yield self._sendRegisters(regs, readback=False)
-        return self.testMode(func)
+        return self.testMode(self._recalibrate)
+    
+    @inlineCallbacks
+    def _recalibrate(self):
+        regs = regAdcRecalibrate()
+        yield self._sendRegisters(regs, readback=False)
     
     def initPLL(self):
-        @inlineCallbacks
-        def func():
-            yield self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-        return self.testMode(func)
+        return self.testMode(self._initPLL)
+    
+    @inlineCallbacks
+    def _initPLL(self):
+        yield self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
+
+    def bringup(self, recalibrate=False):
+        """Initialize the PLL and, if recalibrate is True, recalibrate the ADCs.
+        
+        Recalibrating may change the order of the I and Q outputs, so it is
+        not done by default.
+        """
+        return self.testMode(self._bringup, recalibrate)
+    
+    @inlineCallbacks
+    def _bringup(self, recalibrate):
+        """Bring up the board, see bringup.  Must be run in test mode."""
+        yield self._initPLL()
+        if recalibrate:
+            yield self._recalibrate()
     
     def queryPLL(self):
         @inlineCallbacks
@@ -369,7 +409,8 @@ class AdcDevice(DeviceWrapper):
                     
             # parse the packets out and return data
             packets = [data for src, dst, eth, data in ans.read]
-            returnValue(extractAverage(packets))
+            returnValue(extractAverage(packets, self.buildParams['AVERAGE_PACKETS'],
+                                       self.buildParams.get('AVERAGE_PACKET_LEN', None)))
             
         return self.testMode(func)
 
@@ -410,37 +451,82 @@ class AdcDevice(DeviceWrapper):
             returnValue(None)
         return self.testMode(func)
 
-def extractAverage(packets):
-    """Extract Average waveform from a list of packets (byte strings)."""
+def checkPackets(packets, nPackets=None, packetLen=None, minLen=None):
+    """Check the number and lengths of the packets read back from a board.
     
+    All lengths are checked at once.  Raises an Exception that says how
+    many packets are missing or extra and how many have the wrong length.
+    """
+    if nPackets is None and packetLen is None and minLen is None:
+        return
+    lengths = np.fromiter((len(pkt) for pkt in packets), dtype=int, count=len(packets))
+    problems = []
+    if nPackets is not None and len(packets) != nPackets:
+        problems.append('expected %d packets, got %d' % (nPackets, len(packets)))
+    for bad, what in [(packetLen is not None and lengths != packetLen, '%s bytes long' % packetLen),
+                      (minLen is not None and lengths < minLen, 'at least %s bytes long' % minLen)]:
+        bad = np.flatnonzero(bad)
+        if len(bad):
+            problems.append('%d packets not %s, e.g. packet %d with %d bytes'
+                            % (len(bad), what, bad[0], lengths[bad[0]]))
+    if problems:
+        raise Exception('Bad packets from ADC: %s.' % '; '.join(problems))
+
+def counterGaps(counters, bits=16):
+    """Find lost and repeated packets from packet counters that should count up by one.
+    
+    Returns (missing, duplicated), the number of packets that were skipped
+    by the counters and the number of packets whose counter did not move
+    forward.
+    """
+    steps = np.diff(np.asarray(counters, dtype=int)) % (1 << bits)
+    back = (steps == 0) | (steps >= 1 << (bits-1)) # repeated or out of order
+    skipped = steps[~back] - 1
+    return int(np.sum(skipped)), int(np.sum(back))
+
+def extractAverage(packets, nPackets=None, packetLen=None):
+    """Extract Average waveform from a list of packets (byte strings).
+    
+    If nPackets or packetLen are given, the number and lengths of the
+    packets are checked first.
+    """
+    checkPackets(packets, nPackets, packetLen)
     data = ''.join(packets) #Join all byte strings together into one long string
-    Is, Qs = np.fromstring(data, dtype='<i2').reshape(-1, 2).astype(int).T
+    Is, Qs = np.frombuffer(data, dtype='<i2').reshape(-1, 2).astype(int).T
     return (Is, Qs)
 
-def extractDemod(packets, nDemod):
-    """Extract Demodulation data from a list of packets (byte strings)."""
-    data = ''.join(data[:44] for data in packets)   #stick all data strings in packets together, chopping out last 4 bytes from each string
-    vals = np.fromstring(data, dtype='<i2')         #Convert string of bytes into numpy array of 16bit integers. <i2 means little endian 2 byte
-    Is, Qs = vals.reshape(-1, 2).astype(int).T      #Is,Qs are numpy arrays like   [I0,I1,...,I_numChannels,    I0,I1,...,I_numChannels]
+def extractDemod(packets, nDemod, nPackets=None, checkCounters=False):
+    """Extract Demodulation data from a list of packets (byte strings).
+    
+    Each packet has (I, Q) for all channels in its first 44 bytes, as
+    little endian 16 bit integers, and the I and Q ranges in bytes 46 and
+    47.  All packets are decoded at once from one joined buffer.  If
+    checkCounters is True, bytes 44 and 45 are taken as a packet counter
+    and an Exception is raised if packets were lost or repeated.
+    """
+    checkPackets(packets, nPackets, minLen=48)
+    data = ''.join(pkt[:48] for pkt in packets)
+    pkts = np.frombuffer(data, dtype='<u1').reshape(-1, 48)
+    if checkCounters:
+        missing, duplicated = counterGaps(pkts[:, 44:46].copy().view('<u2').ravel())
+        if missing or duplicated:
+            raise Exception('Demod packet counters show %d missing and %d duplicated packets in %d.'
+                            % (missing, duplicated, len(packets)))
+    vals = pkts[:, :44].copy().view('<i2').ravel().astype(int) #16bit integers, I0,Q0,I1,Q1,... for each packet
+    Is, Qs = vals.reshape(-1, 2).T                  #Is,Qs are numpy arrays like   [I0,I1,...,I_numChannels,    I0,I1,...,I_numChannels]
                                                     #                               1st data run                2nd data run    
     #Parse the IQ data into [(Is ch0, Qs ch0), (Is ch1, Qs ch1),...,(Is chnDemod, Qs chnDemod)]
     data = [(Is[i::nDemod], Qs[i::nDemod]) for i in xrange(nDemod)]
-    #data_saved = data
     # compute overall max and min for I and Q
-    def getRange(pkt):
-        Irng, Qrng = [ord(i) for i in pkt[46:48]]
-        twosComp = lambda i: int(i if i < 0x8 else i - 0x10)
-        Imax = twosComp((Irng >> 4) & 0xF) # << 12
-        Imin = twosComp((Irng >> 0) & 0xF) # << 12
-        Qmax = twosComp((Qrng >> 4) & 0xF) # << 12
-        Qmin = twosComp((Qrng >> 0) & 0xF) # << 12
-        return Imax, Imin, Qmax, Qmin
-    
-    ranges = np.array([getRange(pkt) for pkt in packets]).T
-    Imax = int(max(ranges[0]))
-    Imin = int(min(ranges[1]))
-    Qmax = int(max(ranges[2]))
-    Qmin = int(min(ranges[3]))
+    # each range byte holds max and min as 4 bit two's complement numbers
+    rng = pkts[:, 46:48].astype(int)
+    twosComp = lambda i: i - ((i & 0x8) << 1)
+    rngMax = twosComp((rng >> 4) & 0xF) # << 12
+    rngMin = twosComp((rng >> 0) & 0xF) # << 12
+    Imax = int(rngMax[:, 0].max())
+    Imin = int(rngMin[:, 0].min())
+    Qmax = int(rngMax[:, 1].max())
+    Qmin = int(rngMin[:, 1].min())
     
     return (data, (Imax, Imin, Qmax, Qmin))
 
@@ -1,9 +1,12 @@
+import random
+
 import numpy as np
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from labrad.devices import DeviceWrapper
 from labrad import types as T
+from labrad.util import wakeupCall
 
 from util import littleEndian, TimedLock
 
@@ -180,33 +183,35 @@ def processReadback(resp):
     }
 
 def pktWriteSram(device, derp, data):
-    assert 0 <= derp < device.buildParams['SRAM_WRITE_DERPS'], "SRAM derp out of range: %d" % derp 
-    data = np.asarray(data)
-    pkt = np.zeros(1026, dtype='<u1')
-    pkt[0] = (derp >> 0) & 0xFF
-    pkt[1] = (derp >> 8) & 0xFF
-    pkt[2:2+len(data)*4:4] = (data >> 0) & 0xFF
-    pkt[3:3+len(data)*4:4] = (data >> 8) & 0xFF
-    pkt[4:4+len(data)*4:4] = (data >> 16) & 0xFF
-    pkt[5:5+len(data)*4:4] = (data >> 24) & 0xFF
-    #a, b, c, d = littleEndian(data)
-    #pkt[2:2+len(data)*4:4] = a
-    #pkt[3:3+len(data)*4:4] = b
-    #pkt[4:4+len(data)*4:4] = c
-    #pkt[5:5+len(data)*4:4] = d
-    return pkt
+    """Make a packet to write up to one derp of SRAM words."""
+    return pktsWriteSram(device, derp, data)[0]
+
+def pktsWriteSram(device, derp, data):
+    """Make packets to write SRAM words, one derp per packet, starting at derp.
+    
+    The packets are the rows of the returned uint8 array.  The words are
+    put in place as a byte view of the uint32 data, and the last derp is
+    padded with zeros.
+    """
+    data = np.ascontiguousarray(data, dtype='<u4')
+    derpLen = device.buildParams['SRAM_WRITE_PKT_LEN']
+    n = max((len(data) + derpLen - 1) / derpLen, 1)
+    derps = np.arange(derp, derp + n)
+    assert 0 <= derps[0] and derps[-1] < device.buildParams['SRAM_WRITE_DERPS'], "SRAM derp out of range: %d" % derps[-1]
+    words = np.zeros(n * derpLen, dtype='<u4')
+    words[:len(data)] = data
+    pkts = np.zeros((n, 1026), dtype='<u1')
+    pkts[:, 0] = derps & 0xFF
+    pkts[:, 1] = (derps >> 8) & 0xFF
+    pkts[:, 2:2+derpLen*4] = words.view('<u1').reshape(n, derpLen*4)
+    return pkts
 
 def pktWriteMem(page, data):
-    data = np.asarray(data)
+    """Make a packet to write memory commands, the low 3 bytes of each word."""
+    data = np.ascontiguousarray(data, dtype='<u4')
     pkt = np.zeros(769, dtype='<u1')
     pkt[0] = page
-    pkt[1:1+len(data)*3:3] = (data >> 0) & 0xFF
-    pkt[2:2+len(data)*3:3] = (data >> 8) & 0xFF
-    pkt[3:3+len(data)*3:3] = (data >> 16) & 0xFF
-    #a, b, c = littleEndian(data, 3)
-    #pkt[1:1+len(data)*3:3] = a
-    #pkt[2:2+len(data)*3:3] = b
-    #pkt[3:3+len(data)*3:3] = c
+    pkt[1:1+len(data)*3] = data.view('<u1').reshape(-1, 4)[:, :3].ravel()
     return pkt
 
 
@@ -278,19 +283,23 @@ class DacDevice(DeviceWrapper):
         return self.server.packet(context=self.ctx)
 
     def makeSRAM(self, data, p, page=0):
-        """Update a packet for the ethernet server with SRAM commands."""
+        """Update a packet for the ethernet server with SRAM commands.
+        
+        data is an array of SRAM words.
+        """
+        if not len(data):
+            return
         #Set starting write derp to the beginning of the chosen SRAM page
         writeDerp = page * self.buildParams['SRAM_PAGE_LEN'] / self.buildParams['SRAM_WRITE_PKT_LEN']
-        #Crete SRAM write commands and add them to the packet for the direct ethernet server
-        while len(data) > 0:
-            chunk, data = data[:self.buildParams['SRAM_WRITE_PKT_LEN']*4], data[self.buildParams['SRAM_WRITE_PKT_LEN']*4:]
-            chunk = np.fromstring(chunk, dtype='<u4')
-            pkt = pktWriteSram(self, writeDerp, chunk)
+        #Create SRAM write commands and add them to the packet for the direct ethernet server
+        for pkt in pktsWriteSram(self, writeDerp, data):
             p.write(pkt.tostring())
-            writeDerp += 1
 
     def makeMemory(self, data, p, page=0):
-        """Update a packet for the ethernet server with Memory commands."""
+        """Update a packet for the ethernet server with Memory commands.
+        
+        data is an array of memory commands.
+        """
         if len(data) > MEM_PAGE_LEN:
             msg = "Memory length %d exceeds maximum memory length %d (one page)."
             raise Exception(msg % (len(data), MEM_PAGE_LEN))
@@ -315,7 +324,7 @@ class DacDevice(DeviceWrapper):
         will not happen
         """
         p = self.makePacket()
-        p.timeout(T.Value(timeout, 's'))
+        p.timeout(T.Value(timeout, 's'), key='timeout')
         p.collect(nPackets)
         # note that if a timeout error occurs the remainder of the packet
         # is discarded, so that the trigger command will not be sent
@@ -436,12 +445,13 @@ class DacDevice(DeviceWrapper):
         return self.testMode(func)
         
     def initPLL(self):
-        @inlineCallbacks
-        def func():
-            yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-            regs = regRunSram(self, 0, 0, loop=False) #Run sram with startAddress=endAddress=0. Run once, no loop.
-            yield self._sendRegisters(regs, readback=False)
-        return self.testMode(func)
+        return self.testMode(self._initPLL)
+    
+    @inlineCallbacks
+    def _initPLL(self):
+        yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
+        regs = regRunSram(self, 0, 0, loop=False) #Run sram with startAddress=endAddress=0. Run once, no loop.
+        yield self._sendRegisters(regs, readback=False)
         
     def queryPLL(self):
         @inlineCallbacks
@@ -452,11 +462,12 @@ class DacDevice(DeviceWrapper):
         return self.testMode(func)
     
     def resetPLL(self):
-        @inlineCallbacks
-        def func():
-            regs = regPllReset()
-            yield self._sendRegisters(regs)
-        return self.testMode(func)
+        return self.testMode(self._resetPLL)
+    
+    @inlineCallbacks
+    def _resetPLL(self):
+        regs = regPllReset()
+        yield self._sendRegisters(regs)
     
     def debugOutput(self, word1, word2, word3, word4):
         @inlineCallbacks
@@ -471,9 +482,9 @@ class DacDevice(DeviceWrapper):
             pkt = regPing()
             yield self._sendRegisters(pkt)
                 
-            data = np.array(dataIn, dtype='<u4').tostring()
+            data = np.array(dataIn, dtype='<u4')
             yield self._sendSRAM(data)
-            startAddr, endAddr = 0, len(data) / 4
+            startAddr, endAddr = 0, len(data)
     
             pkt = regRunSram(self, startAddr, endAddr, loop, blockDelay)
             yield self._sendRegisters(pkt, readback=False)
@@ -492,102 +503,104 @@ class DacDevice(DeviceWrapper):
         return self.testMode(self._setPolarity, chan, invert)
     
     def setLVDS(self, cmd, sd, optimizeSD):
-        @inlineCallbacks
-        # See U:\John\ProtelDesigns\GHzDAC_R3_1\Documentation\HardRegProgram.txt
-        # for how this function works.
-        def func():
-            #TODO: repeat LVDS measurement five times and average results.
-            pkt = [[0x0400 + (i<<4), 0x8500, 0x0400 + i, 0x8500][j]
-                   for i in range(16) for j in range(4)]
-    
-            if optimizeSD is True:
-                # Find the leading/trailing edges of the DATACLK_IN clock. First
-                # set SD to 0. Then, for bits from 0 to 15, set MSD to this bit
-                # and MHD to 0, read the check bit, set MHD to this bit and MSD
-                # to 0, read the check bit.
-                answer = yield self._runSerial(cmd, [0x0500] + pkt)
-                answer = [answer[i*2+2] & 1 for i in range(32)]
-    
-                # Locate where the check bit changes from 1 to 0 for both MSD and MHD.
-                MSD = -2
-                MHD = -2
-                for i in range(16):
-                    if MSD == -2 and answer[i*2] == 1: MSD = -1
-                    if MSD == -1 and answer[i*2] == 0: MSD = i
-                    if MHD == -2 and answer[i*2+1] == 1: MHD = -1
-                    if MHD == -1 and answer[i*2+1] == 0: MHD = i
-                MSD = max(MSD, 0)
-                MHD = max(MHD, 0)
-                # Find the optimal SD based on MSD and MHD.
-                t = (MHD-MSD)/2 & 0xF
-                setMSDMHD = False
-            elif sd is None:
-                # Get the SD value from the registry.
-                t = int(self.boardParams['lvdsSD']) & 0xF
-                MSD, MHD = -1, -1
-                setMSDMHD = True
-            else:
-                # This occurs if the SD is not specified (by optimization or in
-                # the registry).
-                t = sd & 0xF
-                MSD, MHD = -1, -1
-                setMSDMHD = True
-    
-            # Set the SD and check that the resulting difference between MSD and
-            # MHD is no more than one bit. Any more indicates noise on the line.
-            answer = yield self._runSerial(cmd, [0x0500 + (t<<4)] + pkt)
-            MSDbits = [bool(answer[i*4+2] & 1) for i in range(16)]
-            MHDbits = [bool(answer[i*4+4] & 1) for i in range(16)]
-            MSDswitch = [(MSDbits[i+1] != MSDbits[i]) for i in range(15)]
-            MHDswitch = [(MHDbits[i+1] != MHDbits[i]) for i in range(15)]
-            leadingEdge = MSDswitch.index(True)
-            trailingEdge = MHDswitch.index(True)
-            if setMSDMHD:
-                if sum(MSDswitch)==1: MSD = leadingEdge
-                if sum(MHDswitch)==1: MHD = trailingEdge
-            if abs(trailingEdge-leadingEdge)<=1 and sum(MSDswitch)==1 and sum(MHDswitch)==1:
-                success = True
-            else:
-                success = False
-            checkResp = yield self._runSerial(cmd, [0x8500])
-            checkHex = checkResp[0] & 0x7
-            returnValue((success, MSD, MHD, t, (range(16), MSDbits, MHDbits), checkHex))
-        return self.testMode(func)
+        return self.testMode(self._setLVDS, cmd, sd, optimizeSD)
+    
+    # See U:\John\ProtelDesigns\GHzDAC_R3_1\Documentation\HardRegProgram.txt
+    # for how this function works.
+    @inlineCallbacks
+    def _setLVDS(self, cmd, sd, optimizeSD):
+        #TODO: repeat LVDS measurement five times and average results.
+        pkt = [[0x0400 + (i<<4), 0x8500, 0x0400 + i, 0x8500][j]
+               for i in range(16) for j in range(4)]
+
+        if optimizeSD is True:
+            # Find the leading/trailing edges of the DATACLK_IN clock. First
+            # set SD to 0. Then, for bits from 0 to 15, set MSD to this bit
+            # and MHD to 0, read the check bit, set MHD to this bit and MSD
+            # to 0, read the check bit.
+            answer = yield self._runSerial(cmd, [0x0500] + pkt)
+            answer = [answer[i*2+2] & 1 for i in range(32)]
+
+            # Locate where the check bit changes from 1 to 0 for both MSD and MHD.
+            MSD = -2
+            MHD = -2
+            for i in range(16):
+                if MSD == -2 and answer[i*2] == 1: MSD = -1
+                if MSD == -1 and answer[i*2] == 0: MSD = i
+                if MHD == -2 and answer[i*2+1] == 1: MHD = -1
+                if MHD == -1 and answer[i*2+1] == 0: MHD = i
+            MSD = max(MSD, 0)
+            MHD = max(MHD, 0)
+            # Find the optimal SD based on MSD and MHD.
+            t = (MHD-MSD)/2 & 0xF
+            setMSDMHD = False
+        elif sd is None:
+            # Get the SD value from the registry.
+            t = int(self.boardParams['lvdsSD']) & 0xF
+            MSD, MHD = -1, -1
+            setMSDMHD = True
+        else:
+            # This occurs if the SD is not specified (by optimization or in
+            # the registry).
+            t = sd & 0xF
+            MSD, MHD = -1, -1
+            setMSDMHD = True
+
+        # Set the SD and check that the resulting difference between MSD and
+        # MHD is no more than one bit. Any more indicates noise on the line.
+        answer = yield self._runSerial(cmd, [0x0500 + (t<<4)] + pkt)
+        MSDbits = [bool(answer[i*4+2] & 1) for i in range(16)]
+        MHDbits = [bool(answer[i*4+4] & 1) for i in range(16)]
+        MSDswitch = [(MSDbits[i+1] != MSDbits[i]) for i in range(15)]
+        MHDswitch = [(MHDbits[i+1] != MHDbits[i]) for i in range(15)]
+        leadingEdge = MSDswitch.index(True)
+        trailingEdge = MHDswitch.index(True)
+        if setMSDMHD:
+            if sum(MSDswitch)==1: MSD = leadingEdge
+            if sum(MHDswitch)==1: MHD = trailingEdge
+        if abs(trailingEdge-leadingEdge)<=1 and sum(MSDswitch)==1 and sum(MHDswitch)==1:
+            success = True
+        else:
+            success = False
+        checkResp = yield self._runSerial(cmd, [0x8500])
+        checkHex = checkResp[0] & 0x7
+        returnValue((success, MSD, MHD, t, (range(16), MSDbits, MHDbits), checkHex))
     
     def setFIFO(self, chan, op, targetFifo):
+        return self.testMode(self._setFIFO, chan, op, targetFifo)
+    
+    @inlineCallbacks
+    def _setFIFO(self, chan, op, targetFifo):
         if targetFifo is None:
             # Grab targetFifo from registry if not specified.
             targetFifo = int(self.boardParams['fifoCounter'])
-        @inlineCallbacks
-        def func():
-            # set clock polarity to positive
-            clkinv = False
-            yield self._setPolarity(chan, clkinv)
-    
-            tries = 1
-            found = False
-    
-            while tries <= MAX_FIFO_TRIES and not found:
-                # Send all four PHOFs & measure resulting FIFO counters. If one
-                # of these equals targetFifo, set the PHOF and check that the
-                # FIFO counter is indeed targetFifo. If so, break out.
-                pkt =  [0x0700, 0x8700, 0x0701, 0x8700, 0x0702, 0x8700, 0x0703, 0x8700]
-                reading = yield self._runSerial(op, pkt)
-                fifoCounters = np.array([(reading[i]>>4) & 0xF for i in [1, 3, 5, 7]])
-                PHOF, found = yield self._checkPHOF(op, fifoCounters, targetFifo)
-                if found:
-                    break
-                else:
-                    # If none of PHOFs gives FIFO counter of targetFifo
-                    # initially or after verification, flip clock polarity and
-                    # try again.
-                    clkinv = not clkinv
-                    yield self._setPolarity(chan, clkinv)
-                    tries += 1
-    
-            ans = found, clkinv, PHOF, tries, targetFifo
-            returnValue(ans)
-        return self.testMode(func)
+        # set clock polarity to positive
+        clkinv = False
+        yield self._setPolarity(chan, clkinv)
+
+        tries = 1
+        found = False
+
+        while tries <= MAX_FIFO_TRIES and not found:
+            # Send all four PHOFs & measure resulting FIFO counters. If one
+            # of these equals targetFifo, set the PHOF and check that the
+            # FIFO counter is indeed targetFifo. If so, break out.
+            pkt =  [0x0700, 0x8700, 0x0701, 0x8700, 0x0702, 0x8700, 0x0703, 0x8700]
+            reading = yield self._runSerial(op, pkt)
+            fifoCounters = np.array([(reading[i]>>4) & 0xF for i in [1, 3, 5, 7]])
+            PHOF, found = yield self._checkPHOF(op, fifoCounters, targetFifo)
+            if found:
+                break
+            else:
+                # If none of PHOFs gives FIFO counter of targetFifo
+                # initially or after verification, flip clock polarity and
+                # try again.
+                clkinv = not clkinv
+                yield self._setPolarity(chan, clkinv)
+                tries += 1
+
+        ans = found, clkinv, PHOF, tries, targetFifo
+        returnValue(ans)
     
     @inlineCallbacks
     def _checkPHOF(self, op, fifoReadings, counterValue):
@@ -613,56 +626,90 @@ class DacDevice(DeviceWrapper):
     
     def runBIST(self, cmd, shift, dataIn):
         """Run a BIST on the given SRAM sequence. (DAC only)"""
-        @inlineCallbacks
-        def func():
-            pkt = regRunSram(self, 0, 0, loop=False)
-            yield self._sendRegisters(pkt, readback=False)
-    
-            dat = [d & 0x3FFF for d in dataIn]
-            data = [0, 0, 0, 0] + [d << shift for d in dat]
-            # make sure data is at least 20 words long by appending 0's
-            data += [0] * (20-len(data))
-            data = np.array(data, dtype='<u4').tostring()
-            yield self._sendSRAM(data)
-            startAddr, endAddr = 0, len(data) / 4
-            yield self._runSerial(cmd, [0x0004, 0x1107, 0x1106])
+        return self.testMode(self._runBIST, cmd, shift, dataIn)
     
-            pkt = regRunSram(self, startAddr, endAddr, loop=False)
-            yield self._sendRegisters(pkt, readback=False)
+    @inlineCallbacks
+    def _runBIST(self, cmd, shift, dataIn):
+        pkt = regRunSram(self, 0, 0, loop=False)
+        yield self._sendRegisters(pkt, readback=False)
+
+        dat = [d & 0x3FFF for d in dataIn]
+        data = [0, 0, 0, 0] + [d << shift for d in dat]
+        # make sure data is at least 20 words long by appending 0's
+        data += [0] * (20-len(data))
+        data = np.array(data, dtype='<u4')
+        yield self._sendSRAM(data)
+        startAddr, endAddr = 0, len(data)
+        yield self._runSerial(cmd, [0x0004, 0x1107, 0x1106])
+
+        pkt = regRunSram(self, startAddr, endAddr, loop=False)
+        yield self._sendRegisters(pkt, readback=False)
+
+        seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
+        theory = tuple(bistChecksum(dat))
+        bist = yield self._runSerial(cmd, seq)
+        reading = [(bist[i+4] <<  0) + (bist[i+3] <<  8) +
+                   (bist[i+2] << 16) + (bist[i+1] << 24)
+                   for i in [0, 5, 10, 15]]
+        lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
+
+        # lvds and fifo may be reversed.  This is okay
+        lvds = lvds[::-1] if lvds[::-1] == theory else lvds
+        fifo = fifo[::-1] if fifo[::-1] == theory else fifo
+        returnValue((lvds == theory and fifo == theory, theory, lvds, fifo))
+
+    def bringup(self, lvdsOptimize=False, lvdsSD=None, signed=True, targetFifo=None):
+        """Initialize the PLL, then set LVDS and FIFO and run the BIST on each DAC.
+        
+        Returns a list with one tuple of (key, value) pairs for each DAC, see
+        the DAC Bringup setting of the FPGA server.
+        """
+        return self.testMode(self._bringup, lvdsOptimize, lvdsSD, signed, targetFifo)
     
-            seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
-            theory = tuple(bistChecksum(dat))
-            bist = yield self._runSerial(cmd, seq)
-            reading = [(bist[i+4] <<  0) + (bist[i+3] <<  8) +
-                       (bist[i+2] << 16) + (bist[i+1] << 24)
-                       for i in [0, 5, 10, 15]]
-            lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
-    
-            # lvds and fifo may be reversed.  This is okay
-            lvds = lvds[::-1] if lvds[::-1] == theory else lvds
-            fifo = fifo[::-1] if fifo[::-1] == theory else fifo
-            returnValue((lvds == theory and fifo == theory, theory, lvds, fifo))
-        return self.testMode(func)
+    @inlineCallbacks
+    def _bringup(self, lvdsOptimize, lvdsSD, signed, targetFifo):
+        """Bring up the board, see bringup.  Must be run in test mode."""
+        ans = []
+        yield self._resetPLL()
+        yield wakeupCall(0.100)
+        yield self._initPLL()
+        for dac in ['A','B']:
+            ansDAC = [('dac',dac)]
+            cmd, shift = {'A': (2, 0), 'B': (3, 14)}[dac]
+            pkt = [0x0024, 0x0004, 0x1603, 0x0500] if signed else \
+                  [0x0026, 0x0006, 0x1603, 0x0500]
+            yield self._runSerial(cmd, pkt)
+            lvdsAns = yield self._setLVDS(cmd, lvdsSD, lvdsOptimize)
+            lvdsKeys = ['lvdsSuccess','lvdsMSD','lvdsMHD','lvdsSD','lvdsTiming','lvdsCheck']
+            for key,val in zip(lvdsKeys,lvdsAns):
+                ansDAC.append((key,val))
+            fifoAns = yield self._setFIFO(dac, cmd, targetFifo)
+            fifoKeys = ['fifoSuccess','fifoClockPolarity','fifoPHOF','fifoTries','fifoCounter']
+            for key,val in zip(fifoKeys,fifoAns):
+                ansDAC.append((key,val))
+            bistData = [random.randint(0, 0x3FFF) for i in range(1000)]
+            bistAns = yield self._runBIST(cmd, shift, bistData)
+            bistKeys = ['bistSuccess','bistTheory','bistLVDS','bistFIFO']
+            for key,val in zip(bistKeys,bistAns):
+                ansDAC.append((key,val))
+            ans.append(tuple(ansDAC))
+        returnValue(ans)
     
 
 def shiftSRAM(device, cmds, page):
     """Shift the addresses of SRAM calls for different pages.
 
-    Takes a list of memory commands and a page number and
-    modifies the commands for calling SRAM to point to the
-    appropriate page.
+    Takes an array of memory commands and a page number and
+    returns a copy in which the commands for calling SRAM point
+    to the appropriate page.
     """
-    def shiftAddr(cmd):
-        opcode, address = getOpcode(cmd), getAddress(cmd)
-        if opcode in [0x8, 0xA]: 
-            address += page * device.buildParams['SRAM_PAGE_LEN']
-            return (opcode << 20) + address
-        else:
-            return cmd
-    return [shiftAddr(cmd) for cmd in cmds]
+    cmds = np.array(cmds, dtype='<u4')
+    opcodes = getOpcode(cmds)
+    cmds[(opcodes == 0x8) | (opcodes == 0xA)] += page * device.buildParams['SRAM_PAGE_LEN']
+    return cmds
 
 def getOpcode(cmd):
     return (cmd & 0xF00000) >> 20
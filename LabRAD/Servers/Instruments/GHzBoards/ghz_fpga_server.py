@@ -181,6 +181,8 @@ timeout = 20
 
 import sys
 import os
+import copy
+import hashlib
 import itertools
 import struct
 import time
@@ -189,7 +191,7 @@ def timeString():
     ts = '%s %s %s %s %s %s' %(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
     return ts
 
-import random
+from collections import deque, OrderedDict
 
 from msvcrt import getch, kbhit
 def waitForkey():
@@ -202,6 +204,7 @@ import numpy as np
 from twisted.internet import defer
 from twisted.internet.reactor import callLater
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import failure
 
 from labrad import types as T
 from labrad.devices import DeviceServer
@@ -209,7 +212,7 @@ from labrad.server import setting
 
 import adc
 import dac
-from util import TimedLock
+from telemetry import TimedLock, PipelineTelemetry, CollectTimes, TIMES_TO_KEEP
 
 from matplotlib import pyplot as plt
 
@@ -219,6 +222,19 @@ MASTER_SRAM_DELAY = 2 # microseconds for master to delay before SRAM to ensure s
 
 TIMEOUT_FACTOR = 10 # timing estimates are multiplied by this factor to determine sequence timeout
 
+DETECT_TIMEOUT = 1.0 # seconds to wait for responses to a full detection sweep
+DETECT_QUIET_TIME = 0.2 # a full sweep ends when no response arrives for this long
+QUICK_DETECT_TIMEOUT = 0.1 # seconds to wait for known boards to respond
+FULL_DETECT_INTERVAL = 3600 # seconds between full sweeps of all MAC addresses
+
+RUN_PLAN_CACHE_SIZE = 20 # run plans kept by each board group (see RunPlan)
+
+STREAM_CHUNK_REPS = 3000 # default reps per chunk of a streamed sequence
+STREAM_BUFFER_CHUNKS = 4 # chunks of a streamed sequence run ahead of the client
+MAX_REPS = 0xFFFF # reps are a 16 bit register on DAC and ADC boards
+
+BRINGUP_CONCURRENCY = 4 # boards of a board group brought up at once by Bringup All
+
 I2C_RB = 0x100
 I2C_ACK = 0x200
 I2C_RB_ACK = I2C_RB | I2C_ACK
@@ -230,9 +246,7 @@ I2C_END = 0x400
 #   (when a board does not belong to a board group) or 'production' mode
 #   (when a board does belong to a board group).  It would be nice if boards
 #   could be dynamically moved between groups, but we'll see about that...
-# TODO: store memory and SRAM as numpy arrays, rather than lists and strings, respectively
 # TODO: run sequences to verify the daisy-chain order automatically
-# TODO: when running adc boards in demodulation (streaming mode), check counters to verify that there is no packet loss
 # TODO: think about whether page selection and pipe semaphore can interact badly to slow down pipelining
 
 
@@ -258,12 +272,20 @@ class BoardGroup(object):
         self.ctx = server.context()
         #self.sourceMac = getLocalMac(port)
         self.pipeSemaphore = defer.DeferredSemaphore(NUM_PAGES)
+        self.testLock = defer.DeferredLock()
         self.pageNums = itertools.cycle(range(NUM_PAGES))
         self.pageLocks = [TimedLock() for _ in range(NUM_PAGES)]
         self.runLock = TimedLock()
         self.readLock = TimedLock()
         self.setupState = set()
-        self.runWaitTimes = []
+        self.runWaitTimes = deque(maxlen=TIMES_TO_KEEP)
+        self.telemetry = PipelineTelemetry()
+        self.collectTimes = CollectTimes() # learned collect timeouts, see RunPlan.timingKey
+        self.lastSeen = {} # mac: (devName, time)
+        self.lastFullDetection = None
+        self.fullDetectionRequested = False
+        self.runPlans = OrderedDict() # key: RunPlan, least recently used first
+        self.pagePlans = [None] * NUM_PAGES # plan whose sequence data is loaded in each page
         self.prevTriggers = 0
     
     @inlineCallbacks
@@ -283,16 +305,62 @@ class BoardGroup(object):
     def configure(self, name, boards):
         """Update configuration for this board group."""
         self.name = name
+        self.boards = boards
         self.boardOrder = ['%s %s' % (name, boardName) for (boardName, delay) in boards]
         self.boardDelays = [delay for (boardName, delay) in boards]
+        # cached plans and collect times depend on the board order and delays
+        self.runPlans.clear()
+        self.pagePlans = [None] * NUM_PAGES
+        self.collectTimes.reset()
         
+    def knownMacs(self):
+        """Get the MAC addresses of the boards we expect on this board group.
+
+        These are the boards configured for this group in the registry
+        and all boards that have been detected before.
+        """
+        macs = set(self.lastSeen.keys())
+        for boardName, delay in self.boards:
+            for module, boardType in [(dac, 'DAC'), (adc, 'ADC')]:
+                if boardType in boardName:
+                    try:
+                        macs.add(module.macFor(int(boardName.split()[-1])))
+                    except ValueError:
+                        pass
+        return macs
+
+    def needFullDetection(self):
+        """Check whether the next detection should sweep all MAC addresses."""
+        return (self.fullDetectionRequested or
+                self.lastFullDetection is None or
+                time.time() - self.lastFullDetection > FULL_DETECT_INTERVAL or
+                not len(self.knownMacs()))
+
     @inlineCallbacks
-    def detectBoards(self):
+    def detectBoards(self, full=None):
         """Detect boards on the ethernet adapter managed by this board group.
         
+        Normally only the known boards (see knownMacs) are pinged, and we
+        stop listening as soon as they have all answered or after a short
+        timeout.  Boards that are not known yet are only found by a full
+        sweep of all 256 MAC addresses per board type, which is done the
+        first time, every FULL_DETECT_INTERVAL seconds, or when asked for
+        with full=True or requestFullDetection.
+        
         The autodetect operation is guarded by board group locks so that it
-        will not conflict with sequences running on this board group.
+        will not conflict with sequences running on this board group.  The
+        locks are released as soon as the responses are in.
         """
+        if full is None:
+            full = self.needFullDetection()
+        if full:
+            dacMacs = adcMacs = None
+            timeout = DETECT_TIMEOUT
+        else:
+            known = self.knownMacs()
+            dacMacs = sorted(mac for mac in known if dac.isMac(mac))
+            adcMacs = sorted(mac for mac in known if adc.isMac(mac))
+            timeout = QUICK_DETECT_TIMEOUT
         try:
             # acquire all locks so we can ping boards without
             # interfering with board group operations
@@ -303,16 +371,13 @@ class BoardGroup(object):
             yield self.runLock.acquire()
             yield self.readLock.acquire()
             
+            # boards may have been replaced or power cycled,
+            # so we no longer know what is loaded in their pages
+            self.pagePlans = [None] * NUM_PAGES
+            
             # detect each board type in its own context
-            detections = [self.detectDACs(), self.detectADCs()]
+            detections = [self.detectDACs(dacMacs, timeout), self.detectADCs(adcMacs, timeout)]
             answer = yield defer.DeferredList(detections, consumeErrors=True)
-            found = []
-            for success, result in answer:
-                if success:
-                    found.extend(result)
-                else:
-                    print 'autodetect error:'
-                    result.printTraceback()
             
             # clear any detection packets which may be buffered in device contexts
             #TODO: check that this actually clears packets
@@ -320,8 +385,6 @@ class BoardGroup(object):
             clears = []
             for dev in devices:
                 clears.append(dev.clear().send())
-            
-            returnValue(found)
         finally:
             # release all locks once we're done with autodetection
             for i in xrange(NUM_PAGES):
@@ -330,9 +393,33 @@ class BoardGroup(object):
                 pageLock.release()
             self.runLock.release()
             self.readLock.release()
+        
+        found = []
+        for success, result in answer:
+            if success:
+                found.extend(result)
+            else:
+                print 'autodetect error:'
+                result.printTraceback()
+        now = time.time()
+        for devName, args in found:
+            board = args[4]
+            module = adc if ' ADC ' in devName else dac
+            self.lastSeen[module.macFor(board)] = (devName, now)
+        if full:
+            self.lastFullDetection = now
+            self.fullDetectionRequested = False
+        returnValue(found)
+
+    def requestFullDetection(self):
+        """Make the next detection sweep all MAC addresses."""
+        self.fullDetectionRequested = True
 
-    def detectDACs(self, timeout=1.0):
-        """Try to detect DAC boards on this board group."""
+    def detectDACs(self, macs=None, timeout=DETECT_TIMEOUT):
+        """Try to detect DAC boards on this board group.
+        
+        By default all 256 DAC MAC addresses are tried.
+        """
         def callback(src, data):
             board = int(src[-2:], 16)
             info = dac.processReadback(data)
@@ -340,11 +427,15 @@ class BoardGroup(object):
             devName = '%s DAC %d' % (self.name, board)
             args = devName, self, self.server, self.port, board, build
             return (devName, args)
-        macs = [dac.macFor(board) for board in range(256)]
-        return self._doDetection(macs, dac.regPing(), dac.READBACK_LEN, callback)
+        if macs is None:
+            macs = [dac.macFor(board) for board in range(256)]
+        return self._doDetection(macs, dac.regPing(), dac.READBACK_LEN, callback, timeout)
     
-    def detectADCs(self, timeout=1.0):
-        """Try to detect ADC boards on this board group."""
+    def detectADCs(self, macs=None, timeout=DETECT_TIMEOUT):
+        """Try to detect ADC boards on this board group.
+        
+        By default all 256 ADC MAC addresses are tried.
+        """
         def callback(src, data):
             board = int(src[-2:], 16) #16 indicates number base for conversion from string to integer
             info = adc.processReadback(data)
@@ -352,17 +443,22 @@ class BoardGroup(object):
             devName = '%s ADC %d' % (self.name, board)
             args = devName, self, self.server, self.port, board, build
             return (devName, args)
-        macs = [adc.macFor(board) for board in range(256)]
-        return self._doDetection(macs, adc.regPing(), adc.READBACK_LEN, callback)
+        if macs is None:
+            macs = [adc.macFor(board) for board in range(256)]
+        return self._doDetection(macs, adc.regPing(), adc.READBACK_LEN, callback, timeout)
 
     @inlineCallbacks
-    def _doDetection(self, macs, packet, respLength, callback, timeout=1.0):
+    def _doDetection(self, macs, packet, respLength, callback, timeout=DETECT_TIMEOUT):
         """Try to detect a boards at the specified mac addresses.
         
         For each response of the correct length received within the timeout from
         one of the given mac addresses, the callback function will be called and
-        should return data to be added to the list of found devices. 
+        should return data to be added to the list of found devices.  We stop
+        listening once all boards have responded, or when no response has
+        arrived for DETECT_QUIET_TIME.
         """
+        if not len(macs):
+            returnValue([])
         try:
             ctx = self.server.context()
             
@@ -371,7 +467,7 @@ class BoardGroup(object):
             p.connect(self.port)
             #p.source_mac(self.sourceMac)
             p.require_length(respLength)
-            p.timeout(T.Value(timeout, 's'))
+            p.timeout(T.Value(min(timeout, DETECT_QUIET_TIME), 's'))
             p.listen()
             for mac in macs:
                 p.destination_mac(mac)
@@ -380,10 +476,12 @@ class BoardGroup(object):
             # listen for responses
             start = time.time()
             found = []
-            while (len(found) < len(macs)) and (time.time() - start < timeout):
+            waiting = set(macs)
+            while len(waiting) and (time.time() - start < timeout):
                 try:
                     src, dst, eth, data = yield self.server.read(context=ctx)
-                    if src in macs:
+                    if src in waiting:
+                        waiting.remove(src)
                         devInfo = callback(src, data)
                         found.append(devInfo)
                 except T.Error:
@@ -405,16 +503,43 @@ class BoardGroup(object):
         This makes sure that all currently-executing pipeline stages
         are finished by acquiring the pipe semaphore for all pages,
         then runs the function, and finally releases the semaphore
-        to allow the pipeline to continue.
+        to allow the pipeline to continue.  Test mode calls take turns
+        on the test lock, so that two of them never each hold part of
+        the semaphore while waiting for the rest.
         """
-        for i in xrange(NUM_PAGES):
-            yield self.pipeSemaphore.acquire()
+        yield self.testLock.acquire()
         try:
-            ans = yield func(*a, **kw)
-            returnValue(ans)
-        finally:
             for i in xrange(NUM_PAGES):
-                self.pipeSemaphore.release()
+                yield self.pipeSemaphore.acquire()
+            try:
+                # test mode functions may write memory or SRAM directly
+                self.pagePlans = [None] * NUM_PAGES
+                ans = yield func(*a, **kw)
+                returnValue(ans)
+            finally:
+                for i in xrange(NUM_PAGES):
+                    self.pipeSemaphore.release()
+        finally:
+            self.testLock.release()
+
+    def bringup(self, devs, func, concurrency=BRINGUP_CONCURRENCY):
+        """Bring up several boards concurrently in test mode.
+        
+        func(dev) is called for each board and should return a Deferred.
+        It is called while we are in test mode, so it must use the device
+        functions that do not enter test mode themselves (such as
+        _bringup), or it would wait for us forever.  The board group stays
+        in test mode until all boards are done, and at most concurrency
+        boards are brought up at once, so that the direct ethernet server
+        is not flooded.  Returns a list of (success, result) pairs in the
+        order of devs, as from a DeferredList, so that a failed board gets
+        a Failure and does not stop the others.
+        """
+        def bringupAll():
+            sem = defer.DeferredSemaphore(concurrency)
+            ds = [sem.run(func, dev) for dev in devs]
+            return defer.DeferredList(ds, consumeErrors=True)
+        return self.testMode(bringupAll)
 
 
     def makePackets(self, runners, page, reps, timingOrder, sync=249):
@@ -462,10 +587,14 @@ class BoardGroup(object):
         packets have the right destination MAC and therefore arrive in
         the right place.
         """
-        # dictionary of devices to be run
+        loadPkts = self.makeLoadPackets(runners, page)
+        setupPkts = self.makeSetupPackets(runners)
+        runPkts, collectPkts, readPkts = self.makeRepsPackets(runners, page, timingOrder, sync)
+        return loadPkts, setupPkts, runPkts, collectPkts, readPkts
+
+    def makeLoadPackets(self, runners, page):
+        """Make packets to upload sequence data (pipelined)."""
         runnerInfo = dict((runner.dev.devName, runner) for runner in runners)
-        
-        # upload sequence data (pipelined)
         loadPkts = []
         for board in self.boardOrder:
             if board in runnerInfo:
@@ -474,9 +603,11 @@ class BoardGroup(object):
                 p = runner.loadPacket(page, isMaster)
                 if p is not None:
                     loadPkts.append(p)
-        
-        # setup board state (not pipelined)
-        # Build a list of (setupPacket, setupState)
+        return loadPkts
+
+    def makeSetupPackets(self, runners):
+        """Make a list of (setupPacket, setupState) to set up board state (not pipelined)."""
+        runnerInfo = dict((runner.dev.devName, runner) for runner in runners)
         setupPkts = []
         for board in self.boardOrder:
             if board in runnerInfo:
@@ -484,6 +615,14 @@ class BoardGroup(object):
                 p = runner.setupPacket()
                 if p is not None:
                     setupPkts.append(p)
+        return setupPkts
+
+    def makeRepsPackets(self, runners, page, timingOrder, sync=249):
+        """Make the run, collect and read packets.
+        
+        These are the only packets that depend on the number of reps.
+        """
+        runnerInfo = dict((runner.dev.devName, runner) for runner in runners)
         # Run all boards (master last)
         # Set the first board which is both in the boardOrder and
         # which is also in the list of runners for this sequence as
@@ -517,8 +656,58 @@ class BoardGroup(object):
         seqTime = max(runner.seqTime for runner in runners)
         collectPkts = [runner.collectPacket(seqTime, self.ctx) for runner in runners]
         readPkts = [runner.readPacket(timingOrder) for runner in runners]
-            
-        return loadPkts, setupPkts, runPkts, collectPkts, readPkts
+        return runPkts, collectPkts, readPkts
+
+    def runPlan(self, key, makeRunners):
+        """Get the cached run plan for a key, or make a new one.
+        
+        makeRunners is called to get the runners for a new plan.  The
+        key must identify everything that goes into the packets except
+        for the page and the number of reps (see FPGAServer.sequence_run).
+        """
+        plan = self.runPlans.pop(key, None)
+        if plan is None:
+            runners = makeRunners()
+            runnerInfo = dict((runner.dev.devName, runner) for runner in runners)
+            master = [runnerInfo[board] for board in self.boardOrder if board in runnerInfo][:1]
+            plan = RunPlan(runners, master[0] if master else None)
+        if RUN_PLAN_CACHE_SIZE:
+            self.runPlans[key] = plan
+            while len(self.runPlans) > RUN_PLAN_CACHE_SIZE:
+                self.runPlans.popitem(last=False)
+        return plan
+
+    def forgetPlan(self, page, pageable=True):
+        """Forget which plan is loaded in a page, before loading it with something else.
+        
+        Sequences that are not pageable use SRAM from all pages, so loading
+        one clears all pages, and loading any page clears them.
+        """
+        for i, loaded in enumerate(self.pagePlans):
+            if i == page or not pageable or (loaded is not None and not loaded.pageable):
+                self.pagePlans[i] = None
+
+    def planPackets(self, plan, runners, page, timingOrder, sync):
+        """Get the packets to run a plan on a page, building them if needed.
+        
+        runners are the plan's runners for this call (see RunPlan.runners).
+        Returns the same packets as makePackets.  Load and setup packets
+        are built once per plan and page, the other packets again only when
+        the number of reps changes.  Packets can be sent any number of times
+        and the only parts we change later, the number of triggers to wait for
+        in the run packets and the timeout of the collect packets, are set
+        right before sending under the run lock, so sequences in flight can
+        share them.
+        """
+        if page not in plan.loadPkts:
+            plan.loadPkts[page] = self.makeLoadPackets(plan.templates, page)
+        if plan.setupPkts is None:
+            plan.setupPkts = self.makeSetupPackets(plan.templates)
+        reps = runners[0].reps
+        if plan.repsPkts.get(page, (None,))[0] != reps:
+            plan.repsPkts[page] = (reps,) + self.makeRepsPackets(runners, page, timingOrder, sync)
+        runPkts, collectPkts, readPkts = plan.repsPkts[page][1:]
+        return plan.loadPkts[page], plan.setupPkts, runPkts, collectPkts, readPkts
 
     def makeRunPackets(self, data):
         """Create packets to run a set of boards.
@@ -555,10 +744,10 @@ class BoardGroup(object):
         return wait, run, both
 
     @inlineCallbacks
-    def run(self, runners, reps, setupPkts, setupState, sync, getTimingData, timingOrder):
+    def run(self, plan, runners, reps, setupPkts, setupState, sync, getTimingData, timingOrder):
         """Run a sequence on this board group."""
         # check whether this sequence will fit in just one page
-        if all(runner.pageable() for runner in runners):
+        if plan.pageable:
             # lock just one page
             page = self.pageNums.next()
             pageLocks = [self.pageLocks[page]]
@@ -568,7 +757,7 @@ class BoardGroup(object):
             page = 0
             pageLocks = self.pageLocks
         # prepare packets
-        pkts = self.makePackets(runners, page, reps, timingOrder, sync)
+        pkts = self.planPackets(plan, runners, page, timingOrder, sync)
         loadPkts, boardSetupPkts, runPkts, collectPkts, readPkts = pkts
         # add setup packets from boards (ADCs) to that provided in the args
         setupPkts.extend(pkt for pkt, state in boardSetupPkts) # this is a list
@@ -579,13 +768,22 @@ class BoardGroup(object):
                 # stage 1: load
                 for pageLock in pageLocks: # lock pages to be written
                     yield pageLock.acquire()
-                loadDone = self.sendAll(loadPkts, 'Load') #Send load packets. Do not wait for response.
-                                                          #We already acquired the page lock, so sending data to
-                                                          #SRAM and memory is kosher at this time
+                loadStart = time.time()
+                if self.pagePlans[page] is plan:
+                    # the last sequence loaded into this page was the same as ours,
+                    # e.g. the previous chunk of a streamed sequence, so skip the load
+                    loadDone = defer.succeed(None)
+                else:
+                    self.forgetPlan(page, plan.pageable)
+                    loadDone = self.sendAll(loadPkts, 'Load') #Send load packets. Do not wait for response.
+                                                              #We already acquired the page lock, so sending data to
+                                                              #SRAM and memory is kosher at this time
                 # stage 2: run
                 runNow = self.runLock.acquire() # Send a request for the run lock, do not wait for response.
                 try:
                     yield loadDone # wait until load is finished.
+                    self.pagePlans[page] = plan
+                    self.telemetry.record('load', time.time() - loadStart)
                     yield runNow # Wait for acquisition of the run lock.
                     
                     # Set the number of triggers needed before we can actually run.
@@ -607,7 +805,9 @@ class BoardGroup(object):
                         r = yield waitPkt.send() # if this fails, something BAD happened!
                         try:
                             # Then set up
+                            setupStart = time.time()
                             yield self.sendAll(setupPkts, 'Setup')
+                            self.telemetry.record('setup', time.time() - setupStart)
                             self.setupState = setupState
                         except Exception:
                             # if there was an error, clear setup state
@@ -619,13 +819,20 @@ class BoardGroup(object):
                         r = yield bothPkt.send() # if this fails, something BAD happened!
                     
                     # keep track of how long the packet waited before being able to run
-                    self.runWaitTimes.append(float(r['nTriggers']))
-                    if len(self.runWaitTimes) > 100:
-                        self.runWaitTimes.pop(0)
+                    runWait = r['nTriggers']['s']
+                    self.runWaitTimes.append(runWait)
+                    self.telemetry.record('run-wait', runWait)
                         
                     yield self.readLock.acquire() # wait for our turn to read data
                     # stage 3: collect
                     # Collect appropriate number of packets and then trigger the run context.
+                    # The timeout is learned from previous runs of this sequence if there
+                    # were enough, otherwise it is the static estimate of the runners.
+                    seqTime = max(runner.seqTime for runner in runners)
+                    seqTime = self.collectTimes.timeout(plan.timingKey, reps, seqTime)
+                    for p in collectPkts:
+                        p['timeout'] = T.Value(seqTime, 's')
+                    collectStart = time.time()
                     collectAll = defer.DeferredList([p.send() for p in collectPkts], consumeErrors=True)
         
                 finally:
@@ -649,6 +856,8 @@ class BoardGroup(object):
                     self.runLock.release()
                 # Wait for data to be collected.
                 results = yield collectAll
+                collectTime = time.time() - collectStart
+                self.telemetry.record('collect', collectTime)
             finally:
                 for pageLock in pageLocks:
                     pageLock.release()
@@ -664,15 +873,22 @@ class BoardGroup(object):
             
             # stage 4: read
             # no timeout, so go ahead and read data
+            self.collectTimes.record(plan.timingKey, reps, collectTime)
+            for runner in runners:
+                self.telemetry.countPackets(runner.dev.devName, runner.nPackets)
             boardOrder = [runner.dev.devName for runner in runners]
+            readStart = time.time()
             readAll = self.sendAll(readPkts, 'Read', boardOrder)
             self.readLock.release()
             #This line scales really badly with incrasing stats
             #At 9600 stats the next line takes 10s out of 20s per
             #sequence.
             results = yield readAll # wait for read to complete
+            self.telemetry.record('read', time.time() - readStart)
+            self.telemetry.countSequence(reps)
 
             if getTimingData:
+                extractStart = time.time()
                 allDacs = True
                 answers = []
                 boardResults = {}
@@ -718,6 +934,7 @@ class BoardGroup(object):
                     # have to use a cluster. Therefore, cast to a python
                     # tuple here.
                     answers = tuple(answers)
+                self.telemetry.record('extract', time.time() - extractStart)
                 returnValue(answers)
         finally:
             self.pipeSemaphore.release()
@@ -740,6 +957,30 @@ class BoardGroup(object):
                     msg += str(i) + (': %s\n\n' % m)
             raise Exception(msg)
         
+    def executionCounts(self, devs):
+        """Read the execution counters of several boards concurrently.
+
+        Each board gets one packet in its own context which clears the
+        packet buffer, pings the register and reads back the result.  All
+        packets are sent at once in test mode, so polling a whole daisy
+        chain costs about one round trip instead of one per board.
+        Counts are returned in the order of devs.
+        """
+        @inlineCallbacks
+        def func():
+            pkts = []
+            for dev in devs:
+                module = dac if isinstance(dev, dac.DacDevice) else adc
+                p = dev.clear()
+                p.write(module.regPing().tostring())
+                p.timeout(dev.timeout)
+                p.read(1)
+                pkts.append(p)
+            answers = yield self.sendAll(pkts, 'Execution Counts', [dev.devName for dev in devs])
+            counts = [executionCount(dev, ans.read[0][3]) for dev, ans in zip(devs, answers)]
+            returnValue(counts)
+        return self.testMode(func)
+
     def extractTiming(self, packets):
         """Extract timing data coming back from a readPacket."""
         data = ''.join(data[3:63] for data in packets)
@@ -969,6 +1210,12 @@ class FPGAServer(DeviceServer):
         c['daisy_chain'] = []
         c['timing_order'] = None
         c['master_sync'] = 249
+    
+    def expireContext(self, c):
+        """Drop the unfetched chunks of a streamed sequence."""
+        if 'stream' in c:
+            c['stream'].close()
+        DeviceServer.expireContext(self, c)
 
     ## remote settings
 
@@ -1024,6 +1271,37 @@ class FPGAServer(DeviceServer):
             devices = [name for name in devices if name.startswith(boardGroup)]
         return devices
 
+    @setting(13, 'Detect Boards', full='b', returns='*(ws)')
+    def detect_boards(self, c, full=True):
+        """Detect boards on all board groups and update the device list.
+        
+        If full is True (the default), all MAC addresses are swept, so that
+        new boards are found.  Otherwise only the known boards are pinged,
+        which is what happens on an ordinary refresh.  Returns the list of
+        devices, like List Devices.
+        """
+        if full:
+            for boardGroup in self.boardGroups.values():
+                boardGroup.requestFullDetection()
+        yield self.refreshDeviceList()
+        IDs, names = self.deviceLists()
+        returnValue(zip(IDs, names))
+
+    @setting(14, 'Last Seen', boardGroup='s', returns='*(sv)')
+    def last_seen(self, c, boardGroup=None):
+        """Get the time in seconds since each board last answered a detection ping.
+        
+        If the optional boardGroup argument is specified, then only those
+        boards belonging to that board group will be included.
+        """
+        if boardGroup is None:
+            groups = self.boardGroups.values()
+        else:
+            groups = [self.getBoardGroup(boardGroup)]
+        now = time.time()
+        return sorted((devName, now - t) for group in groups
+                                         for devName, t in group.lastSeen.values())
+
 
     ## Memory and SRAM upload
 
@@ -1038,9 +1316,7 @@ class FPGAServer(DeviceServer):
         #for this DAC object.
         dev = self.selectedDAC(c)
         d = c.setdefault(dev, {})
-        if not isinstance(data, str):
-            data = data.asarray.tostring()
-        d['sram'] = data
+        d['sram'] = sramWords(data)
 
     @setting(21, 'SRAM dual block',
              block0='*w: SRAM Words for first block',
@@ -1051,7 +1327,7 @@ class FPGAServer(DeviceServer):
         """Writes a dual-block SRAM sequence with a delay between the two blocks.
         
         COMMENTS
-        block0 and block1 should be passed in as byte strings.
+        block0 and block1 can also be passed in as byte strings.
         Recall that each SRAM word is 4 bytes ;)
         
         The amount of time spent idling between blocks is
@@ -1060,24 +1336,21 @@ class FPGAServer(DeviceServer):
         """
         dev = self.selectedDAC(c)
         d = c.setdefault(dev, {})
-        sram = d.get('sram', '')
-        #Convert SRAM blocks to byte strings
-        if not isinstance(block0, str):
-            block0 = block0.asarray.tostring()
-        if not isinstance(block1, str):
-            block1 = block1.asarray.tostring()
+        #Convert SRAM blocks to arrays of words
+        block0 = sramWords(block0)
+        block1 = sramWords(block1)
         #Block delays come in chunks of 1024ns. Thus we need to package
         #the desired delay into an integral number of delay blocks, with
         #the difference made up by adding data to block1
         delayPad = delay % dev.buildParams['SRAM_DELAY_LEN']
         delayBlocks = delay / dev.buildParams['SRAM_DELAY_LEN']
         # add padding to beginning of block1 to get delay right
-        block1 = block0[-4:] * delayPad + block1
+        block1 = np.hstack((np.repeat(block0[-1:], delayPad), block1))
         # add padding to end of block1 to ensure that its length is a
         # multiple of 4
-        endPad = 4 - (len(block1) / 4) % 4
+        endPad = 4 - len(block1) % 4
         if endPad != 4:
-            block1 = block1 + block1[-4:] * endPad
+            block1 = np.hstack((block1, np.repeat(block1[-1:], endPad)))
         d['sram'] = (block0, block1, delayBlocks)
 
     @setting(22, 'SRAM Address', addr='w', returns='')
@@ -1094,7 +1367,7 @@ class FPGAServer(DeviceServer):
         """Writes data to the Memory at the current starting address."""
         dev = self.selectedDAC(c)
         d = c.setdefault(dev, {})
-        d['mem'] = data
+        d['mem'] = np.asarray(data, dtype='<u4')
 
 
     # ADC configuration
@@ -1264,6 +1537,93 @@ class FPGAServer(DeviceServer):
         average mode return (*i,{I} *i{Q}); and ADC boards in demodulate
         mode also return (*i,{I} *i{Q}) for each channel.
         """
+        bg, plan, timingOrder, reps = self.sequencePlan(c, reps, getTimingData)
+        runners = plan.runners(reps)
+
+        # build setup requests
+        setupReqs = processSetupPackets(self.client, setupPkts)
+        
+        # run the sequence
+        d = bg.run(plan, runners, reps, setupReqs, set(setupState), c['master_sync'], getTimingData, timingOrder)
+        ans = yield self._timeoutDeferred(d, 60)
+        self.storeRanges(c, runners, getTimingData, timingOrder)
+        returnValue(ans)
+
+    @setting(51, 'Run Sequence Streamed', reps='w', chunkReps='w', getTimingData='b',
+                                          setupPkts='?{(((ww), s, ((s?)(s?)(s?)...))...)}',
+                                          setupState='*s',
+                                          returns='w')
+    def sequence_run_streamed(self, c, reps, chunkReps=STREAM_CHUNK_REPS, getTimingData=True,
+                              setupPkts=[], setupState=[]):
+        """Start a sequence with many reps, run as a series of chunks.
+        
+        The reps are split into chunks of chunkReps, each of which is run
+        like Run Sequence, with the chunks pipelined just like separate
+        sequences.  As all chunks run the same sequence, it is loaded only
+        once into each page.  Unlike Run Sequence, this returns right away
+        with the number of chunks.  The results of each chunk are then
+        fetched in order with Next Chunk, as they come in, and are in the
+        same format as for Run Sequence.  Concatenating the DAC timing data
+        or ADC demodulation data of all chunks gives the results of one run
+        with all reps.  ADC boards in average mode return their average for
+        each chunk.
+        
+        Both reps and chunkReps are rounded up to a multiple of 30 when DACs
+        are in the timing order, as for Run Sequence.  chunkReps is limited
+        to 65535, but reps is not.  Only STREAM_BUFFER_CHUNKS chunks are run
+        ahead of the client fetching them.  Starting another streamed sequence
+        in this context drops any results not fetched yet.
+        """
+        bg, plan, timingOrder, chunkReps = self.sequencePlan(c, min(reps, chunkReps), getTimingData)
+        if not 0 < chunkReps <= MAX_REPS:
+            raise Exception('Chunks must have between 1 and %d reps.' % MAX_REPS)
+        reps = roundReps(reps, timingOrder)
+        chunks = [chunkReps] * (reps / chunkReps)
+        if reps % chunkReps:
+            chunks.append(reps % chunkReps)
+        setupReqs = processSetupPackets(self.client, setupPkts)
+        sync = c['master_sync']
+        
+        def runChunk(chunk):
+            runners = plan.runners(chunk)
+            d = bg.run(plan, runners, chunk, list(setupReqs), set(setupState), sync, getTimingData, timingOrder)
+            d = self._timeoutDeferred(d, 60)
+            @d.addCallback
+            def done(ans):
+                self.storeRanges(c, runners, getTimingData, timingOrder)
+                return ans
+            return d
+        
+        if 'stream' in c:
+            c['stream'].close()
+        c['stream'] = SequenceStream(chunks, runChunk)
+        return len(chunks)
+
+    @setting(53, 'Next Chunk', returns=['*2w', '?', ''])
+    def sequence_next_chunk(self, c):
+        """Get the results of the next chunk of a streamed sequence.
+        
+        Waits for the chunk to finish if necessary.  See Run Sequence Streamed.
+        """
+        stream = c.get('stream', None)
+        if stream is None or not stream.remaining():
+            raise Exception('No chunks left from Run Sequence Streamed in this context.')
+        return stream.next()
+
+    def storeRanges(self, c, runners, getTimingData, timingOrder):
+        """For ADCs in demodulate mode, store their I and Q ranges to check for possible clipping."""
+        for runner in runners:
+            if getTimingData and isinstance(runner, AdcRunner) and runner.runMode == 'demodulate' and runner.dev.devName in timingOrder:
+                c[runner.dev]['ranges'] = runner.ranges
+
+    def sequencePlan(self, c, reps, getTimingData):
+        """Get the board group, run plan, timing order and rounded reps for a sequence."""
+        if len(c['daisy_chain']):
+            # run multiple boards, with first board as master
+            devs = [self.getDevice(c, name) for name in c['daisy_chain']]
+        else:
+            # run the selected device only (must be a DAC)
+            devs = [self.selectedDAC(c)]
         # determine timing order
         if getTimingData:
             if c['timing_order'] is None:
@@ -1277,24 +1637,30 @@ class FPGAServer(DeviceServer):
                 timingOrder = c['timing_order']
         else:
             timingOrder = []
-        #Round reps to multiple of 30 if DACs are in timing order
-        for chan in timingOrder:
-            if 'DAC' in chan:
-                # Round stats up to multiple of the timing packet length
-                reps += dac.TIMING_PACKET_LEN - 1
-                reps -= reps % dac.TIMING_PACKET_LEN
-                break
-        if len(c['daisy_chain']):
-            # run multiple boards, with first board as master
-            devs = [self.getDevice(c, name) for name in c['daisy_chain']]
-        else:
-            # run the selected device only (must be a DAC)
-            devs = [self.selectedDAC(c)]
+        reps = roundReps(reps, timingOrder)
         # check to make sure that all boards are in the same board group
         if len(set(dev.boardGroup for dev in devs)) > 1:
             raise Exception("Can only run multiboard sequence if all boards are in the same board group!")
         bg = devs[0].boardGroup
-        # build a list of runners which have necessary sequence information for each board
+        # Sequences that have been run before with the same boards, timing order
+        # and board contents reuse the runners and packets made the first time,
+        # see RunPlan. The contents are identified by digests.
+        digests = []
+        for dev in devs:
+            info = c.get(dev, {})
+            if isinstance(dev, dac.DacDevice):
+                digests.append(dacDigest(info))
+            elif isinstance(dev, adc.AdcDevice):
+                channels = dict((i, info[i]) for i in range(dev.buildParams['DEMOD_CHANNELS']) if i in info)
+                digests.append(adcDigest(info, channels))
+            else:
+                raise Exception("Unknown device type: %s" % dev)
+        key = (tuple(devs), tuple(timingOrder), c['master_sync'], tuple(digests))
+        plan = bg.runPlan(key, lambda: self.makeRunners(c, devs, reps))
+        return bg, plan, timingOrder, reps
+
+    def makeRunners(self, c, devs, reps):
+        """Build a list of runners which have necessary sequence information for each board."""
         runners = []
         for dev in devs:
             if isinstance(dev, dac.DacDevice):
@@ -1324,18 +1690,7 @@ class FPGAServer(DeviceServer):
             else:
                 raise Exception("Unknown device type: %s" % dev) 
             runners.append(runner)
-
-        # build setup requests
-        setupReqs = processSetupPackets(self.client, setupPkts)
-        
-        # run the sequence
-        d = bg.run(runners, reps, setupReqs, set(setupState), c['master_sync'], getTimingData, timingOrder)
-        ans = yield self._timeoutDeferred(d, 60)
-        # for ADCs in demodulate mode, store their I and Q ranges to check for possible clipping
-        for runner in runners:
-            if getTimingData and isinstance(runner, AdcRunner) and runner.runMode == 'demodulate' and runner.dev.devName in timingOrder:
-                c[runner.dev]['ranges'] = runner.ranges
-        returnValue(ans)
+        return runners
 
     @setting(52, 'Daisy Chain', boards='*s', returns='*s')
     def sequence_boards(self, c, boards=None):
@@ -1422,16 +1777,50 @@ class FPGAServer(DeviceServer):
         be the run packet wait time.  In other words, if you have non-zero
         times for the run-packet wait, then the pipe is saturated,
         and the experiment is running at full capacity.
+
+        Only the last 100 times are returned.  See 'Pipeline Telemetry'
+        for percentiles over all runs.
         """
         ans = []
         for (server, port), group in sorted(self.boardGroups.items()):
-            pageTimes = [lock.times for lock in group.pageLocks]
-            runTime = group.runLock.times
-            runWaitTime = group.runWaitTimes
-            readTime = group.readLock.times
+            pageTimes = [list(lock.times) for lock in group.pageLocks]
+            runTime = list(group.runLock.times)
+            runWaitTime = list(group.runWaitTimes)
+            readTime = list(group.readLock.times)
             ans.append(((server, port), (pageTimes[0], pageTimes[1], runTime, runWaitTime, readTime)))
         return ans
 
+    @setting(58, 'Pipeline Telemetry', reset='b',
+                 returns='*((sw){group}, *(swvvvv){stages}, *(swwv){boards}, (wwvv){sequences})')
+    def pipeline_telemetry(self, c, reset=False):
+        """Get percentiles of pipeline stage times and board throughput.
+
+        For each board group this returns:
+            stages: (name, count, p50, p90, p99, max) for the load, setup,
+                run-wait, collect, read and extract stages of Run Sequence,
+                followed by the waits for the page, run and read locks.
+                Times are in seconds.
+            boards: (name, runs, packets, packets per second) for each
+                board that has returned data.
+            sequences: (sequences, stats, sequences per second,
+                stats per second).
+        Rates are averaged since the last reset.  If reset is True, all
+        histograms and counters are cleared after they have been read.
+        """
+        ans = []
+        for (server, port), group in sorted(self.boardGroups.items()):
+            tel = group.telemetry
+            locks = [('page %d lock' % i, lock) for i, lock in enumerate(group.pageLocks)]
+            locks += [('run lock', group.runLock), ('read lock', group.readLock)]
+            stages = tel.stageSummary()
+            stages += [(name,) + lock.histogram.summary() for name, lock in locks]
+            ans.append(((server, port), stages, tel.boardSummary(), tel.sequenceSummary()))
+            if reset:
+                tel.reset()
+                for name, lock in locks:
+                    lock.histogram.reset()
+        return ans
+
 
     @setting(200, 'PLL Init', returns='')
     def pll_init(self, c, data):
@@ -1474,6 +1863,25 @@ class FPGAServer(DeviceServer):
         count = yield dev.executionCount()
         returnValue(int(count))
 
+    @setting(205, 'Execution Counts', boards='*s', returns='*i')
+    def execution_counts(self, c, boards=None):
+        """Read the execution counters of several boards at once (DAC and ADC)
+
+        If boards is not specified, the boards in the current daisy chain
+        are read.  All boards must belong to the same board group.  The
+        register pings are sent to all boards concurrently and the counts
+        are returned in the order of boards.
+        """
+        if boards is None:
+            boards = c['daisy_chain']
+        devs = [self.getDevice(c, name) for name in boards]
+        if not len(devs):
+            returnValue([])
+        if len(set(dev.boardGroup for dev in devs)) > 1:
+            raise Exception("Can only read execution counts if all boards are in the same board group!")
+        counts = yield devs[0].boardGroup.executionCounts(devs)
+        returnValue(counts)
+
     @setting(1080, 'DAC Debug Output', data='wwww', returns='')
     def dac_debug_output(self, c, data):
         """Outputs data directly to the output bus. (DAC only)"""
@@ -1732,30 +2140,7 @@ class FPGAServer(DeviceServer):
         the calibration parameters.
         """
         dev = self.selectedDAC(c)
-        ans = []
-        yield dev.resetPLL()
-        time.sleep(0.100)
-        yield dev.initPLL()
-        for dac in ['A','B']:
-            ansDAC = [('dac',dac)]
-            cmd, shift = {'A': (2, 0), 'B': (3, 14)}[dac]
-            pkt = [0x0024, 0x0004, 0x1603, 0x0500] if signed else \
-                  [0x0026, 0x0006, 0x1603, 0x0500]
-            yield dev.runSerial(cmd, pkt)
-            lvdsAns = yield dev.setLVDS(cmd, lvdsSD, lvdsOptimize)
-            lvdsKeys = ['lvdsSuccess','lvdsMSD','lvdsMHD','lvdsSD','lvdsTiming','lvdsCheck']
-            for key,val in zip(lvdsKeys,lvdsAns):
-                ansDAC.append((key,val))
-            fifoAns = yield dev.setFIFO(dac, cmd, targetFifo)
-            fifoKeys = ['fifoSuccess','fifoClockPolarity','fifoPHOF','fifoTries','fifoCounter']
-            for key,val in zip(fifoKeys,fifoAns):
-                ansDAC.append((key,val))
-            bistData = [random.randint(0, 0x3FFF) for i in range(1000)]
-            bistAns = yield dev.runBIST(cmd, shift, bistData)
-            bistKeys = ['bistSuccess','bistTheory','bistLVDS','bistFIFO']
-            for key,val in zip(bistKeys,bistAns):
-                ansDAC.append((key,val))
-            ans.append(tuple(ansDAC))
+        ans = yield dev.bringup(lvdsOptimize, lvdsSD, signed, targetFifo)
         returnValue(ans)
             
 
@@ -1817,10 +2202,52 @@ class FPGAServer(DeviceServer):
     def adc_bringup(self, c):
         """Runs the bringup procedure.
         
-        This code initializes the PLL and recalibrates the ADC.
+        This code initializes the PLL.
         """
         dev = self.selectedADC(c)
-        yield dev.initPLL()
+        yield dev.bringup()
+
+    @setting(2800, 'Bringup All', boardGroup='s', lvdsOptimize='b', lvdsSD='w', signed='b',
+                                  targetFifo='w', adcRecalibrate='b', concurrency='w',
+                                  returns='*(sbs*((ss)(sb)(sw)(sw)(sw)(s(*w*b*b))(sw)(sb)(sb)(si)(sw)(sw)(sb)(s(ww))(s(ww))(s(ww))))')
+    def bringup_all(self, c, boardGroup=None, lvdsOptimize=False, lvdsSD=None, signed=True,
+                    targetFifo=None, adcRecalibrate=False, concurrency=BRINGUP_CONCURRENCY):
+        """Runs the bringup procedure on all boards of a board group at once. (DAC and ADC)
+        
+        If boardGroup is not specified, the board group of the selected
+        device is used.  DACs are brought up as with DAC Bringup, using the
+        other arguments, and ADCs as with ADC Bringup, after which their
+        ADCs are recalibrated if adcRecalibrate is True.  At most concurrency boards are brought up at a time.
+        Returns one (board, success, error, DAC results) cluster per board,
+        sorted by board name.  Success is True if the bringup ran and every
+        FIFO calibration and BIST passed, and error is the error message if
+        it did not run through.  DAC results are the results of DAC Bringup,
+        and empty for ADCs and failed boards.
+        """
+        if boardGroup is None:
+            bg = self.selectedDevice(c).boardGroup
+        else:
+            bg = self.getBoardGroup(boardGroup)
+        if not concurrency:
+            raise Exception('Concurrency must be at least 1.')
+        devs = sorted(bg.devices(), key=lambda dev: dev.devName)
+        def func(dev):
+            # we are in test mode already, see BoardGroup.bringup
+            if isinstance(dev, dac.DacDevice):
+                return dev._bringup(lvdsOptimize, lvdsSD, signed, targetFifo)
+            return dev._bringup(adcRecalibrate)
+        results = yield bg.bringup(devs, func, concurrency)
+        ans = []
+        for dev, (success, result) in zip(devs, results):
+            if not success:
+                ans.append((dev.devName, False, result.getErrorMessage(), []))
+            elif isinstance(dev, dac.DacDevice):
+                okay = all(dict(dacAns)[key] for dacAns in result
+                                             for key in ['fifoSuccess', 'bistSuccess'])
+                ans.append((dev.devName, okay, '', result))
+            else:
+                ans.append((dev.devName, True, '', []))
+        returnValue(ans)
     
     # TODO: new settings
     # - set up ADC options for data readout, to be used with the next daisy-chain run
@@ -1846,21 +2273,35 @@ class DacRunner(object):
         self.mem = mem
         self.sram = sram
         self.blockDelay = None
+        self.isMaster = False
         self._fixDualBlockSram()
         
         if self.pageable():
             # shorten our sram data so that it fits in one page
-            # Why is there a factor of 4 here? Is this because each SRAM
-            # word is 4 bytes? Check John's documentation
-            self.sram = self.sram[:self.dev.buildParams['SRAM_PAGE_LEN']*4]
+            self.sram = self.sram[:self.dev.buildParams['SRAM_PAGE_LEN']]
         
-        # calculate expected number of packets
         self.nTimers = timerCount(self.mem)
-        self.nPackets = self.reps * self.nTimers / dac.TIMING_PACKET_LEN
-        # calculate sequence time
         self.memTime = sequenceTime_sec(self.mem)
+        self.setReps(reps)
+    
+    def setReps(self, reps):
+        """Set the number of reps and everything that depends on it."""
+        self.reps = reps
+        # calculate expected number of packets
+        self.nPackets = self.reps * self.nTimers / dac.TIMING_PACKET_LEN
+        # calculate sequence time, the collect timeout until actual collect
+        # times have been learned (see BoardGroup.collectTimes)
         self.seqTime = TIMEOUT_FACTOR * (self.memTime * self.reps) + 1 #Why is this +1 here?
     
+    def makeMaster(self):
+        """Add the master delays before SRAM, if not already done."""
+        if not self.isMaster:
+            self.isMaster = True
+            self.mem = addMasterDelay(self.mem)
+            #Recompute sequence time
+            self.memTime = sequenceTime_sec(self.mem) # recalculate sequence time
+            self.setReps(self.reps) #added Oct 2 2012 - DTS
+    
     def pageable(self):
         """Check whether sequence fits in one page, based on SRAM addresses called by mem commands"""
         return maxSRAM(self.mem) <= self.dev.buildParams['SRAM_PAGE_LEN']
@@ -1869,7 +2310,7 @@ class DacRunner(object):
         """If this sequence is for dual-block sram, fix memory addresses and build sram.
         
         When this function completes
-          1. self.sram will be a byte string to be written to the
+          1. self.sram will be an array of words to be written to the
              physical memory block
           2. self.blockDelay will be an integer, the number of times
              to repeate the delay block
@@ -1883,38 +2324,34 @@ class DacRunner(object):
         Output:
         |00000aaaaaaaaaaaaa|bbbbbb
         
-        The sram byte string is prepended with zeros to make sure that
+        The sram is prepended with zeros to make sure that
         our desired block0, represented by a's, lies with its end
         exactly at the end of the physical memory block0. The two blocks
-        are concatened forming a single byte string.
+        are concatened forming a single array.
         
         Note that because the sram sequence will be padded to take up the
         entire first block of SRAM (before the delay section), this
         disables paging.
         """
         #Note that as this function executes self.sram should be a tuple of
-        #(block0,block1,delay) where block0 and block1 are strings
+        #(block0,block1,delay) where block0 and block1 are arrays of words
         if isinstance(self.sram, tuple):
             # update addresses in memory commands that call into SRAM
             self.mem = fixSRAMaddresses(self.mem, self.sram, self.dev)
             
             # combine blocks into one sram sequence to be uploaded
             block0, block1, delayBlocks = self.sram
-            #Prepend bloock0 with \x00's so that the actual signal data
+            #Prepend block0 with zeros so that the actual signal data
             #exactly fills the first physical SRAM block
-            #Note block0 length in bytes = 4*block0 length in words
-            data = '\x00' * (self.dev.buildParams['SRAM_BLOCK0_LEN']*4 - len(block0)) + block0 + block1
-            self.sram = data
+            padding = np.zeros(self.dev.buildParams['SRAM_BLOCK0_LEN'] - len(block0), dtype='<u4')
+            self.sram = np.hstack((padding, block0, block1))
             self.blockDelay = delayBlocks
     
     def loadPacket(self, page, isMaster):
         """Create pipelined load packet.  For DAC, upload mem and SRAM."""
         if isMaster:
             # this will be the master, so add delays before SRAM
-            self.mem = addMasterDelay(self.mem)
-            #Recompute sequence time
-            self.memTime = sequenceTime_sec(self.mem) # recalculate sequence time
-            self.seqTime = TIMEOUT_FACTOR * (self.memTime * self.reps) + 1 #added Oct 2 2012 - DTS
+            self.makeMaster()
         return self.dev.load(self.mem, self.sram, page)
     
     def setupPacket(self):
@@ -1948,19 +2385,25 @@ class DacRunner(object):
 class AdcRunner(object):
     def __init__(self, dev, reps, runMode, startDelay, filter, channels):
         self.dev = dev
-        self.reps = reps
         self.runMode = runMode
         self.startDelay = startDelay
         self.filter = filter
         self.channels = channels
         if self.runMode == 'average':
             self.mode = adc.RUN_MODE_AVERAGE_DAISY
-            self.nPackets = self.dev.buildParams['AVERAGE_PACKETS']
         elif self.runMode == 'demodulate':
             self.mode = adc.RUN_MODE_DEMOD_DAISY
-            self.nPackets = reps
         else:
             raise Exception("Unknown run mode '%s' for board '%s'" % (self.runMode, self.dev.devName))
+        self.setReps(reps)
+    
+    def setReps(self, reps):
+        """Set the number of reps and everything that depends on it."""
+        self.reps = reps
+        if self.runMode == 'average':
+            self.nPackets = self.dev.buildParams['AVERAGE_PACKETS']
+        else:
+            self.nPackets = reps
         #16us acquisition time + 10us packet transmit. Not sure why the extra +1 is here
         self.seqTime = TIMEOUT_FACTOR * (26E-6 * self.reps) + 1
         
@@ -2007,12 +2450,165 @@ class AdcRunner(object):
     def extract(self, packets):
         """Extract timing data coming back from a readPacket."""
         if self.runMode == 'average':
-            return adc.extractAverage(packets)
+            return adc.extractAverage(packets, self.nPackets,
+                                      self.dev.buildParams.get('AVERAGE_PACKET_LEN', None))
         elif self.runMode == 'demodulate':
-            return adc.extractDemod(packets, self.dev.buildParams['DEMOD_CHANNELS_PER_PACKET'])
+            return adc.extractDemod(packets, self.dev.buildParams['DEMOD_CHANNELS_PER_PACKET'],
+                                    self.nPackets, self.dev.buildParams.get('DEMOD_PACKET_COUNTER', False))
+
+class RunPlan(object):
+    """Runners and prebuilt packets for running a sequence on a board group.
+    
+    Making the runners and packets for a sequence takes most of the time
+    the server spends per sequence, mostly in building the memory and SRAM
+    packets.  Board groups keep plans for recent sequences (see
+    BoardGroup.runPlan), so that when the same boards are run again with
+    the same sequence data only the packets that depend on the number of
+    reps are made again, and only if the reps have changed.
+    
+    The runners given to a new plan are kept as templates, with master
+    delays already added to the master.  Each run gets copies of them, so
+    that state such as the ADC demodulation ranges is not shared between
+    sequences in flight.
+    """
+    def __init__(self, runners, master=None):
+        if isinstance(master, DacRunner):
+            master.makeMaster()
+        self.templates = runners
+        self.pageable = all(runner.pageable() for runner in runners)
+        self.timingKey = timingDigest(runners)
+        self.loadPkts = {} # page: load packets
+        self.setupPkts = None
+        self.repsPkts = {} # page: (reps, runPkts, collectPkts, readPkts)
+    
+    def runners(self, reps):
+        """Get copies of the runners for a run with the given number of reps."""
+        runners = [copy.copy(runner) for runner in self.templates]
+        for runner in runners:
+            runner.setReps(reps)
+        return runners
+
+class SequenceStream(object):
+    """Chunks of a streamed sequence, run in order and handed out one at a time.
+    
+    runChunk is called with the reps of a chunk and returns a Deferred
+    that fires with its results.  At most NUM_PAGES chunks run at once,
+    and a new chunk is only started while fewer than maxBuffered results,
+    including those of running chunks, are waiting to be fetched with next,
+    so that a slow client does not make us hold all the data.  After a
+    chunk fails, no more chunks are started.
+    """
+    def __init__(self, chunks, runChunk, maxBuffered=STREAM_BUFFER_CHUNKS):
+        self.chunks = deque(chunks)
+        self.runChunk = runChunk
+        self.maxBuffered = max(maxBuffered, 1)
+        self.pending = deque()
+        self.running = 0
+        self.failed = False
+        self.fill()
+    
+    def fill(self):
+        """Start as many chunks as we may."""
+        while (len(self.chunks) and not self.failed and
+               self.running < NUM_PAGES and len(self.pending) < self.maxBuffered):
+            self.running += 1
+            d = self.runChunk(self.chunks.popleft())
+            self.pending.append(d)
+            d.addBoth(self._chunkDone)
+    
+    def _chunkDone(self, result):
+        self.running -= 1
+        if isinstance(result, failure.Failure):
+            self.failed = True
+            self.chunks.clear()
+        self.fill()
+        return result
+    
+    def remaining(self):
+        """Number of chunks that can still be fetched."""
+        return len(self.pending) + len(self.chunks)
+    
+    def next(self):
+        """Get a Deferred that fires with the results of the next chunk."""
+        d = self.pending.popleft()
+        self.fill()
+        return d
+    
+    def close(self):
+        """Drop the chunks that were not fetched.
+        
+        No more chunks are started.  Running chunks cannot be stopped, but
+        their results, and any errors, are discarded.
+        """
+        self.chunks.clear()
+        while len(self.pending):
+            self.pending.popleft().addErrback(lambda failure: None)
+
+def dacDigest(info):
+    """Digest of the memory, SRAM and start delay of a DAC in a context."""
+    h = hashlib.md5()
+    h.update('startDelay=%r;' % (info.get('startDelay', 0),))
+    mem = info.get('mem', None)
+    if mem is not None:
+        mem = np.asarray(mem, dtype='<u4').tostring()
+        h.update('mem=%d:%s;' % (len(mem), mem))
+    sram = info.get('sram', None)
+    if isinstance(sram, tuple):
+        block0, block1, delayBlocks = sram
+        block0, block1 = block0.tostring(), block1.tostring()
+        h.update('dual=%d:%s%d:%s%d;' % (len(block0), block0, len(block1), block1, delayBlocks))
+    elif sram is not None:
+        sram = sram.tostring()
+        h.update('sram=%d:%s;' % (len(sram), sram))
+    return h.digest()
+
+def adcDigest(info, channels):
+    """Digest of the run mode, filter and demodulation channels of an ADC in a context."""
+    h = hashlib.md5()
+    h.update('runMode=%r;startDelay=%r;' % (info.get('runMode', None), info.get('startDelay', None)))
+    if 'filterFunc' in info:
+        filterFunc = info['filterFunc'].tostring()
+        h.update('filter=%d:%s,%r,%r;' % (len(filterFunc), filterFunc,
+                                          info.get('filterStretchLen', None),
+                                          info.get('filterStretchAt', None)))
+    for i in sorted(channels):
+        # the sine and cosine tables follow from the amplitudes
+        params = sorted((k, v) for k, v in channels[i].items() if k not in ['sine', 'cosine'])
+        h.update('channel%d=%r;' % (i, params))
+    return h.digest()
+
+def timingDigest(runners):
+    """Digest of what determines how long a sequence takes, apart from the reps.
+    
+    Sequences with different SRAM data but the same boards, memory
+    sequences and run modes share a digest, and so share collect times.
+    """
+    h = hashlib.md5()
+    for runner in runners:
+        if isinstance(runner, DacRunner):
+            mem = np.asarray(runner.mem, dtype='<u4').tostring()
+            h.update('%s:mem=%d:%s,%r;' % (runner.dev.devName, len(mem), mem, runner.startDelay))
+        else:
+            h.update('%s:runMode=%s,%r;' % (runner.dev.devName, runner.runMode, runner.startDelay))
+    return h.digest()
 
 # some helper methods
     
+def sramWords(data):
+    """Get SRAM data, given as a byte string or a list of words, as an array of words."""
+    if isinstance(data, str):
+        return np.fromstring(data, dtype='<u4')
+    return np.asarray(data.asarray, dtype='<u4')
+
+def roundReps(reps, timingOrder):
+    """Round reps up to a multiple of the timing packet length if DACs are in the timing order."""
+    for chan in timingOrder:
+        if 'DAC' in chan:
+            reps += dac.TIMING_PACKET_LEN - 1
+            reps -= reps % dac.TIMING_PACKET_LEN
+            break
+    return reps
+
 def getCommand(cmds, chan):
     """Get a command from a dictionary of commands.
 
@@ -2022,7 +2618,14 @@ def getCommand(cmds, chan):
         return cmds[chan]
     except:
         raise Exception("Allowed channels are %s." % sorted(cmds.keys()))
-    
+
+def executionCount(dev, data):
+    """Get the execution counter from a register readback of a DAC or ADC board."""
+    if isinstance(dev, dac.DacDevice):
+        return int(dac.processReadback(data)['executionCounter'])
+    else:
+        return int(adc.processReadback(data)['executionCount'])
+
 def processSetupPackets(cxn, setupPkts):
     """Process packets sent in flattened form into actual labrad packets on the given connection."""
     pkts = []
@@ -2089,15 +2692,12 @@ def addMasterDelay(cmds, delay_us=MASTER_SRAM_DELAY):
     
     TODO: check for repeated delay calls to make sure delays actually happen
     """
-    newCmds = []
     delayCycles = int(delay_us * 25) #memory clock speed is 25MHz
     assert delayCycles < 0xFFFFF
     delayCmd = 0x300000 + delayCycles
-    for cmd in cmds:
-        if getOpcode(cmd) == 0xC: # call SRAM
-            newCmds.append(delayCmd) # add delay
-        newCmds.append(cmd)
-    return newCmds
+    cmds = np.asarray(cmds, dtype='<u4')
+    calls = np.flatnonzero(getOpcode(cmds) == 0xC) # call SRAM
+    return np.insert(cmds, calls, delayCmd) # add delay before each call
     
 def fixSRAMaddresses(mem, sram, device):
     """Set the addresses of SRAM calls for multiblock sequences.
@@ -2131,27 +2731,23 @@ def fixSRAMaddresses(mem, sram, device):
     in other words, endAddr is equal to
     # of 0s in block0 + # of -'s in block0 + # of -'s in block1 + DELAY
     """
-    block0Len_words = len(sram[0])/4
-    block1Len_words = len(sram[1])/4
-    delayBlocks = sram[2]
     if not isinstance(sram, tuple):
         return mem
-    numSramCalls = sum(getOpcode(cmd) == 0xC for cmd in mem)
+    block0Len_words = len(sram[0])
+    block1Len_words = len(sram[1])
+    delayBlocks = sram[2]
+    mem = np.array(mem, dtype='<u4')
+    opcodes = getOpcode(mem)
+    numSramCalls = np.sum(opcodes == 0xC)
     if numSramCalls > 1:
         raise Exception('Only one SRAM call allowed in multi-block sequences.')
-    def fixAddr(cmd):
-        opcode, address = getOpcode(cmd), getAddress(cmd)
-        if opcode == 0x8:
-            # SRAM start address
-            address = device.buildParams['SRAM_BLOCK0_LEN'] - block0Len_words
-            return (opcode << 20) + address
-        elif opcode == 0xA:
-            # SRAM end address
-            address = device.buildParams['SRAM_BLOCK0_LEN'] + block1Len_words + device.buildParams['SRAM_DELAY_LEN'] * delayBlocks - 1
-            return (opcode << 20) + address
-        else:
-            return cmd
-    return [fixAddr(cmd) for cmd in mem]
+    # SRAM start address
+    address = device.buildParams['SRAM_BLOCK0_LEN'] - block0Len_words
+    mem[opcodes == 0x8] = (0x8 << 20) + address
+    # SRAM end address
+    address = device.buildParams['SRAM_BLOCK0_LEN'] + block1Len_words + device.buildParams['SRAM_DELAY_LEN'] * delayBlocks - 1
+    mem[opcodes == 0xA] = (0xA << 20) + address
+    return mem
     
 def maxSRAM(cmds):
     """Determines the maximum SRAM address used in a memory sequence.
@@ -2159,9 +2755,9 @@ def maxSRAM(cmds):
     This is used to determine whether a given memory sequence is pageable,
     since only half of the available SRAM can be used when paging.
     """
-    def addr(cmd):
-        return getAddress(cmd) if getOpcode(cmd) in [0x8, 0xA] else 0
-    return max(addr(cmd) for cmd in cmds)
+    cmds = np.asarray(cmds)
+    opcodes = getOpcode(cmds)
+    return int(np.max(np.where((opcodes == 0x8) | (opcodes == 0xA), getAddress(cmds), 0)))
     
 def timerCount(cmds):
     """Return the number of timer stops in a memory sequence.
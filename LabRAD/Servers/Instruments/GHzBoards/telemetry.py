@@ -0,0 +1,281 @@
+import math
+import time
+from collections import deque, OrderedDict
+
+from twisted.internet import defer
+
+
+# +DOCUMENTATION
+#
+# Pipeline telemetry for the GHz FPGA server.
+#
+# Every stage of BoardGroup.run (load, setup, run-wait, collect, read and
+# extract) and every board group lock records its durations in a Histogram.
+# Histograms have a fixed number of log-spaced buckets, in the spirit of HDR
+# histograms, so they cost the same memory after a thousand runs as after a
+# million and percentiles can be read off at any time. Meters count packets
+# and sequences to get throughput.
+#
+# CollectTimes learns how long each sequence takes to collect, so that the
+# collect timeout can follow the observed times instead of a tenfold
+# overestimate, and a hung board is noticed sooner.
+#
+# All times are in seconds.
+
+STAGES = ['load', 'setup', 'run-wait', 'collect', 'read', 'extract']
+TIMES_TO_KEEP = 100
+
+COLLECT_TIMES_TO_KEEP = 100 # collect times kept for each sequence and number of reps
+COLLECT_SEQUENCES = 50 # sequences whose collect times are kept
+COLLECT_MIN_SAMPLES = 5 # collect times needed before the timeout is learned
+COLLECT_PERCENTILE = 99
+COLLECT_FACTOR = 2.0 # learned timeouts are this factor times the percentile
+COLLECT_MARGIN = 1.0 # plus this margin
+
+
+class Histogram(object):
+    """Fixed-memory histogram of non-negative values.
+
+    Each power of two between lowest and highest is split into subBuckets
+    equal buckets, so that a recorded value is known to within a relative
+    error of 1/(2*subBuckets). Values below lowest go into a single bucket
+    that reads as 0, values above highest into the top bucket, which reads
+    as the maximum. The exact minimum, maximum and sum are kept as well.
+    """
+
+    def __init__(self, lowest=1e-6, highest=1e3, subBuckets=32):
+        self.lowest = float(lowest)
+        self.subBuckets = subBuckets
+        octaves = int(math.ceil(math.log(highest / self.lowest, 2)))
+        self.counts = [0] * (1 + octaves * subBuckets)
+        self.reset()
+
+    def reset(self):
+        for i in xrange(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        """Get the bucket for a value."""
+        if value < self.lowest:
+            return 0
+        m, e = math.frexp(value / self.lowest) # value/lowest = m * 2**e, 0.5 <= m < 1
+        i = 1 + (e-1) * self.subBuckets + int((2*m - 1) * self.subBuckets)
+        return min(i, len(self.counts) - 1)
+
+    def value(self, index):
+        """Get the value in the middle of a bucket."""
+        if index == 0:
+            return 0.0
+        octave, sub = divmod(index - 1, self.subBuckets)
+        return self.lowest * 2**octave * (1 + (sub + 0.5) / self.subBuckets)
+
+    def record(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, q):
+        """Get the value below which q percent of the recorded values lie."""
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(q / 100.0 * self.count)), 1)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                if i == len(self.counts) - 1:
+                    return self.max
+                return min(max(self.value(i), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """Get (count, p50, p90, p99, max) of the recorded values."""
+        return (self.count, self.percentile(50), self.percentile(90),
+                self.percentile(99), self.max or 0.0)
+
+
+class Meter(object):
+    """Counts events and the packets they carry, to get rates."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.events = 0
+        self.total = 0
+        self.start = time.time()
+
+    def mark(self, n=0):
+        self.events += 1
+        self.total += n
+
+    def rates(self):
+        """Get events and total per second since the last reset."""
+        dt = time.time() - self.start
+        if dt <= 0:
+            return 0.0, 0.0
+        return self.events / dt, self.total / dt
+
+
+class TimedLock(object):
+    """
+    A lock that times how long it takes to acquire.
+
+    Waiters get the lock in the order they asked for it. Wait times go
+    into a histogram, and the most recent ones are kept in times.
+    """
+
+    locked = 0
+
+    def __init__(self):
+        self.waiting = deque()
+        self.histogram = Histogram()
+        self.times = deque(maxlen=TIMES_TO_KEEP)
+
+    def addTime(self, dt):
+        self.times.append(dt)
+        self.histogram.record(dt)
+
+    def meanTime(self):
+        return self.histogram.mean()
+
+    def acquire(self):
+        """Attempt to acquire the lock.
+
+        @return: a Deferred which fires on lock acquisition.
+        """
+        d = defer.Deferred()
+        if self.locked:
+            t = time.time()
+            self.waiting.append((d, t))
+        else:
+            self.locked = 1
+            self.addTime(0)
+            d.callback(0)
+        return d
+
+    def release(self):
+        """Release the lock.
+
+        Should be called by whomever did the acquire() when the shared
+        resource is free.
+        """
+        assert self.locked, "Tried to release an unlocked lock"
+        self.locked = 0
+        if self.waiting:
+            # someone is waiting to acquire lock
+            self.locked = 1
+            d, t = self.waiting.popleft()
+            dt = time.time() - t
+            self.addTime(dt)
+            d.callback(dt)
+
+
+class PipelineTelemetry(object):
+    """Stage durations, board packet counts and sequence rates of a board group."""
+
+    def __init__(self, stages=STAGES):
+        self.stages = [(name, Histogram()) for name in stages]
+        self._byName = dict(self.stages)
+        self.boards = {}
+        self.sequences = Meter()
+
+    def record(self, stage, dt):
+        self._byName[stage].record(dt)
+
+    def countPackets(self, board, n):
+        """Count one run of a board that returned n packets."""
+        if board not in self.boards:
+            self.boards[board] = Meter()
+        self.boards[board].mark(n)
+
+    def countSequence(self, reps):
+        self.sequences.mark(reps)
+
+    def reset(self):
+        for name, hist in self.stages:
+            hist.reset()
+        self.boards.clear()
+        self.sequences.reset()
+
+    def stageSummary(self):
+        """Get (stage, count, p50, p90, p99, max) for every stage."""
+        return [(name,) + hist.summary() for name, hist in self.stages]
+
+    def boardSummary(self):
+        """Get (board, runs, packets, packets per second) for every board."""
+        ans = []
+        for board, meter in sorted(self.boards.items()):
+            runRate, packetRate = meter.rates()
+            ans.append((board, meter.events, meter.total, packetRate))
+        return ans
+
+    def sequenceSummary(self):
+        """Get (sequences, stats, sequences per second, stats per second)."""
+        seqRate, statRate = self.sequences.rates()
+        return (self.sequences.events, self.sequences.total, seqRate, statRate)
+
+
+class CollectTimes(object):
+    """Learns collect timeouts from the collect times of successful runs.
+
+    Times are kept for the most recent sequences, each identified by a key
+    (e.g. a digest of the memory sequences) and a number of reps.  Once a
+    sequence has been collected minSamples times, its timeout is factor
+    times the given percentile of its recent collect times plus margin,
+    but never more than the static estimate passed to timeout.  Until then
+    the static estimate is used.
+    """
+
+    def __init__(self, history=COLLECT_TIMES_TO_KEEP, sequences=COLLECT_SEQUENCES,
+                 minSamples=COLLECT_MIN_SAMPLES, percentile=COLLECT_PERCENTILE,
+                 factor=COLLECT_FACTOR, margin=COLLECT_MARGIN):
+        self.history = history
+        self.sequences = sequences
+        self.minSamples = minSamples
+        self.percentile = percentile
+        self.factor = factor
+        self.margin = margin
+        self.times = OrderedDict() # (key, reps): deque of times, least recently used first
+
+    def record(self, key, reps, dt):
+        """Record the collect time of a successful run."""
+        times = self.times.pop((key, reps), None)
+        if times is None:
+            times = deque(maxlen=self.history)
+        times.append(dt)
+        self.times[key, reps] = times
+        while len(self.times) > self.sequences:
+            self.times.popitem(last=False)
+
+    def estimate(self, key, reps):
+        """Get the learned timeout for a sequence, or None if it has too few times."""
+        times = self.times.get((key, reps), ())
+        if len(times) < max(self.minSamples, 1):
+            return None
+        times = sorted(times)
+        rank = max(int(math.ceil(self.percentile / 100.0 * len(times))), 1)
+        return self.factor * times[rank - 1] + self.margin
+
+    def timeout(self, key, reps, default):
+        """Get the timeout for a sequence, with default as the static estimate."""
+        learned = self.estimate(key, reps)
+        if learned is None:
+            return default
+        return min(learned, default)
+
+    def reset(self):
+        self.times.clear()
@@ -45,6 +45,8 @@ if LABRAD_PATH not in sys.path:
 
 import numpy
 
+from twisted.internet.defer import inlineCallbacks
+
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from labrad.server import setting, returnValue
 import labrad.units as units
@@ -52,15 +54,98 @@ import labrad.units as units
 from LabRAD.Servers.Utilities.general import sleep
 
 
+FORM5_HEADER = 4    # '#A' followed by a two-byte data length.
+
+
+def decode_form5(buf, points=None):
+    """Decode a trace transferred in the FORM5 format (little-endian
+    IEEE 32-bit floats, real and imaginary parts interleaved) into
+    a complex128 array. If points is given, the data length is
+    verified against it.
+    """
+    data = numpy.frombuffer(buf, dtype='<c8',
+            offset=FORM5_HEADER).astype(numpy.complex128)
+    if points is not None and data.size != points:
+        raise ValueError('Expected %d points, received %d.'
+                %(points, data.size))
+    return data
+
+
+class Agilent8720ETWrapper(GPIBDeviceWrapper):
+    def initialize(self):
+        # Sweep configuration that is needed to trigger and read
+        # a trace. It is fetched once and reset by any setting that
+        # changes it.
+        self.sweepConfig = None
+
+    def invalidate(self):
+        self.sweepConfig = None
+
+    @inlineCallbacks
+    def getSweepConfig(self):
+        """Get the sweep configuration: the active channel, the number
+        of points of each channel (the channels may be uncoupled) and
+        the averaging state of the active channel.
+        """
+        if self.sweepConfig is None:
+            p = self._packet()
+            p.write('FORM5')
+            p.query('CHAN1?', key='chan1')
+            p.query('AVERO?', key='avg')
+            p.query('AVERFACT?', key='avgPoints')
+            resp = yield p.send()
+            channel = 1 if bool(int(resp.chan1)) else 2
+            p = self._packet()
+            for ch in (1, 2):
+                p.write('CHAN%i' %ch)
+                p.query('POIN?', key='points%i' %ch)
+            p.write('CHAN%i' %channel)
+            points = yield p.send()
+            self.sweepConfig = {'channel': channel,
+                                'points': dict((ch, int(float(points['points%i' %ch])))
+                                               for ch in (1, 2)),
+                                'avg': bool(int(resp.avg)),
+                                'avgPoints': int(float(resp.avgPoints))}
+        returnValue(self.sweepConfig)
+
+    @inlineCallbacks
+    def sweep(self):
+        """Trigger a sweep (or a group of sweeps if averaging is on)
+        and wait for it to complete."""
+        config = yield self.getSweepConfig()
+        if config['avg']:
+            yield self.write('AVERREST')
+            yield self.query('OPC?;NUMG%i' %config['avgPoints'])
+        else:
+            yield self.query('OPC?;SING')
+
+    @inlineCallbacks
+    def readChannels(self, channels):
+        """Read the traces of the given channels in a single GPIB
+        packet. The data are returned as a list of complex128 arrays.
+        The active channel is restored afterwards.
+        """
+        config = yield self.getSweepConfig()
+        p = self._packet()
+        for ch in channels:
+            p.write('CHAN%i;OUTPFORM;' %ch)
+            p.read_raw(key='ch%i' %ch)
+        p.write('CHAN%i' %config['channel'])
+        resp = yield p.send()
+        returnValue([decode_form5(resp['ch%i' %ch], config['points'][ch])
+                     for ch in channels])
+
+
 class Agilent8720ETServer(GPIBManagedServer):
     name = 'Agilent 8720ET Network Analyzer'
     deviceName = 'HEWLETT PACKARD 8720ET'
-    deviceWrapper = GPIBDeviceWrapper
+    deviceWrapper = Agilent8720ETWrapper
     
     @setting(431, 'Preset')
     def preset(self, c):
         """Reset the network analyzer."""
         dev = self.selectedDevice(c)
+        dev.invalidate()
         yield dev.query('OPC?;PRES')
         
     @setting(432, 'Start Frequency', freq=['v[Hz]'], returns=['v[Hz]'])
@@ -71,6 +156,7 @@ class Agilent8720ETServer(GPIBManagedServer):
             resp = yield dev.query('STAR?')
             freq = float(resp) * units.Hz
         else:
+            dev.invalidate()
             yield dev.write('STAR%i' %freq['Hz'])
         returnValue(freq)
     
@@ -82,6 +168,7 @@ class Agilent8720ETServer(GPIBManagedServer):
             resp = yield dev.query('STOP?')
             freq = float(resp) * units.Hz
         else:
+            dev.invalidate()
             yield dev.write('STOP%i' %freq['Hz'])
         returnValue(freq)
         
@@ -122,6 +209,7 @@ class Agilent8720ETServer(GPIBManagedServer):
             resp = yield dev.query('POIN?')
             pn = int(float(resp))
         else:
+            dev.invalidate()
             yield dev.write('POIN%i' %pn)
             t = yield dev.query('SWET?')
             yield sleep(2 * float(t)) # Be sure to wait for two sweep
@@ -136,6 +224,7 @@ class Agilent8720ETServer(GPIBManagedServer):
             resp = yield dev.query('AVERO?')
             avg = bool(int(resp))
         else:
+            dev.invalidate()
             if avg:
                 yield dev.write('AVEROON')
             else:
@@ -150,6 +239,7 @@ class Agilent8720ETServer(GPIBManagedServer):
             N = yield dev.query('AVERFACT?')
             aN = int(float(N))
         else:
+            dev.invalidate()
             yield dev.write('AVERFACT%i' %aN)
         returnValue(aN)
         
@@ -176,6 +266,24 @@ class Agilent8720ETServer(GPIBManagedServer):
             yield dev.write('POWE%iDB' %pow['dBm'])
         returnValue(pow)
         
+    @setting(440, 'Segmented Sweep', segments=['*(v[Hz], v[Hz], w)'])
+    def segmented_sweep(self, c, segments=None):
+        """Set up a list frequency sweep. Each segment is specified
+        as a (start frequency, stop frequency, number of points)
+        tuple. An empty list restores the linear frequency sweep.
+        """
+        dev = self.selectedDevice(c)
+        dev.invalidate()
+        if not segments:
+            yield dev.write('LINFREQ')
+            return
+        cmd = 'EDITLIST;CLEL;'
+        for start, stop, pn in segments:
+            cmd += ('SADD;STAR%i;STOP%i;POIN%i;SDON;'
+                    %(start['Hz'], stop['Hz'], pn))
+        cmd += 'EDITDONE;LISFREQ'
+        yield dev.write(cmd)
+
     @setting(450, 'Get Trace', returns=['*v[]'])
     def get_trace(self, c):
         """Get network analyzer trace. The output is complex and depends
@@ -185,30 +293,26 @@ class Agilent8720ETServer(GPIBManagedServer):
             "PHASE"  - real: degrees, imag: N/A;
             "REIM"   - real: real part (linear), imag: imaginary part\
                 (linear).
+        Only the real part is returned.
         """
         dev = self.selectedDevice(c)
-        yield dev.write('FORM5')
-        avgOn = yield self.average_mode(c)
-        
-        if avgOn:
-            numAvg = yield self.average_points(c)
-            yield dev.write('AVERREST')
-            yield dev.query('OPC;NUMG%i'%numAvg)
-        else:
-            sweepWait = float(waitTime)
-            yield dev.query('OPC;SING')
-            
-        
+        yield dev.sweep()
+        config = yield dev.getSweepConfig()
         yield dev.write('OUTPFORM;')
         dataBuffer = yield dev.read_raw()
-        rawData = numpy.fromstring(dataBuffer,dtype=numpy.float32)
-        data = numpy.empty((rawData.shape[-1] - 1) / 2)
-        real = rawData[1:-1:2]
-        imag = numpy.hstack((rawData[2:-1:2], rawData[-1])) #ugly...
-        
-        data = real;
-        
-        returnValue(data.astype(float))
+        data = decode_form5(dataBuffer, config['points'][config['channel']])
+        returnValue(data.real)
+
+    @setting(452, 'Get Traces', returns=['(*c, *c)'])
+    def get_traces(self, c):
+        """Trigger a sweep and get the complex traces of both channels
+        in a single GPIB packet. See 'Get Trace' for the meaning of the
+        real and imaginary parts.
+        """
+        dev = self.selectedDevice(c)
+        yield dev.sweep()
+        data = yield dev.readChannels((1, 2))
+        returnValue(tuple(data))
         
     @setting(451, 'Display Format', fmt=['s'], returns=['s'])
     def display_format(self, c, fmt=None):
@@ -254,6 +358,7 @@ class Agilent8720ETServer(GPIBManagedServer):
         """Initialize the network analyzer."""
         dev = self.selectedDevice(c)
         yield self.preset(c)
+        dev.invalidate()
         yield dev.write('CHAN1;AUXCOFF;S21;LOGM;AUTO')
         yield self.sweep_points(c, 801)
         print('Initialized...')
@@ -52,14 +52,44 @@ import labrad.units as units
 from LabRAD.Servers.Utilities.general import sleep
 
 
-class Agilent8720ETServer(GPIBManagedServer):
+TRACE_POINTS = 601         # Number of points in an 8560 E-series trace.
+MU_PER_SCREEN = 600.       # Measurement units per ten display divisions.
+
+
+def decode_trace(buf, start, stop, ref_level, log_scale):
+    """Decode a trace transferred in the 'TDF B' binary format.
+    
+    Input:
+        buf: raw string returned by the analyzer in response to 'TRA?',
+            601 big-endian 16-bit words in measurement units (0-610).
+        start, stop: sweep start and stop frequencies in Hz.
+        ref_level: reference level in dBm.
+        log_scale: scale in dB/div for the log display mode, 0 for
+            the linear display mode.
+    Output:
+        (f, P): frequencies in Hz and powers in dBm as numpy arrays.
+    """
+    mu = numpy.frombuffer(buf, dtype='>u2', count=TRACE_POINTS)
+    mu = mu.astype(float)
+    f = numpy.linspace(start, stop, TRACE_POINTS)
+    if log_scale:
+        P = ref_level + log_scale * (mu / (MU_PER_SCREEN / 10.) - 10.)
+    else:
+        # In the linear mode the reference level is at the top of the
+        # screen and the trace is linear in voltage.
+        with numpy.errstate(divide='ignore'):
+            P = ref_level + 20. * numpy.log10(mu / MU_PER_SCREEN)
+    return f, P
+
+
+class HP8565EServer(GPIBManagedServer):
     name = 'HP 8565E Spectrum Analyzer'
     deviceName = 'HEWLETT PACKARD 8565E'
     deviceWrapper = GPIBDeviceWrapper
     
     @setting(551, 'Preset')
     def preset(self, c):
-        """Reset the network analyzer."""
+        """Reset the spectrum analyzer."""
         dev = self.selectedDevice(c)
         yield dev.write('IP')
         
@@ -73,16 +103,119 @@ class Agilent8720ETServer(GPIBManagedServer):
         else:
             yield dev.write('CF %i' %freq['Hz'])
         returnValue(freq)
+        
+    @setting(553, 'Frequency Span', span=['v[Hz]'], returns=['v[Hz]'])
+    def frequency_span(self, c, span=None):
+        """Set or get the frequency span of the trace."""
+        dev = self.selectedDevice(c)
+        if span is None:
+            resp = yield dev.query('SP?')
+            span = float(resp) * units.Hz
+        else:
+            yield dev.write('SP %i' %span['Hz'])
+        returnValue(span)
+
+    @setting(554, 'Resolution Bandwidth', bw=['v[Hz]'], returns=['v[Hz]'])
+    def resolution_bandwidth(self, c, bw=None):
+        """Set or get the resolution bandwidth."""
+        dev = self.selectedDevice(c)
+        if bw is None:
+            resp = yield dev.query('RB?')
+            bw = float(resp) * units.Hz
+        else:
+            yield dev.write('RB %i' %bw['Hz'])
+        returnValue(bw)
+
+    @setting(555, 'Video Bandwidth', bw=['v[Hz]'], returns=['v[Hz]'])
+    def video_bandwidth(self, c, bw=None):
+        """Set or get the video bandwidth."""
+        dev = self.selectedDevice(c)
+        if bw is None:
+            resp = yield dev.query('VB?')
+            bw = float(resp) * units.Hz
+        else:
+            yield dev.write('VB %i' %bw['Hz'])
+        returnValue(bw)
+
+    @setting(556, 'Sweep Time', swt=['v[s]'], returns=['v[s]'])
+    def sweep_time(self, c, swt=None):
+        """Set or get the sweep time."""
+        dev = self.selectedDevice(c)
+        if swt is None:
+            resp = yield dev.query('ST?')
+            swt = float(resp) * units.s
+        else:
+            yield dev.write('ST %fSC' %swt['s'])
+        returnValue(swt)
+
+    @setting(557, 'Reference Level', rl=['v[dBm]'], returns=['v[dBm]'])
+    def reference_level(self, c, rl=None):
+        """Set or get the reference level."""
+        dev = self.selectedDevice(c)
+        if rl is None:
+            resp = yield dev.query('RL?')
+            rl = float(resp) * units.dBm
+        else:
+            yield dev.write('RL %fDB' %rl['dBm'])
+        returnValue(rl)
+
+    @setting(558, 'Single Sweep')
+    def single_sweep(self, c):
+        """Switch to the single sweep mode, trigger a sweep and wait
+        until it is complete.
+        """
+        dev = self.selectedDevice(c)
+        resp = yield dev.query('ST?')
+        yield dev.write('SNGLS;TS;')
+        # Do not block the GPIB bus while the sweep is in progress.
+        yield sleep(float(resp))
+        yield dev.query('DONE?')
+
+    @setting(559, 'Continuous Sweep')
+    def continuous_sweep(self, c):
+        """Return to the continuous sweep mode."""
+        dev = self.selectedDevice(c)
+        yield dev.write('CONTS')
+
+    @setting(560, 'Get Trace', sweep=['b'], returns=['(*v[Hz], *v[dBm])'])
+    def get_trace(self, c, sweep=True):
+        """Get trace A from the spectrum analyzer. If sweep is True
+        (default), a single sweep is taken before the trace transfer.
+        The trace is transferred in the binary 'TDF B' format and
+        returned as a (frequencies, powers) pair.
+        """
+        dev = self.selectedDevice(c)
+        if sweep:
+            yield self.single_sweep(c)
+        start = yield dev.query('FA?')
+        stop = yield dev.query('FB?')
+        ref_level = yield dev.query('RL?')
+        log_scale = yield dev.query('LG?')
+        yield dev.write('TDF B;TRA?;')
+        buf = yield dev.read_raw()
+        f, P = decode_trace(buf, float(start), float(stop),
+                float(ref_level), float(log_scale))
+        returnValue((f * units.Hz, P * units.dBm))
+
+    @setting(561, 'Peak Search', sweep=['b'], returns=['(v[Hz], v[dBm])'])
+    def peak_search(self, c, sweep=True):
+        """Return the frequency and the power of the highest point
+        on trace A. The search is done by the server rather than by
+        the instrument marker.
+        """
+        f, P = yield self.get_trace(c, sweep)
+        idx = numpy.argmax(P['dBm'])
+        returnValue((f[idx], P[idx]))
 
     @setting(949, 'Initialize')
     def initialize(self, c):
-        """Initialize the network analyzer."""
+        """Initialize the spectrum analyzer."""
         dev = self.selectedDevice(c)
         yield self.preset(c)
         print('Initialized...')
 
 
-__server__ = Agilent8720ETServer()
+__server__ = HP8565EServer()
 
 
 if __name__ == '__main__':
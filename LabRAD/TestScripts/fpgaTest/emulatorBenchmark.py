@@ -0,0 +1,174 @@
+"""
+End-to-end benchmark of run_sequence throughput against emulated boards.
+
+The Direct Ethernet Emulator server (LabRAD/Servers/DirectEthernet/
+direct_ethernet_emulator.py) stands in for the direct ethernet server and
+answers like real GHz DAC and ADC boards would, so the whole FPGA server
+pipeline (load, setup, run, collect, read) can be timed without hardware.
+
+To run the benchmark:
+1. Start the Direct Ethernet Emulator.
+2. Point a board group at it in the registry, e.g. in
+   ['', 'Servers', 'GHz FPGAs'] set
+   boardGroups = [('Emu', '<node> Direct Ethernet Emulator', 1, [('DAC 1', 0), ('ADC 1', 0)])]
+   Build parameters for the boards must be in the registry as usual
+   (dacBuildN, dacN and adcBuildN keys).
+3. Start the GHz FPGA server (or refresh its devices if it is running).
+Then
+
+>> report = benchmark(cxn, ['Emu DAC 1'], ['Emu ADC 1'], reps=3000, runs=200)
+>> printReport(report)
+
+addBoards creates the emulated boards if they are not in the emulator's
+registry key. Each of the `depth` pipelined run_sequence requests uses its
+own context on the FPGA server, so up to `depth` sequences are in flight,
+as with the pipelined sweeps in pyle.
+"""
+
+import time
+from collections import deque
+
+import numpy as np
+
+import ethernetStress
+
+EMULATOR = 'Direct Ethernet Emulator'
+FPGA_SERVER = 'GHz FPGAs'
+SRAM_LEN = 4000 # SRAM words (ns) played per repetition
+DEMOD_CHANNELS = 4
+FILTER_LEN = 4096
+
+
+def emulator(cxn):
+    """Find the direct ethernet emulator server on this connection."""
+    for name in cxn.servers:
+        if name.endswith(EMULATOR):
+            return cxn[name]
+    raise Exception('No direct ethernet emulator found.')
+
+def addBoards(cxn, port, boards, dacBuild, adcBuild):
+    """Add emulated boards for the given board names, e.g. 'Emu DAC 1'.
+
+    Boards that are already emulated are left alone. Remember to refresh
+    the FPGA server's devices afterwards.
+    """
+    em = emulator(cxn)
+    existing = set((p, kind, number) for p, kind, number, build, mac in em.boards())
+    for boardName in boards:
+        number, kind = ethernetStress.boardInfo(boardName)
+        if (port, kind, number) not in existing:
+            build = dacBuild if kind == 'DAC' else adcBuild
+            em.add_board(port, kind, number, build)
+
+def dacMemory(timers):
+    """Memory sequence playing SRAM_LEN ns of SRAM, with one timer if timers is True."""
+    mem = [0x000000,                 # NoOp
+           0x800000,                 # SRAM start address
+           0xA00000 + SRAM_LEN - 1,  # SRAM end address
+           0xC00000,                 # call SRAM
+           0x300190]                 # Delay 400+1 cycles = 16us for ADC demod
+    if timers:
+        mem.extend([0x400000,        # start timer
+                    0x300064,        # Delay 100+1 cycles = 4us
+                    0x400001])       # stop timer
+    mem.append(0xF00000)             # branch back to start
+    return mem
+
+def configure(fpga, context, dacs, adcs, timers):
+    """Upload sequences for all boards and set the daisy chain in one context."""
+    p = fpga.packet(context=context)
+    for dac in dacs:
+        p.select_device(dac)
+        p.memory(dacMemory(timers))
+        p.sram(np.zeros(SRAM_LEN, dtype='u4'))
+    for adc in adcs:
+        p.select_device(adc)
+        p.start_delay(0)
+        p.adc_run_mode('demodulate')
+        p.adc_filter_func(np.zeros(FILTER_LEN, dtype='<u1').tostring(), 0, 0)
+        for chan in range(DEMOD_CHANNELS):
+            p.adc_demod_phase(chan, 100*(chan+1), 0)
+            p.adc_trig_magnitude(chan, 255, 255)
+    p.daisy_chain(list(dacs) + list(adcs))
+    timingOrder = ['%s::%d' % (adc, chan) for adc in adcs for chan in range(DEMOD_CHANNELS)]
+    if timers:
+        timingOrder.extend(dacs)
+    p.timing_order(timingOrder)
+    p.send()
+
+def benchmark(cxn, dacs, adcs, reps=3000, runs=100, depth=2, timers=True,
+              getTimingData=True):
+    """Run a sequence many times and measure the throughput.
+
+    dacs and adcs are lists of device names on the FPGA server; the first
+    DAC is the master. Returns a report dictionary with the rate of
+    sequences and repetitions (stats) per second, the round trip times of
+    the run_sequence requests and the emulator statistics for the runs.
+    """
+    fpga = cxn[FPGA_SERVER]
+    em = emulator(cxn)
+    contexts = [cxn.context() for _ in range(depth)]
+    for ctx in contexts:
+        configure(fpga, ctx, dacs, adcs, timers)
+    em.reset_statistics()
+    pending = deque()
+    latencies = []
+    failures = 0
+    start = time.time()
+    for i in range(runs + depth):
+        # keep depth requests in flight
+        if len(pending) >= depth or (i >= runs and len(pending)):
+            t, req = pending.popleft()
+            try:
+                req.wait()
+            except Exception:
+                failures += 1
+            latencies.append(time.time() - t)
+        if i < runs:
+            p = fpga.packet(context=contexts[i % depth])
+            p.run_sequence(reps, getTimingData)
+            pending.append((time.time(), p.send(wait=False)))
+    elapsed = time.time() - start
+    latencies = np.array(latencies)
+    return {
+        'boards': list(dacs) + list(adcs),
+        'reps': reps,
+        'runs': runs,
+        'depth': depth,
+        'failures': failures,
+        'elapsed': elapsed,
+        'runsPerSecond': runs / elapsed,
+        'statsPerSecond': runs * reps / elapsed,
+        'latency': {
+            'mean': float(np.mean(latencies)),
+            'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(np.max(latencies)),
+        },
+        'emulator': dict(em.statistics()),
+        'timeScale': float(em.time_scale()),
+    }
+
+def printReport(report):
+    print 'Boards: %s' % ', '.join(report['boards'])
+    print '%d runs of %d reps, %d in flight (time scale %g): %.2f s' % (
+        report['runs'], report['reps'], report['depth'], report['timeScale'], report['elapsed'])
+    print '  %.2f sequences/s, %.0f stats/s, %d failed' % (
+        report['runsPerSecond'], report['statsPerSecond'], report['failures'])
+    lat = report['latency']
+    print '  round trip: mean %.1f ms, p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+        1e3*lat['mean'], 1e3*lat['p50'], 1e3*lat['p99'], 1e3*lat['max'])
+    print '  emulator: %s' % ', '.join('%s=%d' % kv for kv in sorted(report['emulator'].items()))
+
+
+if __name__ == '__main__':
+    import sys
+    import labrad
+    group = sys.argv[1] if len(sys.argv) > 1 else 'Emu'
+    cxn = labrad.connect()
+    fpga = cxn[FPGA_SERVER]
+    dacs = list(fpga.list_dacs(group))
+    adcs = list(fpga.list_adcs(group))
+    for depth in [1, 2, 4]:
+        printReport(benchmark(cxn, dacs, adcs, depth=depth))
+    cxn.disconnect()
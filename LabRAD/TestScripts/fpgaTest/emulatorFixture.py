@@ -0,0 +1,399 @@
+"""
+Run the GHz FPGA server against the Direct Ethernet Emulator in-process.
+
+This is a test fixture: no LabRAD manager is needed.  The FPGA server and
+the emulator (LabRAD/Servers/DirectEthernet/direct_ethernet_emulator.py)
+are created as ordinary objects, and the FPGA server talks to the emulator
+through EmulatorClient, which stands in for a LabRAD client of the direct
+ethernet server.  Packets are handled by calling the emulator's settings
+directly, with requests in the same context handled in order, as LabRAD
+does.  The registry is a dict, see Registry.
+
+>> fixture = EmulatorFixture([('DAC', 1), ('DAC', 2), ('ADC', 1)])
+>> yield fixture.start()
+>> fpga = fixture.fpga  # the GHz FPGA server, boards already detected
+>> c = fixture.context()
+>> fpga.select_device(c, 'Emu DAC 1')
+
+The settings of both servers are called directly with a context from
+fixture.context(); they return Deferreds.  Use it from tests that run the
+reactor, e.g. twisted.trial tests.
+"""
+
+import imp
+import os
+import sys
+
+import numpy as np
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from labrad.support import mangle
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+GHZ_DIR = os.path.join(REPO, 'LabRAD', 'Servers', 'Instruments', 'GHzBoards')
+for path in [REPO, GHZ_DIR]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import dac
+import adc
+import ghz_fpga_server
+
+emulator = imp.load_source('direct_ethernet_emulator',
+    os.path.join(REPO, 'LabRAD', 'Servers', 'DirectEthernet', 'direct_ethernet_emulator.py'))
+
+EMULATOR_NAME = 'Test Direct Ethernet Emulator'
+EMULATOR_ID = 10
+REGISTRY_ID = 2
+FPGA_SOURCE = 100 # connection ID of the FPGA server, as seen by the emulator
+GROUP = 'Emu'
+
+DAC_BUILD = 13
+ADC_BUILD = 7
+DAC_BUILD_PARAMS = [('SRAM_LEN', 18432), ('SRAM_PAGE_LEN', 9216),
+                    ('SRAM_DELAY_LEN', 1024), ('SRAM_BLOCK0_LEN', 16384),
+                    ('SRAM_WRITE_PKT_LEN', 256)]
+DAC_BOARD_PARAMS = [('fifoCounter', 3), ('lvdsSD', 3)]
+ADC_BUILD_PARAMS = [('DEMOD_CHANNELS', 4), ('DEMOD_CHANNELS_PER_PACKET', 11),
+                    ('AVERAGE_PACKETS', 32), ('AVERAGE_PACKET_LEN', 1024),
+                    ('TRIG_AMP', 255), ('LOOKUP_TABLE_LEN', 256),
+                    ('FILTER_LEN', 4096), ('SRAM_WRITE_DERPS', 9),
+                    ('SRAM_WRITE_PKT_LEN', 1024)]
+
+
+class Response(dict):
+    """Answers to a packet, by key and by setting name."""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Packet(object):
+    """Records setting calls and sends them with the server's send function.
+
+    Like a LabRAD packet, a record can be changed by key before the packet
+    is sent again, and the records are copied when the packet is sent.
+    """
+    def __init__(self, send, context):
+        self._send = send
+        self._context = context
+        self._records = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def record(*args, **kw):
+            self._records.append((name, args, kw.pop('key', None)))
+            return self
+        return record
+
+    def __setitem__(self, key, value):
+        for i, (name, args, k) in enumerate(self._records):
+            if k == key:
+                self._records[i] = (name, (value,), k)
+
+    def send(self, context=None):
+        if context is None:
+            context = self._context
+        return self._send(context, list(self._records))
+
+
+class Context(dict):
+    """Server-side context, as passed to settings."""
+    def __init__(self, ID, source):
+        dict.__init__(self)
+        self.ID = ID
+        self.source = source
+
+
+class Registry(object):
+    """Registry stand-in.  dirs maps directory tuples to dicts of keys."""
+    ID = REGISTRY_ID
+
+    def __init__(self, dirs=None):
+        self.dirs = dirs if dirs is not None else {}
+        self._contexts = 0
+
+    def context(self):
+        self._contexts += 1
+        return (0, self._contexts)
+
+    def packet(self, context=None):
+        return Packet(self._send, context)
+
+    def _send(self, context, records):
+        ans = Response()
+        path = ('',)
+        try:
+            for name, args, key in records:
+                if name == 'cd':
+                    path = tuple(args[0])
+                    if len(args) > 1 and args[1]:
+                        self.dirs.setdefault(path, {})
+                    result = list(path)
+                elif name == 'get':
+                    keys = self.dirs.get(path, {})
+                    if args[0] in keys:
+                        result = keys[args[0]]
+                    elif len(args) > 2:
+                        result = args[2]
+                        if args[1]:
+                            keys[args[0]] = result
+                    else:
+                        raise KeyError('Registry key %r not found in %r' % (args[0], path))
+                elif name == 'set':
+                    self.dirs.setdefault(path, {})[args[0]] = args[1]
+                    result = None
+                else:
+                    raise Exception('Registry setting %r is not emulated' % name)
+                ans[name] = result
+                if key is not None:
+                    ans[key] = result
+        except Exception:
+            return defer.fail()
+        return defer.succeed(ans)
+
+
+class Manager(object):
+    def __init__(self, servers):
+        self.servers = servers
+
+    def expire_context(self, ID, context):
+        for server in self.servers.values():
+            if server.ID == ID:
+                server.expireContext(context)
+        return defer.succeed(None)
+
+
+class Client(object):
+    """The LabRAD client connection of the FPGA server."""
+    def __init__(self, registry):
+        self.registry = registry
+        self.servers = {}
+        self.manager = Manager(self.servers)
+
+    def refresh(self):
+        return defer.succeed(None)
+
+
+class EmulatorClient(object):
+    """Client side of the Direct Ethernet Emulator, as used by the FPGA server."""
+    ID = EMULATOR_ID
+    _labrad_name = EMULATOR_NAME
+
+    def __init__(self, server, cxn, source=FPGA_SOURCE):
+        self.server = server
+        self.source = source
+        self._cxn = cxn
+        self._contexts = 0
+        self._serverContexts = {}
+        self._locks = {}
+        self.requests = 0
+        # settings by python name, as a LabRAD client would name them.
+        # Tests may replace them, e.g. to inject delays or failures.
+        self.settings = {}
+        for attr in dir(type(server)):
+            func = getattr(server, attr)
+            if hasattr(func, 'handleRequest'):
+                self.settings[mangle(func.name)] = func
+
+    def context(self):
+        self._contexts += 1
+        return (0, self._contexts)
+
+    def packet(self, context=None):
+        return Packet(self._send, context)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def call(*args, **kw):
+            p = self.packet(context=kw.pop('context', None))
+            getattr(p, name)(*args)
+            return p.send().addCallback(lambda ans: ans[name])
+        return call
+
+    def serverContext(self, context):
+        if context is None:
+            context = (0, 0)
+        if context[0] == 0:
+            context = (self.source, context[1])
+        if context not in self._serverContexts:
+            c = self._serverContexts[context] = Context(context, self.source)
+            self.server.initContext(c)
+            self._locks[context] = defer.DeferredLock()
+        return self._serverContexts[context]
+
+    def expireContext(self, context):
+        c = self.serverContext(context)
+        del self._serverContexts[c.ID]
+        self.server.expireContext(c)
+
+    def _send(self, context, records):
+        c = self.serverContext(context)
+        self.requests += 1
+        return self._locks[c.ID].run(self._handle, c, records)
+
+    @inlineCallbacks
+    def _handle(self, c, records):
+        ans = Response()
+        for name, args, key in records:
+            func = self.settings[name]
+            result = yield defer.maybeDeferred(func, c, *args)
+            ans[name] = result
+            if key is not None:
+                ans[key] = result
+        returnValue(ans)
+
+
+class DacChipBoard(emulator.DacBoard):
+    """Emulated DAC board that also models the serial interface of its DACs.
+
+    The emulator echoes serial data, which is enough for the PLL, but the
+    LVDS, FIFO and BIST measurements of bringup need answers from the DAC
+    chips (serial ops 2 and 3).  The check bit of the LVDS timing is set
+    while both MSD and MHD are below lvdsEdge, the FIFO counter of PHOF p
+    is fifoCounters[p], and the BIST checksums are those of the SRAM, so
+    that bringup succeeds with the DAC_BOARD_PARAMS.  Change these
+    attributes to make it fail.
+    """
+    lvdsEdge = 4
+    fifoCounters = [3, 0, 1, 2]
+    bistError = 0 # xor'ed into the BIST checksums
+
+    def __init__(self, *args):
+        emulator.DacBoard.__init__(self, *args)
+        self.chips = {2: {'shift': 0}, 3: {'shift': 14}}
+
+    def registers(self, regs):
+        op = regs[47]
+        if op in self.chips:
+            data = int(regs[48]) + (int(regs[49]) << 8) + (int(regs[50]) << 16)
+            regs = regs.copy()
+            regs[48] = self.serial(self.chips[op], data)
+        emulator.DacBoard.registers(self, regs)
+
+    def serial(self, chip, data):
+        """Handle a serial command and return the byte read back."""
+        cmd, arg = data >> 8, data & 0xFF
+        if cmd == 0x04:
+            chip['msd'], chip['mhd'] = arg >> 4, arg & 0xF
+        elif cmd == 0x85:
+            return int(chip.get('msd', 0) < self.lvdsEdge and
+                       chip.get('mhd', 0) < self.lvdsEdge)
+        elif cmd == 0x07:
+            chip['phof'] = arg & 0x3
+        elif cmd == 0x87:
+            return self.fifoCounters[chip.get('phof', 0)] << 4
+        elif cmd == 0x11:
+            theory = self.checksums(chip['shift'])
+            chip['bist'] = theory[(arg >> 6) & 1] ^ self.bistError
+        elif 0x92 <= cmd <= 0x95:
+            return (chip.get('bist', 0) >> (8 * (0x95 - cmd))) & 0xFF
+        return 0
+
+    def checksums(self, shift):
+        words = np.fromstring(''.join(self.sram[d] for d in sorted(self.sram)), dtype='<u4')
+        return dac.bistChecksum(list((words >> shift) & 0x3FFF))
+
+
+class Emulator(emulator.DirectEthernetEmulator):
+    client = None # the registry client, instead of a LabRAD connection
+
+    @inlineCallbacks
+    def addBoard(self, port, kind, number, build):
+        mac = yield emulator.DirectEthernetEmulator.addBoard(self, port, kind, number, build)
+        if kind == 'DAC':
+            adapter = self.getAdapter(port)
+            adapter.boards[mac] = DacChipBoard(self, adapter, number, build)
+        returnValue(mac)
+
+
+class FPGAServer(ghz_fpga_server.FPGAServer):
+    client = None
+
+    def log(self, *messages):
+        self.messages.append(messages)
+
+
+class EmulatorFixture(object):
+    """GHz FPGA server with emulated boards on one board group.
+
+    boards is a list of (kind, number) pairs, e.g. [('DAC', 1), ('ADC', 1)].
+    Board names in the board group are e.g. 'DAC 1', so devices are named
+    'Emu DAC 1'.  The emulator runs sequences instantly by default (see
+    the emulator's time scale).
+    """
+    def __init__(self, boards, port=0, timeScale=0.0, latency=100e-6, seed=0):
+        self.boards = boards
+        self.port = port
+        fpgaDir = {'boardGroups': [(GROUP, EMULATOR_NAME, port,
+                                    [('%s %d' % b, 0) for b in boards])],
+                   'dacBuild%d' % DAC_BUILD: DAC_BUILD_PARAMS,
+                   'adcBuild%d' % ADC_BUILD: ADC_BUILD_PARAMS}
+        for kind, number in boards:
+            if kind == 'DAC':
+                fpgaDir['dac%d' % number] = DAC_BOARD_PARAMS
+        emulatorDir = {'boards': [(port, kind, number, DAC_BUILD if kind == 'DAC' else ADC_BUILD)
+                                  for kind, number in boards]}
+        self.registry = Registry({('', 'Servers', 'GHz FPGAs'): fpgaDir,
+                                  ('', 'Servers', 'Direct Ethernet Emulator'): emulatorDir})
+        self.cxn = Client(self.registry)
+        self.emulator = Emulator()
+        self.emulator.client = self.cxn
+        self.de = EmulatorClient(self.emulator, self.cxn)
+        self.cxn.servers[EMULATOR_NAME] = self.de
+        self.fpga = FPGAServer()
+        self.fpga.messages = []
+        self.fpga.client = self.cxn
+        self.timeScale = timeScale
+        self.latency = latency
+        self.seed = seed
+        self._contexts = 0
+
+    @inlineCallbacks
+    def start(self):
+        """Start the emulator, then the FPGA server, which detects the boards."""
+        yield self.emulator.initServer()
+        self.emulator.config['timeScale'] = self.timeScale
+        self.emulator.config['latency'] = self.latency
+        self.emulator.random = np.random.RandomState(self.seed)
+        yield self.fpga.initServer()
+        self.boardGroup = self.fpga.getBoardGroup(GROUP)
+
+    def stop(self):
+        return self.fpga.stopServer()
+
+    def context(self):
+        """A new context of the FPGA server."""
+        self._contexts += 1
+        c = Context((1, self._contexts), 1)
+        self.fpga.initContext(c)
+        return c
+
+    def device(self, name):
+        """The FPGA server's device object for a board, e.g. 'DAC 1'."""
+        return self.fpga.devices['%s %s' % (GROUP, name)]
+
+    def board(self, name):
+        """The emulated board, e.g. 'DAC 1'."""
+        kind, number = name.split()
+        module = dac if kind == 'DAC' else adc
+        return self.emulator.adapters[self.port].boards[module.macFor(int(number))]
+
+    @inlineCallbacks
+    def addBoard(self, kind, number):
+        """Plug in another board.  The FPGA server finds it when it refreshes."""
+        build = DAC_BUILD if kind == 'DAC' else ADC_BUILD
+        if kind == 'DAC':
+            self.registry.dirs['', 'Servers', 'GHz FPGAs']['dac%d' % number] = DAC_BOARD_PARAMS
+        yield self.emulator.addBoard(self.port, kind, number, build)
+
+    def removeBoard(self, kind, number):
+        """Unplug a board."""
+        module = dac if kind == 'DAC' else adc
+        del self.emulator.adapters[self.port].boards[module.macFor(number)]
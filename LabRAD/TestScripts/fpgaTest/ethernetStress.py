@@ -0,0 +1,437 @@
+"""
+Ethernet stress test for the GHz DAC and ADC boards.
+
+Register ping packets are sent to many boards at once through the direct
+ethernet server. Each board gets its own direct ethernet context with up
+to `depth` ping requests in flight, so pings to different boards are
+interleaved on the wire. The server handles the requests of one context
+in order, so the pings to one board do not overlap, but the next one is
+already queued on the server when a readback arrives instead of waiting
+for a round trip to the client. For every board we record the
+round trip time of each ping and count the pings that were not answered
+within the timeout. The result is a dictionary which can be printed with
+printReport or saved as JSON with writeReport.
+
+Do not run this while someone is taking data! Just like pingBoardDirect
+in fpgaTest.py, this bypasses the FPGA server.
+
+FakeDirectEthernet is a loopback stand-in for the direct ethernet server
+that answers register pings with canned readback packets, so that the
+stress test can be run without any hardware:
+
+>> de = FakeDirectEthernet(latency=200e-6, loss=0.01)
+>> report = stressTest(de, 1, ['Vince DAC 1', 'Vince ADC 2'], 1000)
+>> printReport(report)
+"""
+
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+import numpy as np
+
+import LabRAD.Servers.Instruments.GHzBoards.dac as dacModule
+import LabRAD.Servers.Instruments.GHzBoards.adc as adcModule
+
+MODULES = {'DAC': dacModule, 'ADC': adcModule}
+
+# Round trip time histogram bins, 10 us to 10 s with 10 bins per decade.
+LATENCY_BINS = np.logspace(-5, 1, 61)
+
+
+def boardInfo(boardName):
+    """Gets the (number, type) of an FPGA board from the name"""
+    m = re.search('\d+', boardName)
+    if m is None:
+        raise Exception('No board number in board name %s' %boardName)
+    for boardType in MODULES:
+        if boardType in boardName:
+            return (int(m.group()), boardType)
+    raise Exception('Board type of board %s not recognized' %boardName)
+
+
+def _stamp(result, done):
+    """Callback recording the time at which a request completed."""
+    done.append(time.time())
+    return result
+
+
+def stressTest(de, port, boards, numPings, depth=4, timeout=1.0):
+    """Ping many boards concurrently and measure latency and packet loss.
+
+    PARAMETERS
+    ----------
+    de: server wrapper
+        Direct ethernet server talking to the boards, or a
+        FakeDirectEthernet.
+    port: number
+        Port number, on the direct ethernet server, connected to the boards.
+    boards: list of str
+        Board names, eg. ['Vince DAC 11', 'Vince ADC 2'].
+    numPings: int
+        Number of register pings to send to each board.
+    depth: int
+        Maximum number of ping requests in flight per board.
+    timeout: float
+        Seconds to wait for each readback.
+
+    OUTPUT
+    ----------
+    dict - report, see printReport. Latencies are in seconds.
+
+    A ping whose readback is late is counted as lost. If the late
+    readback does arrive, it is taken as the answer to the next ping
+    to the same board, so after losses the latencies of that board are
+    only approximate.
+    """
+    names = list(boards)
+    macs = []
+    regs = []
+    for name in names:
+        num, boardType = boardInfo(name)
+        module = MODULES[boardType]
+        macs.append(module.macFor(num))
+        regs.append(module.regPing().tostring())
+    readbackLen = dict((name, MODULES[boardInfo(name)[1]].READBACK_LEN) for name in names)
+    ctxts = [de.context() for _ in names]
+    try:
+        #Set up connection to direct ethernet, one context per board
+        for ctxt, mac in zip(ctxts, macs):
+            p = de.packet(context=ctxt)
+            p.connect(port)                 #Choose ethernet port
+            p.require_source_mac(mac)       #Receive only packets from the board's mac address
+            p.destination_mac(mac)          #Set the destination mac of our outgoing packets
+            p.timeout(timeout)
+            p.listen()                      #Start listening for packets
+            p.clear()
+            p.send()
+
+        sent = [0] * len(names)
+        pending = [deque() for _ in names]
+        latencies = [[] for _ in names]
+        lost = [0] * len(names)
+        start = time.time()
+        while any(pending) or min(sent) < numPings:
+            #Top up the pipeline for every board before waiting on anything
+            for i, ctxt in enumerate(ctxts):
+                while sent[i] < numPings and len(pending[i]) < depth:
+                    p = de.packet(context=ctxt)
+                    p.write(regs[i])
+                    p.read()
+                    done = []
+                    tSent = time.time()
+                    req = p.send(wait=False)
+                    req.addCallback(_stamp, done)
+                    pending[i].append((req, tSent, done))
+                    sent[i] += 1
+            #Collect the oldest request of each board. Completion times
+            #are stamped by the callback, so the order in which we wait
+            #does not affect the measured latencies.
+            for i in range(len(names)):
+                if not pending[i]:
+                    continue
+                req, tSent, done = pending[i].popleft()
+                try:
+                    req.wait()
+                    latencies[i].append(done[0] - tSent)
+                except Exception:
+                    lost[i] += 1
+        duration = time.time() - start
+    finally:
+        for ctxt in ctxts:
+            de._cxn.manager.expire_context(de.ID, context=ctxt)
+
+    report = {
+        'port': port,
+        'pings': numPings,
+        'depth': depth,
+        'timeout': timeout,
+        'duration': duration,
+        'latencyBins': [float(t) for t in LATENCY_BINS],
+        'boards': {},
+    }
+    bytesSent = bytesReceived = received = 0
+    for i, name in enumerate(names):
+        t = np.array(latencies[i])
+        counts = np.histogram(np.clip(t, LATENCY_BINS[0], LATENCY_BINS[-1]), LATENCY_BINS)[0]
+        report['boards'][name] = {
+            'mac': macs[i],
+            'sent': sent[i],
+            'received': len(t),
+            'lost': lost[i],
+            'lossFraction': float(lost[i]) / max(sent[i], 1),
+            'latency': _latencySummary(t),
+            'histogram': [int(n) for n in counts],
+        }
+        received += len(t)
+        bytesSent += sent[i] * len(regs[i])
+        bytesReceived += len(t) * readbackLen[name]
+    report['throughput'] = {
+        'pingsPerSecond': received / duration if duration else 0.0,
+        'bytesSentPerSecond': bytesSent / duration if duration else 0.0,
+        'bytesReceivedPerSecond': bytesReceived / duration if duration else 0.0,
+    }
+    return report
+
+
+def _latencySummary(t):
+    if not len(t):
+        return {'mean': None, 'p50': None, 'p99': None, 'max': None}
+    return {'mean': float(np.mean(t)),
+            'p50': float(np.percentile(t, 50)),
+            'p99': float(np.percentile(t, 99)),
+            'max': float(np.max(t))}
+
+
+def printReport(report):
+    """Print a human readable summary of a stress test report."""
+    print 'Pinged %d boards %d times each in %.2f s (depth %d)' %(len(report['boards']),
+            report['pings'], report['duration'], report['depth'])
+    thru = report['throughput']
+    print 'Throughput: %.0f pings/s, %.0f bytes/s out, %.0f bytes/s in' %(thru['pingsPerSecond'],
+            thru['bytesSentPerSecond'], thru['bytesReceivedPerSecond'])
+    for name, info in sorted(report['boards'].items()):
+        lat = info['latency']
+        if lat['mean'] is None:
+            times = 'no readbacks'
+        else:
+            times = 'latency mean %.0f us, p50 %.0f us, p99 %.0f us, max %.0f us' %(
+                    lat['mean']*1e6, lat['p50']*1e6, lat['p99']*1e6, lat['max']*1e6)
+        print '%s: %d/%d received, %d lost; %s' %(name, info['received'], info['sent'],
+                                                  info['lost'], times)
+
+
+def writeReport(report, filename):
+    """Save a stress test report as JSON."""
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+########################################
+## Loopback direct ethernet for tests ##
+########################################
+
+class FakeTimeoutError(Exception):
+    """Raised by the fake direct ethernet server when a read times out."""
+
+
+class FakeFuture(object):
+    """Minimal stand-in for the future returned by packet.send(wait=False)."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._fired = False
+        self._result = None
+        self._error = None
+
+    def addCallback(self, func, *args):
+        with self._lock:
+            if not self._fired:
+                self._callbacks.append((func, args))
+                return self
+        if self._error is None:
+            self._result = func(self._result, *args)
+        return self
+
+    def _fire(self, result=None, error=None):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._fired = True
+            callbacks, self._callbacks = self._callbacks, []
+        if error is None:
+            for func, args in callbacks:
+                self._result = func(self._result, *args)
+        # Only wake up wait() once the callbacks have run.
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class FakePacketResult(dict):
+    """Packet result allowing both ans['read'] and ans.read."""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakePacket(object):
+    """Records direct ethernet settings until the packet is sent."""
+    def __init__(self, server, context):
+        self._server = server
+        self._context = context
+        self._records = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def record(*args, **kw):
+            self._records.append((name, args))
+            return self
+        return record
+
+    def send(self, wait=True, context=None):
+        if context is None:
+            context = self._context
+        future = self._server._submit(context, list(self._records))
+        if wait:
+            return future.wait()
+        return future
+
+
+class _FakeManager(object):
+    def __init__(self, server):
+        self._server = server
+
+    def expire_context(self, ID=None, context=None):
+        self._server._expire(context)
+
+
+class _FakeConnection(object):
+    def __init__(self, server):
+        self.manager = _FakeManager(server)
+
+
+class _FakeContext(object):
+    """State and worker thread of one direct ethernet context.
+
+    Requests in a context are handled one at a time in the order they
+    were sent, like on the real server.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.dest = None
+        self.timeout = 1.0
+        self.buffer = deque() # (arrival time, packet)
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            records, future = item
+            result = FakePacketResult()
+            try:
+                for name, args in records:
+                    ans = self._handle(name, args)
+                    if ans is not None:
+                        result[name] = ans
+            except Exception, e:
+                future._fire(error=e)
+            else:
+                future._fire(result)
+
+    def _handle(self, name, args):
+        if name == 'destination_mac':
+            self.dest = args[0]
+        elif name == 'timeout':
+            self.timeout = float(args[0])
+        elif name == 'write':
+            reply = self.server.respond(self.dest, args[0])
+            if reply is not None:
+                self.buffer.append((time.time() + self.server.latency, reply))
+        elif name == 'clear':
+            self.buffer.clear()
+        elif name in ['read', 'collect', 'discard']:
+            n = args[0] if len(args) else 1
+            self._waitFor(n)
+            if name == 'collect':
+                return None
+            pkts = [self.buffer.popleft()[1] for _ in range(n)]
+            if name == 'discard':
+                return None
+            return pkts if len(args) else pkts[0]
+        return None
+
+    def _waitFor(self, n):
+        """Wait until n packets have arrived, or raise FakeTimeoutError."""
+        deadline = time.time() + self.timeout
+        while True:
+            if len(self.buffer) >= n:
+                arrival = self.buffer[n-1][0]
+                if arrival <= deadline:
+                    time.sleep(max(0, arrival - time.time()))
+                    return
+            time.sleep(max(0, deadline - time.time()))
+            raise FakeTimeoutError('Operation timed out.')
+
+
+class FakeDirectEthernet(object):
+    """Loopback stand-in for the direct ethernet server.
+
+    Register pings written to a DAC or ADC MAC address are answered with
+    a readback packet of the right length after `latency` seconds,
+    except that a fraction `loss` of them is dropped. Other writes are
+    ignored. Only the settings used by the fpgaTest scripts are modelled.
+    """
+    ID = 0
+
+    def __init__(self, latency=100e-6, loss=0.0, build=7, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.build = build
+        self.random = random.Random(seed)
+        self._cxn = _FakeConnection(self)
+        self._ids = itertools.count(1)
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def context(self):
+        return (0, self._ids.next())
+
+    def packet(self, context=None):
+        return FakePacket(self, context)
+
+    def _submit(self, context, records):
+        with self._lock:
+            if context not in self._contexts:
+                self._contexts[context] = _FakeContext(self)
+            ctx = self._contexts[context]
+        future = FakeFuture()
+        ctx.queue.put((records, future))
+        return future
+
+    def _expire(self, context):
+        with self._lock:
+            ctx = self._contexts.pop(context, None)
+        if ctx is not None:
+            ctx.queue.put(None)
+
+    def respond(self, mac, data):
+        """Build the (src, dst, eth, data) reply to a packet, or None."""
+        if mac is None:
+            return None
+        if dacModule.isMac(mac) and len(data) == dacModule.REG_PACKET_LEN:
+            readback = np.zeros(dacModule.READBACK_LEN, dtype='<u1')
+            readback[51] = self.build
+        elif adcModule.isMac(mac) and len(data) == adcModule.REG_PACKET_LEN:
+            readback = np.zeros(adcModule.READBACK_LEN, dtype='<u1')
+            readback[0] = self.build
+        else:
+            return None
+        with self._lock:
+            if self.random.random() < self.loss:
+                return None
+        return (mac, '00:00:00:00:00:00', len(readback), readback.tostring())
+
+
+if __name__ == '__main__':
+    de = FakeDirectEthernet(latency=200e-6, loss=0.001, seed=0)
+    boards = ['Test DAC %d' %i for i in range(8)] + ['Test ADC %d' %i for i in range(2)]
+    printReport(stressTest(de, 1, boards, 500, timeout=0.05))
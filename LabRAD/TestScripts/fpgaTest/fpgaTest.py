@@ -56,10 +56,6 @@
 # inf. Read the source code to see what functions are available. Have fun :)
 # 
 
-#TODO
-#
-# In ADC scans, use all four available demod channels to make things run faster
-
 import sys
 import time
 import numpy as np
@@ -76,6 +72,7 @@ DATA_VAULT = 'data_vault'
 
 import LabRAD.Servers.Instruments.GHzBoards.dac as dacModule
 import LabRAD.Servers.Instruments.GHzBoards.adc as adcModule
+import LabRAD.TestScripts.fpgaTest.ethernetStress as ethernetStress
 import LabRAD.TestScripts.fpgaTest.pyle.pyle.dataking.util as dataUtil
 import LabRAD.TestScripts.fpgaTest.pyle.pyle.util.sweeptools as st
 
@@ -219,58 +216,32 @@ def getBuildNumber(fpga, device):
     return buildNumber
     
     
-def hammarEthernet(de, port, boards, numRuns):
+def hammarEthernet(de, port, boards, numRuns, depth=4, filename=None):
     """Send many register ping packets to the boards to check reliability of ethernet connection
     
-    Packets for each board are sent sequentially, ie. not at the same time. This manes we are
-    testing only the bare ethernet communication for individual channels and are not sensitive
-    to packet collision type failure modes.
+    Pings to all boards are pipelined, with each board in its own direct
+    ethernet context, so this also exercises packet collisions on the
+    board group. See ethernetStress.stressTest for details.
+    
+    PARAMETERS
+    ----------
+    numRuns: int
+        Number of pings to send to each board.
+    depth: int
+        Maximum number of pings in flight per board.
+    filename: str
+        If given, the report is also saved here as JSON.
+    
+    OUTPUT
+    ----------
+    dict - report with per board latency histograms and packet loss,
+    and overall throughput.
     """
-    boardInfo = [boardName2Info(board) for board in boards]
-    boardRegs = []
-    ctxts = []
-    macs = []
-    modules = {'DAC': dacModule, 'ADC': adcModule}
-    #Get a direct ethernet context, MAC, and register packet for each board
-    for num, boardType in zip(boards, boardInfo):
-        module = modules[boardType]
-        boardRegs.append(module.regPing())
-        ctxts.append(de.context())
-        macs.append(module.macFor(num))
-    #Set up connection to direct ethernet, one context per board
-    for ctxt, mac in zip(ctxts, macs):
-        p = de.packet(context=ctxt)
-        p.timeout(1.0)
-        p.connect(port, context=ctxt)                   #Choose ethernet port
-        p.require_source_mac(mac, context=ctxt)         #Receive only packets from the board's mac address
-        p.destination_mac(mac, context=ctxt)            #Set the destination mac of our outgoing packets
-        p.listen(context=ctxt)                          #Start listening for packets
-        p.send()
-    #Ping the boards a lot
-    for _ in range(numRuns):
-        for regs, ctxt in zip(boardRegs, ctxts):
-            p = de.packet(context=ctxt)
-            p.write(regs.tostring(), context=ctxt)      #Convert the board packet to a byte string and write it out over the wire
-            p.send()                                    #Send the direct ethernet server packet
-    #Check to see that number of returned packets is as expected
-    try:
-        for ctxt in ctxts:
-            p = de.packet(context=ctxt)
-            p.timeout(10)
-            p.collect(numRuns)
-            p.send()
-    except Exception:
-        print Exception
-        print 'Some boards dropped packets'
-    finally:
-        print 'Sequence done'
-        print 'Check packet buffer. Number of packets should be %d' %numRuns
-        print 'Then hit any key to continue'
-        while kbhit():
-            getch()
-        getch()
-        for ctxt in ctxts:
-            de._cxn.manager.expire_context(context=ctxt)
+    report = ethernetStress.stressTest(de, port, boards, numRuns, depth=depth)
+    ethernetStress.printReport(report)
+    if filename is not None:
+        ethernetStress.writeReport(report, filename)
+    return report
     
     
 def daisyCheck(sample, cxn, iterations, repsPerIteration, runTimers):
@@ -287,8 +258,8 @@ def daisyCheck(sample, cxn, iterations, repsPerIteration, runTimers):
     runTimers, bool: True will run timers on DAC boards. False will not.
     
     RETURNS
-    Array of size (iterations x N) where N is number of boards returning
-    timing data. Entry  ij is the number of times the jth board executed
+    Array of size (iterations x N) where N is number of boards in the
+    daisy chain. Entry  ij is the number of times the jth board executed
     on the ith iteration.
     """
     fpga = cxn.ghz_fpgas
@@ -334,7 +305,8 @@ def daisyCheck(sample, cxn, iterations, repsPerIteration, runTimers):
     timingOrderList = ['%s::%d' %(adc['_id'],chan) for adc in adcs for chan in range(ADC_DEMOD_CHANNELS)]
     if runTimers:
         timingOrderList.extend([dac['_id'] for dac in dacs])
-    executions = np.array([])
+    boardNames = [board['_id'] for board in dacs+adcs]
+    executions = np.zeros((iterations, len(boardNames)), dtype=int)
     for iteration in range(iterations):
         print 'Running iteration %d' %iteration
         #Set up DAC
@@ -349,14 +321,11 @@ def daisyCheck(sample, cxn, iterations, repsPerIteration, runTimers):
             result = fpga.run_sequence(repsPerIteration, True)
         except:
             print 'Error in sequence run;'
-        #Whether or not there is an error, ping all boards to check how many times they executed
+        #Whether or not there is an error, ping all boards to check how many times they executed.
+        #The server pings all boards at once.
         finally:
-            for board in dacs+adcs:
-                name = board['_id']
-                fpga.select_device(name)
-                resp = fpga.execution_count()
-                executions = np.hstack((executions, resp))
-    return np.reshape(executions, (iterations,-1))
+            executions[iteration] = fpga.execution_counts(boardNames)
+    return executions
 
 
 ###################
@@ -694,9 +663,99 @@ def sumCheck(sample, cxn, repetitions=None, plot=False, collect=False,
 ## DEMODULATOR MODE ##
 ######################
 
+class DemodScan(object):
+    """Scan the ADC demodulator frequency with a fixed DAC output tone.
+    
+    The DAC memory and SRAM are uploaded to the FPGA server only when
+    they differ from the last upload, so repeated scans with the same
+    DAC tone (e.g. with different ADC filters) share one upload.
+    
+    If spread is False (default), all channels demodulate at the same
+    frequency, one point per run_sequence call. If spread is True,
+    consecutive scan frequencies are assigned to the ADC_DEMOD_CHANNELS
+    demodulator channels so that each run_sequence call measures
+    ADC_DEMOD_CHANNELS points. Each channel keeps its own phase and
+    amplitudes in both cases. The demod settings of the adc passed to
+    scan are not modified.
+    """
+    def __init__(self, fpga, reps=30, spread=False):
+        self.fpga = fpga
+        self.reps = reps
+        self.spread = spread
+        self.dacUploads = 0
+        self.runs = 0
+        self._lastDac = None
+        
+    def uploadDac(self, dac):
+        sramLen = int(dac['signalTime']['ns'])
+        dac['memory'] = dacMemory(sramLen, 25000)
+        waves = makeDacWaveforms(dac)
+        dac['sram'] = waves2sram(waves[0], waves[1])
+        state = (dac['_id'], dac['memory'], dac['sram'])
+        if state != self._lastDac:
+            _sendDac(dac, self.fpga)
+            self._lastDac = state
+            self.dacUploads += 1
+    
+    def scan(self, dac, adc, freqScan):
+        """Return (freqs [MHz], powers). The powers array has the shape
+        (len(freqScan), 1) if spread is True and (len(freqScan),
+        ADC_DEMOD_CHANNELS) otherwise.
+        """
+        fpga = self.fpga
+        self.uploadDac(dac)
+        #Set up ADC
+        adc = adc.copy()
+        adc['demods'] = list(adc['demods'])
+        adc['runMode'] = 'demodulate'
+        _sendAdc(adc, fpga)
+        #Set up board group
+        fpga.daisy_chain([dac['_id'], adc['_id']])
+        fpga.timing_order(['%s::%d' %(adc['_id'], chan)
+                           for chan in range(ADC_DEMOD_CHANNELS)])
+        freqScan = list(freqScan)
+        freqs = np.array([demodFreq['MHz'] for demodFreq in freqScan])
+        if self.spread:
+            data = np.zeros((len(freqScan), 1))
+            points = range(0, len(freqScan), ADC_DEMOD_CHANNELS)
+        else:
+            data = np.zeros((len(freqScan), ADC_DEMOD_CHANNELS))
+            points = range(len(freqScan))
+        for idx in points:
+            if self.spread:
+                chunk = freqScan[idx:idx + ADC_DEMOD_CHANNELS]
+                print 'Acquiring data at', chunk
+                # Unused channels of the last chunk repeat its last
+                # frequency.
+                chanFreqs = chunk + [chunk[-1]] * (ADC_DEMOD_CHANNELS - len(chunk))
+                for chan, demodFreq in enumerate(chanFreqs):
+                    modifyDemodChannel(adc, chan, freq=demodFreq)
+            else:
+                chunk = [freqScan[idx]]
+                print 'Acquiring data at', freqScan[idx]
+                for chan in range(ADC_DEMOD_CHANNELS):
+                    modifyDemodChannel(adc, chan, freq=freqScan[idx])
+            _sendAdcDemods(adc, fpga)
+            #Run the sequence
+            result = fpga.run_sequence(self.reps, True)
+            self.runs += 1
+            # Parse/average the data
+            mags = np.zeros(ADC_DEMOD_CHANNELS)
+            for chan in range(ADC_DEMOD_CHANNELS):
+                Is, Qs = result[chan]
+                I, Q = np.mean(Is), np.mean(Qs)
+                mags[chan] = (I**2) + (Q**2)
+            if self.spread:
+                data[idx:idx + len(chunk), 0] = mags[:len(chunk)]
+            else:
+                data[idx] = mags
+        return freqs, data
+
+
 def spectrum(sample, cxn, freqScan=st.r[-20:20:0.1,MHz], filter=None,
             dacFreq=None, reps=30, plot=False,
-            save=True, name='Spectrum', folder=None):
+            save=True, name='Spectrum', folder=None, spread=False,
+            scanner=None):
     """ Scan the ADC demodulator frequency with a fixed DAC output tone
     
     Each channel of the DAC will put out a tone at fixed frequency (with
@@ -716,6 +775,11 @@ def spectrum(sample, cxn, freqScan=st.r[-20:20:0.1,MHz], filter=None,
     signalPhase = [0.0, 0.25]. Both amplitudes MUST be identical, or else
     you will see a spurious negative sideband peak.   
     
+    By default every demod channel measures every frequency and there is
+    a power column per channel. With spread=True the scan frequencies are
+    spread across the ADC demod channels (see DemodScan) and there is a
+    single power column. A DemodScan can be passed as scanner to reuse
+    the DAC upload between calls.
     """
     fpga = cxn[FPGA_SERVER]
     dacs, adcs = loadDacsAdcs(sample)
@@ -728,49 +792,17 @@ def spectrum(sample, cxn, freqScan=st.r[-20:20:0.1,MHz], filter=None,
         dac['signalFrequency']=[dacFreq,dacFreq]
     if filter is not None:
         adc['filterFunc']=filter    
+    if scanner is None:
+        scanner = DemodScan(fpga, reps, spread)
 
-    data=np.array([])
-    freqs=[]
     print 'freqScan', freqScan
-    for demodFreq in freqScan:
-        freqs.append(demodFreq['MHz'])
-        print 'Acquiring data at',demodFreq
-        #Set up DAC
-        sramLen=int(dac['signalTime']['ns'])
-        dac['memory']=dacMemory(sramLen, 25000)
-        waves=makeDacWaveforms(dac)
-        dac['sram']=waves2sram(waves[0],waves[1])
-        _sendDac(dac,fpga)
-        #Set up ADC
-        adc['runMode']='demodulate'
-        for chan in range(ADC_DEMOD_CHANNELS):
-            modifyDemodChannel(adc, chan, freq=demodFreq)
-        _sendAdc(adc,fpga)
-        #Set up board group
-        daisychainList = [dac['_id'],adc['_id']]
-        timingOrderList = ['%s::%d' %(adc['_id'],chan) for chan in range(ADC_DEMOD_CHANNELS)]
-        fpga.daisy_chain(daisychainList)
-        fpga.timing_order(timingOrderList)
-        #Run the sequence
-        result = fpga.run_sequence(reps,True)
-        # Parse/average the data
-        mags=np.zeros(ADC_DEMOD_CHANNELS)
-        for chan in range(ADC_DEMOD_CHANNELS):
-            Is, Qs = result[chan]
-            I, Q = np.mean(Is), np.mean(Qs)
-            print 'chan', chan, 'I', I
-            mag = (I**2)+(Q**2)
-            mags[chan]=mag
-        data = np.hstack((data,mags))
-    data = np.reshape(data,(-1, ADC_DEMOD_CHANNELS))
-    freqs=np.array(freqs)
+    freqs, data = scanner.scan(dac, adc, freqScan)
+    channels = range(data.shape[1])
     if plot:
         plt.figure()
         markers = ['b','r','g','k']
-        for chan in range(ADC_DEMOD_CHANNELS):
+        for chan in channels:
             plt.semilogy(freqs,data[:,chan],markers[chan],label=str(adc['demods'][chan][2]))
-            print 'freqs', freqs
-            print 'data', data[:,chan]
         plt.legend(loc="upper left")
         plt.grid()
         plt.xlabel('Frequency [MHz]')
@@ -781,7 +813,7 @@ def spectrum(sample, cxn, freqScan=st.r[-20:20:0.1,MHz], filter=None,
             folder = sample._dir
         dependents = []
         dataSave = [freqs]
-        for chan in range(ADC_DEMOD_CHANNELS):
+        for chan in channels:
             dependents += [('Power',str(adc['demods'][chan][2]),'')]
             dataSave += [data[:,chan]]
         params = dict(dac.items()+adc.items())
@@ -826,9 +858,10 @@ def sideband(sample, cxn, sourceFreq=None, freqScan=st.r[-20:20:0.5,MHz], filter
     if save:
         dependents = []
         dataSave = [[freqSideband[MHz] for freqSideband in freqScan]]
+    scanner = DemodScan(cxn[FPGA_SERVER])
     for freq,marker in zip([-sourceFreq,sourceFreq],['b','r']):
         data = spectrum(sample, cxn, freqScan=freqScan, filter=filter,
-                dacFreq=freq, save=save)
+                dacFreq=freq, save=save, scanner=scanner)
         results.append(data)
         if plot:
             plt.semilogy(data[:,0],data[:,1],marker,label=str(freq))
@@ -864,9 +897,11 @@ def filterCompare(sample, cxn, filters, freqScan=st.r[-20:20:0.5,MHz],
     adc=adcs[0]
     data=np.array([])
     results={}
+    # The DAC tone is the same for all filters, so it is uploaded once.
+    scanner = DemodScan(cxn[FPGA_SERVER])
     for filter in filters:
         data = spectrum(sample, cxn, freqScan=freqScan, filter=filter,
-                save=save)
+                save=save, scanner=scanner)
         data = data[:,:2]
         results[filter]=data
     if plot:
@@ -1512,6 +1547,16 @@ def _sendAdc(adc, server):
         p.adc_trig_magnitude(chan, ampSin, ampCos)
     p.send()
 
+def _sendAdcDemods(adc, server):
+    """Send only the demodulator channel settings of an ADC."""
+    p = server.packet()
+    p.select_device(adc['_id'])
+    for chan in range(ADC_DEMOD_CHANNELS):
+        frequency, phase, ampSin, ampCos = adc['demods'][chan]
+        p.adc_demod_phase(chan, frequency2dPhi(frequency), cycles2phi0(phase))
+        p.adc_trig_magnitude(chan, ampSin, ampCos)
+    p.send()
+
 def filterBytes(adc):
     filterFunc = adc['filterFunc'][0]
     sigma = adc['filterFunc'][1]
@@ -1605,7 +1650,7 @@ def frequency2dPhi(frequency):
     
     assert isinstance(frequency,Value), 'data must be instance of labrad.units.Value with frequency units'
     assert frequency.isCompatible('Hz'), 'data must be instance of labrad.units.Value with frequency units'
-    dPhi = int(np.floor((frequency/Value(7629.0,'Hz')).inBaseUnits().value))
+    dPhi = int(np.floor(frequency['Hz']/7629.0))
     return dPhi
 
 def cycles2phi0(phase):
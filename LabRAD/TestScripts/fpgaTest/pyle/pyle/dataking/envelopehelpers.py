@@ -4,10 +4,48 @@ import pyle.envelopes as env
 from pyle.dataking import utilMultilevels as ml
 
 import util
+from pyle.util import memoize
 
 # sequence helpers
 # these are simple functions for building standard control envelopes by
 # pulling out appropriate configuration parameters for a particular qubit.
+#
+# The envelopes themselves are built by the memoized functions below, which
+# take only the parameters pulled out of the qubit, so that pulses which are
+# requested over and over in a sweep (the same pi pulse at the same time for
+# every point, say) are built only once and shared.  Envelopes are never
+# modified in place, so sharing them is safe.
+
+ENVELOPE_CACHE_SIZE = 1000 # envelopes kept per helper
+
+@memoize(maxsize=ENVELOPE_CACHE_SIZE)
+def _mix(seq, df, phase):
+    return env.mix(seq, df) * np.exp(1j*phase)
+
+@memoize(maxsize=ENVELOPE_CACHE_SIZE)
+def _gaussianHD(t0, w, amp, phase, alpha, delta):
+    x = env.gaussian(t0, w=w, amp=amp, phase=phase)
+    y = -alpha * env.deriv(x) / delta
+    return x + 1j*y
+
+@memoize(maxsize=ENVELOPE_CACHE_SIZE)
+def _flattopHD(t0, len, w, amp, overshoot, overshoot_w, alpha, delta):
+    x = env.flattop(t0, len, w, amp, overshoot, overshoot_w)
+    y = -alpha * env.deriv(x) / delta
+    return x + 1j*y
+
+@memoize(maxsize=ENVELOPE_CACHE_SIZE)
+def _gaussian(t0, w, amp):
+    return env.gaussian(t0, w=w, amp=amp)
+
+@memoize(maxsize=ENVELOPE_CACHE_SIZE)
+def _trapezoid(t0, rise, top, fall, amp):
+    return env.trapezoid(t0, rise, top, fall, amp)
+
+@memoize(maxsize=ENVELOPE_CACHE_SIZE)
+def _readout(t0, len, w, amp, df):
+    return env.mix(env.flattop(t0, len, w=w, amp=amp), df)
+
 
 def power2amp(power):
     """
@@ -53,7 +91,7 @@ def mix(q, seq, freq=None, state=None):
         if state is None:
             state=1
         freq = ml.getMultiLevels(q,'frequency',state)
-    return env.mix(seq, freq - q['fc']) * np.exp(1j*q['uwavePhase'])
+    return _mix(seq, freq - q['fc'], q['uwavePhase'])
 
 
 # xy rotations with half-derivative term on other quadrature
@@ -78,9 +116,7 @@ def rotPulseHD(q, t0, angle=np.pi, phase=0, alpha=0.5, state=1, length='piFWHM')
     piamp = ml.getMultiLevels(q,'piAmp',state)
     r = angle / np.pi
     delta = 2*np.pi * (q['f21'] - q['f10'])['GHz']
-    x = env.gaussian(t0, w=q[length], amp=piamp*r, phase=phase)
-    y = -alpha * env.deriv(x) / delta
-    return x + 1j*y
+    return _gaussianHD(t0, q[length], piamp*r, phase, alpha, delta)
 
 def rabiPulseHD(q, t0, len, w=None, amp=None, overshoot=0.0, overshoot_w=1.0, alpha=0.5, state=1):
     """Rabi pulse using a flattop envelope with half-derivative Y quadrature."""
@@ -94,9 +130,7 @@ def rabiPulseHD(q, t0, len, w=None, amp=None, overshoot=0.0, overshoot_w=1.0, al
     if w is None:
         w=q['piFWHM']
     delta = 2*np.pi * (q['f21'] - q['f10'])['GHz']
-    x = env.flattop(t0, len, w, amp, overshoot, overshoot_w)
-    y = -alpha * env.deriv(x) / delta
-    return x + 1j*y
+    return _flattopHD(t0, len, w, amp, overshoot, overshoot_w, alpha, delta)
 
 # z rotations
 def piPulseZ(q, t0):
@@ -110,7 +144,7 @@ def piHalfPulseZ(q, t0):
 def rotPulseZ(q, t0, angle=np.pi):
     """Rotation pulse using a gaussian envelope."""
     r = angle / np.pi
-    return env.gaussian(t0, w=q['piFWHMZ'], amp=q['piAmpZ']*r)
+    return _gaussian(t0, q['piFWHMZ'], q['piAmpZ']*r)
 
 
 # default pulse type is half-derivative
@@ -133,18 +167,18 @@ def measurePulse(q, t0, state=1):
     t0 - value [us]: Time to start the measure pulses.
     state - scalar: Which state's measure pulse to use.
     """
-    return env.trapezoid(t0, 0, q['measureLenTop'], q['measureLenFall'], ml.getMultiLevels(q,'measureAmp',state))
+    return _trapezoid(t0, 0, q['measureLenTop'], q['measureLenFall'], ml.getMultiLevels(q,'measureAmp',state))
 
 
 def measurePulse2(q, t0):
-    return env.trapezoid(t0, 0, q['measureLenTop2'], q['measureLenFall2'], q['measureAmp2'])
+    return _trapezoid(t0, 0, q['measureLenTop2'], q['measureLenFall2'], q['measureAmp2'])
 
 
 def readoutPulse(q, t0):
     dt = q['readoutLen']
     amp = power2amp(q['readout power'])
     df = q['readout frequency'] - q['readout fc']
-    return env.mix(env.flattop(t0, dt, w=q['readoutWidth'], amp=amp), df)
+    return _readout(t0, dt, q['readoutWidth'], amp, df)
 
 
 def boostState(q, t0, state):
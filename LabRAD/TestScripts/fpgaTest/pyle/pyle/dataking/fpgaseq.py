@@ -1,10 +1,14 @@
+import collections
+import hashlib
 import os
+import threading
 
 from labrad.units import Unit
 ns, us, V, mV, GHz = [Unit(s) for s in ('ns', 'us', 'V', 'mV', 'GHz')]
 
 import pyle.envelopes as env
 from pyle.dataking import envelopehelpers as eh
+from pyle.util import _freeze
 import numpy as np
 
 # default channel identifiers
@@ -23,6 +27,9 @@ POSTPAD = 50
 # debug dumps 
 DEBUG_PATH = os.path.join(os.path.expanduser('~'), '.packet-dump')
 
+# number of contexts whose built sequence runQubits remembers (see SequenceCache)
+SEQUENCE_CACHE_SIZE = 100
+
 def filterBytes(filterLen = 16384*ns):
     filter_len = round(filterLen['ns']/4)
     filt = np.zeros(filter_len,dtype='<u1')
@@ -100,7 +107,7 @@ def sortqubits_readoutDAC(qubits):
     return groups                       
     
 def runQubits(server, devices, stats, probs=None, dataFormat=None,
-              debug=False):
+              debug=False, cache=True):
     """A generic sequence for running multiple devices with the Qubit Sequencer.
     qubits
     These parameters control the sequence and how it should be run:
@@ -127,6 +134,15 @@ def runQubits(server, devices, stats, probs=None, dataFormat=None,
     separate - a flag indicating whether to return separate probabilities
         for each qubit (N possibilities), or combined probabilities of the
         multi-qubit states (2**N posibilities; the default).
+    
+    cache - if True, the sequence is not sent and built again when the
+        context of the packet has already built a sequence with identical
+        contents, which saves the Qubit Sequencer compiling it and
+        uploading it to the boards.  The sequence is still made, so that
+        its contents, sampled envelopes included, can be compared (see
+        sequenceDigest and SequenceCache).  Code that builds sequences in
+        the same contexts without going through runQubits should call
+        sequenceCache.forget first.
     """
     if dataFormat is None:
         dataFormat = 'probs'
@@ -134,8 +150,19 @@ def runQubits(server, devices, stats, probs=None, dataFormat=None,
     phaseQubits = sortedDevices['phaseQubits']
     
     p = server.packet()
-    makeSequence(p, devices)
-    p.build_sequence()
+    built = None
+    if cache:
+        recorder = SequenceRecorder()
+        makeSequence(recorder, devices)
+        digest = sequenceDigest(recorder)
+        if not sequenceCache.lookup(server, p, digest):
+            recorder.replay(p)
+            p.build_sequence()
+            built = sequenceCache.building(server, p, digest)
+    else:
+        makeSequence(p, devices)
+        p.build_sequence()
+        sequenceCache.forget(server, p)
     p.run(long(stats))
     
     # get the data in the desired format
@@ -168,7 +195,10 @@ def runQubits(server, devices, stats, probs=None, dataFormat=None,
             raise Exception('dataFormat %s not recognized' %str(dataFormat))
 
             #Send the packet with wait=False, therefore returning a Future
-    return sendPacket(p, debug)
+    req = sendPacket(p, debug)
+    if built is not None:
+        req.addCallback(built)
+    return req
 
 
 def runInterlaced(server, qubits, stats, probs=None, raw=False, separate=False, debug=False):
@@ -209,6 +239,7 @@ def runInterlacedSRAM(server, qubits, stats, probs=None, raw=False, separate=Fal
     p = server.packet()
     makeSequenceInterlaced(p, qubits, numSRAM)
     p.build_sequence()
+    sequenceCache.forget(server, p)
 
     p.run(long(stats))
     
@@ -263,8 +294,124 @@ def makeSequence(p, devices):
     memqubits = [q for q in phaseQubits if 'flux' in dict(q['channels'])]
     addMem(p, memqubits, ['block0'])
     addSram(p, devices, [t], ['block0'])   
-    for key in groups_ADC.keys():
-        addADC(p, groups_ADC[key])
+    for adc in groups_ADC.keys():
+        addADC(p, groups_ADC[adc])
+
+
+def sequenceDigest(recorder):
+    """Make a digest of the sequence recorded by a SequenceRecorder.
+    
+    The digest covers every call made to build the sequence, with their
+    arguments made hashable with pyle.util._freeze.  This includes the
+    SRAM data sampled from the envelopes, so sequences with equal
+    contents have equal digests however their envelopes were made.
+    Returns None if some argument cannot be used in a digest.
+    """
+    try:
+        calls = _freeze(recorder.calls)
+    except TypeError:
+        return None
+    return hashlib.sha1(repr(calls)).hexdigest()
+
+
+class SequenceRecorder(object):
+    """Stand-in for a Qubit Sequencer packet that records calls made on it."""
+    def __init__(self):
+        self.calls = []
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def record(*args, **kw):
+            self.calls.append((name, args, kw))
+        return record
+    
+    def replay(self, p):
+        """Make the recorded calls on a packet."""
+        for name, args, kw in self.calls:
+            getattr(p, name)(*args, **kw)
+
+
+class SequenceCache(object):
+    """The sequences built in each Qubit Sequencer context, by digest.
+    
+    The Qubit Sequencer keeps the sequence last built in a context, so a
+    packet in that context can run it again without sending it.  A
+    context is only marked as having built a sequence once the packet
+    that built it has succeeded, and only if no other sequence was sent
+    to that context since, so packets still in flight never leave a
+    stale entry.  Contexts are keyed by server and packet context (see
+    packetContext), and at most maxsize of them are remembered, dropping
+    the least recently used.
+    """
+    def __init__(self, maxsize=SEQUENCE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # context -> (generation, digest)
+    
+    def _key(self, server, p):
+        return server, packetContext(p)
+    
+    def lookup(self, server, p, digest):
+        """Check whether the context of packet p has built this sequence."""
+        key = self._key(server, p)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            if digest is not None and entry is not None and entry[1] == digest:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+    
+    def building(self, server, p, digest):
+        """Record that packet p builds a sequence in its context.
+        
+        Returns a callback to add to the request, which marks the sequence
+        as built once the request succeeds.
+        """
+        key = self._key(server, p)
+        with self._lock:
+            entry = self._entries.pop(key, (0, None))
+            generation = entry[0] + 1
+            self._entries[key] = (generation, None)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        def built(result):
+            with self._lock:
+                entry = self._entries.get(key)
+                if digest is not None and entry is not None and entry[0] == generation:
+                    self._entries[key] = (generation, digest)
+            return result
+        return built
+    
+    def forget(self, server, p):
+        """Forget the sequence built in the context of packet p."""
+        self.building(server, p, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+    
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def packetContext(p):
+    """Get the context a LabRAD packet will be sent in.
+    
+    None stands for the default context of the server.
+    """
+    kw = getattr(p, '_kw', None) or {}
+    return kw.get('context')
+
+sequenceCache = SequenceCache()
 
 
 def makeSequenceInterlaced(p, qubits, numSRAM):
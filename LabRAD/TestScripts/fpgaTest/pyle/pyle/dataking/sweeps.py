@@ -1,10 +1,27 @@
+import itertools
+import time
+
 import numpy as np
 
 import pyle
-from pyle.pipeline import pmap, returnValue
 from pyle.util import getch
 
 
+# pyle.pipeline is only needed to run sweeps, so it is imported when a sweep
+# runs rather than with this module.  This lets the data collection and grid
+# scheduling helpers below be used without it.
+
+def pmap(func, iterable, **kw):
+    """Pipelined map, see pyle.pipeline.pmap."""
+    from pyle.pipeline import pmap
+    return pmap(func, iterable, **kw)
+
+def returnValue(val):
+    """Return a value from a pipelined function, see pyle.pipeline.returnValue."""
+    from pyle.pipeline import returnValue
+    returnValue(val)
+
+
 def prepDataset(sample, name, axes=None, dependents=None, measure=None, cxn=None, kw=None, explicitIndependents=None):
     """Prepare dataset for a sweep.
     
@@ -110,7 +127,8 @@ def prepDataset(sample, name, axes=None, dependents=None, measure=None, cxn=None
 
 def run(func, sweep, save=True, dataset=None,
         abortable=True, abortPrefix=[],
-        collect=True, noisy=True, pipesize=10):
+        collect=True, noisy=True, pipesize=10,
+        refresh=1.0, chunksize=1024, filename=None):
     """Run a function pipelined over an iterable sweep.
     
     func: function that will be called once for each value in the sweep.
@@ -122,10 +140,18 @@ def run(func, sweep, save=True, dataset=None,
     abortable: if True, check for keypresses to allow the sweep to be aborted cleanly
     save: if True, create a new dataset (using ds_info) and save all data to it
     collect: if True, collect the data into an array and return it
-    noisy: if True, print each row of data as it comes in
+    noisy: if True, print a summary line with the latest row of data
+           at most every refresh seconds (every row if refresh is None)
     
     dataset: a dataset that will be called with the iterable of data to be saved
-    pipesize: the number of pipelined calls to func that should be run in parallel
+    pipesize: the number of pipelined calls to func that should be run in parallel,
+              or 'auto' (or a PipeTuner) to adjust it from measured latencies
+    
+    refresh: minimum time in seconds between progress lines when noisy
+    chunksize: number of rows allocated at once when collecting data
+    filename: if given, collected data are written to this file in chunks
+              of chunksize rows instead of being kept in memory, and the
+              returned array is a read-only memmap of the file (see Collector)
 
     
     The following additional parameters usually only need to be modified for defining
@@ -139,34 +165,32 @@ def run(func, sweep, save=True, dataset=None,
             sweep = checkAbort(sweep, prefix=abortPrefix)
         
         # wrap the function to pass the qubit sequencer as the first param
+        tuner = makeTuner(pipesize)
         def wrapped(val):
+            t = time.time()
             ans = yield func(sequencer, val)
-            ans = np.asarray(ans)
-            if noisy:
-                if len(ans.shape) == 1:
-                    rows = [ans]
-                else:
-                    rows = ans
-                for row in rows:
-                    print ' '.join(('%0.3g' % v).ljust(8) for v in row)
-            returnValue(ans)
+            if tuner is not None:
+                tuner.record(time.time() - t)
+            returnValue(np.asarray(ans))
         
         # Build the generator that returns results of func. Note that this generator
         # doesn't execute any code yet, and won't until .next() is called. 
-        iter = pmap(wrapped, sweep, size=pipesize)
+        if tuner is not None:
+            iter = tuner.pmap(wrapped, sweep)
+        else:
+            iter = pmap(wrapped, sweep, size=pipesize)
         #Massage iter so that the datavault can catch incoming data
         if save and dataset:
             iter = dataset.capture(iter)
         
         # run the iterable, and either collect or discard
-        if collect:
-            return np.vstack(iter)
-        else:
-            for _ in iter: pass
+        return consume(iter, collect=collect, noisy=noisy, refresh=refresh,
+                       chunksize=chunksize, filename=filename)
 
 def runSim(func, sweep, save=True, dataset=None,
         abortable=True, abortPrefix=[],
-        collect=True, noisy=True, pipesize=10):
+        collect=True, noisy=True, pipesize=10,
+        refresh=1.0, chunksize=1024, filename=None):
     """Run a function pipelined over an iterable sweep.
     
     func: function that will be called once for each value in the sweep.
@@ -178,10 +202,18 @@ def runSim(func, sweep, save=True, dataset=None,
     abortable: if True, check for keypresses to allow the sweep to be aborted cleanly
     save: if True, create a new dataset (using ds_info) and save all data to it
     collect: if True, collect the data into an array and return it
-    noisy: if True, print each row of data as it comes in
+    noisy: if True, print a summary line with the latest row of data
+           at most every refresh seconds (every row if refresh is None)
     
     dataset: a dataset that will be called with the iterable of data to be saved
-    pipesize: the number of pipelined calls to func that should be run in parallel
+    pipesize: the number of pipelined calls to func that should be run in parallel,
+              or 'auto' (or a PipeTuner) to adjust it from measured latencies
+    
+    refresh: minimum time in seconds between progress lines when noisy
+    chunksize: number of rows allocated at once when collecting data
+    filename: if given, collected data are written to this file in chunks
+              of chunksize rows instead of being kept in memory, and the
+              returned array is a read-only memmap of the file (see Collector)
 
     
     The following additional parameters usually only need to be modified for defining
@@ -194,32 +226,245 @@ def runSim(func, sweep, save=True, dataset=None,
         sweep = checkAbort(sweep, prefix=abortPrefix)
     
     # wrap the function to pass the qubit sequencer as the first param
+    tuner = makeTuner(pipesize)
     def wrapped(val):
+        t = time.time()
         ans = yield func(val)
-        ans = np.asarray(ans)
-        if noisy:
-            if len(ans.shape) == 1:
-                rows = [ans]
-            else:
-                rows = ans
-            for row in rows:
-                print ' '.join(('%0.3g' % v).ljust(8) for v in row)
-        returnValue(ans)
+        if tuner is not None:
+            tuner.record(time.time() - t)
+        returnValue(np.asarray(ans))
     
     # Build the generator that returns results of func. Note that this generator
     # doesn't execute any code yet, and won't until .next() is called. 
-    iter = pmap(wrapped, sweep, size=pipesize)
+    if tuner is not None:
+        iter = tuner.pmap(wrapped, sweep)
+    else:
+        iter = pmap(wrapped, sweep, size=pipesize)
     #Massage iter so that the datavault can catch incoming data
     if save and dataset:
         iter = dataset.capture(iter)
     
     # run the iterable, and either collect or discard
-    if collect:
-        return np.vstack(iter)
-    else:
-        for _ in iter: pass
-            
-def grid(func, axes, **kw):
+    return consume(iter, collect=collect, noisy=noisy, refresh=refresh,
+                   chunksize=chunksize, filename=filename)
+
+
+def makeTuner(pipesize):
+    """Get the PipeTuner to use for a pipesize argument, or None."""
+    if isinstance(pipesize, PipeTuner):
+        return pipesize
+    if pipesize == 'auto':
+        return PipeTuner()
+    return None
+
+
+class PipeTuner(object):
+    """Tune the number of pipelined calls from measured latencies.
+    
+    The sweep is run in segments of segment points (by default, four
+    times the current size), each with its own pmap.  After each segment
+    the size is adjusted much like the window of a
+    pyle.util.labradtools.ContextCycler: comparing the mean latency of the
+    points in the segment with the smallest latency seen so far estimates
+    how many calls are waiting in the server rather than being worked on.
+    If fewer than one, the server is keeping up and we double the size; if
+    more than three, we shrink it so that about two are waiting.
+    
+    Keep a PipeTuner and pass it as the pipesize of later sweeps to start
+    them from the size found so far.
+    """
+    def __init__(self, size=10, minSize=1, maxSize=100, segment=None):
+        self.size = size
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.segment = segment
+        self.baseLatency = None
+        self.sizes = [] # size used for each segment
+        self._latencies = []
+    
+    def record(self, latency):
+        """Record the latency of one pipelined call."""
+        self._latencies.append(latency)
+    
+    def adapt(self):
+        """Adjust the size from the latencies recorded since the last call."""
+        latencies, self._latencies = self._latencies, []
+        if not len(latencies):
+            return
+        base = min(latencies)
+        if self.baseLatency is None or base < self.baseLatency:
+            self.baseLatency = base
+        latency = sum(latencies) / len(latencies)
+        if latency <= 0:
+            return
+        queued = self.size * (1.0 - self.baseLatency / latency)
+        if queued < 1:
+            self.size = min(2 * self.size, self.maxSize)
+        elif queued > 3:
+            self.size = max(self.size - int(queued) + 2, self.minSize)
+    
+    def pmap(self, func, iterable):
+        """Pipelined map over iterable, adapting the size between segments."""
+        it = iter(iterable)
+        while True:
+            segment = list(itertools.islice(it, self.segment or 4 * self.size))
+            if not len(segment):
+                break
+            self.sizes.append(self.size)
+            for ans in pmap(func, segment, size=self.size):
+                yield ans
+            self.adapt()
+
+
+def consume(iter, collect=True, noisy=True, refresh=1.0, chunksize=1024, filename=None):
+    """Run an iterable of sweep results, printing progress and collecting data.
+    
+    Each item produced by iter should be a row of data or a 2D array of rows.
+    If collect is True, the rows are collected with a Collector and returned
+    as a single 2D array; otherwise they are discarded and None is returned.
+    If noisy is True, progress is printed with a Progress object.
+    """
+    collector = Collector(chunksize, filename) if collect else None
+    progress = Progress(refresh) if noisy else None
+    try:
+        for ans in iter:
+            if progress is not None:
+                progress.update(ans)
+            if collector is not None:
+                collector.add(ans)
+    finally:
+        if progress is not None:
+            progress.done()
+    if collector is not None:
+        return collector.data()
+
+
+class Collector(object):
+    """Collect rows of sweep data into a single array.
+    
+    Rows are copied into a preallocated array of chunksize rows, which is
+    doubled in size whenever it fills up, so collecting n rows takes time
+    proportional to n and at most twice the memory needed for the data.
+    
+    If filename is given, the data are not kept in memory.  Instead, every
+    time chunksize rows have been collected they are appended to the file
+    as raw binary data, and data returns a read-only memmap of the file, so
+    memory use stays constant however long the sweep is.  The file is
+    overwritten if it already exists.
+    
+    The dtype of the data is that of the first rows added, promoted as
+    needed by later rows (while the data are still in memory).
+    """
+    def __init__(self, chunksize=1024, filename=None):
+        self.chunksize = chunksize
+        self.filename = filename
+        self.rows = 0 # total number of rows collected
+        self._buf = None
+        self._count = 0 # number of rows in _buf
+        self._file = None
+    
+    def add(self, ans):
+        """Add one row (a scalar is a row of length 1) or a 2D array of rows."""
+        rows = np.atleast_1d(ans)
+        if len(rows.shape) == 1:
+            rows = rows[np.newaxis,:]
+        n = len(rows)
+        if self._buf is None:
+            self._buf = np.empty((max(self.chunksize, n), rows.shape[1]), dtype=rows.dtype)
+        elif rows.shape[1:] != self._buf.shape[1:]:
+            raise ValueError('Expected rows of length %d, got %d' % (self._buf.shape[1], rows.shape[1]))
+        elif self._file is None:
+            dtype = np.promote_types(self._buf.dtype, rows.dtype)
+            if dtype != self._buf.dtype:
+                self._buf = self._buf.astype(dtype)
+        if self._count + n > len(self._buf):
+            self.flush()
+        if self._count + n > len(self._buf):
+            size = len(self._buf)
+            while size < self._count + n:
+                size *= 2
+            buf = np.empty((size,) + self._buf.shape[1:], dtype=self._buf.dtype)
+            buf[:self._count] = self._buf[:self._count]
+            self._buf = buf
+        self._buf[self._count:self._count+n] = rows
+        self._count += n
+        self.rows += n
+        if self._count >= self.chunksize:
+            self.flush()
+    
+    def flush(self):
+        """Write the rows held in memory to the file, if we have one."""
+        if self.filename is None or not self._count:
+            return
+        if self._file is None:
+            self._file = open(self.filename, 'wb')
+        self._buf[:self._count].tofile(self._file)
+        self._file.flush()
+        self._count = 0
+    
+    def data(self):
+        """Get all collected rows as a 2D array."""
+        if self._buf is None:
+            return np.zeros((0, 0))
+        if self.filename is None:
+            return self._buf[:self._count]
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return np.memmap(self.filename, dtype=self._buf.dtype, mode='r',
+                         shape=(self.rows, self._buf.shape[1]))
+
+
+class Progress(object):
+    """Print progress of a sweep without spending much time printing.
+    
+    At most one line is printed every refresh seconds, giving the number
+    of rows so far, the current rate and the latest row of data.  If
+    refresh is None, every row is printed as it comes in instead.
+    """
+    def __init__(self, refresh=1.0):
+        self.refresh = refresh
+        self.rows = 0
+        self.start = time.time()
+        self._last = None
+        self._printed = self.start
+        self._pending = False
+    
+    def update(self, ans):
+        ans = np.atleast_1d(ans)
+        if len(ans.shape) == 1:
+            ans = ans[np.newaxis,:]
+        self.rows += len(ans)
+        if self.refresh is None:
+            for row in ans:
+                print formatRow(row)
+            return
+        self._last = ans[-1]
+        self._pending = True
+        now = time.time()
+        if now - self._printed >= self.refresh:
+            self._print(now)
+    
+    def done(self):
+        """Print a final line if there are rows that have not been reported."""
+        if self._pending:
+            self._print(time.time())
+    
+    def _print(self, now):
+        elapsed = now - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        print '%d rows, %.1f s, %.1f rows/s: %s' % (self.rows, elapsed, rate, formatRow(self._last))
+        self._printed = now
+        self._pending = False
+
+
+def formatRow(row):
+    """Format a row of data for printing."""
+    return ' '.join(('%0.3g' % v).ljust(8) for v in row)
+
+
+def grid(func, axes, expensive=None, **kw):
     """Run a pipelined sweep on a grid over the given list of axes.
     
     The axes should be specified as a list of (value, label) tuples.
@@ -228,8 +473,18 @@ def grid(func, axes, **kw):
     (e.g. probabilities), and the independent variables that are being
     swept will be prepended automatically before the data is passed along.
     
+    expensive is an optional list of labels of axes that are slow to change
+    (e.g. a magnet field or an RF frequency), most expensive first.  If
+    given, the grid points are run in the order given by gridSchedule so
+    that these axes change as few times as possible, and the collected
+    data are put back in the usual grid order before being returned.  Note
+    that the data are saved to the data vault in the order they were taken.
+    
     All other keyword arguments to this function are passed directly to run.
     """
+    if expensive:
+        return scheduledGrid(func, axes, expensive, **kw)
+    
     def gridSweep(axes):
         if not len(axes):
             yield (), ()
@@ -255,6 +510,108 @@ def grid(func, axes, **kw):
     
     return run(wrapped, gridSweep(axes), abortPrefix=[1], **kw)
     
+def gridOrder(shape, loop, serpentine=0):
+    """Get the order in which to run the points of a grid.
+    
+    shape gives the length of each swept axis, in grid order.  loop gives
+    the axes in the order of the loops that should run over them, from the
+    outermost to the innermost.  The first serpentine loops after the
+    outermost one run alternately forwards and backwards, so that each
+    step between points changes their axis by a single value.
+    
+    Returns an array with the index that each point would have in the
+    usual grid order (the first axis outermost), in the order in which
+    the points should be run.
+    """
+    loopShape = [shape[a] for a in loop]
+    counters = np.indices(loopShape).reshape(len(loop), -1)
+    idx = counters.copy()
+    for j in xrange(1, min(serpentine + 1, len(loop))):
+        outer = np.ravel_multi_index(tuple(counters[:j]), loopShape[:j])
+        idx[j] = np.where(outer % 2, loopShape[j] - 1 - counters[j], counters[j])
+    gridIdx = [None] * len(shape)
+    for j, a in enumerate(loop):
+        gridIdx[a] = idx[j]
+    return np.ravel_multi_index(tuple(gridIdx), shape)
+
+
+def gridSchedule(axes, expensive):
+    """Plan the order of the points of a grid sweep with expensive axes.
+    
+    The axes named in expensive are moved to the outermost loops, in the
+    order given, followed by the other swept axes in grid order.  All but
+    the outermost expensive axis are run serpentine style (see gridOrder)
+    so that they only move by a single step at a time.
+    
+    Returns the order of the points as given by gridOrder and a function
+    that creates the sweep, which yields (all, swept, n) tuples where all
+    gives the values of all axes, swept those of the swept axes, and n is
+    the position of the point in the order.
+    """
+    labels = [label for _param, label in axes]
+    swept = [i for i, (param, _label) in enumerate(axes) if np.iterable(param)]
+    values = [list(axes[i][0]) for i in swept]
+    shape = [len(v) for v in values]
+    loop = []
+    for label in expensive:
+        if label not in labels:
+            raise ValueError('Unknown axis %r' % (label,))
+        i = labels.index(label)
+        if i in swept and swept.index(i) not in loop:
+            loop.append(swept.index(i))
+    serpentine = len(loop) - 1
+    loop += [a for a in xrange(len(swept)) if a not in loop]
+    if len(loop):
+        order = gridOrder(shape, loop, serpentine)
+    else:
+        order = np.zeros(1, dtype=int) # a single point
+    
+    def sweep():
+        for n, flat in enumerate(order):
+            point = np.unravel_index(flat, shape)
+            vals = [values[a][k] for a, k in enumerate(point)]
+            all = [param for param, _label in axes]
+            for a, i in enumerate(swept):
+                all[i] = vals[a]
+            yield tuple(all), tuple(vals), n
+    
+    return order, sweep
+
+
+def scheduledGrid(func, axes, expensive, **kw):
+    """Run a grid sweep in the order given by gridSchedule.
+    
+    This is called by grid when some axes are marked as expensive.  The
+    number of rows returned by func for each point is recorded, so that
+    the collected data can be put back in grid order with a stable sort.
+    """
+    order, sweep = gridSchedule(axes, expensive)
+    counts = {}
+    
+    def wrapped(server, args):
+        all, swept, n = args
+        ans = yield func(server, *all)
+        ans = np.asarray(ans)
+        pre = np.asarray(swept)
+        if len(ans.shape) != 1:
+            pre = np.tile([pre], (ans.shape[0], 1))
+            counts[n] = ans.shape[0]
+        else:
+            counts[n] = 1
+        returnValue(np.hstack((pre, ans)))
+    
+    data = run(wrapped, sweep(), abortPrefix=[1], **kw)
+    if data is None:
+        return None
+    # the points that were run are the first ones in the order,
+    # unless the sweep was aborted
+    n = total = 0
+    while total < len(data):
+        total += counts[n]
+        n += 1
+    keys = np.repeat(order[:n], [counts[i] for i in xrange(n)])
+    return data[np.argsort(keys, kind='mergesort')]
+    
 def gridSim(func, axes, **kw):
     """Run a pipelined sweep on a grid over the given list of axes.
     
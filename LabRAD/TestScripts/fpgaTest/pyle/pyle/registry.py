@@ -13,6 +13,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
+import threading
+import time
+
 
 class AttrDict(dict):
     """A dict whose entries can also be accessed as attributes.
@@ -208,3 +212,293 @@ class RegistryWrapper(object):
     def __repr__(self):
         return '<RegistryWrapper: %r>' % (self._dir,)
 
+    def snapshot(self, ttl=60, notify=True):
+        """Return a RegistrySnapshot of this directory.
+        
+        See RegistrySnapshot for the meaning of the arguments.
+        """
+        return RegistrySnapshot(self._cxn, self._dir, self._ctx,
+                                ttl=ttl, notify=notify)
+
+
+# message IDs for registry change notifications
+_notify_ids = itertools.count(0x5ea000)
+
+
+def _equal(a, b):
+    """Compare registry values; values that cannot be compared (such
+    as arrays) are considered different."""
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+class _Snapshot(object):
+    """Local copy of a registry subtree.
+    
+    The tree is a pair of dicts (subdirs, keys) for each directory,
+    where subdirs maps names to the same kind of pair.  It is shared
+    by the RegistrySnapshot wrappers of all directories in the subtree.
+    
+    Change notifications arrive on the listener thread, so the state
+    they touch (tree, generation and unverified) is guarded by lock.
+    """
+    def __init__(self, cxn, srv, ctx, root, ttl, notify):
+        self.cxn = cxn
+        self.srv = srv
+        self.ctx = ctx
+        self.root = root
+        self.ttl = ttl
+        self.notify = notify
+        self.lock = threading.Lock()
+        self.tree = None
+        self.generation = 0
+        self.fetched = None
+        self.pending = []
+        self.watched = {}
+        self.written = {}
+        self.unverified = set()
+        
+    def invalidate(self, *args):
+        with self.lock:
+            self.tree = None
+            self.generation += 1
+    
+    def changed(self, c, data, dir):
+        """Handle a change notification for a watched directory.
+        
+        A change of a key that we have written ourselves may be the
+        echo of our own write.  Instead of refetching the whole tree,
+        the key is read again on the next access and compared with the
+        value we wrote (see verify).  Any other change invalidates the
+        local copy.
+        """
+        name, isDir, addOrChange = data
+        key = (dir, name)
+        with self.lock:
+            if not isDir and addOrChange and key in self.written:
+                self.unverified.add(key)
+                return
+        self.invalidate()
+    
+    def node(self, dir):
+        """Get the (subdirs, keys) pair for a directory."""
+        with self.lock:
+            tree = self.tree
+            unverified, self.unverified = self.unverified, set()
+        if tree is None or (self.ttl is not None and
+                            time.time() - self.fetched > self.ttl):
+            tree = self.fetch()
+        elif len(unverified):
+            tree = self.verify(tree, unverified)
+        node = tree
+        for name in dir[len(self.root):]:
+            node = node[0][name]
+        return node
+    
+    def verify(self, tree, keys):
+        """Read keys that changed after our own writes in one packet.
+        
+        If the registry still has the value we wrote, the notification
+        was our own echo.  Otherwise another client has written the key
+        and the local copy takes its value, unless we have a newer
+        write pending.
+        """
+        keys = sorted(keys)
+        p = self.srv.packet(context=self.ctx)
+        for i, (dir, name) in enumerate(keys):
+            p.cd(list(dir))
+            p.get(name, key='get%d' % i)
+        try:
+            ans = p.cd(['']).send()
+        except Exception:
+            # e.g. the key has been deleted in the meantime
+            return self.fetch()
+        pending = set((tuple(dir), name) for dir, name, value in self.pending)
+        for i, key in enumerate(keys):
+            value = ans['get%d' % i]
+            if _equal(value, self.written[key]) or key in pending:
+                continue
+            node = tree
+            try:
+                for name in key[0][len(self.root):]:
+                    node = node[0][name]
+            except KeyError:
+                return self.fetch()
+            node[1][key[1]] = value
+            self.written[key] = value
+        return tree
+        
+    def fetch(self):
+        """Fetch the whole subtree, one packet per directory level.
+        
+        The packet for each level lists all directories of that level
+        and gets the keys found in the level above.
+        """
+        self.flush()
+        with self.lock:
+            generation = self.generation
+        tree = ({}, {})
+        nodes = {tuple(self.root): tree}
+        dirs, gets = [self.root], []
+        while len(dirs) or len(gets):
+            p = self.srv.packet(context=self.ctx)
+            for i, dir in enumerate(dirs):
+                p.cd(dir, True)
+                p.dir(key='dir%d' % i)
+            for i, (dir, name) in enumerate(gets):
+                p.cd(dir)
+                p.get(name, key='get%d' % i)
+            ans = p.cd(['']).send()
+            for i, (dir, name) in enumerate(gets):
+                nodes[tuple(dir)][1][name] = ans['get%d' % i]
+            subdirs, gets = [], []
+            for i, dir in enumerate(dirs):
+                names, keys = ans['dir%d' % i]
+                node = nodes[tuple(dir)]
+                for name in names:
+                    node[0][name] = nodes[tuple(dir + [name])] = ({}, {})
+                    subdirs.append(dir + [name])
+                gets.extend((dir, name) for name in keys)
+            dirs = subdirs
+        with self.lock:
+            # A change reported while we were fetching may not be in
+            # this copy: use it for this access, but fetch again on
+            # the next one.
+            if self.generation == generation:
+                self.tree = tree
+        self.fetched = time.time()
+        if self.notify:
+            self.watch([list(dir) for dir in nodes])
+        return tree
+    
+    def watch(self, dirs):
+        """Request change notifications for the given directories.
+        
+        A subscription stays with the directory in which it was made,
+        so all directories are subscribed in a single packet, which
+        then returns to the root.  Each directory gets its own message
+        ID so that we know where a change happened.
+        """
+        p = self.srv.packet(context=self.ctx)
+        new = []
+        for dir in dirs:
+            dir = tuple(dir)
+            if dir in self.watched:
+                continue
+            ID = _notify_ids.next()
+            self.cxn._cxn.addListener(self.changed, source=self.srv.ID,
+                                      ID=ID, args=(dir,))
+            p.cd(list(dir)).notify_on_change(ID, True)
+            new.append((dir, ID))
+        if not len(new):
+            return
+        p.cd(['']).send()
+        self.watched.update(new)
+    
+    def flush(self):
+        """Send all pending writes in a single packet."""
+        if not len(self.pending):
+            return
+        p = self.srv.packet(context=self.ctx)
+        for dir, name, value in self.pending:
+            p.cd(dir, True)
+            p.set(name, value)
+            key = (tuple(dir), name)
+            if key[0] in self.watched:
+                with self.lock:
+                    self.written[key] = value
+        self.pending = []
+        p.cd(['']).send()
+        
+
+class RegistrySnapshot(RegistryWrapper):
+    """A RegistryWrapper that serves reads from a local copy.
+    
+    The whole subtree is prefetched on first access with one packet
+    per directory level.  Writes are applied to the local copy and
+    sent to the registry in a single packet by flush (which is also
+    called before the subtree is refreshed).  The local copy is
+    refreshed when the registry reports a change by another client in
+    any of the directories (if notify is True) or, as a fallback, when
+    it is older than ttl seconds (never, if ttl is None).  Deletions
+    are sent immediately.
+    """
+    def __init__(self, cxn, dir='', ctx=None, ttl=60, notify=True,
+                 snapshot=None):
+        if snapshot is None:
+            RegistryWrapper.__init__(self, cxn, dir, ctx)
+            snapshot = _Snapshot(cxn, self._srv, self._ctx, self._dir,
+                                 ttl, notify)
+        else:
+            # A subdirectory of an existing snapshot: the directory is
+            # created when pending writes are flushed.
+            object.__setattr__(self, '_dir', dir)
+            object.__setattr__(self, '_cxn', cxn)
+            object.__setattr__(self, '_srv', snapshot.srv)
+            object.__setattr__(self, '_ctx', ctx)
+        object.__setattr__(self, '_snapshot', snapshot)
+    
+    def _subdir(self, name):
+        if name == '':
+            raise Exception('Empty string is invalid subdirectory name')
+        return RegistrySnapshot(self._cxn, self._dir + [name], self._ctx,
+                                snapshot=self._snapshot)
+    
+    def _node(self):
+        return self._snapshot.node(self._dir)
+    
+    def _get_list(self):
+        dirs, keys = self._node()
+        return sorted(dirs), sorted(keys)
+    
+    def __getitem__(self, name):
+        dirs, keys = self._node()
+        if name in dirs:
+            return self._subdir(name)
+        elif name in keys:
+            return keys[name]
+        else:
+            raise KeyError(name)
+    
+    def __setitem__(self, name, value):
+        dirs, keys = self._node()
+        if isinstance(value, (dict, RegistryWrapper)):
+            if name not in dirs:
+                dirs[name] = ({}, {})
+            subdir = self._subdir(name)
+            for element in value:
+                subdir[element] = value[element]
+        else:
+            keys[name] = value
+            self._snapshot.pending.append((self._dir, name, value))
+    
+    def __delitem__(self, name):
+        self._snapshot.flush()
+        RegistryWrapper.__delitem__(self, name)
+        self._snapshot.invalidate()
+    
+    def copy(self):
+        """Make a local copy, recursively copying subdirs as well.
+        Returns an AttrDict, NOT another RegistryWrapper"""
+        dirs, keys = self._node()
+        d = AttrDict(keys)
+        object.__setattr__(d, '_dir', self._dir)
+        object.__setattr__(d, '__name__', self._dir[-1])
+        for name in dirs:
+            d[name] = self._subdir(name).copy()
+        return d
+    
+    def flush(self):
+        """Send pending writes to the registry."""
+        self._snapshot.flush()
+    
+    def refresh(self):
+        """Discard the local copy so that it is fetched again."""
+        self._snapshot.flush()
+        self._snapshot.invalidate()
+    
+    def __repr__(self):
+        return '<RegistrySnapshot: %r>' % (self._dir,)
+
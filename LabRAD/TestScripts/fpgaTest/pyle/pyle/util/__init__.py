@@ -1,6 +1,11 @@
+import collections
 from contextlib import contextmanager
 import functools
+import hashlib
 import inspect
+import sys
+import threading
+import time
 
 import numpy as np
 
@@ -102,17 +107,118 @@ except ImportError:
         yield # a do-nothing context manager for non-windows compatibility
 
 
-def memoize(f):
-    """Wraps a one-argument function so that it caches computed results."""
-    _cache = {}
+def _freeze(v):
+    """Convert a function argument into a hashable cache key.
+
+    numpy arrays are keyed by dtype, shape and a digest of their data,
+    and values with units by their value and unit string, so equal
+    quantities in different units (1 us and 1000 ns) get different keys.
+    Lists, tuples, dicts and sets are frozen recursively.  Anything else
+    must be hashable itself, otherwise TypeError is raised.
+    """
+    if isinstance(v, np.ndarray):
+        v = np.ascontiguousarray(v)
+        return ('ndarray', v.dtype.str, v.shape, hashlib.sha1(v.tostring()).digest())
+    if hasattr(v, 'unit') and hasattr(v, 'value'): # prefer over subclass check: isinstance(v, Value)
+        return ('units', _freeze(v.value), str(v.unit))
+    if isinstance(v, (list, tuple)):
+        return (type(v).__name__,) + tuple(_freeze(x) for x in v)
+    if isinstance(v, dict):
+        return ('dict',) + tuple(sorted((k, _freeze(x)) for k, x in v.iteritems()))
+    if isinstance(v, (set, frozenset)):
+        return ('set', frozenset(_freeze(x) for x in v))
+    hash(v)
+    return v
+
+def _sizeof(v):
+    """Approximate memory used by a cached value, in bytes."""
+    if isinstance(v, np.ndarray):
+        return v.nbytes
+    if hasattr(v, 'unit') and hasattr(v, 'value'):
+        return _sizeof(v.value)
+    if isinstance(v, (list, tuple)):
+        return sys.getsizeof(v) + sum(_sizeof(x) for x in v)
+    return sys.getsizeof(v)
+
+def memoize(f=None, maxsize=1000, maxbytes=None, ttl=None):
+    """Wraps a function so that it caches computed results.
+    
+    Can be used as a plain decorator, @memoize, or with arguments,
+    @memoize(maxsize=100, maxbytes=10e6, ttl=60).  The cache keeps the
+    most recently used results: at most maxsize of them and, if maxbytes
+    is given, at most maxbytes bytes worth (see _sizeof).  Results older
+    than ttl seconds are recomputed.  Use None to disable a limit.
+    
+    Arguments may be numpy arrays, values with units and nested lists,
+    tuples or dicts of these (see _freeze).  Calls with arguments that
+    can't be used as keys are passed through without caching.  Cached
+    results are shared between callers, so they should not be modified.
+    
+    The wrapped function has cache_info(), which returns hit and miss
+    statistics, and cache_clear().
+    """
+    if f is None:
+        return lambda f: memoize(f, maxsize=maxsize, maxbytes=maxbytes, ttl=ttl)
+    _cache = collections.OrderedDict() # key -> (value, size, time), least recently used first
+    lock = threading.Lock()
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'uncacheable': 0, 'bytes': 0}
+    
     @functools.wraps(f)
-    def wrapped(a):
+    def wrapped(*a, **kw):
         try:
-            return _cache[a]
-        except KeyError:
-            val = _cache[a] = f(a)
+            key = (_freeze(a), _freeze(kw))
+        except TypeError:
+            stats['uncacheable'] += 1
+            return f(*a, **kw)
+        with lock:
+            entry = _cache.pop(key, None)
+            if entry is not None:
+                if ttl is None or time.time() - entry[2] < ttl:
+                    _cache[key] = entry # now the most recently used
+                    stats['hits'] += 1
+                    return entry[0]
+                stats['expired'] += 1
+                stats['bytes'] -= entry[1]
+            stats['misses'] += 1
+        # compute without holding the lock, so f may call itself
+        val = f(*a, **kw)
+        size = _sizeof(val)
+        if maxbytes is not None and size > maxbytes:
             return val
+        with lock:
+            old = _cache.pop(key, None)
+            if old is not None:
+                stats['bytes'] -= old[1]
+            _cache[key] = (val, size, time.time())
+            stats['bytes'] += size
+            while len(_cache) and ((maxsize is not None and len(_cache) > maxsize) or
+                                   (maxbytes is not None and stats['bytes'] > maxbytes)):
+                _, (_, s, _) = _cache.popitem(last=False)
+                stats['bytes'] -= s
+                stats['evictions'] += 1
+        return val
+    
+    def cache_info():
+        """Return a dict of cache statistics."""
+        with lock:
+            info = dict(stats)
+            info['size'] = len(_cache)
+        info['maxsize'] = maxsize
+        info['maxbytes'] = maxbytes
+        calls = info['hits'] + info['misses']
+        info['hitRate'] = float(info['hits']) / calls if calls else 0.0
+        return info
+    
+    def cache_clear():
+        """Empty the cache and reset the statistics."""
+        with lock:
+            _cache.clear()
+            for k in stats:
+                stats[k] = 0
+    
     wrapped._cache = _cache
+    wrapped.cache_info = cache_info
+    wrapped.cache_clear = cache_clear
     return wrapped
 
 @memoize
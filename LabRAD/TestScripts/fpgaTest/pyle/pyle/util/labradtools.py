@@ -1,6 +1,11 @@
+import collections
 import itertools
+import math
+import threading
+import time
 
 import labrad
+from twisted.python import threadable
 
 
 class ContextCycler(object):
@@ -13,14 +18,44 @@ class ContextCycler(object):
     it automatically closed when the with-statement is exited.  In addition,
     we wait for all pending requests to finish before disconnecting.  To make
     requests, call the 'send' method.
+
+    The number of requests in flight is bounded by a window.  When the
+    window is full, sending another packet blocks until the oldest pending
+    request has finished (if we are called from the reactor thread, where
+    blocking would deadlock, the packet is sent anyway and counted as an
+    overflow in the stats).  If adaptive is True, the window is adjusted
+    after every completed request, Vegas style: it grows while the measured
+    latency stays close to the smallest recent latency, i.e. while the
+    server is keeping up, and shrinks when requests start queueing up in
+    the server.
+
+    Requests in one context are run by the server in the order they were
+    sent.  Packets are normally spread over the contexts round robin; to
+    make sure that some requests run in order, create their packets with
+    the same order_key, and they will all be sent in the same context.
     """
     
-    def __init__(self, name, contexts=10, cxn=None):
+    def __init__(self, name, contexts=10, cxn=None, window=20, min_window=2,
+                 max_window=100, adaptive=True, history=1000):
         self.cxn = cxn
         self.num_contexts = contexts
         self.request_nums = itertools.count()
         self.requests = {}
         self.server_name = name
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.adaptive = adaptive
+        self.latencies = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.completed = 0
+        self.failed = 0
+        self.overflows = 0
+        self.max_in_flight = 0
+        self.blocked_time = 0.0
+        self.first_send = None
+        self.last_done = None
     
     def connect(self):
         """Connect to labrad and set up contexts."""
@@ -30,13 +65,15 @@ class ContextCycler(object):
         else:
             self.close_cxn = False
         self.server = self.cxn[self.server_name]
-        self.contexts = itertools.cycle(self.server.context() for _ in xrange(self.num_contexts))
+        self.context_list = [self.server.context() for _ in xrange(self.num_contexts)]
+        self.contexts = itertools.cycle(self.context_list)
+        self.keyed_contexts = {}
 
     def disconnect(self):
         """Wait for pending requests and disconnect from labrad."""
         try:
             # wait for any requests that are still pending
-            reqs = self.requests.values()
+            reqs = [req for req, t in self.requests.values()]
             if len(reqs):
                 print 'Waiting for %d requests to complete...' % len(reqs)
             for req in reqs:
@@ -63,21 +100,127 @@ class ContextCycler(object):
             if t is None:
                 raise
     
-    def packet(self, **kwargs):
-        kwargs['context'] = self.contexts.next()    
+    def packet(self, order_key=None, **kwargs):
+        """Create a packet in the next context.
+
+        Packets created with the same order_key always use the same context.
+        """
+        if order_key is None:
+            context = self.contexts.next()
+        else:
+            if order_key not in self.keyed_contexts:
+                self.keyed_contexts[order_key] = self.contexts.next()
+            context = self.keyed_contexts[order_key]
+        kwargs['context'] = context
         p = self.server.packet(**kwargs)
         return ManagedPacket(self, p)
         
-    def _start_request(self, req):
+    def in_flight(self):
+        """Number of requests that have been sent but have not finished."""
+        return len(self.requests)
+
+    def _wait_for_room(self):
+        """Block until fewer than window requests are in flight."""
+        if self.in_flight() < self.window:
+            return
+        if threadable.isInIOThread():
+            self.overflows += 1
+            return
+        t = time.time()
+        while self.in_flight() >= self.window:
+            with self._lock:
+                if not len(self.requests):
+                    break
+                i = min(self.requests)
+                req = self.requests[i][0]
+            try:
+                req.wait()
+            except Exception:
+                with self._lock:
+                    if self.requests.pop(i, None) is not None:
+                        self.failed += 1
+            else:
+                # the callback normally removes the request, but
+                # make sure we do not wait for it again
+                self._finish_request(None, i)
+        self.blocked_time += time.time() - t
+
+    def _start_request(self, req, t):
         i = self.request_nums.next()
-        self.requests[i] = req
+        with self._lock:
+            self.requests[i] = (req, t)
+            self.sent += 1
+            if self.first_send is None:
+                self.first_send = t
+            self.max_in_flight = max(self.max_in_flight, len(self.requests))
         req.addCallback(self._finish_request, i)
     
     def _finish_request(self, result, i):
         """Remove a request from the list of pending requests."""
-        del self.requests[i]
+        now = time.time()
+        with self._lock:
+            info = self.requests.pop(i, None)
+            if info is not None:
+                req, t = info
+                latency = now - t
+                self.latencies.append(latency)
+                self.completed += 1
+                self.last_done = now
+                if self.adaptive:
+                    self._adapt(latency)
         return result
 
+    def _adapt(self, latency):
+        """Adjust the window from the latency of a completed request.
+
+        The difference between the number of requests we would expect
+        to complete per latency if the server were idle (window / base
+        latency) and what we actually get (window / latency), measured
+        in requests, estimates how many requests are queued up in the
+        server.  We aim to keep that between 1 and 3.
+        """
+        base = min(self.latencies)
+        if latency <= 0:
+            return
+        queued = self.window * (1.0 - base / latency)
+        if queued < 1:
+            self.window = min(self.window + 1, self.max_window)
+        elif queued > 3:
+            self.window = max(self.window - 1, self.min_window)
+
+    def stats(self):
+        """Get counters and latency statistics for the requests sent so far.
+
+        Latencies are in seconds and cover the most recent requests (see
+        history).  Throughput is in completed requests per second, from
+        the first request sent to the last one finished.
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            ans = {
+                'sent': self.sent,
+                'completed': self.completed,
+                'failed': self.failed,
+                'in_flight': len(self.requests),
+                'max_in_flight': self.max_in_flight,
+                'window': self.window,
+                'overflows': self.overflows,
+                'blocked_time': self.blocked_time,
+            }
+            if self.first_send is not None and self.last_done is not None and self.last_done > self.first_send:
+                ans['throughput'] = self.completed / (self.last_done - self.first_send)
+            else:
+                ans['throughput'] = 0.0
+        if len(latencies):
+            def percentile(q):
+                return latencies[min(int(math.ceil(q * len(latencies))) - 1, len(latencies) - 1)]
+            ans['latency_min'] = latencies[0]
+            ans['latency_mean'] = sum(latencies) / len(latencies)
+            ans['latency_p50'] = percentile(0.5)
+            ans['latency_p99'] = percentile(0.99)
+            ans['latency_max'] = latencies[-1]
+        return ans
+
 
 class ManagedPacket(object):
     """A packet that notifies a manager when it gets sent.
@@ -100,8 +243,10 @@ class ManagedPacket(object):
         raise TypeError("'ManagedPacket' object is not iterable")
     
     def send(self, wait=False, **kwargs):
+        if not wait:
+            self._manager._wait_for_room()
+        t = time.time()
         req = self._packet.send(wait=wait, **kwargs)
         if not wait:
-            self._manager._start_request(req)
+            self._manager._start_request(req, t)
         return req
-
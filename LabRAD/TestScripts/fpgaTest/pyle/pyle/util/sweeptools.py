@@ -24,14 +24,27 @@ def averagedScan(r,averages,noisy=True):
     return delay_gen
     
 def shuffle(iterable):
+    """Return the elements of an iterable in random order.
+    
+    Range objects are shuffled as arrays, and the shuffled range remembers
+    the permutation so that data can be put back in order with unshuffle.
+    """
+    if isinstance(iterable, ArrayRange):
+        return iterable.shuffled()
     L = list(iterable)
     random.shuffle(L)
     return L
 
 
-def unshuffle(data):
+def unshuffle(data, permutation=None):
     """Unshuffles data taken with the sweep server in shuffle mode.
     
+    If permutation is given, either as an array of indices or as a range
+    returned by shuffle, row i of data is taken to belong to point
+    permutation[i] of the original sweep, and the rows are put back in
+    that order.  Otherwise the rows are sorted by their columns as
+    described below.
+    
     For a 2D array of data, np.lexsort sorts columns using values in the
     last row, then the next to last row, etc. (don't ask me why it works
     that way, but it does).  We want to sort rows using the first
@@ -42,6 +55,11 @@ def unshuffle(data):
     the rows of the input matrix in the order returned by lexsort.
     """
     data = np.asarray(data)
+    if permutation is not None:
+        permutation = getattr(permutation, 'permutation', permutation)
+        ans = np.empty_like(data)
+        ans[permutation] = data
+        return ans
     indices = np.lexsort(data[:,::-1].T)
     return data.take(indices, axis=0)
 
@@ -53,7 +71,7 @@ def nearest(val, incr):
 
 def inUnits(v, units):
     """Convert a value into the given units if possible."""
-    if hasattr(v, 'value'):
+    if isinstance(v, Value) or hasattr(v, 'value'): # newer Values have no value attribute
         return v[units]
     else:
         return v
@@ -67,15 +85,77 @@ def iterUnits(iterable, unit=None):
         return (val*unit for val in iterable)
 
 
-class Range(object):
+class ArrayRange(object):
+    """A sweep axis stored as one numpy array of values in a given unit.
+    
+    Iterating over or indexing the range gives Values (plain numbers if
+    unit is None), but the values are computed all at once, and asarray
+    gives them as an array without creating any Values.  The array is
+    computed the first time it is needed by _makeArray, which subclasses
+    override.
+    
+    Unlike the generators the ranges used to be, indexing past either end
+    of the range raises IndexError rather than extrapolating, and slicing
+    gives another ArrayRange.
+    
+    shuffled returns a new range with the same values in random order,
+    which remembers the permutation used, so data taken over the shuffled
+    range can be put back in order with unshuffle.
+    """
+    def __init__(self, values, unit=None, permutation=None):
+        self._values = None if values is None else np.asarray(values)
+        self.unit = unit
+        self.permutation = permutation
+    
+    def _makeArray(self):
+        raise NotImplementedError
+    
+    def asarray(self):
+        """Get the values of this range in its unit as a numpy array."""
+        if self._values is None:
+            self._values = self._makeArray()
+        return self._values
+    
+    def __iter__(self):
+        values = self.asarray().tolist()
+        u = self.unit
+        if u is None:
+            return iter(values)
+        return (v * u for v in values)
+    
+    def __getitem__(self, i):
+        values = self.asarray()
+        if isinstance(i, slice):
+            return ArrayRange(values[i], self.unit)
+        v = values[i].item()
+        return v if self.unit is None else v * self.unit
+    
+    def __len__(self):
+        return len(self.asarray())
+    
+    def shuffled(self, seed=None):
+        """Create a new range with the values of this one in random order.
+        
+        The new range has a permutation attribute such that
+        shuffled[i] == self[permutation[i]].
+        """
+        rand = np.random if seed is None else np.random.RandomState(seed)
+        permutation = rand.permutation(len(self))
+        return ArrayRange(self.asarray()[permutation], self.unit, permutation)
+    
+    def __repr__(self):
+        return 'ArrayRange(%r, %s)' % (self.asarray(), self.unit)
+
+
+class Range(ArrayRange):
     """Simple object that encapsulates a range of values with units.
     
     Rather than generating a list of Values, this object is iterable and
     generates Values on demand, as needed.
     """
     def __init__(self, range, unit):
+        ArrayRange.__init__(self, None, unit)
         self.range = range
-        self.unit = unit
         
     def fill(self, default):
         """Create a new range with missing values filled in from a default range."""
@@ -97,32 +177,23 @@ class Range(object):
         count = int(math.floor(d / s + 0.000000001)) + 1
         return start, step, count
     
-    def __iter__(self):
-        start, step, count = self._count()
-        for i in xrange(count):
-            yield start + step * i
-    
-    def __getitem__(self, i):
+    def _makeArray(self):
         start, step, count = self._count()
-        if i >= 0:
-            return start + step * i
-        elif i < 0:
-            return start + step * (count + i)
-    
-    def __len__(self):
-        return self._count()[2]
+        start, step = inUnits(start, self.unit), inUnits(step, self.unit)
+        return start + step * np.arange(count)
     
     def __repr__(self):
         r, u = self.range, self.unit
         return 'r[%s:%s:%s,%s]' % (r.start, r.stop, r.step, u)
 
-class Range2(object):
+class Range2(ArrayRange):
     """Simple object that encapsulates a range of values with units.
     
     Rather than generating a list of Values, this object is iterable and
     generates Values on demand, as needed.
     """
     def __init__(self, range, unit):
+        ArrayRange.__init__(self, None, unit)
         if isinstance(range, list):
             self.rangeList = range
         else:
@@ -153,26 +224,10 @@ class Range2(object):
             info.append((start,step,count))
         return info
     
-    def __iter__(self):
-        info = self._count()
-        for start, step, count in info:
-            for i in xrange(count):
-                yield start + step * i
-    
-    def __getitem__(self, i):
-        info = self._count()
-        if i>=0:
-            for start, step, count in info:
-                if i>count-1:
-                    i -= count
-                else:
-                    return start + step * i
-        elif i < 0:
-            for start, step, count in reversed(info):
-                if abs(i) >= count:
-                    i += count
-                else:
-                    return start + step * (count+i)
+    def _makeArray(self):
+        u = self.unit
+        return np.hstack([inUnits(start, u) + inUnits(step, u) * np.arange(count)
+                          for start, step, count in self._count()])
 
     def __add__(self, other):
         if not self.unit.isCompatible(other.unit):
@@ -181,10 +236,6 @@ class Range2(object):
         range.extend(other.rangeList[:]) 
         unit = self.unit
         return Range2(range, unit)
-
-    def __len__(self):
-        info = self._count()
-        return sum([info[i][2] for i in range(len(info))])
     
     def __repr__(self):
         reprs = ''
@@ -195,15 +246,15 @@ class Range2(object):
         return reprs
 
 
-class LogRange(object):
+class LogRange(ArrayRange):
     """Simple object that encapsulates a log-spaced range of values with units.
     
     Rather than generating a list of Values, this object is iterable and
     generates Values on demand, as needed.
     """
     def __init__(self, range, unit):
+        ArrayRange.__init__(self, None, unit)
         self.range = range
-        self.unit = unit
         
     def fill(self, default):
         """Create a new range with missing values filled in from a default range."""
@@ -220,14 +271,7 @@ class LogRange(object):
         start, stop, N = inUnits(r.start, u), inUnits(r.stop, u), inUnits(r.step, u)
         return np.logspace(np.log10(start), np.log10(stop), N)
     
-    def __iter__(self):
-        r = self._range()
-        for i in r:
-            yield i * self.unit
-    
-    def __len__(self):
-        r = self._range()
-        return len(r)
+    _makeArray = _range
     
     def __repr__(self):
         r, u = self.range, self.unit
@@ -0,0 +1,218 @@
+"""
+Property tests for decoding the packets read back from ADC boards.
+
+Random packet streams, with packets dropped, repeated, cut short and with
+counters wrapping around, are decoded and compared with the previous
+decoders, which are kept here for reference, and with a packet by packet
+count of the counter gaps.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.join(REPO, 'LabRAD', 'Servers', 'Instruments', 'GHzBoards'))
+import adc
+
+TRIALS = 300
+AVERAGE_PACKETS = 32
+AVERAGE_PACKET_LEN = 1024
+DEMOD_PACKET_LEN = 48
+DEMOD_CHANNELS_PER_PACKET = 11
+
+
+# previous implementation, one packet at a time
+
+def oldExtractAverage(packets):
+    data = ''.join(packets)
+    Is, Qs = np.fromstring(data, dtype='<i2').reshape(-1, 2).astype(int).T
+    return (Is, Qs)
+
+def oldExtractDemod(packets, nDemod):
+    data = ''.join(data[:44] for data in packets)
+    vals = np.fromstring(data, dtype='<i2')
+    Is, Qs = vals.reshape(-1, 2).astype(int).T
+    data = [(Is[i::nDemod], Qs[i::nDemod]) for i in xrange(nDemod)]
+    def getRange(pkt):
+        Irng, Qrng = [ord(i) for i in pkt[46:48]]
+        twosComp = lambda i: int(i if i < 0x8 else i - 0x10)
+        Imax = twosComp((Irng >> 4) & 0xF)
+        Imin = twosComp((Irng >> 0) & 0xF)
+        Qmax = twosComp((Qrng >> 4) & 0xF)
+        Qmin = twosComp((Qrng >> 0) & 0xF)
+        return Imax, Imin, Qmax, Qmin
+    ranges = np.array([getRange(pkt) for pkt in packets]).T
+    return (data, (int(max(ranges[0])), int(min(ranges[1])),
+                   int(max(ranges[2])), int(min(ranges[3]))))
+
+def countGaps(counters):
+    """Count skipped and repeated 16 bit counters one packet at a time."""
+    missing = duplicated = 0
+    for a, b in zip(counters[:-1], counters[1:]):
+        step = (b - a) % 65536
+        if step == 0 or step >= 32768:
+            duplicated += 1
+        else:
+            missing += step - 1
+    return missing, duplicated
+
+
+class Stream(object):
+    """Random packet streams, some of whose packets get lost or repeated."""
+    def __init__(self, seed):
+        self.random = np.random.RandomState(seed)
+
+    def packets(self, n, length):
+        return [self.random.bytes(length) for _ in xrange(n)]
+
+    def demodPackets(self, counters):
+        pkts = []
+        for count in counters:
+            pkt = bytearray(self.random.bytes(DEMOD_PACKET_LEN))
+            pkt[44] = count & 0xFF
+            pkt[45] = (count >> 8) & 0xFF
+            pkts.append(str(pkt))
+        return pkts
+
+    def counters(self, n, loss=0.05, repeat=0.05, burst=4):
+        """Counters of n packets sent, and of those received.
+
+        Packets get lost in bursts of up to burst packets, or repeated.
+        The first and last packets always arrive, so that every lost
+        packet shows up as a gap.  Half of the streams wrap around.
+        Returns (received, missing, duplicated).
+        """
+        if self.random.random_sample() < 0.5:
+            start = 65536 - self.random.randint(1, n + 1)
+        else:
+            start = self.random.randint(0, 65536)
+        sent = [(start + i) % 65536 for i in xrange(n)]
+        received = [sent[0]]
+        missing = duplicated = 0
+        i = 1
+        while i < n - 1:
+            r = self.random.random_sample()
+            if r < loss:
+                k = min(self.random.randint(1, burst + 1), n - 1 - i)
+                missing += k
+                i += k
+                continue
+            received.append(sent[i])
+            if r > 1 - repeat:
+                received.append(sent[i])
+                duplicated += 1
+            i += 1
+        received.append(sent[-1])
+        return received, missing, duplicated
+
+
+def raises(func, *args):
+    """Get the message of the Exception raised by func, or None."""
+    try:
+        func(*args)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+class AdcPacketTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = Stream(0)
+
+    def assertSame(self, a, b):
+        if isinstance(a, (tuple, list)):
+            self.assertEqual(len(a), len(b))
+            for x, y in zip(a, b):
+                self.assertSame(x, y)
+        elif isinstance(a, np.ndarray):
+            self.assertEqual(a.dtype, b.dtype)
+            np.testing.assert_array_equal(a, b)
+        else:
+            self.assertEqual(a, b)
+
+    def testAverageMatchesOld(self):
+        for trial in xrange(TRIALS):
+            n = self.stream.random.randint(1, 2 * AVERAGE_PACKETS)
+            pkts = self.stream.packets(n, AVERAGE_PACKET_LEN)
+            self.assertSame(adc.extractAverage(pkts), oldExtractAverage(pkts))
+            self.assertSame(adc.extractAverage(pkts, n, AVERAGE_PACKET_LEN),
+                            oldExtractAverage(pkts))
+
+    def testDemodMatchesOld(self):
+        for trial in xrange(TRIALS):
+            n = self.stream.random.randint(1, 200)
+            pkts = self.stream.packets(n, DEMOD_PACKET_LEN)
+            for nDemod in [1, 4, DEMOD_CHANNELS_PER_PACKET]:
+                self.assertSame(adc.extractDemod(pkts, nDemod), oldExtractDemod(pkts, nDemod))
+            self.assertSame(adc.extractDemod(pkts, DEMOD_CHANNELS_PER_PACKET, n),
+                            oldExtractDemod(pkts, DEMOD_CHANNELS_PER_PACKET))
+
+    def testDroppedAveragePackets(self):
+        for trial in xrange(TRIALS):
+            pkts = self.stream.packets(AVERAGE_PACKETS, AVERAGE_PACKET_LEN)
+            keep = self.stream.random.random_sample(AVERAGE_PACKETS) > 0.1
+            received = [pkt for pkt, k in zip(pkts, keep) if k]
+            msg = raises(adc.extractAverage, received, AVERAGE_PACKETS, AVERAGE_PACKET_LEN)
+            if keep.all():
+                self.assertEqual(msg, None)
+            else:
+                self.assertTrue('expected %d packets, got %d'
+                                % (AVERAGE_PACKETS, len(received)) in msg, msg)
+
+    def testShortPackets(self):
+        for trial in xrange(TRIALS):
+            pkts = self.stream.packets(AVERAGE_PACKETS, AVERAGE_PACKET_LEN)
+            bad = sorted(set(self.stream.random.randint(0, AVERAGE_PACKETS, 3)))
+            for k in bad:
+                pkts[k] = pkts[k][:self.stream.random.randint(0, AVERAGE_PACKET_LEN // 2) * 2]
+            msg = raises(adc.extractAverage, pkts, AVERAGE_PACKETS, AVERAGE_PACKET_LEN)
+            self.assertTrue('%d packets not %d bytes long, e.g. packet %d with %d bytes'
+                            % (len(bad), AVERAGE_PACKET_LEN, bad[0], len(pkts[bad[0]])) in msg, msg)
+            demod = self.stream.packets(20, DEMOD_PACKET_LEN)
+            k = self.stream.random.randint(0, 20)
+            demod[k] = demod[k][:self.stream.random.randint(0, DEMOD_PACKET_LEN)]
+            msg = raises(adc.extractDemod, demod, DEMOD_CHANNELS_PER_PACKET)
+            self.assertTrue('at least %d bytes long, e.g. packet %d' % (DEMOD_PACKET_LEN, k) in msg, msg)
+
+    def testCounterGaps(self):
+        for trial in xrange(TRIALS):
+            n = self.stream.random.randint(2, 300)
+            received, missing, duplicated = self.stream.counters(n)
+            self.assertEqual(adc.counterGaps(received), (missing, duplicated))
+            self.assertEqual(adc.counterGaps(received), countGaps(received))
+        # arbitrary counters, also going backwards
+        for trial in xrange(TRIALS):
+            counters = list(self.stream.random.randint(0, 65536, self.stream.random.randint(1, 50)))
+            self.assertEqual(adc.counterGaps(counters), countGaps(counters))
+
+    def testCounterWraparound(self):
+        self.assertEqual(adc.counterGaps([65534, 65535, 0, 1]), (0, 0))
+        self.assertEqual(adc.counterGaps([65534, 0, 1]), (1, 0))
+        self.assertEqual(adc.counterGaps([65535, 65535, 0]), (0, 1))
+        self.assertEqual(adc.counterGaps([5, 3]), (0, 1))
+        self.assertEqual(adc.counterGaps([7]), (0, 0))
+
+    def testDemodCounters(self):
+        for trial in xrange(TRIALS):
+            n = self.stream.random.randint(2, 200)
+            received, missing, duplicated = self.stream.counters(n)
+            pkts = self.stream.demodPackets(received)
+            msg = raises(adc.extractDemod, pkts, DEMOD_CHANNELS_PER_PACKET, None, True)
+            if missing or duplicated:
+                self.assertEqual(msg, 'Demod packet counters show %d missing and %d duplicated packets in %d.'
+                                      % (missing, duplicated, len(received)))
+            else:
+                self.assertEqual(msg, None)
+                self.assertSame(adc.extractDemod(pkts, DEMOD_CHANNELS_PER_PACKET, n, True),
+                                oldExtractDemod(pkts, DEMOD_CHANNELS_PER_PACKET))
+            # without the counter check the packets are decoded as they are
+            self.assertSame(adc.extractDemod(pkts, DEMOD_CHANNELS_PER_PACKET),
+                            oldExtractDemod(pkts, DEMOD_CHANNELS_PER_PACKET))
+
+
+if __name__ == '__main__':
+    unittest.main()
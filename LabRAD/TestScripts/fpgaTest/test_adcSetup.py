@@ -0,0 +1,143 @@
+"""
+Tests for the setup packets and setup states of ADC boards (AdcDevice.setup),
+run against the emulator (see emulatorFixture).
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import numpy as np
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture, adc
+
+BOARDS = [('DAC', 1), ('ADC', 1), ('ADC', 2)]
+MEMORY = [0x000000,                       # NoOp
+          0x800000,                       # SRAM start address
+          0xA00000 + 999,                 # SRAM end address
+          0xC00000,                       # call SRAM
+          0x300000 + 2499,                # delay
+          0x400000,                       # start timer
+          0x300064,                       # delay 100+1 cycles
+          0x400001,                       # stop timer
+          0xF00000]                       # branch back to start
+FILTER_LEN = 4096
+
+
+def filterFunc(value=0):
+    return (np.zeros(FILTER_LEN, dtype='<u1') + value, 0, 0)
+
+
+class AdcSetupTest(unittest.TestCase):
+    timeout = 60
+    cacheSize = adc.SETUP_CACHE_SIZE
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture(BOARDS)
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.c = self.fixture.context()
+        self.dev = self.fixture.device('ADC 1')
+        # count the filter uploads built
+        self.built = 0
+        makeFilter = self.dev.makeFilter
+        def counting(data, p):
+            self.built += 1
+            return makeFilter(data, p)
+        self.dev.makeFilter = counting
+
+    def tearDown(self):
+        adc.SETUP_CACHE_SIZE = self.cacheSize
+        return self.fixture.stop()
+
+    def demods(self, amps, dev='ADC 1'):
+        """Demod channels with the given (sineAmp, cosineAmp), as set by ADC Trig Magnitude."""
+        c = self.fixture.context()
+        self.fpga.select_device(c, 'Emu ' + dev)
+        for chan, (sineAmp, cosineAmp) in enumerate(amps):
+            if sineAmp is not None:
+                self.fpga.adc_trig_magnitude(c, chan, sineAmp, cosineAmp)
+                self.fpga.adc_demod_frequency(c, chan, 100 * chan, chan)
+        return c.get(self.fixture.device(dev), {})
+
+    def testCached(self):
+        demods = self.demods([(255, 255), (100, 50)])
+        p, state = self.dev.setup(filterFunc(), demods)
+        self.assertEqual(self.built, 1)
+        self.assertTrue(len(state) < 100, state)
+        # equal contents in new objects
+        again, againState = self.dev.setup(filterFunc(), self.demods([(255, 255), (100, 50)]))
+        self.assertTrue(again is p)
+        self.assertEqual(againState, state)
+        self.assertEqual(self.built, 1)
+        # the packet is the one that would be built without the cache
+        fresh = self.dev.makePacket()
+        self.dev.makeFilter(filterFunc()[0], fresh)
+        self.dev.makeTrigLookups(demods, fresh)
+        self.assertEqual(p._records, fresh._records)
+
+    def testChangedState(self):
+        demods = self.demods([(255, 255), (100, 50)])
+        p, state = self.dev.setup(filterFunc(), demods)
+        changes = [(filterFunc(1), demods),
+                   (filterFunc(), self.demods([(255, 255), (100, 51)])),
+                   (filterFunc(), self.demods([(255, 255), (50, 100)])),
+                   (filterFunc(), self.demods([(255, 255)])),
+                   (filterFunc(), self.demods([(None, None), (100, 50)]))]
+        states = set([state])
+        for f, d in changes:
+            other, otherState = self.dev.setup(f, d)
+            self.assertFalse(other is p)
+            states.add(otherState)
+        self.assertEqual(len(states), len(changes) + 1)
+        self.assertEqual(self.built, len(changes) + 1)
+        # the demod phases are set in the run registers, not by setup
+        same, sameState = self.dev.setup(filterFunc(), dict((ch, dict(d, dPhi=7)) for ch, d in demods.items()))
+        self.assertEqual(sameState, state)
+        # other boards are in other states
+        other = self.fixture.device('ADC 2')
+        otherPacket, otherState = other.setup(filterFunc(), self.demods([(255, 255), (100, 50)], 'ADC 2'))
+        self.assertNotEqual(otherState, state)
+        self.assertFalse(otherPacket is p)
+
+    def testBound(self):
+        adc.SETUP_CACHE_SIZE = 2
+        demods = self.demods([(255, 255)])
+        packets = [self.dev.setup(filterFunc(k), demods)[0] for k in range(3)]
+        self.assertEqual(len(self.dev.setupCache), 2)
+        self.assertEqual(self.built, 3)
+        # the least recently used packet was dropped
+        self.assertTrue(self.dev.setup(filterFunc(2), demods)[0] is packets[2])
+        self.assertTrue(self.dev.setup(filterFunc(1), demods)[0] is packets[1])
+        self.assertFalse(self.dev.setup(filterFunc(0), demods)[0] is packets[0])
+        self.assertEqual(self.built, 4)
+        # filter 2 is now the least recently used
+        self.dev.setup(filterFunc(1), demods)
+        self.dev.setup(filterFunc(2), demods)
+        self.assertEqual(self.built, 5)
+        self.assertEqual(len(self.dev.setupCache), 2)
+
+    @inlineCallbacks
+    def testRuns(self):
+        """Sweeping the DAC data makes new run plans, but the ADC setup is reused."""
+        self.fpga.select_device(self.c, 'Emu DAC 1')
+        self.fpga.dac_memory(self.c, MEMORY)
+        self.fpga.select_device(self.c, 'Emu ADC 1')
+        self.fpga.start_delay(self.c, 0)
+        self.fpga.adc_run_mode(self.c, 'demodulate')
+        self.fpga.adc_filter_func(self.c, filterFunc()[0].tostring(), 0, 0)
+        self.fpga.adc_trig_magnitude(self.c, 0, 255, 255)
+        self.fpga.adc_demod_frequency(self.c, 0, 100, 0)
+        self.fpga.sequence_boards(self.c, ['Emu DAC 1', 'Emu ADC 1'])
+        self.fpga.sequence_timing_order(self.c, ['Emu ADC 1::0'])
+        for value in range(3):
+            self.fpga.select_device(self.c, 'Emu DAC 1')
+            self.fpga.dac_sram(self.c, (np.zeros(1000, dtype='<u4') + value).tostring())
+            ans = yield self.fpga.sequence_run(self.c, 30, True)
+            self.assertEqual(list(ans[0][0]), [100] * 30)
+        self.assertEqual(len(self.fixture.boardGroup.runPlans), 3)
+        self.assertEqual(self.built, 1)
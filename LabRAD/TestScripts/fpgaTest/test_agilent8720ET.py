@@ -0,0 +1,251 @@
+"""
+Tests for the FORM5 trace transfer and the cached sweep configuration of
+the Agilent 8720ET Network Analyzer server.
+
+The device wrapper is connected to a fake GPIB bus, which models the
+commands of the analyzer that the server uses and counts the packets and
+queries it receives.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import imp
+import os
+import sys
+
+import numpy as np
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+na8720 = imp.load_source('agilent_8720et_network_analyzer',
+    os.path.join(REPO, 'LabRAD', 'Servers', 'Instruments', 'agilent_8720et_network_analyzer.py'))
+
+units = na8720.units
+
+
+def form5(data):
+    """A trace as the analyzer sends it in FORM5."""
+    body = np.asarray(data, dtype='<c8').tostring()
+    return '#A' + np.array([len(body)], dtype='<u2').tostring() + body
+
+
+class FakeAnalyzer(object):
+    """Just enough of an 8720ET to answer the server.
+
+    The two channels are uncoupled, with their own number of points.
+    """
+    def __init__(self, seed=0):
+        rand = np.random.RandomState(seed)
+        self.channel = 1
+        self.points = {1: 201, 2: 401}
+        self.traces = dict((ch, rand.normal(size=n) + 1j * rand.normal(size=n))
+                           for ch, n in self.points.items())
+        self.avg = False
+        self.avgPoints = 16
+        self.output = None
+        self.sweeps = 0
+        self.commands = []
+
+    def write(self, cmd):
+        for part in cmd.split(';'):
+            if not part:
+                continue
+            self.commands.append(part)
+            if part in ['CHAN1', 'CHAN2']:
+                self.channel = int(part[-1])
+            elif part == 'OUTPFORM':
+                self.output = form5(self.traces[self.channel])
+            elif part.startswith('POIN'):
+                self.points[self.channel] = int(part[4:])
+            elif part in ['AVEROON', 'AVEROOFF']:
+                self.avg = part == 'AVEROON'
+            elif part.startswith('AVERFACT'):
+                self.avgPoints = int(part[8:])
+
+    def query(self, cmd):
+        self.commands.append(cmd)
+        if cmd == 'CHAN1?':
+            return str(int(self.channel == 1))
+        elif cmd == 'POIN?':
+            return '%E' % self.points[self.channel]
+        elif cmd == 'AVERO?':
+            return str(int(self.avg))
+        elif cmd == 'AVERFACT?':
+            return '%E' % self.avgPoints
+        elif cmd in ['STAR?', 'STOP?']:
+            return '1.000000E+09'
+        elif cmd == 'SWET?':
+            return '1.0E-3'
+        elif cmd.startswith('OPC?;'):
+            self.write(cmd[5:])
+            if cmd in ['OPC?;SING', 'OPC?;NUMG%i' % self.avgPoints]:
+                self.sweeps += 1
+            return '1'
+        raise Exception('Unknown query %r' % cmd)
+
+    def read_raw(self, bytes=None):
+        data, self.output = self.output, None
+        return data
+
+
+class Response(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakePacket(object):
+    def __init__(self, bus):
+        self.bus = bus
+        self.records = []
+
+    def __getattr__(self, name):
+        def record(*args, **kw):
+            self.records.append((name, args, kw.get('key')))
+            return self
+        return record
+
+    def send(self):
+        self.bus.packets += 1
+        ans = {}
+        for name, args, key in self.records:
+            if name in ['write', 'query', 'read_raw']:
+                result = getattr(self.bus.device, name)(*args)
+            else:
+                result = None
+            ans[name] = result
+            if key is not None:
+                ans[key] = result
+        return defer.succeed(Response(ans))
+
+
+class FakeGPIBBus(object):
+    """Stands in for the GPIB bus server, with one analyzer on it."""
+    def __init__(self, device):
+        self.device = device
+        self.packets = 0
+
+    def context(self):
+        return (0, 1)
+
+    def packet(self, context=None):
+        return FakePacket(self)
+
+
+class DecodeForm5Test(unittest.TestCase):
+    def testRoundTrip(self):
+        rand = np.random.RandomState(1)
+        for n in [1, 3, 201, 1601]:
+            data = (rand.normal(size=n) + 1j * rand.normal(size=n)).astype('c8')
+            decoded = na8720.decode_form5(form5(data), n)
+            self.assertEqual(decoded.dtype, np.complex128)
+            np.testing.assert_array_equal(decoded, data)
+
+    def testWrongLength(self):
+        buf = form5(np.zeros(201))
+        self.assertEqual(len(na8720.decode_form5(buf)), 201)
+        self.assertRaises(ValueError, na8720.decode_form5, buf, 401)
+        self.assertRaises(ValueError, na8720.decode_form5, buf[:-3])
+
+
+class SweepConfigTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.na = FakeAnalyzer()
+        self.bus = FakeGPIBBus(self.na)
+        self.dev = na8720.Agilent8720ETWrapper(1, 'Fake 8720ET')
+        yield self.dev.connect(self.bus, 'GPIB0::16')
+        self.server = na8720.Agilent8720ETServer()
+        self.server.selectedDevice = lambda c: self.dev
+        self.c = {}
+
+    def configQueries(self):
+        return self.na.commands.count('POIN?')
+
+    @inlineCallbacks
+    def testGetTrace(self):
+        data = yield self.server.get_trace(self.c)
+        np.testing.assert_allclose(data, self.na.traces[1].real.astype('f4'))
+        self.assertEqual(self.na.sweeps, 1)
+        self.assertEqual(self.configQueries(), 2)
+        # the configuration is only read once
+        packets = self.bus.packets
+        yield self.server.get_trace(self.c)
+        self.assertEqual(self.configQueries(), 2)
+        self.assertEqual(self.bus.packets - packets, 3) # sweep, OUTPFORM, read
+        self.assertEqual(self.na.sweeps, 2)
+
+    @inlineCallbacks
+    def testGetTracesPointsPerChannel(self):
+        for active in [1, 2]:
+            self.na.channel = active
+            self.dev.invalidate()
+            packets = self.bus.packets
+            yield self.dev.getSweepConfig()
+            self.assertEqual(self.bus.packets - packets, 2)
+            packets = self.bus.packets
+            ch1, ch2 = yield self.server.get_traces(self.c)
+            self.assertEqual(self.bus.packets - packets, 2) # sweep, both traces
+            np.testing.assert_allclose(ch1, self.na.traces[1].astype('c8'))
+            np.testing.assert_allclose(ch2, self.na.traces[2].astype('c8'))
+            self.assertEqual((len(ch1), len(ch2)), (201, 401))
+            # the active channel is left as it was
+            self.assertEqual(self.na.channel, active)
+            data = yield self.server.get_trace(self.c)
+            self.assertEqual(len(data), self.na.points[active])
+
+    @inlineCallbacks
+    def testSettersInvalidate(self):
+        setters = [
+            (self.server.start_frequency, (1e9 * units.Hz,)),
+            (self.server.stop_frequency, (2e9 * units.Hz,)),
+            (self.server.sweep_points, (101,)),
+            (self.server.average_mode, (True,)),
+            (self.server.average_points, (8,)),
+            (self.server.segmented_sweep, ([(1e9 * units.Hz, 2e9 * units.Hz, 101)],)),
+            (self.server.segmented_sweep, ()),
+            (self.server.preset, ()),
+        ]
+        yield self.server.get_trace(self.c)
+        for setter, args in setters:
+            queries = self.configQueries()
+            yield setter(self.c, *args)
+            self.assertEqual(self.dev.sweepConfig, None, setter)
+            yield self.dev.getSweepConfig()
+            self.assertEqual(self.configQueries(), queries + 2, setter)
+        config = yield self.dev.getSweepConfig()
+        self.assertEqual(config, {'channel': 1, 'points': {1: 101, 2: 401},
+                                  'avg': True, 'avgPoints': 8})
+
+    @inlineCallbacks
+    def testGettersKeepCache(self):
+        yield self.server.get_trace(self.c)
+        for getter in [self.server.start_frequency, self.server.sweep_points,
+                       self.server.average_mode]:
+            yield getter(self.c)
+            self.assertNotEqual(self.dev.sweepConfig, None, getter)
+
+    @inlineCallbacks
+    def testAveraging(self):
+        yield self.server.average_mode(self.c, True)
+        yield self.server.get_trace(self.c)
+        self.assertEqual(self.na.commands[-4:], ['AVERREST', 'OPC?;NUMG16', 'NUMG16', 'OUTPFORM'])
+
+    @inlineCallbacks
+    def testSegmentedSweep(self):
+        segments = [(1e9 * units.Hz, 2e9 * units.Hz, 11), (3e9 * units.Hz, 4e9 * units.Hz, 21)]
+        yield self.server.segmented_sweep(self.c, segments)
+        self.assertEqual(self.na.commands,
+                         ['EDITLIST', 'CLEL',
+                          'SADD', 'STAR1000000000', 'STOP2000000000', 'POIN11', 'SDON',
+                          'SADD', 'STAR3000000000', 'STOP4000000000', 'POIN21', 'SDON',
+                          'EDITDONE', 'LISFREQ'])
+        yield self.server.segmented_sweep(self.c)
+        self.assertEqual(self.na.commands[-1], 'LINFREQ')
@@ -0,0 +1,131 @@
+"""
+Tests for Bringup All of the GHz FPGA server, run against the emulator.
+
+See emulatorFixture.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture, GROUP
+
+BOARDS = [('DAC', 1), ('DAC', 2), ('DAC', 3), ('ADC', 1)]
+
+
+class BringupTest(unittest.TestCase):
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture(BOARDS)
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.c = self.fixture.context()
+
+    def tearDown(self):
+        return self.fixture.stop()
+
+    def results(self, ans):
+        return dict((name, (success, error, dacs)) for name, success, error, dacs in ans)
+
+    def countConcurrent(self):
+        """Count how many DACs are brought up at once.
+
+        The DACs take longest, as they wait for their PLL to settle.
+        """
+        self.running = 0
+        self.peak = 0
+        for kind, number in BOARDS:
+            if kind == 'DAC':
+                dev = self.fixture.device('DAC %d' % number)
+                dev._bringup = self.counted(type(dev)._bringup.__get__(dev))
+
+    def counted(self, bringup):
+        def func(*a):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            def done(result):
+                self.running -= 1
+                return result
+            return bringup(*a).addBoth(done)
+        return func
+
+    @inlineCallbacks
+    def testBringupAll(self):
+        self.countConcurrent()
+        ans = yield self.fpga.bringup_all(self.c, GROUP)
+        self.assertEqual([row[0] for row in ans],
+                         ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2', 'Emu DAC 3'])
+        for name, success, error, dacs in ans:
+            self.assertTrue(success, (name, error))
+            self.assertEqual(error, '')
+            if 'DAC' in name:
+                self.assertEqual([dict(d)['dac'] for d in dacs], ['A', 'B'])
+                for d in dacs:
+                    d = dict(d)
+                    self.assertTrue(d['lvdsSuccess'])
+                    self.assertEqual(d['fifoCounter'], 3)
+                    self.assertEqual(d['bistLVDS'], d['bistTheory'])
+            else:
+                self.assertEqual(dacs, [])
+        self.assertEqual(self.peak, 3)
+
+    @inlineCallbacks
+    def testConcurrency(self):
+        for concurrency in [1, 2]:
+            self.countConcurrent()
+            ans = yield self.fpga.bringup_all(self.c, GROUP, concurrency=concurrency)
+            self.assertTrue(all(row[1] for row in ans))
+            self.assertEqual(self.peak, concurrency)
+        try:
+            yield self.fpga.bringup_all(self.c, GROUP, concurrency=0)
+        except Exception:
+            pass
+        else:
+            self.fail('Bringup All ran with concurrency 0')
+
+    @inlineCallbacks
+    def testInjectedFailures(self):
+        # DAC 1 fails its BIST, DAC 2 is unplugged and does not answer,
+        # and the bringup of the ADC raises
+        self.fixture.board('DAC 1').bistError = 1
+        self.fixture.removeBoard('DAC', 2)
+        adc = self.fixture.device('ADC 1')
+        def broken(recalibrate):
+            return defer.fail(Exception('injected failure'))
+        adc._bringup = broken
+        ans = yield self.fpga.bringup_all(self.c, GROUP)
+        results = self.results(ans)
+        success, error, dacs = results['Emu DAC 1']
+        self.assertFalse(success)
+        self.assertEqual(error, '')
+        self.assertFalse(any(dict(d)['bistSuccess'] for d in dacs))
+        success, error, dacs = results['Emu DAC 2']
+        self.assertFalse(success)
+        self.assertNotEqual(error, '')
+        self.assertEqual(dacs, [])
+        self.assertEqual(results['Emu ADC 1'], (False, 'injected failure', []))
+        self.assertTrue(results['Emu DAC 3'][0])
+        # the board group has left test mode
+        build = yield self.fixture.device('DAC 3').buildNumber()
+        self.assertEqual(build, '13')
+
+    @inlineCallbacks
+    def testOtherCallsWait(self):
+        """Test mode calls from other contexts wait until all boards are up."""
+        events = []
+        def log(result, event):
+            events.append(event)
+            return result
+        d = self.fpga.bringup_all(self.c, GROUP)
+        d.addCallback(log, 'bringup')
+        dev = self.fixture.device('DAC 1')
+        other = dev.buildNumber().addCallback(log, 'build')
+        ans, build = yield defer.gatherResults([d, other])
+        self.assertTrue(all(row[1] for row in ans))
+        self.assertEqual(build, '13')
+        self.assertEqual(events, ['bringup', 'build'])
+        self.assertFalse(self.fixture.boardGroup.testLock.locked)
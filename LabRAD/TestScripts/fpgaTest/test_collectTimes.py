@@ -0,0 +1,216 @@
+"""
+Tests for the collect timeouts that the GHz FPGA server learns from
+previous runs (see telemetry.CollectTimes).
+
+The estimator is fed synthetic collect times directly, and Run Sequence is
+run against the emulator (see emulatorFixture) with a fake clock in the
+FPGA server that advances by a synthetic time whenever a collect is done.
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import time
+
+import numpy as np
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture, ghz_fpga_server
+import telemetry
+
+DELAY_CYCLES = 250000 # 10 ms at 25 MHz
+MEMORY = [0x000000,                       # NoOp
+          0x800000,                       # SRAM start address
+          0xA00000 + 999,                 # SRAM end address
+          0xC00000,                       # call SRAM
+          0x300000 + DELAY_CYCLES - 1,    # delay
+          0x400000,                       # start timer
+          0x300064,                       # delay 100+1 cycles
+          0x400001,                       # stop timer
+          0xF00000]                       # branch back to start
+REPS = 30
+
+
+def learned(times, collectTimes):
+    """The timeout expected from collect times, see CollectTimes."""
+    times = sorted(times[-collectTimes.history:])
+    rank = max(int(np.ceil(collectTimes.percentile / 100.0 * len(times))), 1)
+    return collectTimes.factor * times[rank - 1] + collectTimes.margin
+
+
+class FakeClock(object):
+    """Stands in for the time module of the FPGA server."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class CollectTimesTest(unittest.TestCase):
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+
+    def testStaticUntilLearned(self):
+        ct = telemetry.CollectTimes()
+        times = list(np.abs(self.random.normal(0.5, 0.02, 20)))
+        for i, dt in enumerate(times):
+            if i < ct.minSamples:
+                self.assertEqual(ct.estimate('seq', 100), None)
+                self.assertEqual(ct.timeout('seq', 100, 10.0), 10.0)
+            else:
+                self.assertAlmostEqual(ct.timeout('seq', 100, 10.0), learned(times[:i], ct))
+            ct.record('seq', 100, dt)
+        self.assertTrue(2.0 < ct.timeout('seq', 100, 10.0) < 2.2)
+
+    def testCappedByStaticEstimate(self):
+        ct = telemetry.CollectTimes()
+        for dt in self.random.uniform(8, 9, 10):
+            ct.record('slow', 100, dt)
+        self.assertTrue(ct.estimate('slow', 100) > 10.0)
+        self.assertEqual(ct.timeout('slow', 100, 10.0), 10.0)
+
+    def testKeysAndReps(self):
+        ct = telemetry.CollectTimes()
+        for i in range(ct.minSamples):
+            ct.record('a', 100, 0.1)
+            ct.record('a', 200, 0.2)
+            ct.record('b', 100, 0.3)
+        self.assertAlmostEqual(ct.timeout('a', 100, 10.0), 1.2)
+        self.assertAlmostEqual(ct.timeout('a', 200, 10.0), 1.4)
+        self.assertAlmostEqual(ct.timeout('b', 100, 10.0), 1.6)
+        self.assertEqual(ct.timeout('b', 200, 10.0), 10.0)
+
+    def testRecentTimesOnly(self):
+        """A sequence that got faster has its timeout tightened once the slow times are out of the history."""
+        ct = telemetry.CollectTimes(history=20)
+        slow = list(self.random.uniform(2.0, 2.5, 20))
+        fast = list(self.random.uniform(0.1, 0.2, 20))
+        for dt in slow:
+            ct.record('seq', 100, dt)
+        self.assertAlmostEqual(ct.timeout('seq', 100, 10.0), learned(slow, ct))
+        for i, dt in enumerate(fast):
+            ct.record('seq', 100, dt)
+            self.assertAlmostEqual(ct.timeout('seq', 100, 10.0),
+                                   learned(slow + fast[:i+1], ct))
+        self.assertAlmostEqual(ct.timeout('seq', 100, 10.0), 2 * max(fast) + 1)
+
+    def testLeastRecentlyUsedSequencesForgotten(self):
+        ct = telemetry.CollectTimes(sequences=3, minSamples=1)
+        for key in ['a', 'b', 'c']:
+            ct.record(key, 100, 0.1)
+        ct.record('a', 100, 0.1) # a is now the most recent
+        ct.record('d', 100, 0.1)
+        self.assertEqual(ct.estimate('b', 100), None)
+        for key in ['a', 'c', 'd']:
+            self.assertNotEqual(ct.estimate(key, 100), None)
+        ct.reset()
+        self.assertEqual(ct.estimate('a', 100), None)
+
+
+class LearnedTimeoutTest(unittest.TestCase):
+    """Run sequences against the emulator with synthetic collect times."""
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture([('DAC', 1)])
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.bg = self.fixture.boardGroup
+        self.clock = FakeClock()
+        self.time = ghz_fpga_server.time
+        ghz_fpga_server.time = self.clock
+        # record the timeout of every collect and make it take a synthetic time
+        self.durations = []
+        self.timeouts = []
+        settings = self.fixture.de.settings
+        collect = settings['collect']
+        def timedCollect(c, count=1):
+            self.timeouts.append(c['timeout'])
+            def done(result):
+                self.clock.now += self.durations.pop(0)
+                return result
+            return collect(c, count).addCallback(done)
+        settings['collect'] = timedCollect
+        self.c = self.fixture.context()
+        self.fpga.select_device(self.c, 'Emu DAC 1')
+        self.fpga.dac_memory(self.c, MEMORY)
+        self.setSram(0)
+        self.fpga.sequence_boards(self.c, ['Emu DAC 1'])
+        self.fpga.sequence_timing_order(self.c, ['Emu DAC 1'])
+
+    def tearDown(self):
+        ghz_fpga_server.time = self.time
+        return self.fixture.stop()
+
+    def setSram(self, value):
+        sram = np.zeros(1000, dtype='<u4') + value
+        self.fpga.dac_sram(self.c, sram.tostring())
+
+    @inlineCallbacks
+    def runSequences(self, durations, reps=REPS):
+        """Run the sequence once for each synthetic collect time."""
+        for dt in durations:
+            self.durations.append(dt)
+            ans = yield self.fpga.sequence_run(self.c, reps, True)
+            self.assertEqual(np.asarray(ans).shape, (1, reps))
+
+    @inlineCallbacks
+    def testLearnedTimeout(self):
+        times = list(np.random.RandomState(1).uniform(0.2, 0.3, 10))
+        yield self.runSequences(times)
+        static = self.timeouts[0]
+        # ten times the 10 ms sequence, plus one second
+        self.assertTrue(abs(static - (10 * 0.010 * REPS + 1)) < 0.05, static)
+        minSamples = self.bg.collectTimes.minSamples
+        self.assertEqual(self.timeouts[:minSamples], [static] * minSamples)
+        for i in range(minSamples, len(times)):
+            self.assertAlmostEqual(self.timeouts[i], learned(times[:i], self.bg.collectTimes))
+            self.assertTrue(self.timeouts[i] < 1.7)
+        hist = dict((stage, hist) for stage, hist in self.bg.telemetry.stages)['collect']
+        self.assertEqual(hist.count, len(times))
+        self.assertAlmostEqual(hist.max, max(times))
+
+    @inlineCallbacks
+    def testOtherRepsUseStaticEstimate(self):
+        yield self.runSequences([0.25] * 6)
+        yield self.runSequences([0.25], reps=2*REPS)
+        self.assertTrue(abs(self.timeouts[-1] - (10 * 0.010 * 2*REPS + 1)) < 0.05)
+
+    @inlineCallbacks
+    def testNewSramKeepsTimeout(self):
+        yield self.runSequences([0.25] * 6)
+        self.setSram(1)
+        yield self.runSequences([0.25])
+        self.assertAlmostEqual(self.timeouts[-1], 1.5)
+
+    @inlineCallbacks
+    def testFailedCollectNotRecorded(self):
+        yield self.runSequences([0.25] * 6)
+        times = list(self.bg.collectTimes.times.values()[0])
+        self.fixture.emulator.config['stall'] = 1.0
+        self.durations.append(0.0) # for the collect that recovers from the timeout
+        stalled = len(self.timeouts)
+        try:
+            yield self.fpga.sequence_run(self.c, REPS, True)
+        except Exception:
+            pass
+        else:
+            self.fail('A stalled run did not fail')
+        # the learned timeout was used
+        self.assertAlmostEqual(self.timeouts[stalled], 1.5)
+        self.assertEqual(list(self.bg.collectTimes.times.values()[0]), times)
+        self.fixture.emulator.config['stall'] = 0.0
+        self.durations = []
+        yield self.runSequences([0.25])
+
+    def testConfigureForgetsTimes(self):
+        self.bg.collectTimes.record('seq', REPS, 0.25)
+        self.bg.configure(self.bg.name, self.bg.boards)
+        self.assertEqual(len(self.bg.collectTimes.times), 0)
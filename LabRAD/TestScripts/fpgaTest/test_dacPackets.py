@@ -0,0 +1,205 @@
+"""
+Tests for the DAC memory and SRAM packets built by the GHz FPGA server.
+
+The packets are compared byte for byte with those made by the previous,
+byte string based implementation, which is kept here for reference.
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+"""
+
+import os
+import sys
+import time
+import unittest
+
+import numpy as np
+
+from twisted.internet import defer
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.join(REPO, 'LabRAD', 'Servers', 'Instruments', 'GHzBoards'))
+import dac
+
+BUILD_PARAMS = {'SRAM_LEN': 65536, 'SRAM_PAGE_LEN': 32768,
+                'SRAM_WRITE_PKT_LEN': 256, 'SRAM_WRITE_DERPS': 256,
+                'SRAM_DELAY_LEN': 1024}
+LOAD_WORDS = 65536
+
+
+# previous implementation, on byte strings of little-endian words
+
+def oldPktWriteSram(device, derp, data):
+    assert 0 <= derp < device.buildParams['SRAM_WRITE_DERPS'], "SRAM derp out of range: %d" % derp
+    data = np.asarray(data)
+    pkt = np.zeros(1026, dtype='<u1')
+    pkt[0] = (derp >> 0) & 0xFF
+    pkt[1] = (derp >> 8) & 0xFF
+    pkt[2:2+len(data)*4:4] = (data >> 0) & 0xFF
+    pkt[3:3+len(data)*4:4] = (data >> 8) & 0xFF
+    pkt[4:4+len(data)*4:4] = (data >> 16) & 0xFF
+    pkt[5:5+len(data)*4:4] = (data >> 24) & 0xFF
+    return pkt
+
+def oldPktWriteMem(page, data):
+    data = np.asarray(data)
+    pkt = np.zeros(769, dtype='<u1')
+    pkt[0] = page
+    pkt[1:1+len(data)*3:3] = (data >> 0) & 0xFF
+    pkt[2:2+len(data)*3:3] = (data >> 8) & 0xFF
+    pkt[3:3+len(data)*3:3] = (data >> 16) & 0xFF
+    return pkt
+
+def oldMakeSRAM(device, data, p, page=0):
+    writeDerp = page * device.buildParams['SRAM_PAGE_LEN'] / device.buildParams['SRAM_WRITE_PKT_LEN']
+    while len(data) > 0:
+        chunk, data = data[:device.buildParams['SRAM_WRITE_PKT_LEN']*4], data[device.buildParams['SRAM_WRITE_PKT_LEN']*4:]
+        chunk = np.fromstring(chunk, dtype='<u4')
+        pkt = oldPktWriteSram(device, writeDerp, chunk)
+        p.write(pkt.tostring())
+        writeDerp += 1
+
+def oldMakeMemory(device, data, p, page=0):
+    if page:
+        data = dac.shiftSRAM(device, data, page)
+    pkt = oldPktWriteMem(page, data)
+    p.write(pkt.tostring())
+
+def oldLoad(device, mem, sram, page=0):
+    p = device.makePacket()
+    oldMakeMemory(device, mem, p, page=page)
+    oldMakeSRAM(device, sram, p, page=page)
+    return p
+
+def oldBistSram(dataIn, shift):
+    dat = [d & 0x3FFF for d in dataIn]
+    data = [0, 0, 0, 0] + [d << shift for d in dat]
+    data += [0] * (20-len(data))
+    return np.array(data, dtype='<u4').tostring()
+
+
+class Packet(object):
+    """Direct ethernet packet that records what is written."""
+    def __init__(self, server):
+        self.server = server
+        self.writes = []
+
+    def write(self, data):
+        assert isinstance(data, str)
+        self.writes.append(data)
+        return self
+
+    def send(self):
+        self.server.sent.append(self.writes)
+        return defer.succeed(None)
+
+
+class Server(object):
+    def __init__(self):
+        self.sent = []
+
+    def packet(self, context=None):
+        return Packet(self)
+
+
+class Dac(dac.DacDevice):
+    """A DAC board without a board group; serial commands read back zeros."""
+    def __init__(self):
+        self.devName = 'Test DAC 1'
+        self.buildParams = dict(BUILD_PARAMS)
+        self.server = Server()
+        self.ctx = (0, 1)
+
+    def testMode(self, func, *a, **kw):
+        return func(*a, **kw)
+
+    def _runSerial(self, op, data):
+        return defer.succeed([0] * len(data))
+
+
+def randomWords(n, bits=32):
+    return np.random.randint(0, 2**bits, n).astype('<u4')
+
+
+class DacPacketTest(unittest.TestCase):
+    def setUp(self):
+        self.dev = Dac()
+
+    def testWriteSram(self):
+        derpLen = BUILD_PARAMS['SRAM_WRITE_PKT_LEN']
+        for n in [1, 5, derpLen - 1, derpLen, derpLen + 1, 10 * derpLen + 17]:
+            data = randomWords(n)
+            pkts = dac.pktsWriteSram(self.dev, 3, data)
+            self.assertEqual(pkts.dtype, np.uint8)
+            self.assertEqual(len(pkts), (n + derpLen - 1) / derpLen)
+            for i, pkt in enumerate(pkts):
+                chunk = data[i*derpLen:(i+1)*derpLen]
+                self.assertEqual(pkt.tostring(),
+                                 oldPktWriteSram(self.dev, 3 + i, chunk).tostring())
+            self.assertEqual(dac.pktWriteSram(self.dev, 3, data[:derpLen]).tostring(),
+                             oldPktWriteSram(self.dev, 3, data[:derpLen]).tostring())
+
+    def testWriteSramFromList(self):
+        data = [0, 1, 0xFFFFFFFF, 0x12345678]
+        self.assertEqual(dac.pktWriteSram(self.dev, 0, data).tostring(),
+                         oldPktWriteSram(self.dev, 0, np.array(data, dtype='<u4')).tostring())
+
+    def testWriteSramOutOfRange(self):
+        data = randomWords(BUILD_PARAMS['SRAM_WRITE_PKT_LEN'] + 1)
+        lastDerp = BUILD_PARAMS['SRAM_WRITE_DERPS'] - 1
+        self.assertRaises(AssertionError, dac.pktsWriteSram, self.dev, lastDerp, data)
+
+    def testWriteMem(self):
+        for n in [0, 1, 100, dac.MEM_PAGE_LEN]:
+            data = randomWords(n, 24)
+            for page in [0, 1]:
+                self.assertEqual(dac.pktWriteMem(page, data).tostring(),
+                                 oldPktWriteMem(page, data).tostring())
+                self.assertEqual(dac.pktWriteMem(page, list(data)).tostring(),
+                                 oldPktWriteMem(page, data).tostring())
+
+    def testLoad(self):
+        mem = [0x000000, 0x800000, 0xA00000 + 4000 - 1, 0xC00000, 0x300190, 0xF00000]
+        for n in [0, 1, 4000, 9000]:
+            sram = randomWords(n)
+            for page in [0, 1]:
+                new = self.dev.load(mem, sram, page=page)
+                old = oldLoad(self.dev, mem, sram.tostring(), page=page)
+                self.assertEqual(new.writes, old.writes)
+
+    def testBist(self):
+        for dataIn, shift in [([], 0), ([1, 2, 3], 0), (range(100), 2),
+                              (list(np.random.randint(0, 2**16, 500)), 4)]:
+            self.dev.server.sent = []
+            ans = []
+            self.dev.runBIST(0x0040, shift, dataIn).addBoth(ans.append)
+            self.assertEqual(len(ans), 1)
+            self.assertFalse(isinstance(ans[0], Exception), ans[0])
+            writes = sum(self.dev.server.sent, [])
+            old = Packet(Server())
+            oldMakeSRAM(self.dev, oldBistSram(dataIn, shift), old)
+            self.assertEqual([w for w in writes if len(w) == 1026], old.writes)
+            words = max(4 + len(dataIn), 20)
+            run = dac.regRunSram(self.dev, 0, words, loop=False).tostring()
+            self.assertTrue(run in writes)
+
+    def testLoadBenchmark(self):
+        """Compare the time to build the load packet for LOAD_WORDS words."""
+        mem = [0x000000, 0x800000, 0xA00000 + LOAD_WORDS - 1, 0xC00000, 0xF00000]
+        sram = randomWords(LOAD_WORDS)
+        sramBytes = sram.tostring()
+        n = 10
+        start = time.time()
+        for i in range(n):
+            new = self.dev.load(mem, sram)
+        newTime = (time.time() - start) / n
+        start = time.time()
+        for i in range(n):
+            old = oldLoad(self.dev, mem, sramBytes)
+        oldTime = (time.time() - start) / n
+        self.assertEqual(new.writes, old.writes)
+        print('\nload of %d SRAM words: %.2f ms, previously %.2f ms'
+              % (LOAD_WORDS, newTime * 1e3, oldTime * 1e3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+"""
+Tests for the vectorized switching statistics of data_processing.
+
+The results are compared with the previous scalar implementations, which
+are kept here as references, on random timing data of various shapes
+and thresholds.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import os
+import sys
+import warnings
+
+import numpy as np
+
+from twisted.trial import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+GENERAL = os.path.join(REPO, 'LabRAD', 'Measurements', 'General')
+if GENERAL not in sys.path:
+    sys.path.insert(0, GENERAL)
+import data_processing as dp
+
+
+# Reference implementations.
+
+def old_mean_time(t, min_threshold=0, max_threshold=1253):
+    t = t[np.logical_and(t > min_threshold, t < max_threshold)]
+    if np.size(t) > 0:
+        return np.mean(t), np.std(t)
+    return np.nan, np.nan
+
+def old_mean_time_diff(t, min_threshold=0, max_threshold=1253):
+    dt = t[0][:] - t[1][:]
+    t0_mask = np.logical_and(t[0,:] > min_threshold, t[0,:] < max_threshold)
+    t1_mask = np.logical_and(t[1,:] > min_threshold, t[1,:] < max_threshold)
+    dt = dt[np.logical_and(t0_mask, t1_mask)]
+    if np.size(dt) > 0:
+        return np.mean(dt), np.std(dt)
+    return np.nan, np.nan
+
+def old_prob(t, min_threshold=0, max_threshold=1253):
+    return (float(np.size(t[np.logical_and(t > min_threshold, t < max_threshold)])) /
+            float(np.size(t)))
+
+def old_outcomes(t, min_threshold=0, max_threshold=1253):
+    def _threshold(x):
+        if x > min_threshold and x < max_threshold:
+            return 1
+        else:
+            return 0
+    return np.vectorize(_threshold)(t)
+
+def old_corr_coef_from_outcomes(outcomes):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return np.corrcoef(outcomes[0,:], outcomes[1,:])[0,1]
+
+
+def timer_data(rand, shape):
+    """Timer counts with the no-switch value 1253 for a random fraction."""
+    t = rand.randint(0, 1300, size=shape).astype(float)
+    t[rand.uniform(size=shape) < rand.uniform()] = 1253
+    return t
+
+def assert_nan_equal(a, b):
+    np.testing.assert_allclose(np.asarray(a, dtype=float),
+                               np.asarray(b, dtype=float), rtol=1e-10, atol=1e-9)
+
+
+class EquivalenceTest(unittest.TestCase):
+    """The vectorized functions agree with the previous ones."""
+    trials = 200
+
+    def cases(self):
+        rand = np.random.RandomState(30)
+        for k in range(self.trials):
+            stats = rand.randint(1, 50)
+            lo = rand.randint(0, 600)
+            hi = rand.randint(lo, 1300)
+            yield rand, stats, lo, hi
+
+    def testOutcomes(self):
+        for rand, stats, lo, hi in self.cases():
+            t = timer_data(rand, (2, stats))
+            result = dp.outcomes(t, lo, hi)
+            np.testing.assert_array_equal(result, old_outcomes(t, lo, hi))
+            self.assertEqual(result.shape, t.shape)
+
+    def testProb(self):
+        for rand, stats, lo, hi in self.cases():
+            t = timer_data(rand, (1, stats))
+            p = dp.prob(t, lo, hi)
+            self.assertTrue(isinstance(p, float))
+            self.assertAlmostEqual(p, old_prob(t, lo, hi))
+            self.assertAlmostEqual(dp.prob(t[0], lo, hi), old_prob(t[0], lo, hi))
+
+    def testMeanTime(self):
+        for rand, stats, lo, hi in self.cases():
+            t = timer_data(rand, (1, stats))
+            result = dp.mean_time(t, lo, hi)
+            self.assertTrue(isinstance(result[0], float))
+            assert_nan_equal(result, old_mean_time(t, lo, hi))
+            assert_nan_equal(dp.mean_time(t[0], lo, hi), old_mean_time(t[0], lo, hi))
+
+    def testMeanTimeDiff(self):
+        for rand, stats, lo, hi in self.cases():
+            t = timer_data(rand, (2, stats))
+            assert_nan_equal(dp.mean_time_diff(t, lo, hi),
+                             old_mean_time_diff(t, lo, hi))
+
+    def testCorrCoef(self):
+        for rand, stats, lo, hi in self.cases():
+            o = old_outcomes(timer_data(rand, (2, stats)), lo, hi)
+            assert_nan_equal(dp.corr_coef_from_outcomes(o),
+                             old_corr_coef_from_outcomes(o))
+
+
+class PropertyTest(unittest.TestCase):
+    """Batched statistics equal the statistics of each run."""
+    def setUp(self):
+        self.rand = np.random.RandomState(31)
+
+    def testBatchedMatchesPerRun(self):
+        for k in range(50):
+            runs = self.rand.randint(1, 6)
+            stats = self.rand.randint(1, 40)
+            t = timer_data(self.rand, (runs, 2, stats))
+            o = dp.outcomes(t)
+            means, stds = dp.mean_time(t, axis=-1)
+            probs = dp.prob(t, axis=-1)
+            diffs, diffStds = dp.mean_time_diff(t)
+            corrs = dp.corr_coef_from_outcomes(o)
+            self.assertEqual(means.shape, (runs, 2))
+            self.assertEqual(corrs.shape, (runs,))
+            for r in range(runs):
+                assert_nan_equal(diffs[r], dp.mean_time_diff(t[r])[0])
+                assert_nan_equal(diffStds[r], dp.mean_time_diff(t[r])[1])
+                assert_nan_equal(corrs[r], dp.corr_coef_from_outcomes(o[r]))
+                for ch in range(2):
+                    assert_nan_equal((means[r, ch], stds[r, ch]),
+                                     dp.mean_time(t[r, ch]))
+                    self.assertAlmostEqual(probs[r, ch], dp.prob(t[r, ch]))
+
+    def testAxis(self):
+        t = timer_data(self.rand, (3, 2, 20))
+        assert_nan_equal(dp.mean_time(t, axis=0),
+                         dp.mean_time(np.rollaxis(t, 0, 3), axis=-1))
+        np.testing.assert_allclose(dp.prob(t, axis=0), dp.prob(t.T, axis=-1).T)
+        self.assertAlmostEqual(dp.prob(t), np.mean(dp.outcomes(t)))
+
+    def testBounds(self):
+        for k in range(50):
+            t = timer_data(self.rand, (4, 2, 30))
+            p = dp.prob(t, axis=-1)
+            self.assertTrue(np.all((p >= 0) & (p <= 1)))
+            means, stds = dp.mean_time(t, 100, 1000, axis=-1)
+            ok = ~np.isnan(means)
+            self.assertTrue(np.all((means[ok] > 100) & (means[ok] < 1000)))
+            self.assertTrue(np.all(stds[ok] >= 0))
+            # NaN exactly where no run switched
+            np.testing.assert_array_equal(ok, dp.prob(t, 100, 1000, axis=-1) > 0)
+            r = dp.corr_coef_from_outcomes(dp.outcomes(t))
+            r = r[~np.isnan(r)]
+            self.assertTrue(np.all(np.abs(r) <= 1 + 1e-12))
+
+    def testJointHistogram(self):
+        t = timer_data(self.rand, (5, 2, 100))
+        o = dp.outcomes(t)
+        counts = dp.joint_outcome_histogram(o)
+        self.assertEqual(counts.shape, (5, 4))
+        np.testing.assert_array_equal(counts.sum(axis=-1), 100)
+        for r in range(5):
+            index = o[r, 0] + 2 * o[r, 1]
+            np.testing.assert_array_equal(counts[r], np.bincount(index, minlength=4))
+        # the marginals are the per-channel switching counts
+        np.testing.assert_array_equal(counts[:, 1] + counts[:, 3], o[:, 0].sum(-1))
+        np.testing.assert_array_equal(counts[:, 2] + counts[:, 3], o[:, 1].sum(-1))
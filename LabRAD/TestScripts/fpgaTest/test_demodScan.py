@@ -0,0 +1,165 @@
+"""
+Tests for the demodulator frequency scan of fpgaTest (DemodScan).
+
+The scan runs against a fake GHz FPGA server that records the uploads
+and returns, for each demod channel, I = dPhi * ampI and Q = 0, so the
+measured power tells which frequency and amplitude the channel had.
+fpgaTest needs msvcrt, so these tests only run on Windows.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from twisted.trial import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+try:
+    import LabRAD.TestScripts.fpgaTest.fpgaTest as fpgaTest
+    from labrad.units import GHz, MHz, ns
+except ImportError as e:
+    fpgaTest = None
+    skipReason = 'fpgaTest cannot be imported: %s' % e
+
+CHANNELS = 4
+
+
+class Number(float):
+    """A dimensionless registry value, as loaded by older pylabrad."""
+    @property
+    def value(self):
+        return float(self)
+
+
+class FakePacket(object):
+    def __init__(self, server):
+        self.server = server
+        self.records = []
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.records.append((name, args))
+            return self
+        return record
+
+    def send(self):
+        self.server.packets += 1
+        for name, args in self.records:
+            if name == 'select_device':
+                self.server.selected = args[0]
+            self.server.calls.append((self.server.selected, name, args))
+            if name == 'adc_demod_phase':
+                self.server.demods[args[0]][:2] = args[1:]
+            elif name == 'adc_trig_magnitude':
+                self.server.demods[args[0]][2:] = args[1:]
+
+
+class FakeFPGA(object):
+    """Records the settings sent to the boards and runs sequences."""
+    def __init__(self):
+        self.packets = 0
+        self.calls = []
+        self.runs = []
+        self.selected = None
+        self.demods = [[0, 0, 0, 0] for chan in range(CHANNELS)]
+
+    def packet(self):
+        return FakePacket(self)
+
+    def count(self, name):
+        return len([call for call in self.calls if call[1] == name])
+
+    def daisy_chain(self, boards):
+        self.calls.append((None, 'daisy_chain', (boards,)))
+
+    def timing_order(self, channels):
+        self.calls.append((None, 'timing_order', (channels,)))
+
+    def run_sequence(self, reps, getTimingData):
+        self.runs.append([tuple(d) for d in self.demods])
+        return [(np.zeros(reps) + dPhi * ampI, np.zeros(reps))
+                for dPhi, phi0, ampI, ampQ in self.demods]
+
+
+class DemodScanTest(unittest.TestCase):
+    if fpgaTest is None:
+        skip = skipReason
+
+    def setUp(self):
+        self.fpga = FakeFPGA()
+        self.dac = {'_id': 'Test DAC 1',
+                    'signalTime': 100 * ns,
+                    'signalWaveform': ['sine', 'sine'],
+                    'signalFrequency': [0.01 * GHz, 0.01 * GHz],
+                    'signalAmplitude': [Number(0.5), Number(0.5)],
+                    'signalPhase': [Number(0.0), Number(0.25)],
+                    'signalDc': [Number(0.0), Number(0.0)]}
+        self.demods = [(0 * MHz, 0.1 * chan, 10 + chan, 20 + chan)
+                       for chan in range(CHANNELS)]
+        self.adc = {'_id': 'Test ADC 1',
+                    'filterFunc': ('square', 0),
+                    'filterStretchLen': 0,
+                    'filterStretchAt': 0,
+                    'demods': list(self.demods)}
+        self.freqs = [(k - 4) * MHz for k in range(10)]
+
+    def dPhi(self, freq):
+        return fpgaTest.frequency2dPhi(freq)
+
+    def checkChannelSettings(self):
+        for run in self.fpga.runs:
+            for chan, (dPhi, phi0, ampI, ampQ) in enumerate(run):
+                _, phase, expectI, expectQ = self.demods[chan]
+                self.assertEqual((phi0, ampI, ampQ),
+                                 (fpgaTest.cycles2phi0(phase), expectI, expectQ))
+
+    def testDefault(self):
+        scanner = fpgaTest.DemodScan(self.fpga, reps=3)
+        self.assertFalse(scanner.spread)
+        freqs, data = scanner.scan(self.dac, self.adc, self.freqs)
+        np.testing.assert_array_equal(freqs, np.arange(-4, 6))
+        self.assertEqual(data.shape, (10, CHANNELS))
+        self.assertEqual(len(self.fpga.runs), 10)
+        for idx, freq in enumerate(self.freqs):
+            for chan in range(CHANNELS):
+                self.assertEqual(data[idx, chan],
+                                 (self.dPhi(freq) * self.demods[chan][2])**2)
+        self.checkChannelSettings()
+        self.assertEqual(self.adc['demods'], self.demods)
+
+    def testSpread(self):
+        scanner = fpgaTest.DemodScan(self.fpga, reps=3, spread=True)
+        freqs, data = scanner.scan(self.dac, self.adc, self.freqs)
+        self.assertEqual(data.shape, (10, 1))
+        # 10 points in runs of 4, 4 and 2 channels; the unused channels
+        # of the last run repeat its last frequency
+        self.assertEqual(scanner.runs, 3)
+        self.assertEqual(len(self.fpga.runs), 3)
+        self.assertEqual([d[0] for d in self.fpga.runs[-1]],
+                         [self.dPhi(f) for f in self.freqs[8:] + self.freqs[9:] * 2])
+        # the points are in scan order, each measured on channel idx % 4
+        for idx, freq in enumerate(self.freqs):
+            ampI = self.demods[idx % CHANNELS][2]
+            self.assertEqual(data[idx, 0], (self.dPhi(freq) * ampI)**2)
+        self.checkChannelSettings()
+        self.assertEqual(self.adc['demods'], self.demods)
+
+    def testDacUploadedOnce(self):
+        scanner = fpgaTest.DemodScan(self.fpga, reps=3, spread=True)
+        scanner.scan(self.dac, self.adc, self.freqs)
+        scanner.scan(self.dac, self.adc, self.freqs[:4])
+        self.assertEqual(scanner.dacUploads, 1)
+        self.assertEqual(self.fpga.count('sram'), 1)
+        self.assertEqual(self.fpga.count('memory'), 1)
+        # the ADC filter is sent once per scan, the demods once per run
+        self.assertEqual(self.fpga.count('adc_filter_func'), 2)
+        self.assertEqual(len(self.fpga.runs), 4)
+        self.dac['signalFrequency'] = [0.02 * GHz, 0.02 * GHz]
+        scanner.scan(self.dac, self.adc, self.freqs[:4])
+        self.assertEqual(scanner.dacUploads, 2)
+        self.assertEqual(self.fpga.count('sram'), 2)
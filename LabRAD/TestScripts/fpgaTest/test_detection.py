@@ -0,0 +1,111 @@
+"""
+Tests for board detection of the GHz FPGA server, run against the emulator.
+
+See emulatorFixture.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture, ghz_fpga_server
+
+BOARDS = [('DAC', 1), ('DAC', 2), ('ADC', 1)]
+
+
+class DetectionTest(unittest.TestCase):
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture(BOARDS)
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.bg = self.fixture.boardGroup
+        self.c = self.fixture.context()
+
+    def tearDown(self):
+        return self.fixture.stop()
+
+    def devices(self):
+        return sorted(self.fpga.deviceLists()[1])
+
+    @inlineCallbacks
+    def refresh(self):
+        """Refresh the device list, counting the pings sent and the time taken."""
+        written = self.fixture.emulator.stats['written']
+        start = time.time()
+        yield self.fpga.refreshDeviceList()
+        self.elapsed = time.time() - start
+        self.pings = self.fixture.emulator.stats['written'] - written
+
+    def testStartupIsFullSweep(self):
+        self.assertEqual(self.devices(), ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2'])
+        self.assertNotEqual(self.bg.lastFullDetection, None)
+        self.assertEqual(sorted(name for name, t in self.bg.lastSeen.values()),
+                         ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2'])
+        self.assertFalse(self.bg.needFullDetection())
+
+    @inlineCallbacks
+    def testQuickRefresh(self):
+        yield self.refresh()
+        # only the known boards are pinged, and all of them answer at once
+        self.assertEqual(self.pings, len(BOARDS))
+        self.assertTrue(self.elapsed < ghz_fpga_server.QUICK_DETECT_TIMEOUT)
+        self.assertEqual(self.devices(), ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2'])
+
+    @inlineCallbacks
+    def testFullSweep(self):
+        start = time.time()
+        devices = yield self.fpga.detect_boards(self.c)
+        elapsed = time.time() - start
+        self.assertEqual(sorted(name for ID, name in devices),
+                         ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2'])
+        # the sweep ends once no more answers come in
+        self.assertTrue(elapsed < ghz_fpga_server.DETECT_TIMEOUT)
+        self.assertFalse(self.bg.fullDetectionRequested)
+
+    @inlineCallbacks
+    def testBoardAppears(self):
+        # a board that is not configured in the registry is only found by a full sweep
+        yield self.fixture.addBoard('DAC', 7)
+        yield self.refresh()
+        self.assertEqual(self.devices(), ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2'])
+        yield self.fpga.detect_boards(self.c)
+        self.assertEqual(self.devices(), ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2', 'Emu DAC 7'])
+        # after which it is known
+        yield self.refresh()
+        self.assertEqual(self.pings, len(BOARDS) + 1)
+        self.assertTrue('Emu DAC 7' in self.devices())
+        build = yield self.fixture.device('DAC 7').buildNumber()
+        self.assertEqual(build, '13')
+
+    @inlineCallbacks
+    def testBoardDisappears(self):
+        seen = dict(self.fpga.last_seen(self.c))
+        self.fixture.removeBoard('DAC', 2)
+        yield self.refresh()
+        self.assertEqual(self.devices(), ['Emu ADC 1', 'Emu DAC 1'])
+        # we waited for the missing board, but not for a full sweep
+        self.assertEqual(self.pings, len(BOARDS))
+        self.assertTrue(self.elapsed < ghz_fpga_server.DETECT_TIMEOUT)
+        lastSeen = dict(self.fpga.last_seen(self.c))
+        self.assertTrue(lastSeen['Emu DAC 2'] > seen['Emu DAC 2'])
+        self.assertTrue(lastSeen['Emu DAC 1'] < lastSeen['Emu DAC 2'])
+        # the board is still known, so it is found again without a full sweep
+        yield self.fixture.addBoard('DAC', 2)
+        yield self.refresh()
+        self.assertEqual(self.pings, len(BOARDS))
+        self.assertEqual(self.devices(), ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2'])
+
+    @inlineCallbacks
+    def testPipelineNotBlocked(self):
+        """The board group locks are free again when detection is done."""
+        yield self.fpga.detect_boards(self.c)
+        yield self.refresh()
+        for lock in self.bg.pageLocks + [self.bg.runLock, self.bg.readLock]:
+            self.assertFalse(lock.locked)
+        self.assertEqual(self.bg.pipeSemaphore.tokens, ghz_fpga_server.NUM_PAGES)
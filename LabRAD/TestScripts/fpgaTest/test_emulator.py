@@ -0,0 +1,262 @@
+"""
+Tests for the Direct Ethernet Emulator and its DAC and ADC board models.
+
+The GHz FPGA server runs sequences on the emulated boards (see
+emulatorFixture), and the emulator's Direct Ethernet settings are also
+called directly.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import time
+
+import numpy as np
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture, Context, emulator, dac, adc, ADC_BUILD_PARAMS
+
+BOARDS = [('DAC', 1), ('DAC', 2), ('ADC', 1)]
+DELAY_CYCLES = 2500 # 100 us at 25 MHz
+MEMORY = [0x000000,                       # NoOp
+          0x800000,                       # SRAM start address
+          0xA00000 + 999,                 # SRAM end address
+          0xC00000,                       # call SRAM
+          0x300000 + DELAY_CYCLES - 1,    # delay
+          0x400000,                       # start timer
+          0x300064,                       # delay 100+1 cycles
+          0x400001,                       # stop timer
+          0xF00000]                       # branch back to start
+FILTER_LEN = 4096
+DEMODS = [(0, 100, 7), (1, 200, -3), (2, -50, 0), (3, 0, 1000)]
+
+
+class EmulatorTest(unittest.TestCase):
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture(BOARDS)
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.em = self.fixture.emulator
+        self.em.reset_statistics(None) # detection waits for boards that are not there
+        self.c = self.fixture.context()
+        for name in ['Emu DAC 1', 'Emu DAC 2']:
+            self.fpga.select_device(self.c, name)
+            self.fpga.dac_memory(self.c, MEMORY)
+            self.fpga.dac_sram(self.c, np.zeros(1000, dtype='<u4').tostring())
+        self.fpga.select_device(self.c, 'Emu ADC 1')
+        self.fpga.start_delay(self.c, 0)
+        self.fpga.adc_filter_func(self.c, np.zeros(FILTER_LEN, dtype='<u1').tostring(), 0, 0)
+        for chan, dPhi, phi0 in DEMODS:
+            self.fpga.adc_demod_frequency(self.c, chan, dPhi, phi0)
+            self.fpga.adc_trig_magnitude(self.c, chan, 255, 255)
+
+    def tearDown(self):
+        return self.fixture.stop()
+
+    def sequence(self, boards, timingOrder, adcMode=None):
+        if adcMode is not None:
+            self.fpga.select_device(self.c, 'Emu ADC 1')
+            self.fpga.adc_run_mode(self.c, adcMode)
+        self.fpga.sequence_boards(self.c, boards)
+        self.fpga.sequence_timing_order(self.c, timingOrder)
+
+    @inlineCallbacks
+    def assertRunFails(self, reps):
+        try:
+            yield self.fpga.sequence_run(self.c, reps, True)
+        except Exception:
+            pass
+        else:
+            self.fail('Run Sequence did not fail')
+
+    @inlineCallbacks
+    def testDetected(self):
+        self.assertEqual(sorted(self.fpga.deviceLists()[1]),
+                         ['Emu ADC 1', 'Emu DAC 1', 'Emu DAC 2'])
+        build = yield self.fixture.device('DAC 1').buildNumber()
+        self.assertEqual(build, '13')
+        build = yield self.fixture.device('ADC 1').buildNumber()
+        self.assertEqual(build, '7')
+        self.assertEqual(self.em.stats['timeouts'], 0)
+
+    @inlineCallbacks
+    def testTimingData(self):
+        cycles, timers = emulator.analyzeMemory(MEMORY)
+        self.assertEqual(timers, [102])
+        self.assertEqual(cycles, 5 + 1000 // emulator.SRAM_WORDS_PER_CYCLE + 1 + DELAY_CYCLES + 101 + 2)
+        self.sequence(['Emu DAC 1', 'Emu DAC 2'], ['Emu DAC 1', 'Emu DAC 2'])
+        ans = yield self.fpga.sequence_run(self.c, 60, True)
+        self.assertEqual(np.asarray(ans).tolist(), [[102] * 60] * 2)
+        # reps are rounded up to whole timing packets
+        ans = yield self.fpga.sequence_run(self.c, 31, True)
+        self.assertEqual(np.asarray(ans).shape, (2, 2 * dac.TIMING_PACKET_LEN))
+        self.assertEqual(self.em.stats['runs'], 4)
+        count = yield self.fixture.device('DAC 2').executionCount()
+        self.assertEqual(count, 2 * dac.TIMING_PACKET_LEN)
+
+    @inlineCallbacks
+    def testAverage(self):
+        self.sequence(['Emu DAC 1', 'Emu ADC 1'], ['Emu ADC 1'], 'average')
+        ans = yield self.fpga.sequence_run(self.c, 30, True)
+        I, Q = ans[0]
+        params = dict(ADC_BUILD_PARAMS)
+        samples = params['AVERAGE_PACKETS'] * params['AVERAGE_PACKET_LEN'] // 4
+        self.assertEqual((len(I), len(Q)), (samples, samples))
+        self.assertFalse(np.any(I) or np.any(Q))
+
+    @inlineCallbacks
+    def testDemod(self):
+        channels = ['Emu ADC 1::%d' % chan for chan, dPhi, phi0 in DEMODS]
+        self.sequence(['Emu DAC 1', 'Emu ADC 1'], channels + ['Emu DAC 1'], 'demodulate')
+        ans = yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(len(ans), len(DEMODS) + 1)
+        # I and Q of each channel echo its dPhi and phi0
+        for (chan, dPhi, phi0), (I, Q) in zip(DEMODS, ans[:-1]):
+            self.assertEqual(list(I), [dPhi] * 30)
+            self.assertEqual(list(Q), [phi0] * 30)
+        self.assertEqual(list(ans[-1]), [102] * 30)
+
+    @inlineCallbacks
+    def testLatencyAndTimeScale(self):
+        self.sequence(['Emu DAC 1'], ['Emu DAC 1'])
+        self.em.config['timeScale'] = 1.0
+        self.em.config['latency'] = 0.05
+        cycles, timers = emulator.analyzeMemory(MEMORY)
+        start = time.time()
+        yield self.fpga.sequence_run(self.c, 300, True)
+        elapsed = time.time() - start
+        self.assertTrue(elapsed >= 300 * cycles / emulator.MEM_CLOCK + 0.05, elapsed)
+
+    @inlineCallbacks
+    def testStall(self):
+        self.sequence(['Emu DAC 1', 'Emu DAC 2'], ['Emu DAC 1', 'Emu DAC 2'])
+        self.em.config['stall'] = 1.0
+        yield self.assertRunFails(300)
+        self.assertEqual(self.em.stats['stalls'], 2)
+        self.assertTrue(self.em.stats['timeouts'] >= 2)
+        # the execution counters stopped early
+        for name in ['DAC 1', 'DAC 2']:
+            self.assertTrue(self.fixture.board(name).executionCount < 300)
+        # the boards are usable again once they no longer stall
+        self.em.config['stall'] = 0.0
+        ans = yield self.fpga.sequence_run(self.c, 300, True)
+        self.assertEqual(np.asarray(ans).shape, (2, 300))
+
+
+class DirectEthernetTest(unittest.TestCase):
+    """The Direct Ethernet settings, called directly."""
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture([('DAC', 1)])
+        yield self.fixture.start()
+        self.em = self.fixture.emulator
+        self.em.reset_statistics(None)
+        self.contexts = 0
+
+    def tearDown(self):
+        return self.fixture.stop()
+
+    def context(self, dest=dac.macFor(1)):
+        self.contexts += 1
+        c = Context((2, self.contexts), 2)
+        self.em.initContext(c)
+        self.em.connect(c, self.fixture.port)
+        self.em.destination_mac(c, dest)
+        self.em.listen(c)
+        return c
+
+    def readback(self):
+        """A DAC register packet that asks for readback."""
+        regs = np.zeros(dac.REG_PACKET_LEN, dtype='<u1')
+        regs[1] = 1
+        return regs.tostring()
+
+    @inlineCallbacks
+    def testReadback(self):
+        c = self.context()
+        self.em.require_length(c, dac.READBACK_LEN)
+        self.em.write(c, self.readback())
+        src, dest, length, data = yield self.em.read(c)
+        self.assertEqual((src, length), (dac.macFor(1), dac.READBACK_LEN))
+        self.assertEqual(dac.processReadback(data)['build'], 13)
+        self.assertEqual(self.em.stats['written'], 1)
+
+    @inlineCallbacks
+    def testFilters(self):
+        c = self.context()
+        other = self.context()
+        self.em.require_length(other, 10)
+        self.em.write(c, self.readback())
+        self.em.write(c, self.readback())
+        yield self.em.collect(c, 2)
+        self.assertEqual(len(c['buffer'].packets), 2)
+        self.assertEqual(len(other['buffer'].packets), 0)
+        yield self.em.discard(c, 1)
+        self.assertEqual(len(c['buffer'].packets), 1)
+        self.em.clear(c)
+        self.assertEqual(len(c['buffer'].packets), 0)
+
+    @inlineCallbacks
+    def testTimeout(self):
+        c = self.context(dest=dac.macFor(2)) # no such board
+        self.em.timeout(c, 0.05)
+        self.em.write(c, self.readback())
+        try:
+            yield self.em.read(c)
+        except emulator.TimeoutError:
+            pass
+        else:
+            self.fail('Read did not time out')
+        self.assertEqual(self.em.stats['timeouts'], 1)
+
+    @inlineCallbacks
+    def testPacketLoss(self):
+        c = self.context()
+        self.em.timeout(c, 0.05)
+        self.em.config['loss'] = 1.0
+        self.em.write(c, self.readback())
+        try:
+            yield self.em.collect(c)
+        except emulator.TimeoutError:
+            pass
+        else:
+            self.fail('A lost packet arrived')
+        self.assertEqual((self.em.stats['lost'], self.em.stats['sent']), (1, 0))
+        self.em.config['loss'] = 0.0
+        self.em.write(c, self.readback())
+        yield self.em.collect(c)
+        self.assertEqual((self.em.stats['lost'], self.em.stats['sent']), (1, 1))
+
+    def testNoAdapter(self):
+        c = Context((2, 100), 2)
+        self.em.initContext(c)
+        self.assertRaises(emulator.NoAdapterError, self.em.write, c, self.readback())
+        self.em.connect(c, 0)
+        self.assertRaises(emulator.NoDestinationError, self.em.write, c, self.readback())
+
+    @inlineCallbacks
+    def testTriggers(self):
+        c = self.context()
+        other = self.context()
+        d = self.em.wait_for_trigger(c, 2)
+        self.em.send_trigger(other, c.ID)
+        self.assertFalse(d.called)
+        self.em.send_trigger(other, c.ID)
+        waited = yield d
+        self.assertTrue(waited['s'] >= 0)
+        self.assertEqual(self.em.triggers[c.ID], 0)
+
+    @inlineCallbacks
+    def testBoards(self):
+        mac = yield self.em.add_board(None, 0, 'ADC', 3, 7)
+        self.assertEqual(mac, adc.macFor(3))
+        self.assertEqual(self.em.boards(None),
+                         [(0, 'DAC', 1, 13, dac.macFor(1)), (0, 'ADC', 3, 7, adc.macFor(3))])
+        self.em.remove_board(None, 0, mac)
+        self.assertRaises(emulator.UnknownBoardError, self.em.remove_board, None, 0, mac)
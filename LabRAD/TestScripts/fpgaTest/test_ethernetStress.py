@@ -0,0 +1,171 @@
+"""
+Tests for the ethernet stress tester, run against FakeDirectEthernet.
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from twisted.trial import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+import LabRAD.TestScripts.fpgaTest.ethernetStress as ethernetStress
+from LabRAD.TestScripts.fpgaTest.ethernetStress import FakeDirectEthernet
+
+dac = ethernetStress.dacModule
+adc = ethernetStress.adcModule
+
+BOARDS = ['Test DAC 1', 'Test DAC 2', 'Test ADC 1']
+
+
+class FakeDirectEthernetTest(unittest.TestCase):
+    def setUp(self):
+        self.de = FakeDirectEthernet(latency=1e-3)
+        self.ctx = self.de.context()
+
+    def tearDown(self):
+        self.de._cxn.manager.expire_context(self.de.ID, context=self.ctx)
+
+    def ping(self, module, num):
+        p = self.de.packet(context=self.ctx)
+        p.destination_mac(module.macFor(num))
+        p.timeout(0.1)
+        p.write(module.regPing().tostring())
+        p.read()
+        return p
+
+    def testReadback(self):
+        for module, build in [(dac, 7), (adc, 7)]:
+            src, dst, eth, data = self.ping(module, 3).send()['read']
+            self.assertEqual(src, module.macFor(3))
+            self.assertEqual(len(data), module.READBACK_LEN)
+            self.assertEqual(eth, module.READBACK_LEN)
+
+    def testNoAnswer(self):
+        p = self.de.packet(context=self.ctx)
+        p.destination_mac(dac.macFor(1))
+        p.timeout(0.05)
+        p.write('not a register packet')
+        p.read()
+        start = time.time()
+        self.assertRaises(ethernetStress.FakeTimeoutError, p.send)
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def testLatency(self):
+        self.de.latency = 0.05
+        start = time.time()
+        self.ping(dac, 1).send()
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def testFuture(self):
+        done = []
+        future = self.ping(adc, 1).send(wait=False)
+        future.addCallback(lambda ans, tag: done.append(tag) or ans, 'a')
+        ans = future.wait()
+        self.assertEqual(done, ['a'])
+        # callbacks added after completion are called at once
+        future.addCallback(lambda ans: done.append('b') or ans)
+        self.assertEqual(done, ['a', 'b'])
+        self.assertEqual(len(ans.read[3]), adc.READBACK_LEN)
+
+    def testOrderInContext(self):
+        futures = [self.ping(module, 1).send(wait=False) for module in [dac, adc, dac]]
+        lengths = [len(f.wait().read[3]) for f in futures]
+        self.assertEqual(lengths, [dac.READBACK_LEN, adc.READBACK_LEN, dac.READBACK_LEN])
+
+    def testSeededLoss(self):
+        def losses(seed):
+            de = FakeDirectEthernet(loss=0.3, seed=seed)
+            return [de.respond(dac.macFor(1), dac.regPing().tostring()) is None
+                    for k in range(200)]
+        self.assertEqual(losses(5), losses(5))
+        self.assertTrue(30 < sum(losses(5)) < 90)
+
+
+class StressTest(unittest.TestCase):
+    def testBoardInfo(self):
+        self.assertEqual(ethernetStress.boardInfo('Vince DAC 11'), (11, 'DAC'))
+        self.assertEqual(ethernetStress.boardInfo('Vince ADC 2'), (2, 'ADC'))
+        self.assertRaises(Exception, ethernetStress.boardInfo, 'Vince DAC')
+        self.assertRaises(Exception, ethernetStress.boardInfo, 'Vince XYZ 3')
+
+    def testNoLoss(self):
+        de = FakeDirectEthernet(latency=1e-3)
+        report = ethernetStress.stressTest(de, 1, BOARDS, 50)
+        self.assertEqual(sorted(report['boards']), sorted(BOARDS))
+        received = 0
+        for name, info in report['boards'].items():
+            num, kind = ethernetStress.boardInfo(name)
+            self.assertEqual(info['mac'], ethernetStress.MODULES[kind].macFor(num))
+            self.assertEqual((info['sent'], info['received'], info['lost']), (50, 50, 0))
+            self.assertEqual(sum(info['histogram']), 50)
+            self.assertTrue(info['latency']['p50'] >= 1e-3)
+            self.assertTrue(info['latency']['max'] >= info['latency']['p99'] >= info['latency']['p50'])
+            received += info['received']
+        thru = report['throughput']
+        self.assertAlmostEqual(thru['pingsPerSecond'], received / report['duration'])
+        self.assertAlmostEqual(thru['bytesReceivedPerSecond'] * report['duration'],
+                               50 * (2 * dac.READBACK_LEN + adc.READBACK_LEN))
+        # the contexts are expired
+        self.assertEqual(de._contexts, {})
+
+    def testLoss(self):
+        de = FakeDirectEthernet(latency=1e-3, loss=0.1, seed=1)
+        report = ethernetStress.stressTest(de, 1, BOARDS[:1], 200, timeout=0.02)
+        info = report['boards'][BOARDS[0]]
+        self.assertEqual(info['received'] + info['lost'], 200)
+        self.assertTrue(0 < info['lost'] < 60, info['lost'])
+        self.assertAlmostEqual(info['lossFraction'], info['lost'] / 200.)
+
+    def testAllLost(self):
+        de = FakeDirectEthernet(loss=1.0)
+        report = ethernetStress.stressTest(de, 1, BOARDS[:1], 4, timeout=0.01)
+        info = report['boards'][BOARDS[0]]
+        self.assertEqual((info['received'], info['lost']), (0, 4))
+        self.assertEqual(info['latency']['mean'], None)
+        self.assertEqual(report['throughput']['pingsPerSecond'], 0.0)
+
+    def testConcurrentBoards(self):
+        """Each board has its own context, so pings to different boards overlap."""
+        latency = 0.02
+        de = FakeDirectEthernet(latency=latency)
+        for depth in [1, 4]:
+            report = ethernetStress.stressTest(de, 1, BOARDS, 20, depth=depth)
+            # 20 pings to each of the boards in a row would take 60 latencies
+            self.assertTrue(20 * latency <= report['duration'] < 40 * latency,
+                            report['duration'])
+            for info in report['boards'].values():
+                self.assertEqual(info['received'], 20)
+
+    def testCallbacksBeforeWait(self):
+        """Latencies are stamped before wait returns, so none are lost."""
+        de = FakeDirectEthernet(latency=0)
+        report = ethernetStress.stressTest(de, 1, BOARDS, 500, depth=8)
+        for info in report['boards'].values():
+            self.assertEqual((info['received'], info['lost']), (500, 0))
+
+    def testReport(self):
+        report = ethernetStress.stressTest(FakeDirectEthernet(), 1, BOARDS, 5)
+        ethernetStress.printReport(report)
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'report.json')
+            ethernetStress.writeReport(report, filename)
+            with open(filename) as f:
+                loaded = json.load(f)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(loaded['pings'], 5)
+        self.assertEqual(len(loaded['latencyBins']), len(ethernetStress.LATENCY_BINS))
+        self.assertEqual(loaded['boards'][BOARDS[0]]['received'], 5)
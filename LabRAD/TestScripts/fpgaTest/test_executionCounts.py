@@ -0,0 +1,97 @@
+"""
+Tests for Execution Counts of the GHz FPGA server, run against the
+emulator (see emulatorFixture).
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import time
+
+import numpy as np
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture
+
+BOARDS = [('DAC', 1), ('DAC', 2), ('ADC', 1)]
+NAMES = ['Emu DAC 1', 'Emu DAC 2', 'Emu ADC 1']
+MEMORY = [0x000000,                       # NoOp
+          0x800000,                       # SRAM start address
+          0xA00000 + 999,                 # SRAM end address
+          0xC00000,                       # call SRAM
+          0x300000 + 2499,                # delay
+          0x400000,                       # start timer
+          0x300064,                       # delay 100+1 cycles
+          0x400001,                       # stop timer
+          0xF00000]                       # branch back to start
+FILTER_LEN = 4096
+
+
+class ExecutionCountsTest(unittest.TestCase):
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture(BOARDS)
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.em = self.fixture.emulator
+        self.c = self.fixture.context()
+        for name in NAMES[:2]:
+            self.fpga.select_device(self.c, name)
+            self.fpga.dac_memory(self.c, MEMORY)
+            self.fpga.dac_sram(self.c, np.zeros(1000, dtype='<u4').tostring())
+        self.fpga.select_device(self.c, 'Emu ADC 1')
+        self.fpga.start_delay(self.c, 0)
+        self.fpga.adc_run_mode(self.c, 'average')
+        self.fpga.adc_filter_func(self.c, np.zeros(FILTER_LEN, dtype='<u1').tostring(), 0, 0)
+        self.fpga.sequence_boards(self.c, NAMES)
+        self.fpga.sequence_timing_order(self.c, NAMES[:2])
+
+    def tearDown(self):
+        return self.fixture.stop()
+
+    @inlineCallbacks
+    def testCounts(self):
+        yield self.fpga.sequence_run(self.c, 60, True)
+        counts = yield self.fpga.execution_counts(self.c)
+        boards = [self.fixture.board(name[4:]) for name in NAMES]
+        self.assertEqual(counts, [board.executionCount for board in boards])
+        self.assertEqual(counts[:2], [60, 60])
+        # the same counts as with one Execution Count per board
+        for name, count in zip(NAMES, counts):
+            self.fpga.select_device(self.c, name)
+            single = yield self.fpga.execution_counter(self.c)
+            self.assertEqual(single, count)
+
+    @inlineCallbacks
+    def testOrderAndSubset(self):
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.fixture.board('DAC 2').executionCount = 7
+        counts = yield self.fpga.execution_counts(self.c, ['Emu DAC 2', 'Emu DAC 1'])
+        self.assertEqual(counts, [7, 30])
+        counts = yield self.fpga.execution_counts(self.c, [])
+        self.assertEqual(counts, [])
+
+    @inlineCallbacks
+    def testConcurrent(self):
+        """The boards are pinged at once: one latency instead of one per board."""
+        self.em.config['latency'] = 0.1
+        written = self.em.stats['written']
+        start = time.time()
+        yield self.fpga.execution_counts(self.c)
+        elapsed = time.time() - start
+        self.assertEqual(self.em.stats['written'] - written, len(NAMES))
+        self.assertTrue(0.1 <= elapsed < 0.1 * len(NAMES), elapsed)
+        start = time.time()
+        for name in NAMES:
+            self.fpga.select_device(self.c, name)
+            yield self.fpga.execution_counter(self.c)
+        self.assertTrue(time.time() - start >= 0.1 * len(NAMES))
+
+    def testUnknownBoard(self):
+        d = self.fpga.execution_counts(self.c, ['Emu DAC 1', 'Emu DAC 9'])
+        return self.assertFailure(d, Exception)
@@ -0,0 +1,245 @@
+"""
+Tests for the sequence cache of pyle.dataking.fpgaseq.runQubits.
+
+runQubits sends its packets to a fake Qubit Sequencer, which keeps the
+sequence built in each context like the real server, and counts the
+sequences it compiles and the SRAM data uploaded to it.  fpgaseq needs
+pyle.envelopes, so these tests are skipped without it.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'pyle'))
+try:
+    from pyle.dataking import fpgaseq
+    import pyle.envelopes as env
+    from labrad.units import Unit
+    us, V = Unit('us'), Unit('V')
+except ImportError as e:
+    fpgaseq = None
+    skipReason = 'fpgaseq cannot be imported: %s' % e
+
+
+class Device(dict):
+    """A device loaded from the registry."""
+    def __init__(self, name, *a, **kw):
+        dict.__init__(self, *a, **kw)
+        self.__name__ = name
+
+
+def makeQubit(name='q0', amp=0.5, bias=0.1):
+    q = Device(name)
+    q.update({
+        '_type': 'phaseQubit',
+        'channels': [('timing', ('Preamp', [name])),
+                     ('squid', ('FastBias', [name])),
+                     ('flux', ('FastBias', [name])),
+                     ('uwave', ('Microwave', ['DAC 1'])),
+                     ('meas', ('Analog', ['DAC 2']))],
+        'readout': True,
+        'fc': 6.0, 'uwavePower': 2.7,
+        'timingLagWrtMaster': 0.0, 'timingLagUwave': 10.0,
+        'biasOperate': bias * V, 'biasOperateSettling': 40 * us,
+        'biasReset': [-0.5 * V], 'biasResetSettling': 10 * us,
+        'biasReadout': 0.3 * V, 'biasReadoutSettling': 5 * us,
+        'squidBias': 0.0 * V, 'squidReadoutDelay': 0 * us,
+        'squidRampLength': 20 * us, 'squidRampBegin': 0.1 * V,
+        'squidRampEnd': 1.0 * V, 'squidReset': 0.0 * V,
+    })
+    # envelopes are new objects every time, as in a sweep
+    q['xy'] = env.gaussian(10, 8, amp=amp) + env.gaussian(40, 8, amp=amp)
+    q['z'] = env.rect(60, 20, 0.2)
+    return q
+
+
+class FakeFuture(object):
+    def __init__(self):
+        self.callbacks = []
+        self.done = False
+
+    def addCallback(self, func, *args):
+        if self.done:
+            self.result = func(self.result, *args)
+        else:
+            self.callbacks.append((func, args))
+        return self
+
+    def fire(self, result):
+        self.done = True
+        self.result = result
+        for func, args in self.callbacks:
+            self.result = func(self.result, *args)
+
+
+class FakePacket(object):
+    def __init__(self, server, context):
+        self.server = server
+        self._kw = {'context': context}
+        self.records = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def record(*args, **kw):
+            self.records.append((name, args, kw))
+        return record
+
+    def send(self, wait=False):
+        future = FakeFuture()
+        self.server.queue.append((self._kw['context'], self.records, future))
+        if not self.server.hold:
+            self.server.process()
+        return future
+
+
+class FakeQubitSequencer(object):
+    """Builds, uploads and runs sequences, in order in each context."""
+    def __init__(self):
+        self.context = (0, 1)
+        self.hold = False     # keep requests queued until process is called
+        self.failBuild = False
+        self.queue = []
+        self.built = {}       # context -> SRAM data of the sequence built there
+        self.compiles = 0
+        self.uploads = 0
+        self.ran = []         # SRAM data of each sequence run
+
+    def packet(self):
+        return FakePacket(self, self.context)
+
+    def process(self):
+        queue, self.queue = self.queue, []
+        for context, records, future in queue:
+            sram = []
+            try:
+                for name, args, kw in records:
+                    if name == 'initialize':
+                        self.built.pop(context, None)
+                    elif name.startswith('sram_') and name.endswith('_fourier'):
+                        self.uploads += 1
+                        sram.append(np.asarray(args[1]))
+                    elif name == 'build_sequence':
+                        if self.failBuild:
+                            raise Exception('build failed')
+                        self.compiles += 1
+                        self.built[context] = sram
+                    elif name == 'run':
+                        if context not in self.built:
+                            raise Exception('no sequence built in %s' % (context,))
+                        self.ran.append(self.built[context])
+            except Exception:
+                continue # the request fails, so its future never fires
+            future.fire({'data': [len(self.ran)]})
+
+
+class SequenceCacheTest(unittest.TestCase):
+    if fpgaseq is None:
+        skip = skipReason
+
+    def setUp(self):
+        fpgaseq.sequenceCache.clear()
+        self.server = FakeQubitSequencer()
+
+    def runQubits(self, devices, **kw):
+        return fpgaseq.runQubits(self.server, devices, 100, probs=[1], **kw)
+
+    def assertRanSame(self, a, b):
+        self.assertEqual(len(self.server.ran[a]), len(self.server.ran[b]))
+        for x, y in zip(self.server.ran[a], self.server.ran[b]):
+            np.testing.assert_array_equal(x, y)
+
+    def testIdenticalRunNotRebuilt(self):
+        req = self.runQubits([makeQubit()])
+        self.assertEqual(req.result, [1])
+        uploads = self.server.uploads
+        self.assertEqual((self.server.compiles, uploads), (1, 2))
+        req = self.runQubits([makeQubit()])
+        self.assertEqual(req.result, [2])
+        self.assertEqual((self.server.compiles, self.server.uploads), (1, uploads))
+        self.assertRanSame(0, 1)
+        info = fpgaseq.sequenceCache.info()
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
+
+    def testChangedSequenceRebuilt(self):
+        self.runQubits([makeQubit()])
+        self.runQubits([makeQubit(amp=0.6)])   # other SRAM data
+        self.runQubits([makeQubit(bias=0.2)])  # other memory commands
+        self.assertEqual(self.server.compiles, 3)
+        self.runQubits([makeQubit(bias=0.2)])
+        self.assertEqual(self.server.compiles, 3)
+        self.assertRanSame(2, 3)
+
+    def testEqualEnvelopesHit(self):
+        """Envelopes with the same samples hit, however they are made."""
+        q = makeQubit()
+        self.runQubits([q])
+        q = makeQubit()
+        q['xy'] = env.gaussian(40, 8, amp=0.5) + env.gaussian(10, 8, amp=0.5)
+        self.runQubits([q])
+        self.assertEqual(self.server.compiles, 1)
+
+    def testContexts(self):
+        self.runQubits([makeQubit()])
+        self.server.context = (0, 2)
+        self.runQubits([makeQubit()])
+        self.assertEqual(self.server.compiles, 2)
+        self.server.context = (0, 1)
+        self.runQubits([makeQubit()])
+        self.assertEqual(self.server.compiles, 2)
+        self.assertEqual(len(self.server.ran), 3)
+
+    def testCacheOff(self):
+        self.runQubits([makeQubit()], cache=False)
+        self.runQubits([makeQubit()], cache=False)
+        self.assertEqual(self.server.compiles, 2)
+        # a sequence built without the cache replaces the remembered one
+        self.runQubits([makeQubit()])
+        self.runQubits([makeQubit(amp=0.6)], cache=False)
+        self.runQubits([makeQubit()])
+        self.assertEqual(self.server.compiles, 5)
+        self.assertRanSame(2, 4)
+
+    def testInFlight(self):
+        """A sequence counts as built only once its request succeeded."""
+        self.server.hold = True
+        self.runQubits([makeQubit()])
+        self.runQubits([makeQubit()])
+        self.server.process()
+        self.assertEqual(self.server.compiles, 2)
+        # another sequence still in flight in the context
+        self.runQubits([makeQubit(amp=0.6)])
+        req = self.runQubits([makeQubit()])
+        self.server.process()
+        self.assertEqual(self.server.compiles, 4)
+        self.assertEqual(req.result, [4])
+        self.assertRanSame(0, 3)
+
+    def testFailedBuild(self):
+        self.runQubits([makeQubit()])
+        self.server.failBuild = True
+        req = self.runQubits([makeQubit(amp=0.6)])
+        self.assertFalse(req.done)
+        self.server.failBuild = False
+        # the context lost its sequence, so it is built again
+        self.runQubits([makeQubit()])
+        self.assertEqual(self.server.compiles, 2)
+        self.assertRanSame(0, 1)
+
+    def testBound(self):
+        cache = fpgaseq.SequenceCache(maxsize=2)
+        for k in range(4):
+            self.server.context = (0, k)
+            p = self.server.packet()
+            cache.building(self.server, p, 'digest')(None)
+        self.assertEqual(cache.info()['size'], 2)
+        self.assertTrue(cache.lookup(self.server, p, 'digest'))
+        self.server.context = (0, 0)
+        self.assertFalse(cache.lookup(self.server, self.server.packet(), 'digest'))
@@ -0,0 +1,125 @@
+"""
+Tests for the trace transfer of the HP 8565E Spectrum Analyzer server.
+
+The server talks to a fake GPIB device that answers queries from a dict of
+instrument state and returns synthetic binary 'TDF B' traces.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import imp
+import os
+import sys
+
+import numpy as np
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+hp8565E = imp.load_source('hp_8565E_spectrum_analyzer',
+    os.path.join(REPO, 'LabRAD', 'Servers', 'Instruments', 'hp_8565E_spectrum_analyzer.py'))
+
+N = hp8565E.TRACE_POINTS
+MU = hp8565E.MU_PER_SCREEN
+
+
+def encode(mu):
+    """A trace in measurement units as the analyzer sends it."""
+    return np.asarray(mu, dtype='>u2').tostring()
+
+
+class FakeGPIB(object):
+    """Answers queries from state and records everything written."""
+    def __init__(self, trace):
+        self.state = {'FA': 1e9, 'FB': 2e9, 'RL': -10.0, 'LG': 10.0, 'ST': 0.01,
+                      'CF': 1.5e9, 'SP': 1e9, 'RB': 1e6, 'VB': 3e5, 'DONE': 1}
+        self.trace = trace
+        self.written = []
+
+    def write(self, cmd):
+        self.written.append(cmd)
+        return defer.succeed(None)
+
+    def query(self, cmd):
+        self.written.append(cmd)
+        return defer.succeed('%g' % self.state[cmd.rstrip('?')])
+
+    def read_raw(self):
+        return defer.succeed(self.trace)
+
+
+class DecodeTraceTest(unittest.TestCase):
+    def testLogScale(self):
+        mu = np.linspace(0, 600, N).round()
+        f, P = hp8565E.decode_trace(encode(mu), 1e9, 2e9, -10.0, 10.0)
+        np.testing.assert_allclose(f, np.linspace(1e9, 2e9, N))
+        # 10 dB per division, 60 measurement units per division,
+        # with the reference level at the top of the screen
+        np.testing.assert_allclose(P, -10.0 + 10.0 * (mu / 60. - 10.))
+        self.assertEqual(P[-1], -10.0)
+        self.assertEqual(P[0], -110.0)
+
+    def testOtherScales(self):
+        mu = np.arange(N) % 611
+        for scale in [1.0, 2.0, 5.0]:
+            f, P = hp8565E.decode_trace(encode(mu), 0, 1e6, 0.0, scale)
+            np.testing.assert_allclose(P, scale * (mu / 60. - 10.))
+
+    def testLinearScale(self):
+        mu = np.arange(N)
+        f, P = hp8565E.decode_trace(encode(mu), 1e9, 2e9, -20.0, 0)
+        self.assertEqual(P[0], -np.inf)
+        self.assertAlmostEqual(P[600], -20.0)
+        self.assertAlmostEqual(P[300], -20.0 + 20 * np.log10(0.5))
+
+    def testExtraBytesIgnored(self):
+        mu = np.arange(N)
+        f, P = hp8565E.decode_trace(encode(mu) + '\r\n', 1e9, 2e9, 0.0, 10.0)
+        self.assertEqual(len(P), N)
+
+    def testShortTrace(self):
+        self.assertRaises(ValueError, hp8565E.decode_trace,
+                          encode(np.arange(N - 1)), 1e9, 2e9, 0.0, 10.0)
+
+
+class GetTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.mu = np.full(N, 300)
+        self.mu[123] = 590
+        self.dev = FakeGPIB(encode(self.mu))
+        self.server = hp8565E.HP8565EServer()
+        self.server.selectedDevice = lambda c: self.dev
+        self.c = {}
+
+    @inlineCallbacks
+    def testGetTrace(self):
+        f, P = yield self.server.get_trace(self.c, False)
+        self.assertEqual(self.dev.written, ['FA?', 'FB?', 'RL?', 'LG?', 'TDF B;TRA?;'])
+        self.assertEqual(len(f), N)
+        self.assertEqual(f[0]['Hz'], 1e9)
+        self.assertEqual(f[-1]['Hz'], 2e9)
+        np.testing.assert_allclose(P['dBm'], -10.0 + 10.0 * (self.mu / 60. - 10.))
+
+    @inlineCallbacks
+    def testSweepFirst(self):
+        yield self.server.get_trace(self.c)
+        self.assertEqual(self.dev.written[:4], ['ST?', 'SNGLS;TS;', 'DONE?', 'FA?'])
+
+    @inlineCallbacks
+    def testPeakSearch(self):
+        f, P = yield self.server.peak_search(self.c, False)
+        self.assertAlmostEqual(f['Hz'], 1e9 + 123 * 1e9 / (N - 1))
+        self.assertAlmostEqual(P['dBm'], -10.0 + 10.0 * (590 / 60. - 10.))
+
+    @inlineCallbacks
+    def testTraceSettings(self):
+        span = yield self.server.frequency_span(self.c)
+        self.assertEqual(span['Hz'], 1e9)
+        yield self.server.frequency_span(self.c, 2e6 * hp8565E.units.Hz)
+        yield self.server.resolution_bandwidth(self.c, 3e3 * hp8565E.units.Hz)
+        yield self.server.sweep_time(self.c, 0.05 * hp8565E.units.s)
+        self.assertEqual(self.dev.written[1:], ['SP 2000000', 'RB 3000', 'ST 0.050000SC'])
@@ -0,0 +1,116 @@
+"""
+Tests for the IV acquisition engine.
+
+The engine runs with FakeSampleSource, which paces the samples in real
+time like a hardware-timed DAQ and counts the samples lost when the
+reader falls behind.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import imp
+import os
+import sys
+import time
+
+import numpy as np
+
+from twisted.trial import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+ivAcquisition = imp.load_source('ivAcquisition',
+    os.path.join(REPO, 'LabRAD', 'Measurements', 'IV', 'ivAcquisition.py'))
+
+SAMP_RATE = 250000
+FREQ = 100
+
+
+class DAQError(Exception):
+    pass
+
+
+class FailingSource(ivAcquisition.FakeSampleSource):
+    """Raises a DAQ error after a number of reads."""
+    def __init__(self, reads, **kw):
+        ivAcquisition.FakeSampleSource.__init__(self, **kw)
+        self.reads = reads
+        self.stopped = 0
+
+    def readInto(self, data):
+        if self.reads == 0:
+            raise DAQError('buffer overflow')
+        self.reads -= 1
+        return ivAcquisition.FakeSampleSource.readInto(self, data)
+
+    def stop(self):
+        self.stopped += 1
+        ivAcquisition.FakeSampleSource.stop(self)
+
+
+class IVAcquisitionTest(unittest.TestCase):
+    def setUp(self):
+        self.wave = ivAcquisition.genWave(1., FREQ, SAMP_RATE)
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.stop()
+
+    def start(self, source):
+        engine = ivAcquisition.IVAcquisition(source)
+        self.engines.append(engine)
+        engine.configure(self.wave, SAMP_RATE, 0, 0)
+        return engine
+
+    def testNoDroppedSamples(self):
+        source = ivAcquisition.FakeSampleSource(gain=0.5)
+        engine = self.start(source)
+        time.sleep(1.)
+        engine.stop()
+        self.assertEqual(engine.samplesDropped, 0)
+        self.assertEqual(engine.samplesAcquired, source.position)
+        self.assertEqual(engine.samplesAcquired,
+                         engine.periodsAcquired * len(self.wave))
+        # The producer keeps up with the sampling rate.
+        self.assertTrue(engine.samplesAcquired >= 0.5 * SAMP_RATE,
+                        engine.samplesAcquired)
+        snap = engine.snapshot()
+        np.testing.assert_allclose(snap['voltages'], 0.5 * self.wave)
+
+    def testAverages(self):
+        engine = self.start(ivAcquisition.FakeSampleSource(gain=2., noise=0.01))
+        engine.startAveraging(20)
+        self.assertTrue(engine.waitAverages(10.))
+        snap = engine.snapshot(1000)
+        self.assertTrue(snap['done'])
+        self.assertEqual(snap['averages'], 20)
+        self.assertEqual(len(snap['voltages']), 834)
+        np.testing.assert_allclose(snap['voltages'], 2. * snap['wave'], atol=0.01)
+        self.assertEqual(engine.samplesDropped, 0)
+
+    def testWaitTimeout(self):
+        engine = self.start(ivAcquisition.FakeSampleSource())
+        engine.startAveraging(1000)
+        self.assertFalse(engine.waitAverages(0.05))
+        engine.cancelAveraging()
+        self.assertRaises(Exception, engine.waitAverages, 1.)
+
+    def testProducerError(self):
+        source = FailingSource(3)
+        engine = self.start(source)
+        engine.startAveraging(100)
+        self.assertRaises(DAQError, engine.waitAverages, 10.)
+        self.assertRaises(DAQError, engine.snapshot)
+        self.assertFalse(engine._thread.is_alive())
+        self.assertEqual(source.stopped, 1)
+        self.assertEqual(engine.periodsAcquired, 3)
+        engine.stop()
+        self.assertRaises(DAQError, engine.snapshot)
+        # A new configuration starts over.
+        source.reads = -1
+        engine.configure(self.wave, SAMP_RATE, 0, 0)
+        engine.startAveraging(2)
+        self.assertTrue(engine.waitAverages(10.))
+        self.assertNotEqual(engine.snapshot(), None)
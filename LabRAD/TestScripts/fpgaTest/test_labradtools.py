@@ -0,0 +1,245 @@
+"""
+Tests for the in-flight window and the statistics of
+pyle.util.labradtools.ContextCycler.
+
+The cycler sends packets to a fake server which runs at most `capacity`
+requests at once, each for `service` seconds, and runs the requests of
+one context in order, like a LabRAD server.  The cycler is driven from
+a separate thread, since it never blocks in the reactor thread.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import itertools
+import os
+import sys
+import threading
+import time
+from Queue import Queue
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'pyle'))
+from pyle.util.labradtools import ContextCycler
+
+
+class FakeFuture(object):
+    """The future returned by packet.send(wait=False)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        self.result = None
+        self.error = None
+
+    def addCallback(self, func, *args):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append((func, args))
+                return self
+        if self.error is None:
+            self.result = func(self.result, *args)
+        return self
+
+    def fire(self, result=None, error=None):
+        with self.lock:
+            callbacks, self.callbacks = self.callbacks, []
+        self.result, self.error = result, error
+        if error is None:
+            for func, args in callbacks:
+                self.result = func(self.result, *args)
+        with self.lock:
+            self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class FakePacket(object):
+    def __init__(self, server, context):
+        self.server = server
+        self.context = context
+        self.records = []
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.records.append((name, args))
+            return self
+        return record
+
+    def send(self, wait=True):
+        future = self.server.submit(self.context, self.records)
+        if wait:
+            return future.wait()
+        return future
+
+
+class FakeServer(object):
+    def __init__(self, capacity=4, service=0.005):
+        self.capacity = threading.Semaphore(capacity)
+        self.service = service
+        self.ids = itertools.count(1)
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.log = []   # (context, tag) in the order the requests ran
+        self.running = 0
+        self.maxRunning = 0
+
+    def context(self):
+        return (0, self.ids.next())
+
+    def packet(self, context=None):
+        return FakePacket(self, context)
+
+    def submit(self, context, records):
+        with self.lock:
+            if context not in self.queues:
+                self.queues[context] = Queue()
+                t = threading.Thread(target=self.serve, args=(self.queues[context],))
+                t.daemon = True
+                t.start()
+        future = FakeFuture()
+        self.queues[context].put((context, records, future))
+        return future
+
+    def serve(self, queue):
+        while True:
+            context, records, future = queue.get()
+            with self.capacity:
+                with self.lock:
+                    self.running += 1
+                    self.maxRunning = max(self.maxRunning, self.running)
+                time.sleep(self.service)
+                with self.lock:
+                    self.running -= 1
+                    for name, args in records:
+                        self.log.append((context, args[0] if args else None))
+            if 'fail' in [name for name, args in records]:
+                future.fire(error=Exception('failed'))
+            else:
+                future.fire(records)
+
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+
+    def __getitem__(self, name):
+        return self.server
+
+
+def inThread(func):
+    """Run func in a new thread and return its result."""
+    result = []
+    def run():
+        try:
+            result.append((True, func()))
+        except Exception as e:
+            result.append((False, e))
+    t = threading.Thread(target=run)
+    t.start()
+    t.join(60)
+    ok, value = result[0]
+    if not ok:
+        raise value
+    return value
+
+
+def send(cycler, tag, order_key=None, name='tag'):
+    # Settings called on a ManagedPacket return the wrapped packet, so
+    # they are not chained into send.
+    p = cycler.packet(order_key=order_key)
+    getattr(p, name)(tag)
+    return p.send(wait=False)
+
+
+class ContextCyclerTest(unittest.TestCase):
+    def cycler(self, server, **kw):
+        return ContextCycler('fake', cxn=FakeConnection(server), **kw)
+
+    def sendAll(self, cycler, n, key=None):
+        def func():
+            with cycler:
+                for k in range(n):
+                    send(cycler, k, key)
+            return cycler.stats()
+        return inThread(func)
+
+    def testFixedWindow(self):
+        server = FakeServer(capacity=10, service=0.005)
+        cycler = self.cycler(server, window=3, adaptive=False)
+        stats = self.sendAll(cycler, 50)
+        self.assertEqual((stats['sent'], stats['completed'], stats['failed']), (50, 50, 0))
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['max_in_flight'], 3)
+        self.assertEqual(stats['window'], 3)
+        self.assertTrue(server.maxRunning <= 3)
+        self.assertTrue(stats['blocked_time'] > 0)
+        self.assertEqual(stats['overflows'], 0)
+
+    def testAdaptiveWindow(self):
+        """The window shrinks towards what the server can run at once."""
+        server = FakeServer(capacity=4, service=0.005)
+        cycler = self.cycler(server, contexts=30, window=20, max_window=40)
+        stats = self.sendAll(cycler, 400)
+        self.assertEqual(stats['completed'], 400)
+        self.assertTrue(4 <= stats['window'] <= 10, stats['window'])
+        # the server stays busy
+        self.assertTrue(stats['throughput'] > 0.5 * 4 / server.service, stats['throughput'])
+
+    def testAdaptiveWindowGrows(self):
+        """The window grows while the server keeps up."""
+        server = FakeServer(capacity=30, service=0.02)
+        cycler = self.cycler(server, contexts=30, window=2, max_window=12)
+        stats = self.sendAll(cycler, 150)
+        self.assertTrue(stats['window'] >= 8, stats['window'])
+        self.assertTrue(stats['max_in_flight'] >= 8)
+
+    def testLatencyStats(self):
+        server = FakeServer(capacity=2, service=0.002)
+        cycler = self.cycler(server, window=4, adaptive=False, history=50)
+        stats = self.sendAll(cycler, 100)
+        self.assertEqual(len(cycler.latencies), 50)
+        self.assertTrue(server.service <= stats['latency_min'])
+        self.assertTrue(stats['latency_min'] <= stats['latency_p50'] <= stats['latency_p99']
+                        <= stats['latency_max'])
+        self.assertTrue(stats['latency_min'] <= stats['latency_mean'] <= stats['latency_max'])
+
+    def testNoRequests(self):
+        stats = self.cycler(FakeServer()).stats()
+        self.assertEqual(stats['sent'], 0)
+        self.assertEqual(stats['throughput'], 0.0)
+        self.assertFalse('latency_p50' in stats)
+
+    def testOrderKey(self):
+        server = FakeServer(capacity=8, service=0.001)
+        cycler = self.cycler(server, contexts=5, window=8)
+        def func():
+            with cycler:
+                for k in range(40):
+                    send(cycler, k, k % 2)
+                    send(cycler, None)
+        inThread(func)
+        for key in [0, 1]:
+            tags = [tag for ctx, tag in server.log if tag is not None and tag % 2 == key]
+            self.assertEqual(tags, range(key, 40, 2))
+            contexts = set(ctx for ctx, tag in server.log
+                           if tag is not None and tag % 2 == key)
+            self.assertEqual(len(contexts), 1)
+
+    def testFailedRequest(self):
+        server = FakeServer(capacity=4, service=0.002)
+        cycler = self.cycler(server, window=2, adaptive=False)
+        def func():
+            cycler.connect()
+            send(cycler, None, name='fail')
+            for k in range(5):
+                send(cycler, k)
+            cycler.disconnect()
+            return cycler.stats()
+        stats = inThread(func)
+        self.assertEqual((stats['sent'], stats['completed'], stats['failed']), (6, 5, 1))
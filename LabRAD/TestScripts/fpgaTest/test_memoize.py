@@ -0,0 +1,163 @@
+"""
+Tests for the LRU cache of pyle.util.memoize.
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'pyle'))
+from pyle.util import memoize
+from labrad.units import Value
+
+
+class Counter(object):
+    """A function which counts its calls."""
+    __name__ = 'counter'
+
+    def __init__(self, func=lambda *a, **kw: (a, sorted(kw.items()))):
+        self.func = func
+        self.calls = 0
+
+    def __call__(self, *a, **kw):
+        self.calls += 1
+        return self.func(*a, **kw)
+
+
+class MemoizeTest(unittest.TestCase):
+    def cached(self, g, f, args):
+        """The args whose results g has cached, looked up in the given order.
+
+        A miss caches its result, so the last arg should be a miss.
+        """
+        cached = []
+        for a in args:
+            calls = f.calls
+            g(a)
+            if f.calls == calls:
+                cached.append(a)
+        return cached
+
+    def testBareDecorator(self):
+        f = Counter(lambda x: x * 2)
+        g = memoize(f)
+        self.assertEqual([g(3), g(3), g(4)], [6, 6, 8])
+        self.assertEqual(f.calls, 2)
+        info = g.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 2, 2))
+        self.assertEqual(info['maxsize'], 1000)
+        self.assertAlmostEqual(info['hitRate'], 1 / 3.)
+
+    def testMaxsize(self):
+        f = Counter()
+        g = memoize(maxsize=3)(f)
+        for k in range(10):
+            g(k)
+        info = g.cache_info()
+        self.assertEqual((info['size'], info['evictions']), (3, 7))
+        self.assertEqual(self.cached(g, f, [9, 8, 7, 6]), [9, 8, 7])
+
+    def testLeastRecentlyUsedEvicted(self):
+        f = Counter()
+        g = memoize(maxsize=2)(f)
+        g(1)
+        g(2)
+        g(1)      # 2 is now the least recently used
+        g(3)
+        calls = f.calls
+        g(1)
+        self.assertEqual(f.calls, calls)
+        g(2)
+        self.assertEqual(f.calls, calls + 1)
+
+    def testUnbounded(self):
+        g = memoize(maxsize=None)(Counter())
+        for k in range(2000):
+            g(k)
+        self.assertEqual(g.cache_info()['size'], 2000)
+        self.assertEqual(g.cache_info()['evictions'], 0)
+
+    def testMaxbytes(self):
+        f = Counter(lambda n: np.zeros(n))
+        g = memoize(maxsize=None, maxbytes=8000)(f)
+        for n in range(100, 600, 100):   # 800, 1600, ... 4000 bytes
+            g(n)
+        info = g.cache_info()
+        self.assertTrue(info['bytes'] <= 8000)
+        self.assertEqual(info['bytes'], sum(v[1] for v in g._cache.values()))
+        # a result larger than maxbytes is returned but not kept
+        self.assertEqual(len(g(2000)), 2000)
+        self.assertEqual(g.cache_info()['size'], 2)
+        self.assertEqual(self.cached(g, f, [500, 400, 300]), [500, 400])
+
+    def testTtl(self):
+        f = Counter()
+        g = memoize(ttl=0.05)(f)
+        g(1)
+        g(1)
+        self.assertEqual(f.calls, 1)
+        time.sleep(0.1)
+        g(1)
+        self.assertEqual(f.calls, 2)
+        self.assertEqual(g.cache_info()['expired'], 1)
+        self.assertEqual(g.cache_info()['size'], 1)
+
+    def testKeys(self):
+        f = Counter()
+        g = memoize(f)
+        a = np.arange(10.0)
+        g(a, scale=2)
+        g(a.copy(), scale=2)                  # equal data
+        g(a[::-1][::-1], scale=2)             # a non-contiguous view
+        self.assertEqual(f.calls, 1)
+        g(a.astype(np.float32), scale=2)      # another dtype
+        g(a.reshape(2, 5), scale=2)           # another shape
+        g(a, scale=3)
+        self.assertEqual(f.calls, 4)
+        g([1, (2, 3)], {'x': [4]})
+        g([1, (2, 3)], {'x': [4]})
+        g((1, (2, 3)), {'x': [4]})            # a tuple is not a list
+        self.assertEqual(f.calls, 6)
+        g(Value(1, 'us'))
+        g(Value(1000, 'ns'))
+        self.assertEqual(f.calls, 8)
+
+    def testUncacheable(self):
+        f = Counter()
+        g = memoize(f)
+        class Unhashable(object):
+            __hash__ = None
+        x = Unhashable()
+        g(x)
+        g(x)
+        self.assertEqual(f.calls, 2)
+        info = g.cache_info()
+        self.assertEqual((info['uncacheable'], info['size']), (2, 0))
+
+    def testCacheClear(self):
+        f = Counter()
+        g = memoize(maxsize=2)(f)
+        for k in [1, 2, 3, 3]:
+            g(k)
+        g.cache_clear()
+        info = g.cache_info()
+        self.assertEqual((info['size'], info['hits'], info['misses'],
+                          info['evictions'], info['bytes']), (0, 0, 0, 0, 0))
+        g(3)
+        self.assertEqual(f.calls, 4)
+
+    def testRecursive(self):
+        @memoize(maxsize=10)
+        def fib(n):
+            return n if n < 2 else fib(n - 1) + fib(n - 2)
+        self.assertEqual(fib(30), 832040)
+        self.assertEqual(fib.cache_info()['size'], 10)
@@ -0,0 +1,282 @@
+"""
+Tests for the registry snapshots of pyle.registry.
+
+The snapshots talk to a fake registry which counts the packets it
+receives and sends change notifications to the subscribed contexts, like
+the LabRAD registry does.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import itertools
+import os
+import sys
+import threading
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'pyle'))
+from pyle import registry
+
+
+class Response(object):
+    """Packet answers by key or attribute; get is a setting name here."""
+    def __init__(self):
+        self.__dict__['ans'] = {}
+
+    def __getitem__(self, key):
+        return self.ans[key]
+
+    def __setitem__(self, key, value):
+        self.ans[key] = value
+
+    def __getattr__(self, name):
+        try:
+            return self.ans[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakePacket(object):
+    def __init__(self, server, context):
+        self.server = server
+        self.context = context
+        self.records = []
+
+    def __getattr__(self, name):
+        def record(*args, **kw):
+            self.records.append((name, args, kw.get('key')))
+            return self
+        return record
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+    def send(self):
+        return self.server.registry.send(self.server.cxn, self.context,
+                                         self.records)
+
+
+class FakeRegistryServer(object):
+    ID = 2
+
+    def __init__(self, registry, cxn):
+        self.registry = registry
+        self.cxn = cxn
+
+    def packet(self, context=None):
+        return FakePacket(self, context)
+
+
+class FakeConnection(object):
+    """A client connection; also stands in for its low-level _cxn."""
+    _contexts = itertools.count(1)
+
+    def __init__(self, registry):
+        self.registry = FakeRegistryServer(registry, self)
+        self.listeners = {}
+        self._cxn = self
+
+    def context(self):
+        return (0, self._contexts.next())
+
+    def addListener(self, func, source, ID, args=()):
+        self.listeners[ID] = (func, args)
+
+
+class FakeRegistry(object):
+    """A registry that counts packets and queues change notifications.
+
+    The notifications are delivered after each packet, or only when
+    deliver is called if autoDeliver is False.
+    """
+    def __init__(self):
+        self.root = ({}, {})
+        self.lock = threading.RLock()
+        self.dirs = {}          # current directory of each context
+        self.subscriptions = {} # directory -> [(cxn, ctx, ID)]
+        self.queue = []
+        self.packets = 0
+        self.gets = 0
+        self.autoDeliver = True
+        self.onSend = None
+
+    def node(self, path, create=False):
+        node = self.root
+        for name in path[1:]:
+            if name not in node[0]:
+                if not create:
+                    raise KeyError(name)
+                node[0][name] = ({}, {})
+                self.changed(path[:path.index(name)], name, True, True)
+            node = node[0][name]
+        return node
+
+    def changed(self, path, name, isDir, addOrChange):
+        for cxn, ctx, ID in self.subscriptions.get(tuple(path), []):
+            self.queue.append((cxn, ctx, ID, (name, isDir, addOrChange)))
+
+    def send(self, cxn, ctx, records):
+        with self.lock:
+            self.packets += 1
+            ans = Response()
+            path = self.dirs.get((cxn, ctx), [''])
+            for name, args, key in records:
+                result = None
+                if name == 'cd':
+                    path = list(args[0])
+                    if path[0] != '':
+                        path = [''] + path
+                    self.node(path, len(args) > 1 and args[1])
+                elif name == 'dir':
+                    dirs, keys = self.node(path)
+                    result = (sorted(dirs), sorted(keys))
+                elif name == 'get':
+                    self.gets += 1
+                    result = self.node(path)[1][args[0]]
+                elif name == 'set':
+                    self.node(path)[1][args[0]] = args[1]
+                    self.changed(path, args[0], False, True)
+                elif name == 'del':
+                    del self.node(path)[1][args[0]]
+                    self.changed(path, args[0], False, False)
+                elif name == 'rmdir':
+                    del self.node(path)[0][args[0]]
+                    self.changed(path, args[0], True, False)
+                elif name == 'notify_on_change':
+                    self.subscriptions.setdefault(tuple(path), []).append(
+                            (cxn, ctx, args[0]))
+                ans[name] = result
+                if key is not None:
+                    ans[key] = result
+            self.dirs[(cxn, ctx)] = path
+        if self.onSend is not None:
+            self.onSend()
+        if self.autoDeliver:
+            self.deliver()
+        return ans
+
+    def deliver(self):
+        with self.lock:
+            queue, self.queue = self.queue, []
+        for cxn, ctx, ID, data in queue:
+            func, args = cxn.listeners[ID]
+            func(ctx, data, *args)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.reg = FakeRegistry()
+        self.other = registry.RegistryWrapper(FakeConnection(self.reg), ['', 'Test'])
+        self.other['a'] = 1
+        self.other['b'] = 'x'
+        self.other['sub'] = {'c': 2.0, 'deeper': {'d': (1, 2)}}
+        self.snap = registry.RegistryWrapper(FakeConnection(self.reg), ['', 'Test']).snapshot()
+        self.reg.packets = self.reg.gets = 0
+
+    def read(self):
+        return (self.snap['a'], self.snap['b'], self.snap.sub['c'],
+                self.snap.sub.deeper['d'])
+
+    def testPrefetch(self):
+        self.assertEqual(self.read(), (1, 'x', 2.0, (1, 2)))
+        # one packet per level, one more to subscribe to all directories
+        self.assertEqual(self.reg.packets, 5)
+        self.read()
+        self.assertEqual(self.reg.packets, 5)
+
+    def testOwnWritesNoRefetch(self):
+        self.read()
+        self.snap['a'] = 5
+        self.snap.sub['c'] = 3.0
+        self.assertEqual(self.snap['a'], 5)
+        self.snap.flush()
+        packets, gets = self.reg.packets, self.reg.gets
+        self.assertEqual(self.read(), (5, 'x', 3.0, (1, 2)))
+        # the echoes are checked with a single packet, no full refetch
+        self.assertEqual(self.reg.packets - packets, 1)
+        self.assertEqual(self.reg.gets - gets, 2)
+        self.read()
+        self.assertEqual(self.reg.packets - packets, 1)
+
+    def testDelayedEchoes(self):
+        self.read()
+        self.reg.autoDeliver = False
+        for value in [5, 6, 7]:
+            self.snap['a'] = value
+            self.snap.flush()
+        self.reg.deliver()
+        packets = self.reg.packets
+        self.assertEqual(self.read()[0], 7)
+        self.assertEqual(self.reg.packets - packets, 1)
+
+    def testOtherClientWritesSameKey(self):
+        self.read()
+        self.reg.autoDeliver = False
+        self.snap['a'] = 5
+        self.snap.flush()
+        self.other['a'] = 8
+        self.reg.deliver()
+        # both notifications are for a key we wrote, but the value differs
+        self.assertEqual(self.snap['a'], 8)
+        self.reg.autoDeliver = True
+        self.snap['a'] = 9
+        self.snap.flush()
+        self.assertEqual(self.snap['a'], 9)
+        self.assertEqual(self.other['a'], 9)
+
+    def testPendingWriteWins(self):
+        self.read()
+        self.reg.autoDeliver = False
+        self.snap['a'] = 5
+        self.snap.flush()
+        self.other['a'] = 8
+        self.snap['a'] = 6
+        self.reg.deliver()
+        self.assertEqual(self.snap['a'], 6)
+        self.snap.flush()
+        self.assertEqual(self.other['a'], 6)
+
+    def testOtherChangesRefetch(self):
+        self.read()
+        self.other.sub['e'] = 4
+        packets = self.reg.packets
+        self.assertEqual(self.snap.sub['e'], 4)
+        self.assertEqual(self.reg.packets - packets, 4)
+        del self.other.sub['e']
+        self.assertFalse('e' in self.snap.sub)
+
+    def testChangeDuringFetch(self):
+        self.read()
+        self.other['e'] = 4
+        sends = []
+        def write():
+            # after the packet that gets the keys of the top level
+            sends.append(None)
+            if len(sends) == 2:
+                self.other['b'] = 'y'
+        self.reg.onSend = write
+        self.assertEqual(self.snap['e'], 4)
+        self.reg.onSend = None
+        self.assertEqual(self.snap['b'], 'y')
+
+    def testConcurrentNotifications(self):
+        """Reads stay consistent while the listener invalidates the copy."""
+        self.read()
+        stop = threading.Event()
+        errors = []
+        def writer():
+            for k in itertools.count():
+                if stop.is_set():
+                    break
+                self.other['b'] = str(k % 2)
+        t = threading.Thread(target=writer)
+        t.start()
+        try:
+            for k in range(500):
+                self.assertEqual(self.snap['a'], 1)
+                self.assertTrue(self.snap['b'] in ['x', '0', '1'])
+        finally:
+            stop.set()
+            t.join()
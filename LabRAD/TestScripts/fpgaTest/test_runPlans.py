@@ -0,0 +1,186 @@
+"""
+Tests for the run plans of the GHz FPGA server (RunPlan, dacDigest and
+adcDigest), run against the emulator (see emulatorFixture).
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import numpy as np
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture, GROUP, ghz_fpga_server
+
+BOARDS = [('DAC', 1), ('DAC', 2), ('ADC', 1)]
+NAMES = ['Emu DAC 1', 'Emu DAC 2', 'Emu ADC 1']
+MEMORY = [0x000000,                       # NoOp
+          0x800000,                       # SRAM start address
+          0xA00000 + 999,                 # SRAM end address
+          0xC00000,                       # call SRAM
+          0x300000 + 2499,                # delay
+          0x400000,                       # start timer
+          0x300064,                       # delay 100+1 cycles
+          0x400001,                       # stop timer
+          0xF00000]                       # branch back to start
+FILTER_LEN = 4096
+
+
+def sram(value):
+    return np.zeros(1000, dtype='<u4') + value
+
+
+class DigestTest(unittest.TestCase):
+    def testDacDigest(self):
+        info = {'mem': MEMORY, 'sram': sram(0), 'startDelay': 0}
+        digest = ghz_fpga_server.dacDigest(info)
+        self.assertEqual(digest, ghz_fpga_server.dacDigest(
+            {'mem': np.array(MEMORY, dtype='<u4'), 'sram': sram(0)}))
+        for change in [{'mem': MEMORY[:-1]}, {'sram': sram(1)}, {'startDelay': 1},
+                       {'sram': (sram(0), sram(0), 0)}]:
+            changed = dict(info, **change)
+            self.assertNotEqual(ghz_fpga_server.dacDigest(changed), digest, change)
+        # the two blocks of dual block SRAM are not run together
+        dual = dict(info, sram=(sram(0)[:500], sram(0)[500:], 3))
+        self.assertNotEqual(ghz_fpga_server.dacDigest(dual),
+                            ghz_fpga_server.dacDigest(dict(info, sram=(sram(0)[:499], sram(0)[499:], 3))))
+        self.assertNotEqual(ghz_fpga_server.dacDigest(dual),
+                            ghz_fpga_server.dacDigest(dict(info, sram=(sram(0)[:500], sram(0)[500:], 4))))
+
+    def testAdcDigest(self):
+        info = {'runMode': 'demodulate', 'startDelay': 0,
+                'filterFunc': np.zeros(FILTER_LEN, dtype='<u1'),
+                'filterStretchLen': 0, 'filterStretchAt': 0}
+        channels = {0: {'dPhi': 100, 'phi0': 7, 'sineAmp': 255, 'cosineAmp': 255}}
+        digest = ghz_fpga_server.adcDigest(info, channels)
+        # the lookup tables follow from the amplitudes
+        tables = {0: dict(channels[0], sine=np.arange(3), cosine=np.arange(3))}
+        self.assertEqual(ghz_fpga_server.adcDigest(info, tables), digest)
+        for change in [{'runMode': 'average'}, {'startDelay': 1},
+                       {'filterFunc': np.ones(FILTER_LEN, dtype='<u1')},
+                       {'filterStretchLen': 5}]:
+            self.assertNotEqual(ghz_fpga_server.adcDigest(dict(info, **change), channels),
+                                digest, change)
+        for changed in [{0: dict(channels[0], dPhi=101)}, {},
+                        {1: channels[0]}]:
+            self.assertNotEqual(ghz_fpga_server.adcDigest(info, changed), digest, changed)
+
+
+class RunPlanTest(unittest.TestCase):
+    timeout = 60
+    cacheSize = ghz_fpga_server.RUN_PLAN_CACHE_SIZE
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture(BOARDS)
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.em = self.fixture.emulator
+        self.bg = self.fpga.getBoardGroup(GROUP)
+        self.c = self.fixture.context()
+        for name in NAMES[:2]:
+            self.fpga.select_device(self.c, name)
+            self.fpga.dac_memory(self.c, MEMORY)
+            self.fpga.dac_sram(self.c, sram(0).tostring())
+        self.fpga.select_device(self.c, 'Emu ADC 1')
+        self.fpga.start_delay(self.c, 0)
+        self.fpga.adc_run_mode(self.c, 'average')
+        self.fpga.adc_filter_func(self.c, np.zeros(FILTER_LEN, dtype='<u1').tostring(), 0, 0)
+        self.fpga.sequence_boards(self.c, NAMES)
+        self.fpga.sequence_timing_order(self.c, NAMES[:2])
+        # count the plans made
+        self.made = 0
+        makeRunners = self.fpga.makeRunners
+        def counting(*args):
+            self.made += 1
+            return makeRunners(*args)
+        self.fpga.makeRunners = counting
+
+    def tearDown(self):
+        ghz_fpga_server.RUN_PLAN_CACHE_SIZE = self.cacheSize
+        return self.fixture.stop()
+
+    def setSram(self, value, name='Emu DAC 1'):
+        self.fpga.select_device(self.c, name)
+        self.fpga.dac_sram(self.c, sram(value).tostring())
+
+    def executionCount(self):
+        return self.fixture.board('DAC 1').executionCount
+
+    @inlineCallbacks
+    def testSameSequence(self):
+        first = yield self.fpga.sequence_run(self.c, 30, True)
+        second = yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(self.made, 1)
+        self.assertEqual(len(self.bg.runPlans), 1)
+        np.testing.assert_array_equal(np.asarray(first), np.asarray(second))
+        self.assertEqual(self.executionCount(), 30)
+
+    @inlineCallbacks
+    def testChangedSequence(self):
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.setSram(1)
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(self.made, 2)
+        # other run settings are part of the key too
+        self.fpga.sequence_timing_order(self.c, NAMES[:1])
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(self.made, 3)
+        self.fpga.sequence_timing_order(self.c, NAMES[:2])
+        self.setSram(0)
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(self.made, 3)
+        self.assertEqual(len(self.bg.runPlans), 3)
+
+    @inlineCallbacks
+    def testReps(self):
+        """A change of reps keeps the plan and rebuilds only the run packets."""
+        yield self.fpga.sequence_run(self.c, 30, True)
+        plan = self.bg.runPlans.values()[0]
+        loadPkts = dict(plan.loadPkts)
+        yield self.fpga.sequence_run(self.c, 60, True)
+        self.assertEqual(self.made, 1)
+        self.assertEqual(self.executionCount(), 60)
+        self.assertEqual(sorted(pkts[0] for pkts in plan.repsPkts.values()), [30, 60])
+        for page, pkts in loadPkts.items():
+            self.assertTrue(plan.loadPkts[page] is pkts)
+        # each run has its own runners
+        self.assertEqual([r.reps for r in plan.runners(90)], [90] * 3)
+        self.assertEqual([r.reps for r in plan.templates], [30] * 3)
+
+    @inlineCallbacks
+    def testLoadSkipped(self):
+        """A page still loaded with the plan is not loaded again."""
+        written = []
+        for k in range(2 * ghz_fpga_server.NUM_PAGES):
+            before = self.em.stats['written']
+            yield self.fpga.sequence_run(self.c, 30, True)
+            written.append(self.em.stats['written'] - before)
+        pages = ghz_fpga_server.NUM_PAGES
+        for k in range(pages):
+            self.assertTrue(written[pages + k] < written[k], written)
+
+    @inlineCallbacks
+    def testBound(self):
+        ghz_fpga_server.RUN_PLAN_CACHE_SIZE = 2
+        for value in range(3):
+            self.setSram(value)
+            yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(len(self.bg.runPlans), 2)
+        self.assertEqual(self.made, 3)
+        # the least recently used plan was dropped
+        self.setSram(0)
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(self.made, 4)
+        self.setSram(2)
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(self.made, 4)
+        # a size of 0 turns the cache off
+        ghz_fpga_server.RUN_PLAN_CACHE_SIZE = 0
+        self.bg.runPlans.clear()
+        yield self.fpga.sequence_run(self.c, 30, True)
+        yield self.fpga.sequence_run(self.c, 30, True)
+        self.assertEqual(self.made, 6)
+        self.assertEqual(len(self.bg.runPlans), 0)
@@ -0,0 +1,149 @@
+"""
+Tests for Run Sequence Streamed and Next Chunk of the GHz FPGA server,
+run against the emulator (see emulatorFixture).
+
+The results of all chunks of a streamed sequence are put together and
+compared with those of one Run Sequence with all reps.  Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import numpy as np
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial import unittest
+
+from emulatorFixture import EmulatorFixture, GROUP, emulator, ghz_fpga_server
+
+BOARDS = [('DAC', 1), ('DAC', 2), ('ADC', 1)]
+MEMORY = [0x000000,                       # NoOp
+          0x800000,                       # SRAM start address
+          0xA00000 + 999,                 # SRAM end address
+          0xC00000,                       # call SRAM
+          0x300000 + 2499,                # delay
+          0x400000,                       # start timer
+          0x300064,                       # delay 100+1 cycles
+          0x400001,                       # stop timer
+          0x400000,                       # start timer
+          0x300031,                       # delay 49+1 cycles
+          0x400001,                       # stop timer
+          0xF00000]                       # branch back to start
+FILTER_LEN = 4096
+DEMODS = [(0, 100, 7), (1, 200, -3)]
+TIMERS = emulator.analyzeMemory(MEMORY)[1] # [102, 51]
+
+
+def columns(ans):
+    """The per rep results of a run, one array per DAC or ADC channel."""
+    cols = []
+    for result in ans:
+        if isinstance(result, tuple):
+            cols.extend(np.asarray(x) for x in result) # I and Q
+        else:
+            cols.append(np.asarray(result))
+    return cols
+
+
+class StreamedTest(unittest.TestCase):
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.fixture = EmulatorFixture(BOARDS)
+        yield self.fixture.start()
+        self.fpga = self.fixture.fpga
+        self.bg = self.fpga.getBoardGroup(GROUP)
+        self.c = self.fixture.context()
+        for name in ['Emu DAC 1', 'Emu DAC 2']:
+            self.fpga.select_device(self.c, name)
+            self.fpga.dac_memory(self.c, MEMORY)
+            self.fpga.dac_sram(self.c, np.zeros(1000, dtype='<u4').tostring())
+        self.fpga.select_device(self.c, 'Emu ADC 1')
+        self.fpga.start_delay(self.c, 0)
+        self.fpga.adc_filter_func(self.c, np.zeros(FILTER_LEN, dtype='<u1').tostring(), 0, 0)
+        for chan, dPhi, phi0 in DEMODS:
+            self.fpga.adc_demod_frequency(self.c, chan, dPhi, phi0)
+            self.fpga.adc_trig_magnitude(self.c, chan, 255, 255)
+
+    def tearDown(self):
+        return self.fixture.stop()
+
+    def sequence(self, boards, timingOrder, adcMode=None):
+        if adcMode is not None:
+            self.fpga.select_device(self.c, 'Emu ADC 1')
+            self.fpga.adc_run_mode(self.c, adcMode)
+        self.fpga.sequence_boards(self.c, boards)
+        self.fpga.sequence_timing_order(self.c, timingOrder)
+
+    @inlineCallbacks
+    def streamed(self, reps, chunkReps):
+        """The results of each chunk of a streamed sequence."""
+        n = self.fpga.sequence_run_streamed(self.c, reps, chunkReps, True)
+        chunks = []
+        for k in range(n):
+            ans = yield self.fpga.sequence_next_chunk(self.c)
+            chunks.append(ans)
+        returnValue(chunks)
+
+    @inlineCallbacks
+    def assertSameAsSingleRun(self, reps, chunkReps):
+        single = yield self.fpga.sequence_run(self.c, reps, True)
+        chunks = yield self.streamed(reps, chunkReps)
+        expected = columns(single)
+        for k, col in enumerate(expected):
+            joined = np.concatenate([columns(chunk)[k] for chunk in chunks])
+            np.testing.assert_array_equal(joined, col)
+        returnValue(chunks)
+
+    @inlineCallbacks
+    def testTimingData(self):
+        self.sequence(['Emu DAC 1', 'Emu DAC 2'], ['Emu DAC 1', 'Emu DAC 2'])
+        chunks = yield self.assertSameAsSingleRun(300, 90)
+        self.assertEqual([np.asarray(chunk).shape for chunk in chunks],
+                         [(2, 180), (2, 180), (2, 180), (2, 60)])
+        self.assertEqual(np.asarray(chunks[0])[0, :4].tolist(), TIMERS * 2)
+        # the chunks and the single run share their run plan
+        self.assertEqual(len(self.bg.runPlans), 1)
+
+    @inlineCallbacks
+    def testDemod(self):
+        channels = ['Emu ADC 1::%d' % chan for chan, dPhi, phi0 in DEMODS]
+        self.sequence(['Emu DAC 1', 'Emu ADC 1'], channels + ['Emu DAC 1'], 'demodulate')
+        chunks = yield self.assertSameAsSingleRun(150, 60)
+        self.assertEqual([len(columns(chunk)[0]) for chunk in chunks], [60, 60, 30])
+
+    @inlineCallbacks
+    def testChunkRepsRounded(self):
+        """Both reps and chunkReps are rounded up to a multiple of 30."""
+        self.sequence(['Emu DAC 1'], ['Emu DAC 1'])
+        chunks = yield self.streamed(100, 50) # two chunks of 60 reps
+        self.assertEqual([np.asarray(chunk).shape[-1] for chunk in chunks], [60 * len(TIMERS)] * 2)
+        # reps that fit one chunk run as one chunk
+        chunks = yield self.streamed(60, ghz_fpga_server.STREAM_CHUNK_REPS)
+        self.assertEqual(len(chunks), 1)
+
+    @inlineCallbacks
+    def testMoreThanMaxReps(self):
+        self.sequence(['Emu DAC 1'], ['Emu DAC 1'])
+        reps = ghz_fpga_server.MAX_REPS + 30
+        chunks = yield self.streamed(reps, 30000)
+        self.assertEqual(len(chunks), 3)
+        joined = np.concatenate([np.asarray(chunk).ravel() for chunk in chunks])
+        self.assertEqual(len(joined), 2 * ghz_fpga_server.roundReps(reps, ['Emu DAC 1']))
+        self.assertEqual(set(joined), set(TIMERS))
+
+    @inlineCallbacks
+    def testNoChunksLeft(self):
+        self.sequence(['Emu DAC 1'], ['Emu DAC 1'])
+        self.assertRaises(Exception, self.fpga.sequence_next_chunk, self.c)
+        yield self.streamed(60, 30)
+        self.assertRaises(Exception, self.fpga.sequence_next_chunk, self.c)
+
+    @inlineCallbacks
+    def testRestart(self):
+        """Another streamed sequence drops the chunks not fetched yet."""
+        self.sequence(['Emu DAC 1'], ['Emu DAC 1'])
+        self.fpga.sequence_run_streamed(self.c, 300, 30, True)
+        yield self.fpga.sequence_next_chunk(self.c)
+        chunks = yield self.streamed(60, 60)
+        self.assertEqual([np.asarray(chunk).shape[-1] for chunk in chunks], [60 * len(TIMERS)])
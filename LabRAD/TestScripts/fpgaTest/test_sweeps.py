@@ -0,0 +1,251 @@
+"""
+Tests for collecting sweep data with pyle.dataking.sweeps.Collector, for
+the order of scheduled grid sweeps and for PipeTuner.
+
+The grid and tuner tests replace run, pmap and returnValue of sweeps with
+serial versions, so no qubit sequencer or pyle.pipeline is needed.
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'pyle'))
+from pyle.dataking import sweeps
+
+ROWS = 10**6
+
+
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testPipelineNotImported(self):
+        """pyle.pipeline is only imported when a sweep runs."""
+        self.assertFalse('pyle.pipeline' in sys.modules)
+
+    def testScalars(self):
+        c = sweeps.Collector(chunksize=4)
+        for k in range(10):
+            c.add(np.float64(k))
+        c.add(10)
+        data = c.data()
+        self.assertEqual(data.shape, (11, 1))
+        np.testing.assert_array_equal(data[:, 0], np.arange(11))
+
+    def testRowsAndBlocks(self):
+        c = sweeps.Collector(chunksize=3)
+        c.add([0, 1])
+        c.add(np.array([[2, 3], [4, 5], [6, 7], [8, 9]]))
+        c.add([10.5, 11])
+        data = c.data()
+        self.assertEqual(data.dtype, np.float64)
+        np.testing.assert_array_equal(data.ravel(), [0, 1, 2, 3, 4, 5, 6, 7,
+                                                     8, 9, 10.5, 11])
+        self.assertRaises(ValueError, c.add, [1, 2, 3])
+
+    def testEmpty(self):
+        self.assertEqual(sweeps.Collector().data().shape, (0, 0))
+
+    def testMillionRows(self):
+        rows = np.random.rand(ROWS, 3)
+        start = time.time()
+        data = sweeps.consume(iter(rows), noisy=False)
+        elapsed = time.time() - start
+        np.testing.assert_array_equal(data, rows)
+        print('\n%d rows collected in %.2f s' % (ROWS, elapsed))
+
+    def testMillionScalarsToFile(self):
+        filename = os.path.join(self.dir, 'data.bin')
+        values = np.arange(ROWS, dtype=float)
+        data = sweeps.consume(iter(values), noisy=False, chunksize=4096,
+                              filename=filename)
+        self.assertEqual(data.shape, (ROWS, 1))
+        np.testing.assert_array_equal(data[:, 0], values)
+        self.assertEqual(os.path.getsize(filename), ROWS * 8)
+        del data
+
+
+class Return(Exception):
+    """Raised by the serial returnValue."""
+    def __init__(self, value):
+        self.value = value
+
+
+def returnValue(value):
+    raise Return(value)
+
+
+def call(func, *args):
+    """Run a pipelined function, whose yields give back what they yield."""
+    gen = func(*args)
+    try:
+        ans = gen.next()
+        while True:
+            ans = gen.send(ans)
+    except Return as r:
+        return r.value
+
+
+class SerialTest(unittest.TestCase):
+    """Run sweeps one point at a time."""
+    def setUp(self):
+        self.saved = sweeps.run, sweeps.pmap, sweeps.returnValue
+        self.calls = []
+        def run(func, sweep, abortPrefix=[], collect=True, **kw):
+            rows = []
+            for val in sweep:
+                rows.append(np.atleast_2d(call(func, None, val)))
+                if len(rows) == getattr(self, 'abortAfter', None):
+                    break
+            return np.vstack(rows)
+        def pmap(func, iterable, size=10):
+            self.calls.append(size)
+            return (call(func, val) for val in iterable)
+        sweeps.run, sweeps.pmap, sweeps.returnValue = run, pmap, returnValue
+
+    def tearDown(self):
+        sweeps.run, sweeps.pmap, sweeps.returnValue = self.saved
+
+
+class GridScheduleTest(SerialTest):
+    def testGridOrder(self):
+        # the usual grid order
+        np.testing.assert_array_equal(sweeps.gridOrder([2, 3], [0, 1]), range(6))
+        # the second axis outermost
+        np.testing.assert_array_equal(sweeps.gridOrder([2, 3], [1, 0]),
+                                      [0, 3, 1, 4, 2, 5])
+        # ... with the first one serpentine
+        np.testing.assert_array_equal(sweeps.gridOrder([2, 3], [1, 0], 1),
+                                      [0, 3, 4, 1, 2, 5])
+
+    def testSerpentineSteps(self):
+        shape = [3, 4, 5]
+        order = sweeps.gridOrder(shape, [2, 0, 1], serpentine=2)
+        self.assertEqual(sorted(order), range(60))
+        points = np.array(np.unravel_index(order, shape)).T
+        steps = np.abs(np.diff(points, axis=0))
+        # each step moves the serpentine axes by at most one value
+        self.assertEqual(steps[:, 0].max(), 1)
+        self.assertEqual(steps[:, 1].max(), 1)
+        # the outermost axis changes only 4 times
+        self.assertEqual(np.count_nonzero(steps[:, 2]), 4)
+
+    def testSchedule(self):
+        axes = [(range(3), 'field'), (0.5, 'bias'), (range(4), 'freq'), (range(2), 'amp')]
+        order, sweep = sweeps.gridSchedule(axes, ['freq', 'field'])
+        points = list(sweep())
+        self.assertEqual(len(points), 24)
+        self.assertEqual([n for vals, swept, n in points], range(24))
+        alls = [vals for vals, swept, n in points]
+        self.assertTrue(all(a[1] == 0.5 for a in alls))
+        freqs = [a[2] for a in alls]
+        fields = [a[0] for a in alls]
+        self.assertEqual(freqs, sorted(freqs))
+        self.assertEqual(np.count_nonzero(np.diff(freqs)), 3)
+        self.assertTrue(np.abs(np.diff(fields)).max() <= 1)
+        self.assertEqual(np.count_nonzero(np.diff(fields)), 4 * 2)
+        self.assertRaises(ValueError, sweeps.gridSchedule, axes, ['flux'])
+
+    def testScheduleUnswept(self):
+        order, sweep = sweeps.gridSchedule([(1, 'a'), (2, 'b')], ['a'])
+        self.assertEqual(list(sweep()), [((1, 2), (), 0)])
+
+    def testScheduledGridData(self):
+        axes = [(range(3), 'field'), (range(4), 'freq'), (np.arange(2) / 2., 'amp')]
+        taken = []
+        def func(server, field, freq, amp):
+            taken.append((field, freq, amp))
+            return [field * 100 + freq * 10 + amp]
+        data = sweeps.grid(func, axes, expensive=['freq'])
+        plain = sweeps.grid(func, axes)
+        np.testing.assert_array_equal(data, plain)
+        self.assertEqual(data.shape, (24, 4))
+        freqs = [freq for field, freq, amp in taken[:24]]
+        self.assertEqual(freqs, sorted(freqs))
+
+    def testScheduledGridRows(self):
+        """Points returning several rows are kept together."""
+        axes = [(range(2), 'x'), (range(3), 'y')]
+        def func(server, x, y):
+            return [[x, y, k] for k in range(x + 1)]
+        data = sweeps.grid(func, axes, expensive=['y'])
+        np.testing.assert_array_equal(data, sweeps.grid(func, axes))
+        self.assertEqual(len(data), 3 + 6)
+
+    def testScheduledGridAborted(self):
+        axes = [(range(3), 'x'), (range(3), 'y')]
+        self.abortAfter = 4
+        data = sweeps.grid(lambda server, x, y: [x, y], axes, expensive=['y'])
+        # the first four points run, with y outermost, in grid order
+        self.assertEqual(data[:, :2].tolist(),
+                         [[0, 0], [0, 1], [1, 0], [2, 0]])
+
+
+class PipeTunerTest(SerialTest):
+    def testMakeTuner(self):
+        self.assertEqual(sweeps.makeTuner(10), None)
+        self.assertTrue(isinstance(sweeps.makeTuner('auto'), sweeps.PipeTuner))
+        tuner = sweeps.PipeTuner()
+        self.assertTrue(sweeps.makeTuner(tuner) is tuner)
+
+    def testGrowsWhileKeepingUp(self):
+        tuner = sweeps.PipeTuner(size=2, maxSize=16)
+        for k in range(5):
+            for n in range(tuner.size):
+                tuner.record(0.1)
+            tuner.adapt()
+        self.assertEqual(tuner.size, 16)
+
+    def testShrinksWhenQueued(self):
+        tuner = sweeps.PipeTuner(size=20)
+        tuner.baseLatency = 0.1
+        # mean latency 4x the base: 15 of the 20 calls are waiting
+        for n in range(20):
+            tuner.record(0.4)
+        tuner.adapt()
+        self.assertEqual(tuner.size, 20 - 15 + 2)
+        self.assertEqual(tuner.baseLatency, 0.1)
+        # no latencies, no change
+        tuner.adapt()
+        self.assertEqual(tuner.size, 7)
+
+    def testLimits(self):
+        tuner = sweeps.PipeTuner(size=4, minSize=5, maxSize=6)
+        tuner.record(0.1)
+        tuner.adapt()
+        self.assertEqual(tuner.size, 6)
+        tuner.record(1.0)
+        tuner.adapt()
+        self.assertEqual(tuner.size, 5)
+
+    def testSegments(self):
+        tuner = sweeps.PipeTuner(size=2, maxSize=8)
+        def func(x):
+            tuner.record(0.1)
+            yield None
+            returnValue(x * 2)
+        results = list(tuner.pmap(func, range(50)))
+        self.assertEqual(results, range(0, 100, 2))
+        # segments of 4 * size points: 8, 16, then 26 at the largest size
+        self.assertEqual(tuner.sizes, [2, 4, 8])
+        self.assertEqual(self.calls, [2, 4, 8])
+        tuner = sweeps.PipeTuner(size=2, segment=5)
+        list(tuner.pmap(func, range(12)))
+        self.assertEqual(len(tuner.sizes), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
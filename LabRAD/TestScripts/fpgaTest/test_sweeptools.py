@@ -0,0 +1,180 @@
+"""
+Tests for the array backed ranges of pyle.util.sweeptools.
+
+The ranges are compared with the generators they replaced, which are
+kept below as subclasses with the old __iter__, __getitem__ and __len__.
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'pyle'))
+from pyle.util import sweeptools
+from pyle.util.sweeptools import r, r2, lr, ArrayRange, Range, Range2, LogRange
+from labrad.units import Unit, Value
+
+
+class OldRange(Range):
+    def __iter__(self):
+        start, step, count = self._count()
+        for i in xrange(count):
+            yield start + step * i
+
+    def __getitem__(self, i):
+        start, step, count = self._count()
+        if i >= 0:
+            return start + step * i
+        elif i < 0:
+            return start + step * (count + i)
+
+    def __len__(self):
+        return self._count()[2]
+
+
+class OldRange2(Range2):
+    def __iter__(self):
+        info = self._count()
+        for start, step, count in info:
+            for i in xrange(count):
+                yield start + step * i
+
+    def __getitem__(self, i):
+        info = self._count()
+        if i>=0:
+            for start, step, count in info:
+                if i>count-1:
+                    i -= count
+                else:
+                    return start + step * i
+        elif i < 0:
+            for start, step, count in reversed(info):
+                if abs(i) >= count:
+                    i += count
+                else:
+                    return start + step * (count+i)
+
+    def __len__(self):
+        info = self._count()
+        return sum([info[i][2] for i in range(len(info))])
+
+
+class OldLogRange(LogRange):
+    def __iter__(self):
+        r = self._range()
+        for i in r:
+            yield i * self.unit
+
+    def __len__(self):
+        r = self._range()
+        return len(r)
+
+
+def same(a, b):
+    """Equal values of the same type, in the same unit."""
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, Value):
+        return a.unit == b.unit and a[a.unit] == b[b.unit]
+    return a == b
+
+
+class ArrayRangeTest(unittest.TestCase):
+    def assertSame(self, new, old):
+        self.assertEqual(len(new), len(old))
+        new, old = list(new), list(old)
+        for a, b in zip(new, old):
+            self.assertTrue(same(a, b), (a, b))
+
+    def testRange(self):
+        ns, us, GHz = Unit('ns'), Unit('us'), Unit('GHz')
+        cases = [(slice(0, 10, 1), None),
+                 (slice(0, 1, 0.1), None),
+                 (slice(10, 0, 1), None),             # the step takes its sign from the span
+                 (slice(10, 0, -0.5), None),
+                 (slice(0, 100, 2.5), ns),
+                 (slice(0 * ns, 1 * us, 50 * ns), ns),
+                 (slice(0 * ns, 1 * us, 50 * ns), us), # unit conversion
+                 (slice(6.5, 6.4, 0.001), GHz),
+                 (slice(3, 3, 1), ns)]                # one point
+        for rng, unit in cases:
+            new, old = Range(rng, unit), OldRange(rng, unit)
+            self.assertSame(new, old)
+            for i in range(-len(old), len(old)):
+                self.assertTrue(same(new[i], old[i]), (rng, i))
+
+    def testRandomRanges(self):
+        rand = np.random.RandomState(0)
+        ns = Unit('ns')
+        for k in range(200):
+            start, span = rand.uniform(-100, 100, 2)
+            step = rand.uniform(0.1, 10) * rand.choice([1, -1])
+            rng = slice(start, start + span, step)
+            self.assertSame(Range(rng, ns), OldRange(rng, ns))
+
+    def testRange2(self):
+        ns = Unit('ns')
+        cases = [[slice(0, 10, 1)],
+                 [slice(0, 10, 2), slice(10, 12, 0.5), slice(20, 0, 5)],
+                 [slice(0 * ns, 0.1 * Unit('us'), 10 * ns), slice(200, 300, 50)]]
+        for ranges in cases:
+            new, old = Range2(ranges, ns), OldRange2(ranges, ns)
+            self.assertSame(new, old)
+            for i in range(len(old)):
+                self.assertTrue(same(new[i], old[i]), (ranges, i))
+                # the old negative indices were off at the range boundaries
+                self.assertTrue(same(new[i - len(new)], new[i]))
+        self.assertEqual(OldRange2([slice(0, 10, 1)], ns)[-11], None)
+        added = r2[0:10:5, ns] + r2[100:110:5, ns]
+        self.assertSame(added, OldRange2(added.rangeList, ns))
+
+    def testLogRange(self):
+        for rng, unit in [(slice(1, 1000, 4), Unit('MHz')),
+                          (slice(1000, 1, 7), Unit('ns')),
+                          (slice(0.01, 10, 31), Unit('V'))]:
+            self.assertSame(LogRange(rng, unit), OldLogRange(rng, unit))
+
+    def testCreators(self):
+        self.assertTrue(isinstance(r[0:10:1, 'ns'], Range))
+        self.assertTrue(isinstance(r2[0:10:1, 'ns'], Range2))
+        self.assertTrue(isinstance(lr[1:10:3, 'ns'], LogRange))
+        self.assertSame(r[0:10:1], range(11))
+        np.testing.assert_array_equal(r[0:10:2, 'ns'].asarray(), [0, 2, 4, 6, 8, 10])
+
+    def testIndexError(self):
+        """Indexing past the end raises, where the old ranges extrapolated."""
+        rng = r[0:10:1, 'ns']
+        self.assertTrue(same(OldRange(rng.range, rng.unit)[11], Value(11, 'ns')))
+        self.assertRaises(IndexError, lambda: rng[11])
+        self.assertRaises(IndexError, lambda: rng[-12])
+        self.assertRaises(IndexError, lambda: r2[0:10:1, 'ns'][11])
+        self.assertRaises(IndexError, lambda: lr[1:10:3, 'ns'][3])
+        self.assertEqual([v['ns'] for v in rng[8:]], [8, 9, 10])
+
+    def testSlice(self):
+        rng = r[0:10:1, 'ns']
+        part = rng[2:8:3]
+        self.assertTrue(isinstance(part, ArrayRange))
+        self.assertSame(part, [Value(2.0, 'ns'), Value(5.0, 'ns')])
+
+    def testShuffle(self):
+        rng = r[0:99:1, 'ns']
+        shuffled = rng.shuffled(seed=1)
+        self.assertEqual(sorted(shuffled.asarray()), list(rng.asarray()))
+        for i in range(len(rng)):
+            self.assertTrue(same(shuffled[i], rng[shuffled.permutation[i]]))
+        # data taken over the shuffled range is put back in order
+        data = np.vstack([shuffled.asarray(), shuffled.asarray() ** 2]).T
+        ordered = sweeptools.unshuffle(data, shuffled)
+        np.testing.assert_array_equal(ordered[:, 0], rng.asarray())
+        np.testing.assert_array_equal(ordered, sweeptools.unshuffle(data))
+        # other iterables are shuffled as lists
+        self.assertEqual(sorted(sweeptools.shuffle(range(10))), range(10))
+        self.assertTrue(isinstance(sweeptools.shuffle(rng), ArrayRange))
@@ -0,0 +1,162 @@
+"""
+Tests for the pipeline telemetry of the GHz FPGA server: histogram accuracy
+and the order in which TimedLock hands out the lock.
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.join(REPO, 'LabRAD', 'Servers', 'Instruments', 'GHzBoards'))
+import telemetry
+
+
+class FakeClock(object):
+    """Stands in for the time module, so that wait times are exact."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class HistogramTest(unittest.TestCase):
+    def testBucketAccuracy(self):
+        h = telemetry.Histogram()
+        maxError = 1.0 / (2 * h.subBuckets)
+        values = 10**np.random.uniform(-6, 3, 10000)
+        for v in values:
+            i = h.index(v)
+            self.assertTrue(abs(h.value(i) - v) <= maxError * v * (1 + 1e-9), (v, h.value(i)))
+        # bucket boundaries
+        for octave in range(5):
+            v = h.lowest * 2**octave
+            self.assertEqual(h.index(v), 1 + octave * h.subBuckets)
+            self.assertEqual(h.index(v * (1 - 1e-12)), octave * h.subBuckets)
+
+    def testPercentiles(self):
+        h = telemetry.Histogram()
+        values = np.random.lognormal(np.log(1e-3), 1.0, 100000)
+        for v in values:
+            h.record(v)
+        maxError = 1.0 / (2 * h.subBuckets)
+        ordered = np.sort(values)
+        for q in [1, 10, 50, 90, 99, 99.9, 100]:
+            rank = max(int(np.ceil(q / 100.0 * len(values))), 1)
+            exact = ordered[rank - 1]
+            self.assertTrue(abs(h.percentile(q) - exact) <= maxError * exact * (1 + 1e-9),
+                            (q, h.percentile(q), exact))
+        self.assertEqual(h.count, len(values))
+        self.assertEqual(h.min, values.min())
+        self.assertEqual(h.max, values.max())
+        self.assertAlmostEqual(h.mean(), values.mean())
+        count, p50, p90, p99, maximum = h.summary()
+        self.assertEqual((count, p50, p90, p99, maximum),
+                         (h.count, h.percentile(50), h.percentile(90),
+                          h.percentile(99), h.max))
+
+    def testOutOfRange(self):
+        h = telemetry.Histogram(lowest=1e-3, highest=1.0)
+        for v in [0, 1e-4, 5e-4]:
+            h.record(v)
+        # values below lowest read as 0
+        self.assertEqual(h.percentile(100), 0.0)
+        for v in [10.0, 100.0, 1000.0]:
+            h.record(v)
+        # values above highest are in the top bucket, which reads as the maximum
+        self.assertEqual(h.index(100.0), len(h.counts) - 1)
+        self.assertEqual(h.percentile(100), 1000.0)
+        self.assertTrue(h.percentile(90) <= 1000.0)
+
+    def testFixedMemory(self):
+        h = telemetry.Histogram()
+        buckets = len(h.counts)
+        for v in np.random.exponential(1e-2, 100000):
+            h.record(v)
+        self.assertEqual(len(h.counts), buckets)
+        self.assertEqual(sum(h.counts), 100000)
+        h.reset()
+        self.assertEqual((h.count, sum(h.counts), h.min, h.max), (0, 0, None, None))
+        self.assertEqual(h.summary(), (0, 0.0, 0.0, 0.0, 0.0))
+
+
+class TimedLockTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = telemetry.time
+        telemetry.time = self.clock
+
+    def tearDown(self):
+        telemetry.time = self.time
+
+    def testFirstComeFirstServed(self):
+        lock = telemetry.TimedLock()
+        order = []
+        lock.acquire().addCallback(lambda dt: order.append('holder'))
+        for name in ['a', 'b', 'c', 'd']:
+            lock.acquire().addCallback(lambda dt, name=name: order.append(name))
+            self.clock.now += 1
+        self.assertEqual(order, ['holder'])
+        for i in range(4):
+            lock.release()
+        self.assertEqual(order, ['holder', 'a', 'b', 'c', 'd'])
+        self.assertTrue(lock.locked)
+        lock.release()
+        self.assertFalse(lock.locked)
+        self.assertRaises(AssertionError, lock.release)
+
+    def testNoBarging(self):
+        """A new request waits behind those already waiting, even during a handover."""
+        lock = telemetry.TimedLock()
+        order = []
+        def got(dt, name):
+            order.append(name)
+            if name == 'a':
+                # ask again while b is still waiting
+                lock.acquire().addCallback(got, 'a again')
+        lock.acquire()
+        lock.acquire().addCallback(got, 'a')
+        lock.acquire().addCallback(got, 'b')
+        for i in range(3):
+            lock.release()
+        self.assertEqual(order, ['a', 'b', 'a again'])
+
+    def testWaitTimes(self):
+        lock = telemetry.TimedLock()
+        waits = []
+        lock.acquire().addCallback(waits.append)
+        lock.acquire().addCallback(waits.append)
+        self.clock.now += 0.5
+        lock.acquire().addCallback(waits.append)
+        self.clock.now += 1.5
+        lock.release()
+        self.clock.now += 1.0
+        lock.release()
+        self.assertEqual(waits, [0, 2.0, 2.5])
+        self.assertEqual(list(lock.times), [0, 2.0, 2.5])
+        self.assertEqual(lock.histogram.count, 3)
+        self.assertAlmostEqual(lock.meanTime(), 1.5)
+        self.assertEqual(lock.histogram.max, 2.5)
+
+    def testManyWaiters(self):
+        lock = telemetry.TimedLock()
+        n = 100000
+        order = []
+        lock.acquire()
+        for i in xrange(n):
+            lock.acquire().addCallback(lambda dt, i=i: order.append(i))
+        for i in xrange(n):
+            lock.release()
+        self.assertEqual(order, range(n))
+        self.assertEqual(len(lock.times), telemetry.TIMES_TO_KEEP)
+        self.assertEqual(lock.histogram.count, n + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Tests for the timed-out execution pools of the measurement utilities.
+
+Run with
+>> python -m unittest discover -s LabRAD/TestScripts/fpgaTest -p "test_*.py"
+or with trial.
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+
+from twisted.trial import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+GENERAL = os.path.join(REPO, 'LabRAD', 'Measurements', 'General')
+if GENERAL not in sys.path:
+    sys.path.insert(0, GENERAL)
+import utilities
+
+
+class ProcessTimeoutPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = utilities.ProcessTimeoutPool(workers=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def testCall(self):
+        self.assertEqual(self.pool.call(5, abs, -3), 3)
+        self.assertRaises(ValueError, self.pool.call, 5, int, 'x')
+        self.assertEqual(self.pool.stats.summary()['errors'], 1)
+
+    def testTimeout(self):
+        self.assertRaises(utilities.TimeoutError, self.pool.call,
+                          0.2, time.sleep, 5)
+        # The hung worker was replaced.
+        self.assertEqual(self.pool.call(5, abs, -1), 1)
+        self.assertEqual(self.pool.stats.summary()['timeouts'], 1)
+
+    def testTimeoutWithSignalHandler(self):
+        """Hung workers are killed even if the parent handles SIGTERM, as a reactor does."""
+        self.pool.close()
+        old = signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        try:
+            self.pool = utilities.ProcessTimeoutPool(workers=1)
+        finally:
+            signal.signal(signal.SIGTERM, old)
+        self.assertRaises(utilities.TimeoutError, self.pool.call,
+                          0.2, time.sleep, 5)
+        self.assertEqual(self.pool.call(5, abs, -1), 1)
+
+    def testWaitForWorker(self):
+        """The wait for a busy worker counts against the timeout."""
+        busy = threading.Thread(target=self.pool.call, args=(5, time.sleep, 1))
+        busy.start()
+        time.sleep(0.2)
+        start = time.time()
+        self.assertRaises(utilities.TimeoutError, self.pool.call,
+                          0.2, abs, -1)
+        self.assertTrue(time.time() - start < 0.6)
+        busy.join()
+        self.assertEqual(self.pool.stats.summary()['timeouts'], 1)
+        self.assertEqual(self.pool.call(5, abs, -1), 1)